@@ -1,6 +1,49 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
+# Các management command không phục vụ request => không cần warm runtime
+_NON_SERVING_COMMANDS = {
+    "check",
+    "collectstatic",
+    "createsuperuser",
+    "dbshell",
+    "makemigrations",
+    "migrate",
+    "shell",
+    "showmigrations",
+    "test",
+}
+
+
+def _should_warm_runtime() -> bool:
+    """Chỉ warm khi process thực sự phục vụ request (runserver, gunicorn, uvicorn...)."""
+    if os.path.basename(sys.argv[0]) != "manage.py" or len(sys.argv) < 2:
+        return True
+    command = sys.argv[1]
+    if command in _NON_SERVING_COMMANDS:
+        return False
+    if command == "runserver":
+        # Autoreloader chạy 2 process; chỉ warm trong process con phục vụ request
+        return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+    return True
+
 
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        from django.conf import settings
+
+        if not getattr(settings, "AGENT_RUNTIME_WARMUP", True):
+            return
+        if not _should_warm_runtime():
+            return
+
+        from runtime import get_runtime
+
+        # Warm trong background để server nhận request ngay; readiness endpoint
+        # chỉ báo healthy khi warm-up hoàn tất
+        get_runtime().warm_in_background()
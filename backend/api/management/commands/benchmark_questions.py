@@ -0,0 +1,326 @@
+"""
+Benchmark độ trễ và độ chính xác của workflow trên bộ câu hỏi test.txt.
+
+Mỗi câu hỏi chạy qua run_djia_graph; report JSON ghi lại cho từng câu hỏi:
+thời gian (wall time, từng node), số lời gọi LLM, có dùng SQL mẫu không và
+câu trả lời có khớp đáp án mong đợi không (graphs.question_suite.check_answer).
+Report có thể so với report của commit trước bằng --compare.
+
+Usage:
+    python manage.py benchmark_questions
+    python manage.py benchmark_questions --section "TEST SQL TEMPLATE" --repeat 3
+    LLM_BACKEND=replay python manage.py benchmark_questions --output new.json --compare base.json
+
+Answer cache bị tắt trong lúc benchmark (trừ khi có --answer-cache) để mọi
+câu hỏi chạy lại toàn bộ workflow.
+
+LLM_BACKEND=synthetic chỉ trả response đúng định dạng (không đúng nội dung),
+nên report chỉ có độ trễ: câu trả lời không được chấm, accuracy là null.
+"""
+
+import json
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+
+from config import PROJECT_ROOT, TEST_QUESTIONS_FILE, LLM_FAKE_LATENCY
+from graphs.djia_graph import run_djia_graph
+from graphs.question_suite import SuiteQuestion, check_answer, load_question_suite
+from nodes.llm import get_backend
+from runtime import get_runtime
+
+BENCHMARK_DIR = PROJECT_ROOT / "data" / "benchmarks"
+
+# Số dòng tối đa của df dùng để so đáp án
+_MAX_CHECK_ROWS = 50
+
+# Các chỉ số trong summary được so khi --compare (True = càng cao càng tốt)
+_COMPARED_METRICS = {
+    "success_rate": True,
+    "accuracy": True,
+    "template_hit_rate": True,
+    "avg_llm_calls": False,
+    "classifier_llm_fallback_rate": False,
+    "latency_p50_ms": False,
+    "latency_p95_ms": False,
+    "latency_mean_ms": False,
+}
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return round(float(np.percentile(values, q)), 2) if values else 0.0
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=PROJECT_ROOT,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def _result_values(result: Dict[str, Any]) -> List[Any]:
+    df = result.get("df")
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return []
+    return list(df.head(_MAX_CHECK_ROWS).to_numpy().ravel())
+
+
+def _run_question(item: SuiteQuestion, repeat: int, grade: bool = True) -> Dict[str, Any]:
+    runs_ms = []
+    result: Dict[str, Any] = {}
+    error = None
+    for attempt in range(repeat):
+        started = time.perf_counter()
+        try:
+            outcome = run_djia_graph(item.question)
+        except Exception as e:
+            outcome, error = {}, str(e)
+        runs_ms.append(round((time.perf_counter() - started) * 1000, 2))
+        # Metrics/câu trả lời lấy từ lần chạy đầu
+        if attempt == 0:
+            result = outcome
+
+    metrics = result.get("metrics") or {}
+    return {
+        "label": item.label,
+        "section": item.section,
+        "category": item.category,
+        "number": item.number,
+        "question": item.question,
+        "expected": item.answer,
+        "answer": result.get("answer"),
+        "correct": check_answer(item, result.get("answer"), _result_values(result))
+        if grade
+        else None,
+        "success": bool(result.get("success")),
+        "error": error or result.get("error"),
+        "used_sample": bool(result.get("used_sample")),
+        "sql_source": result.get("sql_source"),
+        "sql_repairs": result.get("sql_repairs", 0),
+        "sql_fingerprint": result.get("sql_fingerprint"),
+        "is_general_question": bool(result.get("is_general_question")),
+        "classifier_source": (result.get("classification") or {}).get("source"),
+        "sql": result.get("actual_sql") or result.get("sql"),
+        "wall_ms": statistics.median(runs_ms),
+        "runs_ms": runs_ms,
+        "llm_calls": metrics.get("llm_calls", 0),
+        "llm_cache_hits": metrics.get("llm_cache_hits", 0),
+        "llm_ms": metrics.get("llm_ms", 0.0),
+        "prompt_tokens": metrics.get("prompt_tokens", 0),
+        "response_tokens": metrics.get("response_tokens", 0),
+        "sql_queries": metrics.get("sql_queries", 0),
+        "sql_ms": metrics.get("sql_ms", 0.0),
+        "nodes": {m["node"]: m["wall_ms"] for m in metrics.get("nodes", [])},
+    }
+
+
+def _summarize(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    latencies = [row["wall_ms"] for row in rows]
+    graded = [row for row in rows if row["correct"] is not None]
+    sql_rows = [row for row in rows if not row["is_general_question"]]
+    return {
+        "questions": len(rows),
+        "succeeded": sum(row["success"] for row in rows),
+        "success_rate": round(sum(row["success"] for row in rows) / len(rows), 4)
+        if rows
+        else 0.0,
+        "graded": len(graded),
+        "correct": sum(bool(row["correct"]) for row in graded),
+        "accuracy": round(sum(bool(row["correct"]) for row in graded) / len(graded), 4)
+        if graded
+        else None,
+        "template_hit_rate": round(
+            sum(row["used_sample"] for row in sql_rows) / len(sql_rows), 4
+        )
+        if sql_rows
+        else 0.0,
+        "classifier_llm_fallback_rate": round(
+            sum(row["classifier_source"] == "llm" for row in rows) / len(rows), 4
+        )
+        if rows
+        else 0.0,
+        "llm_calls": sum(row["llm_calls"] for row in rows),
+        "avg_llm_calls": round(sum(row["llm_calls"] for row in rows) / len(rows), 2)
+        if rows
+        else 0.0,
+        "latency_mean_ms": round(statistics.fmean(latencies), 2) if latencies else 0.0,
+        "latency_p50_ms": _percentile(latencies, 50),
+        "latency_p90_ms": _percentile(latencies, 90),
+        "latency_p95_ms": _percentile(latencies, 95),
+        "latency_max_ms": round(max(latencies), 2) if latencies else 0.0,
+    }
+
+
+def _summarize_nodes(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    per_node: Dict[str, List[float]] = {}
+    for row in rows:
+        for node, wall_ms in row["nodes"].items():
+            per_node.setdefault(node, []).append(wall_ms)
+    return {
+        node: {
+            "calls": len(values),
+            "mean_ms": round(statistics.fmean(values), 2),
+            "p50_ms": _percentile(values, 50),
+            "p95_ms": _percentile(values, 95),
+        }
+        for node, values in per_node.items()
+    }
+
+
+class Command(BaseCommand):
+    help = "Chạy bộ câu hỏi test.txt qua workflow và ghi report độ trễ/độ chính xác (JSON)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--questions", help="File câu hỏi (mặc định test.txt)")
+        parser.add_argument("--section", help='Chỉ chạy section này, ví dụ "TEST SQL TEMPLATE"')
+        parser.add_argument("--limit", type=int, help="Số câu hỏi tối đa")
+        parser.add_argument(
+            "--repeat", type=int, default=1, help="Số lần chạy mỗi câu hỏi (lấy median)"
+        )
+        parser.add_argument("--output", help="File report JSON (mặc định data/benchmarks/)")
+        parser.add_argument("--compare", help="Report cũ để so sánh")
+        parser.add_argument(
+            "--max-slowdown",
+            type=float,
+            help="Báo lỗi nếu latency p50 tăng quá tỷ lệ này so với --compare (ví dụ 1.2)",
+        )
+        parser.add_argument(
+            "--answer-cache",
+            action="store_true",
+            help="Giữ answer cache (mặc định tắt để đo toàn bộ workflow)",
+        )
+
+    def handle(self, *args, **options):
+        items = load_question_suite(options["questions"] or TEST_QUESTIONS_FILE)
+        if options["section"]:
+            items = [item for item in items if item.section == options["section"]]
+        if options["limit"]:
+            items = items[: options["limit"]]
+        if not items:
+            raise CommandError("Không có câu hỏi nào để chạy.")
+
+        runtime = get_runtime()
+        # Warm trước để câu hỏi đầu tiên không phải trả chi phí khởi tạo
+        runtime.warm()
+        cache = runtime.answer_cache
+        if cache is not None:
+            cache.enabled = options["answer_cache"]
+
+        # Response synthetic không đúng nội dung: không chấm câu trả lời
+        grade = get_backend() != "synthetic"
+        self.stdout.write(f"Chạy {len(items)} câu hỏi (LLM backend: {get_backend()})")
+        if not grade:
+            self.stdout.write(
+                self.style.WARNING("LLM_BACKEND=synthetic: chỉ đo độ trễ, không chấm độ chính xác")
+            )
+        rows = []
+        started = time.perf_counter()
+        for item in items:
+            row = _run_question(item, max(1, options["repeat"]), grade)
+            rows.append(row)
+            mark = {True: "✓", False: "✗", None: "-"}[row["correct"]]
+            self.stdout.write(
+                f"{mark} [{row['wall_ms']:9.1f} ms, {row['llm_calls']} LLM] {item.label}"
+            )
+
+        report = {
+            "meta": {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "git_commit": _git_commit(),
+                "llm_backend": get_backend(),
+                "llm_fake_latency": LLM_FAKE_LATENCY,
+                "answer_cache": options["answer_cache"],
+                "repeat": options["repeat"],
+                "total_seconds": round(time.perf_counter() - started, 2),
+            },
+            "summary": _summarize(rows),
+            "nodes": _summarize_nodes(rows),
+            "questions": rows,
+        }
+
+        output = Path(
+            options["output"]
+            or BENCHMARK_DIR
+            / f"{datetime.now():%Y%m%d-%H%M%S}_{report['meta']['git_commit'] or 'nogit'}.json"
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(
+            json.dumps(report, ensure_ascii=False, indent=2, default=str), encoding="utf-8"
+        )
+
+        self._print_summary(report["summary"])
+        self.stdout.write(f"Report: {output}")
+
+        if options["compare"]:
+            self._compare(report, options["compare"], options["max_slowdown"])
+
+    def _print_summary(self, summary: Dict[str, Any]) -> None:
+        accuracy = "n/a" if summary["accuracy"] is None else f"{summary['accuracy']:.1%}"
+        self.stdout.write(
+            f"\nThành công: {summary['succeeded']}/{summary['questions']}  "
+            f"Đúng: {summary['correct']}/{summary['graded']} ({accuracy})  "
+            f"SQL mẫu: {summary['template_hit_rate']:.1%}  "
+            f"LLM calls: {summary['llm_calls']}\n"
+            f"Latency p50/p95/max: {summary['latency_p50_ms']:.0f} / "
+            f"{summary['latency_p95_ms']:.0f} / {summary['latency_max_ms']:.0f} ms"
+        )
+
+    def _compare(self, report: Dict[str, Any], baseline_path: str, max_slowdown) -> None:
+        try:
+            baseline = json.loads(Path(baseline_path).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Không đọc được report cũ {baseline_path}: {e}")
+
+        self.stdout.write(
+            f"\nSo với {baseline_path} (commit {baseline['meta'].get('git_commit')}):"
+        )
+        before, after = baseline["summary"], report["summary"]
+        for metric, higher_is_better in _COMPARED_METRICS.items():
+            old, new = before.get(metric, 0.0), after.get(metric, 0.0)
+            if old is None or new is None:
+                # accuracy của report không chấm (LLM_BACKEND=synthetic)
+                self.stdout.write(f"  {metric:<28} {str(old):>12} -> {str(new):>12}  (n/a)")
+                continue
+            change = f"{(new - old) / old:+.1%}" if old else "n/a"
+            worse = new < old if higher_is_better else new > old
+            self.stdout.write(
+                f"  {metric:<28} {old:>12} -> {new:>12}  ({change}){'  ⚠' if worse else ''}"
+            )
+
+        # Câu hỏi đúng ở report cũ nhưng sai ở report mới
+        previously_correct = {
+            row["label"] for row in baseline["questions"] if row.get("correct") is True
+        }
+        regressions = [
+            row["label"]
+            for row in report["questions"]
+            if row["label"] in previously_correct and row["correct"] is False
+        ]
+        for label in regressions:
+            self.stdout.write(self.style.ERROR(f"  Sai (trước đây đúng): {label}"))
+
+        problems = []
+        if regressions:
+            problems.append(f"{len(regressions)} câu hỏi trả lời sai so với trước")
+        old_p50 = before.get("latency_p50_ms") or 0.0
+        if max_slowdown and old_p50 and after["latency_p50_ms"] > old_p50 * max_slowdown:
+            problems.append(
+                f"latency p50 tăng {after['latency_p50_ms'] / old_p50:.2f}x "
+                f"(giới hạn {max_slowdown}x)"
+            )
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write(self.style.SUCCESS("Không có regression."))
@@ -0,0 +1,74 @@
+"""
+Thêm SQL do LLM sinh đã chạy tốt nhiều lần vào sql_samples.sql.
+
+Đọc các SQL execute_sql đã ghi lại (TEMPLATE_CANDIDATES_FILE), gom theo SQL
+đã chuẩn hoá và thêm các SQL được ít nhất --min-questions câu hỏi khác nhau
+dùng thành SQL mẫu mới (xem nodes/template_promotion.py). Có thể chạy định kỳ
+(cron) để bộ SQL mẫu lớn dần theo traffic thật.
+
+Usage:
+    python manage.py promote_templates --dry-run
+    python manage.py promote_templates --min-questions 5
+"""
+
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from config import SQL_SAMPLES_FILE, TEMPLATE_CANDIDATES_FILE, TEMPLATE_PROMOTION_MIN_QUESTIONS
+from nodes.template_promotion import (
+    append_templates,
+    cluster_candidates,
+    format_template,
+    load_candidates,
+    prune_candidates,
+    select_promotions,
+)
+from nodes.template_registry import parse_templates
+
+
+class Command(BaseCommand):
+    help = "Thêm SQL do LLM sinh đã được nhiều câu hỏi dùng thành công vào sql_samples.sql."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--candidates", help="File JSONL candidate (mặc định TEMPLATE_CANDIDATES_FILE)")
+        parser.add_argument("--samples", help="File SQL mẫu (mặc định sql_samples.sql)")
+        parser.add_argument(
+            "--min-questions",
+            type=int,
+            default=TEMPLATE_PROMOTION_MIN_QUESTIONS,
+            help="Số câu hỏi khác nhau tối thiểu của một SQL",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Chỉ in các template sẽ thêm"
+        )
+        parser.add_argument(
+            "--keep-candidates",
+            action="store_true",
+            help="Không xoá candidate đã promote khỏi file JSONL",
+        )
+
+    def handle(self, *args, **options):
+        candidates_path = Path(options["candidates"] or TEMPLATE_CANDIDATES_FILE)
+        samples_path = Path(options["samples"] or SQL_SAMPLES_FILE)
+
+        clusters = cluster_candidates(load_candidates(candidates_path))
+        templates = (
+            parse_templates(samples_path.read_text(encoding="utf-8"))
+            if samples_path.exists()
+            else []
+        )
+        selected = select_promotions(clusters, templates, options["min_questions"])
+        self.stdout.write(
+            f"{len(clusters)} SQL khác nhau trong {candidates_path}, "
+            f"{len(selected)} đủ điều kiện (>= {options['min_questions']} câu hỏi)"
+        )
+        for cluster in selected:
+            self.stdout.write(f"\n[{cluster.count} câu hỏi]\n{format_template(cluster)}")
+
+        if options["dry_run"] or not selected:
+            return
+        added = append_templates(samples_path, selected)
+        if not options["keep_candidates"]:
+            prune_candidates(candidates_path, [cluster.key for cluster in selected])
+        self.stdout.write(self.style.SUCCESS(f"\nĐã thêm {added} SQL mẫu vào {samples_path}"))
@@ -1,3 +1,226 @@
-from django.test import TestCase
+"""
+Unit test cho các bước xử lý SQL không cần database/LLM:
+sql_rewriter (khoảng date sargable), sql_validator.check_sql và
+sql_normalizer.normalize_llm_sql.
 
-# Create your tests here.
+Chạy: python manage.py test api
+"""
+
+from django.test import SimpleTestCase
+
+from nodes.sql_normalizer import normalize_llm_sql
+from nodes.sql_rewriter import rewrite_date_predicates
+from nodes.sql_validator import check_sql
+
+_RANGE = "(date >= CAST(:date_from_1 AS DATE) AND date < CAST(:date_to_1 AS DATE))"
+
+_QUARTER_CASE = (
+    "CASE"
+    " WHEN :quarter = 1 THEN TO_CHAR(date, 'MM') IN ('01', '02', '03')"
+    " WHEN :quarter = 2 THEN TO_CHAR(date, 'MM') IN ('04', '05', '06')"
+    " WHEN :quarter = 3 THEN TO_CHAR(date, 'MM') IN ('07', '08', '09')"
+    " WHEN :quarter = 4 THEN TO_CHAR(date, 'MM') IN ('10', '11', '12')"
+    " END"
+)
+
+
+class SqlRewriterTests(SimpleTestCase):
+    PARAMS = {"year": "2024", "month": "03", "quarter": "2", "start_month": "01", "end_month": "06"}
+
+    # (điều kiện WHERE, date_from_1, date_to_1)
+    REWRITTEN = [
+        ("TO_CHAR(date, 'YYYY') = :year", "2024-01-01", "2025-01-01"),
+        ("EXTRACT(YEAR FROM date) = 2023", "2023-01-01", "2024-01-01"),
+        ("DATE_PART('year', date) = '2022'", "2022-01-01", "2023-01-01"),
+        (
+            "TO_CHAR(date, 'YYYY') = :year AND TO_CHAR(date, 'MM') = :month",
+            "2024-03-01",
+            "2024-04-01",
+        ),
+        (
+            "TO_CHAR(date, 'YYYY') = :year AND EXTRACT(MONTH FROM date) = 12",
+            "2024-12-01",
+            "2025-01-01",
+        ),
+        (
+            "TO_CHAR(date, 'YYYY') = :year"
+            " AND TO_CHAR(date, 'MM') BETWEEN :start_month AND :end_month",
+            "2024-01-01",
+            "2024-07-01",
+        ),
+        (
+            "TO_CHAR(date, 'YYYY') = :year AND TO_CHAR(date, 'MM') IN ('01', '02', '03')",
+            "2024-01-01",
+            "2024-04-01",
+        ),
+        (f"TO_CHAR(date, 'YYYY') = :year AND {_QUARTER_CASE}", "2024-04-01", "2024-07-01"),
+    ]
+
+    # Điều kiện không đổi nghĩa được thành khoảng date: giữ nguyên
+    UNCHANGED = [
+        "TO_CHAR(date, 'YYYY') = :year - 1",
+        "EXTRACT(YEAR FROM date) = :year::int",
+        "TO_CHAR(date, 'YYYY') = :missing",
+        "TO_CHAR(date, 'YYYY-MM') = :year",
+    ]
+
+    def test_rewrites_to_half_open_range(self):
+        for condition, date_from, date_to in self.REWRITTEN:
+            with self.subTest(condition=condition):
+                sql, params = rewrite_date_predicates(
+                    f"SELECT close FROM prices WHERE {condition}", self.PARAMS
+                )
+                self.assertEqual(sql, f"SELECT close FROM prices WHERE {_RANGE}")
+                self.assertEqual(params["date_from_1"], date_from)
+                self.assertEqual(params["date_to_1"], date_to)
+
+    def test_keeps_table_alias(self):
+        sql, _ = rewrite_date_predicates(
+            "SELECT close FROM prices p WHERE EXTRACT(YEAR FROM p.date) = 2023", {}
+        )
+        self.assertIn("p.date >= CAST(:date_from_1 AS DATE)", sql)
+        self.assertIn("p.date < CAST(:date_to_1 AS DATE)", sql)
+
+    def test_non_consecutive_months_keep_month_filter(self):
+        sql, params = rewrite_date_predicates(
+            "SELECT close FROM prices WHERE TO_CHAR(date, 'YYYY') = :year"
+            " AND TO_CHAR(date, 'MM') IN ('01', '03')",
+            self.PARAMS,
+        )
+        # Chỉ điều kiện năm được viết lại, lọc tháng giữ nguyên
+        self.assertEqual(
+            sql, f"SELECT close FROM prices WHERE {_RANGE} AND TO_CHAR(date, 'MM') IN ('01', '03')"
+        )
+        self.assertEqual(params["date_to_1"], "2025-01-01")
+
+    def test_unchanged(self):
+        for condition in self.UNCHANGED:
+            with self.subTest(condition=condition):
+                sql = f"SELECT close FROM prices WHERE {condition}"
+                self.assertEqual(rewrite_date_predicates(sql, self.PARAMS), (sql, self.PARAMS))
+
+
+class CheckSqlTests(SimpleTestCase):
+    PARAMS = {"ticker": "AAPL", "year": None}
+
+    # (SQL, thông báo lỗi chứa, blocked)
+    INVALID = [
+        ("DELETE FROM prices", "Chỉ được dùng câu lệnh SELECT", True),
+        ("UPDATE prices SET close = 0", "Chỉ được dùng câu lệnh SELECT", True),
+        (
+            "WITH d AS (DELETE FROM prices RETURNING *) SELECT * FROM d",
+            "Chỉ được dùng câu lệnh SELECT",
+            True,
+        ),
+        ("SELECT 1; SELECT 2", "Chỉ được có đúng một câu lệnh SQL", True),
+        ("SELECT close FROM prices; DROP TABLE prices", "Chỉ được có đúng một câu lệnh SQL", True),
+        ("SELECT * FROM nope", "Bảng không tồn tại: nope", False),
+        ("SELECT foo FROM prices", "Cột không hợp lệ", False),
+        ("SELECT close FROM prices WHERE ticker = :nothere", "Không có giá trị cho tham số: :nothere", False),
+        # Tham số có trong params nhưng câu hỏi không có giá trị
+        ("SELECT close FROM prices WHERE EXTRACT(YEAR FROM date) = :year", ":year", False),
+        ("SELEC close FROM", "Lỗi cú pháp SQL", False),
+    ]
+
+    # (SQL, SQL sau kiểm tra với max_rows=100)
+    VALID = [
+        (
+            "SELECT close FROM prices WHERE ticker = :ticker",
+            "SELECT close FROM prices WHERE ticker = :ticker\nLIMIT 100;",
+        ),
+        ("SELECT close FROM prices;", "SELECT close FROM prices\nLIMIT 100;"),
+        ("SELECT close FROM prices -- comment\n;", "SELECT close FROM prices\nLIMIT 100;"),
+        # Đã giới hạn số dòng hoặc aggregate một dòng: không thêm LIMIT
+        ("SELECT close FROM prices LIMIT 5", "SELECT close FROM prices LIMIT 5"),
+        ("SELECT AVG(close) FROM prices", "SELECT AVG(close) FROM prices"),
+    ]
+
+    def test_invalid(self):
+        for sql, message, blocked in self.INVALID:
+            with self.subTest(sql=sql):
+                result = check_sql(sql, self.PARAMS, max_rows=100)
+                self.assertFalse(result.valid)
+                self.assertIn(message, "; ".join(result.errors))
+                self.assertEqual(result.blocked, blocked)
+                self.assertEqual(result.sql, sql)
+
+    def test_valid(self):
+        for sql, expected in self.VALID:
+            with self.subTest(sql=sql):
+                result = check_sql(sql, self.PARAMS, max_rows=100)
+                self.assertEqual(result.errors, [])
+                self.assertEqual(result.sql, expected)
+
+    def test_no_limit_when_disabled(self):
+        sql = "SELECT close FROM prices"
+        self.assertEqual(check_sql(sql, self.PARAMS, max_rows=0).sql, sql)
+
+
+class NormalizeLlmSqlTests(SimpleTestCase):
+    # (SQL của LLM, SQL sau chuẩn hoá)
+    CASES = [
+        # Hàm SQLite -> PostgreSQL
+        (
+            "SELECT close FROM prices WHERE strftime('%Y', date) = '2024'",
+            "SELECT\n  close\nFROM prices\nWHERE\n  EXTRACT(YEAR FROM date) = 2024;",
+        ),
+        (
+            "SELECT strftime('%Y-%m-%d', date) FROM prices",
+            "SELECT\n  TO_CHAR(date, 'YYYY-MM-DD')\nFROM prices;",
+        ),
+        (
+            "SELECT close FROM prices WHERE date >= date('now', '-6 month')",
+            "SELECT\n  close\nFROM prices\nWHERE\n  date >= CURRENT_DATE - INTERVAL '6 MONTH';",
+        ),
+        (
+            "SELECT close FROM prices WHERE date >= date('now', '+1 day')",
+            "SELECT\n  close\nFROM prices\nWHERE\n  date >= CURRENT_DATE + INTERVAL '1 DAY';",
+        ),
+        # Tên công ty -> ILIKE; metadata công ty -> lọc theo :ticker
+        (
+            "SELECT symbol FROM companies WHERE name = 'Apple'",
+            "SELECT\n  symbol\nFROM companies\nWHERE\n  name ILIKE '%' || 'Apple' || '%';",
+        ),
+        (
+            "SELECT symbol FROM companies WHERE name = :company_name",
+            "SELECT\n  symbol\nFROM companies\nWHERE\n  name ILIKE '%' || :company || '%';",
+        ),
+        (
+            "SELECT sector FROM companies WHERE name = :company",
+            "SELECT\n  sector\nFROM companies\nWHERE\n  symbol = :ticker;",
+        ),
+        # Tên bind parameter chuẩn
+        (
+            "SELECT close FROM prices WHERE ticker = :ticker_symbol",
+            "SELECT\n  close\nFROM prices\nWHERE\n  ticker = :ticker;",
+        ),
+        # CTE tìm ticker theo tên bị bỏ khi đã có :ticker
+        (
+            "WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE :company)"
+            " SELECT p.close FROM prices p JOIN company_ticker ct ON p.ticker = ct.symbol"
+            " WHERE p.ticker = :ticker",
+            "SELECT\n  p.close\nFROM prices AS p\nWHERE\n  p.ticker = :ticker;",
+        ),
+        (
+            "WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE :company)"
+            " SELECT p.close FROM prices p JOIN company_ticker ct ON p.ticker = ct.symbol"
+            " WHERE p.date = :date AND p.ticker = :ticker_symbol",
+            "SELECT\n  p.close\nFROM prices AS p\nWHERE\n  p.date = :date AND p.ticker = :ticker;",
+        ),
+        # Không parse được: giữ nguyên để validate_sql báo lỗi
+        ("SELEC close FROM", "SELEC close FROM;"),
+        ("SELECT 1; SELECT 2;", "SELECT 1; SELECT 2;"),
+    ]
+
+    def test_normalize(self):
+        for sql, expected in self.CASES:
+            with self.subTest(sql=sql):
+                self.assertEqual(normalize_llm_sql(sql), expected)
+
+    def test_cte_kept_without_ticker(self):
+        sql = normalize_llm_sql(
+            "WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE :company)"
+            " SELECT p.close FROM prices p JOIN company_ticker ct ON p.ticker = ct.symbol"
+        )
+        self.assertIn("WITH company_ticker AS", sql)
+        self.assertIn("JOIN company_ticker AS ct", sql)
@@ -1,6 +1,8 @@
 from django.urls import path
 from .views import (
     djia_query,
+    djia_query_async,
+    djia_query_stream,
     list_conversations,
     conversation_messages,
     login_view,
@@ -9,10 +11,13 @@ from .views import (
     register_view,
     delete_conversation,
     execute_sql,
+    readiness,
 )
 
 urlpatterns = [
     path("query/", djia_query, name="djia-query"),
+    path("query/async/", djia_query_async, name="djia-query-async"),
+    path("query/stream/", djia_query_stream, name="djia-query-stream"),
     path("conversations/", list_conversations, name="conversation-list"),
     path(
         "conversations/<uuid:conversation_id>/messages/",
@@ -29,6 +34,7 @@ urlpatterns = [
     path("auth/me/", me_view, name="auth-me"),
     path("auth/register/", register_view, name="auth-register"),
     path("execute-sql/", execute_sql, name="execute-sql"),
+    path("health/ready/", readiness, name="health-ready"),
 ]
 
 
@@ -1,16 +1,22 @@
+import json
 from datetime import date, datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 import pandas as pd
 import plotly.io as pio
 from django.contrib.auth import authenticate, login, logout, get_user_model
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
-from graphs.djia_graph import run_djia_graph
+from graphs.djia_graph import run_djia_graph, arun_djia_graph, astream_djia_graph
 from nodes.sql_executor import run_sql
+from nodes.sql_validator import check_sql
+from runtime import get_runtime
 from .models import Conversation, Message
 
 
@@ -27,6 +33,58 @@ def _df_to_rows(df: pd.DataFrame, max_rows: int = 100) -> List[Dict[str, Any]]:
     return trimmed.applymap(_normalize_value).to_dict(orient="records")
 
 
+def _build_payload(
+    result: Dict[str, Any], conversation_id: Optional[str]
+) -> Dict[str, Any]:
+    """Chuyển kết quả của workflow thành JSON trả về cho FE."""
+    df = result.get("df")
+    rows = _df_to_rows(df) if isinstance(df, pd.DataFrame) else []
+
+    chart = result.get("chart")
+    chart_json = None
+    if chart is not None:
+        try:
+            chart_json = pio.to_json(chart)
+        except Exception:
+            chart_json = None
+
+    return {
+        "success": bool(result.get("success")),
+        "answer": result.get("answer", ""),
+        "sql": result.get("actual_sql") or result.get("sql") or "",
+        "used_sample": bool(result.get("used_sample", False)),
+        "error": result.get("error"),
+        "rows": rows,
+        "workflow": result.get("workflow", []),
+        "complexity": result.get("complexity", {}),
+        "chart_json": chart_json,
+        "metrics": result.get("metrics"),
+        "cached": bool(result.get("cached", False)),
+        "conversation_id": conversation_id,
+    }
+
+
+def _assistant_message_fields(
+    conversation: Conversation, payload: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Các field để lưu Message của assistant từ payload."""
+    return {
+        "conversation": conversation,
+        "role": Message.ROLE_ASSISTANT,
+        "content": payload["answer"],
+        "sql": payload["sql"],
+        "used_sample": payload["used_sample"],
+        "error": str(payload["error"] or ""),
+        "rows_json": payload["rows"],
+        "metadata": {
+            "workflow": payload["workflow"],
+            "complexity": payload["complexity"],
+            "chart_json": payload["chart_json"],
+            "metrics": payload["metrics"],
+        },
+    }
+
+
 @csrf_exempt
 @api_view(["POST"])
 @permission_classes([AllowAny])
@@ -56,31 +114,7 @@ def djia_query(request):
                 status=500,
             )
 
-        df = result.get("df")
-        rows = _df_to_rows(df) if isinstance(df, pd.DataFrame) else []
-
-        chart = result.get("chart")
-        chart_json = None
-        if chart is not None:
-            try:
-                chart_json = pio.to_json(chart)
-            except Exception:
-                chart_json = None
-
-        payload: Dict[str, Any] = {
-            "success": bool(result.get("success")),
-            "answer": result.get("answer", ""),
-            "sql": result.get("actual_sql") or result.get("sql") or "",
-            "used_sample": bool(result.get("used_sample", False)),
-            "error": result.get("error"),
-            "rows": rows,
-            "workflow": result.get("workflow", []),
-            "complexity": result.get("complexity", {}),
-            "chart_json": chart_json,
-            "conversation_id": None,
-        }
-
-        return Response(payload)
+        return Response(_build_payload(result, None))
 
     # ========== ĐÃ ĐĂNG NHẬP: LƯU THEO USER ==========
     conversation_id = request.data.get("conversation_id")
@@ -116,47 +150,219 @@ def djia_query(request):
             status=500,
         )
 
-    df = result.get("df")
-    rows = _df_to_rows(df) if isinstance(df, pd.DataFrame) else []
+    payload = _build_payload(result, str(conversation.id))
 
-    chart = result.get("chart")
-    chart_json = None
-    if chart is not None:
-        try:
-            chart_json = pio.to_json(chart)
-        except Exception:
-            chart_json = None
+    # Lưu message của assistant
+    Message.objects.create(**_assistant_message_fields(conversation, payload))
 
-    payload: Dict[str, Any] = {
-        "success": bool(result.get("success")),
-        "answer": result.get("answer", ""),
-        "sql": result.get("actual_sql") or result.get("sql") or "",
-        "used_sample": bool(result.get("used_sample", False)),
-        "error": result.get("error"),
-        "rows": rows,
-        "workflow": result.get("workflow", []),
-        "complexity": result.get("complexity", {}),
-        "chart_json": chart_json,
-        "conversation_id": str(conversation.id),
+    return Response(payload)
+
+
+def _json_response(data: Dict[str, Any], status: int = 200) -> JsonResponse:
+    # Dùng encoder của DRF để Decimal/numpy/datetime trong rows được serialize
+    # giống hệt Response của các view DRF
+    return JsonResponse(
+        data,
+        status=status,
+        encoder=JSONEncoder,
+        json_dumps_params={"ensure_ascii": False},
+    )
+
+
+async def _aparse_query_request(request) -> Dict[str, Any]:
+    """
+    Đọc body JSON và user hiện tại cho các view async.
+
+    Trả về {"response": JsonResponse} nếu request không hợp lệ.
+    """
+    try:
+        data = json.loads(request.body or b"{}")
+    except (ValueError, UnicodeDecodeError):
+        return {
+            "response": _json_response(
+                {"detail": "Body phải là JSON hợp lệ."}, status=400
+            )
+        }
+
+    question = (data.get("question") or "").strip()
+    if not question:
+        return {
+            "response": _json_response(
+                {"detail": "Thiếu trường 'question'."}, status=400
+            )
+        }
+
+    user = await request.auser()
+    return {
+        "question": question,
+        "force_chart": data.get("force_chart", False),
+        "conversation_id": data.get("conversation_id"),
+        "user": user if user.is_authenticated else None,
     }
 
-    # Lưu message của assistant
-    Message.objects.create(
+
+async def _aopen_conversation(
+    user, conversation_id: Optional[str], question: str
+) -> Optional[Conversation]:
+    """
+    Lấy (hoặc tạo) conversation của user và lưu message của user.
+
+    Trả về None nếu conversation_id không thuộc user.
+    """
+    if conversation_id:
+        try:
+            conversation = await Conversation.objects.aget(
+                id=conversation_id, user=user
+            )
+        except Conversation.DoesNotExist:
+            return None
+    else:
+        conversation = await Conversation.objects.acreate(
+            user=user, title=question[:80]
+        )
+
+    await Message.objects.acreate(
+        conversation=conversation,
+        role=Message.ROLE_USER,
+        content=question,
+    )
+    return conversation
+
+
+async def _asave_agent_error(conversation: Conversation, e: Exception) -> None:
+    await Message.objects.acreate(
         conversation=conversation,
         role=Message.ROLE_ASSISTANT,
-        content=payload["answer"],
-        sql=payload["sql"],
-        used_sample=payload["used_sample"],
-        error=str(payload["error"] or ""),
-        rows_json=rows,
-        metadata={
-            "workflow": payload["workflow"],
-            "complexity": payload["complexity"],
-            "chart_json": chart_json,
-        },
+        content=f"Lỗi nội bộ khi chạy agent: {e}",
+        error=str(e),
     )
 
-    return Response(payload)
+
+@csrf_exempt
+@require_POST
+async def djia_query_async(request):
+    """
+    Phiên bản async của djia_query (chạy dưới ASGI, ví dụ uvicorn core.asgi:application).
+
+    Workflow chạy bằng ainvoke với LLM/DB async, nên request chờ Gemini và
+    PostgreSQL không giữ worker thread. DRF chưa hỗ trợ async view nên view
+    này dùng Django thuần (JsonResponse) với cùng body/payload như djia_query.
+
+    Body:
+        { "question": "...", "force_chart": false, "conversation_id": "..." }
+    """
+    parsed = await _aparse_query_request(request)
+    if "response" in parsed:
+        return parsed["response"]
+
+    question = parsed["question"]
+    user = parsed["user"]
+
+    # Chưa đăng nhập: không lưu DB
+    conversation = None
+    if user is not None:
+        conversation = await _aopen_conversation(
+            user, parsed["conversation_id"], question
+        )
+        if conversation is None:
+            return _json_response({"detail": "Conversation không tồn tại."}, status=404)
+
+    try:
+        result = await arun_djia_graph(question, force_chart=parsed["force_chart"])
+    except Exception as e:
+        if conversation is not None:
+            await _asave_agent_error(conversation, e)
+        return _json_response(
+            {"success": False, "error": f"Lỗi nội bộ khi chạy agent: {e}"},
+            status=500,
+        )
+
+    if conversation is None:
+        return _json_response(_build_payload(result, None))
+
+    payload = _build_payload(result, str(conversation.id))
+    await Message.objects.acreate(**_assistant_message_fields(conversation, payload))
+
+    return _json_response(payload)
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """Format một server-sent event."""
+    body = json.dumps(data, cls=JSONEncoder, ensure_ascii=False)
+    return f"event: {event}\ndata: {body}\n\n"
+
+
+async def _stream_query_events(
+    question: str, force_chart: bool, conversation: Optional[Conversation]
+):
+    conversation_id = str(conversation.id) if conversation is not None else None
+    yield _sse("start", {"conversation_id": conversation_id})
+
+    try:
+        async for item in astream_djia_graph(question, force_chart=force_chart):
+            kind = item["event"]
+            if kind == "rows":
+                df = item["df"]
+                data = {
+                    "rows": _df_to_rows(df) if isinstance(df, pd.DataFrame) else [],
+                    "sql": item["sql"],
+                    "error": item["error"],
+                }
+            elif kind == "result":
+                # Payload cuối cùng giống hệt /api/query/
+                data = _build_payload(item["result"], conversation_id)
+                if conversation is not None:
+                    await Message.objects.acreate(
+                        **_assistant_message_fields(conversation, data)
+                    )
+            else:
+                data = {k: v for k, v in item.items() if k != "event"}
+            yield _sse(kind, data)
+    except Exception as e:
+        if conversation is not None:
+            await _asave_agent_error(conversation, e)
+        yield _sse(
+            "error", {"success": False, "error": f"Lỗi nội bộ khi chạy agent: {e}"}
+        )
+
+
+@csrf_exempt
+@require_POST
+async def djia_query_stream(request):
+    """
+    Phiên bản streaming (Server-Sent Events) của djia_query, chạy dưới ASGI.
+
+    Cùng body với /api/query/. Response là text/event-stream gồm các event:
+    - start: {"conversation_id": ...}
+    - node_start / node_end: {"node": "execute_sql"} khi mỗi node bắt đầu/kết thúc
+    - rows: {"rows": [...], "sql": "...", "error": ...} ngay khi execute_sql xong
+    - token: {"text": "..."} từng đoạn câu trả lời do Gemini stream về
+    - result: payload đầy đủ giống /api/query/ (đã lưu vào lịch sử nếu đăng nhập)
+    - error: {"success": false, "error": "..."} nếu workflow lỗi
+    """
+    parsed = await _aparse_query_request(request)
+    if "response" in parsed:
+        return parsed["response"]
+
+    question = parsed["question"]
+    user = parsed["user"]
+
+    conversation = None
+    if user is not None:
+        conversation = await _aopen_conversation(
+            user, parsed["conversation_id"], question
+        )
+        if conversation is None:
+            return _json_response({"detail": "Conversation không tồn tại."}, status=404)
+
+    response = StreamingHttpResponse(
+        _stream_query_events(question, parsed["force_chart"], conversation),
+        content_type="text/event-stream",
+    )
+    # Không cache/buffer để event tới client ngay (kể cả qua nginx)
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 
 @api_view(["GET"])
@@ -299,6 +505,10 @@ def delete_conversation(request, conversation_id: str):
 def execute_sql(request):
     """
     Chạy SQL trực tiếp trên database (không qua LLM).
+
+    Chỉ nhận một câu lệnh SELECT hợp lệ với schema (nodes.sql_validator, thêm
+    LIMIT SQL_MAX_ROWS nếu chưa có); SQL chạy trong transaction read-only với
+    statement_timeout và giới hạn cost EXPLAIN (db/guard.py).
     
     Body:
         { "sql": "SELECT * FROM prices WHERE ticker = 'AAPL' LIMIT 10" }
@@ -314,6 +524,16 @@ def execute_sql(request):
     sql = (request.data.get("sql") or "").strip()
     if not sql:
         return Response({"detail": "Thiếu trường 'sql'."}, status=400)
+
+    validation = check_sql(sql, {})
+    if not validation.valid:
+        return Response({
+            "success": False,
+            "rows": [],
+            "sql": sql,
+            "error": "; ".join(validation.errors),
+        }, status=400)
+    sql = validation.sql
     
     try:
         # Chạy SQL trực tiếp (không có parameters)
@@ -326,6 +546,14 @@ def execute_sql(request):
             "sql": display_sql,
             "error": None,
         })
+    except ValueError as e:
+        # SQL vượt giới hạn cost (SQL_MAX_PLAN_COST)
+        return Response({
+            "success": False,
+            "rows": [],
+            "sql": sql,
+            "error": str(e),
+        }, status=400)
     except Exception as e:
         return Response({
             "success": False,
@@ -333,3 +561,19 @@ def execute_sql(request):
             "sql": sql,
             "error": str(e),
         }, status=500)
+
+
+@api_view(["GET"])
+@permission_classes([AllowAny])
+def readiness(request):
+    """
+    Readiness probe: chỉ trả 200 khi agent runtime đã warm xong
+    (graph đã compile, engine/SQL samples/template index đã sẵn sàng; lỗi
+    ChromaDB/tài liệu RAG không chặn readiness).
+    """
+    runtime = get_runtime()
+    if not runtime.is_ready:
+        # Warm-up lỗi và thread thử lại đã dừng: chạy lại (không làm gì nếu đang chạy)
+        runtime.warm_in_background()
+    status = runtime.status()
+    return Response(status, status=200 if status["ready"] else 503)
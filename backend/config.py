@@ -33,6 +33,46 @@ DB_CONNECTION_STRING = (
     f"@{POSTGRES_CONFIG['host']}:{POSTGRES_CONFIG['port']}/{POSTGRES_CONFIG['database']}"
 )
 
+# Connection string cho SQLAlchemy AsyncEngine (driver psycopg 3, dùng cho workflow async)
+ASYNC_DB_CONNECTION_STRING = (
+    f"postgresql+psycopg://{POSTGRES_CONFIG['user']}:{POSTGRES_CONFIG['password']}"
+    f"@{POSTGRES_CONFIG['host']}:{POSTGRES_CONFIG['port']}/{POSTGRES_CONFIG['database']}"
+)
+
+# Connection pool dùng chung (xem db/engine.py)
+# - DB_POOL_SIZE: số connection giữ sẵn trong pool
+# - DB_MAX_OVERFLOW: số connection tạm mở thêm khi pool đã hết
+# - DB_POOL_TIMEOUT: số giây tối đa chờ lấy connection trước khi báo lỗi
+# - DB_POOL_RECYCLE: đóng và mở lại connection đã sống quá số giây này
+# - DB_POOL_PRE_PING: kiểm tra connection còn sống trước khi dùng
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Prepared statements cho SQL mẫu (xem db/prepared.py)
+# - DB_PREPARED_STATEMENTS: PREPARE SQL mẫu một lần mỗi connection, các lần sau
+#   chỉ bind parameters và EXECUTE (tắt khi đi qua pgbouncer transaction mode)
+# - DB_PREPARED_MAX: số prepared statement tối đa giữ trên mỗi connection
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() in ("1", "true", "yes")
+DB_PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", 256))
+
+# Giới hạn cho mỗi lần thực thi SQL (xem db/guard.py); mọi SQL chạy trong
+# transaction read-only
+# - DB_STATEMENT_TIMEOUT_MS: statement_timeout của transaction (0 = không giới hạn)
+# - SQL_MAX_PLAN_COST: cost ước tính tối đa (EXPLAIN) của SQL không phải SQL mẫu
+#   (0 = không kiểm tra)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 5000))
+SQL_MAX_PLAN_COST = float(os.getenv("SQL_MAX_PLAN_COST", 1000000))
+
+# Warm-up runtime (xem runtime.py): bước lỗi lúc khởi động (DB/embedding model
+# chưa sẵn sàng) được thử lại trong background
+# - RUNTIME_WARMUP_RETRY_SECONDS: chờ trước lần thử lại đầu tiên (0 = không thử lại)
+# - RUNTIME_WARMUP_RETRY_MAX_SECONDS: thời gian chờ tối đa (nhân đôi sau mỗi lần lỗi)
+RUNTIME_WARMUP_RETRY_SECONDS = float(os.getenv("RUNTIME_WARMUP_RETRY_SECONDS", 5))
+RUNTIME_WARMUP_RETRY_MAX_SECONDS = float(os.getenv("RUNTIME_WARMUP_RETRY_MAX_SECONDS", 300))
+
 
 # ==================== DỮ LIỆU ĐẦU VÀO ====================
 
@@ -46,6 +86,139 @@ DJIA_PRICES_CSV = DATA_DIR / "djia_prices_20251210.csv"
 # Được sử dụng bởi SQL Template Matcher để tìm SQL phù hợp với câu hỏi
 SQL_SAMPLES_FILE = DATA_DIR / "sql_samples.sql"
 
+# Bộ câu hỏi/đáp án mẫu (xem graphs/question_suite.py), dùng để ghi LLM
+# cassette và benchmark
+TEST_QUESTIONS_FILE = Path(os.getenv("TEST_QUESTIONS_FILE", PROJECT_ROOT.parent / "test.txt"))
+
+# Tìm SQL template bằng vector index của các câu hỏi mẫu (xem nodes/template_index.py)
+# - TEMPLATE_MATCH_THRESHOLD: cosine similarity tối thiểu để dùng template ngay
+# - TEMPLATE_MATCH_MARGIN: khoảng cách tối thiểu với template thứ 2 (tránh nhầm
+#   giữa các template gần giống nhau, ví dụ avg_close / avg_open)
+# - TEMPLATE_MATCH_TOP_K: số template ứng viên gửi cho LLM khi chưa đủ tin cậy
+TEMPLATE_MATCH_THRESHOLD = float(os.getenv("TEMPLATE_MATCH_THRESHOLD", 0.85))
+TEMPLATE_MATCH_MARGIN = float(os.getenv("TEMPLATE_MATCH_MARGIN", 0.03))
+TEMPLATE_MATCH_TOP_K = int(os.getenv("TEMPLATE_MATCH_TOP_K", 5))
+
+# Phân loại SQL/OTHER tại chỗ trước khi gọi Gemini (xem nodes/fast_classifier.py)
+# - CLASSIFIER_FAST_PATH: bật/tắt (tắt thì mọi câu hỏi đều hỏi Gemini)
+# - CLASSIFIER_SQL_THRESHOLD / CLASSIFIER_OTHER_THRESHOLD: xác suất SQL từ
+#   ngưỡng trên trở lên là SQL, từ ngưỡng dưới trở xuống là OTHER; ở giữa
+#   (không chắc chắn) thì mới gọi Gemini
+# - CLASSIFIER_KNN_K: số câu hỏi mẫu gần nhất dùng để bỏ phiếu
+CLASSIFIER_FAST_PATH = os.getenv("CLASSIFIER_FAST_PATH", "true").lower() in ("1", "true", "yes")
+CLASSIFIER_SQL_THRESHOLD = float(os.getenv("CLASSIFIER_SQL_THRESHOLD", 0.9))
+CLASSIFIER_OTHER_THRESHOLD = float(os.getenv("CLASSIFIER_OTHER_THRESHOLD", 0.1))
+CLASSIFIER_KNN_K = int(os.getenv("CLASSIFIER_KNN_K", 5))
+
+# Nhận diện tên công ty viết sai chính tả ("Microsft", "Walgren") bằng fuzzy
+# index tại chỗ (xem nodes/company_matcher.py)
+# - COMPANY_FUZZY_MATCHING: bật/tắt
+# - COMPANY_FUZZY_THRESHOLD: độ giống tối thiểu (1 - edit distance / độ dài)
+COMPANY_FUZZY_MATCHING = os.getenv("COMPANY_FUZZY_MATCHING", "true").lower() in ("1", "true", "yes")
+COMPANY_FUZZY_THRESHOLD = float(os.getenv("COMPANY_FUZZY_THRESHOLD", 0.75))
+
+
+# ==================== ANSWER CACHE ====================
+
+# Cache kết quả của cả workflow theo câu hỏi đã chuẩn hoá (xem graphs/answer_cache.py)
+# - ANSWER_CACHE_ENABLED: bật/tắt cache
+# - ANSWER_CACHE_MAX_ENTRIES: số câu trả lời tối đa giữ trong cache (LRU)
+# - ANSWER_CACHE_TTL: số giây một câu trả lời còn hiệu lực
+# - DATA_VERSION_CHECK_INTERVAL: số giây giữa hai lần đọc data version từ
+#   PostgreSQL (dữ liệu import lại sẽ làm cache mất hiệu lực sau tối đa ngần ấy giây)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 512))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 3600))
+DATA_VERSION_CHECK_INTERVAL = float(os.getenv("DATA_VERSION_CHECK_INTERVAL", 5))
+
+# Cache SQL do LLM sinh theo dạng câu hỏi (xem nodes/sql_shape_cache.py):
+# câu hỏi cùng dạng, khác công ty/ngày/năm/quý dùng lại SQL có bind parameters
+# - SQL_SHAPE_CACHE_ENABLED: bật/tắt cache
+# - SQL_SHAPE_CACHE_MAX_ENTRIES: số dạng câu hỏi tối đa giữ trong cache (LRU)
+SQL_SHAPE_CACHE_ENABLED = os.getenv("SQL_SHAPE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SQL_SHAPE_CACHE_MAX_ENTRIES = int(os.getenv("SQL_SHAPE_CACHE_MAX_ENTRIES", 1024))
+
+# Đưa SQL do LLM sinh đã chạy tốt vào sql_samples.sql (xem nodes/template_promotion.py)
+# - TEMPLATE_CANDIDATES_ENABLED: ghi lại SQL của LLM chạy thành công
+# - TEMPLATE_CANDIDATES_FILE: file JSONL chứa các SQL đã ghi lại
+# - TEMPLATE_PROMOTION_MIN_QUESTIONS: số câu hỏi khác nhau tối thiểu đã dùng một
+#   SQL trước khi `manage.py promote_templates` thêm SQL đó thành SQL mẫu
+TEMPLATE_CANDIDATES_ENABLED = os.getenv("TEMPLATE_CANDIDATES_ENABLED", "true").lower() in ("1", "true", "yes")
+TEMPLATE_CANDIDATES_FILE = Path(
+    os.getenv("TEMPLATE_CANDIDATES_FILE", DATA_DIR / "sql_candidates.jsonl")
+)
+TEMPLATE_PROMOTION_MIN_QUESTIONS = int(os.getenv("TEMPLATE_PROMOTION_MIN_QUESTIONS", 3))
+
+# Kiểm tra SQL do LLM sinh tại chỗ trước khi gửi tới PostgreSQL (xem nodes/sql_validator.py)
+# - SQL_VALIDATION_ENABLED: bật/tắt bước validate_sql
+# - SQL_MAX_ROWS: LIMIT thêm vào SQL chưa giới hạn số dòng (0 = không thêm)
+# - SQL_REPAIR_MAX_ATTEMPTS: số lần tối đa gửi lỗi (validate hoặc thực thi) lại
+#   cho LLM để sửa SQL
+SQL_VALIDATION_ENABLED = os.getenv("SQL_VALIDATION_ENABLED", "true").lower() in ("1", "true", "yes")
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", 10000))
+SQL_REPAIR_MAX_ATTEMPTS = int(os.getenv("SQL_REPAIR_MAX_ATTEMPTS", 2))
+
+
+# ==================== LLM CLIENT ====================
+
+# Client Gemini dùng chung cho mọi node (xem nodes/llm.py)
+# - LLM_MODEL: model mặc định
+# - LLM_NODE_MODELS: model riêng cho từng node, dạng "node=model,node=model"
+#   (ví dụ "question_classifier=gemini-2.5-flash-lite,summarize_answer=gemini-2.5-pro")
+# - LLM_MAX_CONCURRENCY: số lời gọi Gemini tối đa chạy đồng thời trong một process
+# - LLM_TIMEOUT: số giây tối đa cho một lần gọi (kể cả thời gian chờ slot)
+# - LLM_MAX_RETRIES: số lần thử lại khi Gemini trả lỗi 429/5xx hoặc timeout
+# - LLM_RETRY_BACKOFF / LLM_RETRY_BACKOFF_MAX: backoff (giây) tăng gấp đôi mỗi
+#   lần thử lại, có jitter ngẫu nhiên, tối đa LLM_RETRY_BACKOFF_MAX
+# - LLM_API_ENDPOINT: endpoint thay cho Google API (ví dụ server giả lập local
+#   "http://localhost:8089" để test offline), mặc định transport REST
+# - LLM_TRANSPORT: "rest", "grpc" hoặc "grpc_asyncio" (mặc định của SDK nếu bỏ trống)
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
+LLM_NODE_MODELS = {
+    node.strip(): model.strip()
+    for node, _, model in (
+        item.partition("=") for item in os.getenv("LLM_NODE_MODELS", "").split(",")
+    )
+    if node.strip() and model.strip()
+}
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", 0.5))
+LLM_RETRY_BACKOFF_MAX = float(os.getenv("LLM_RETRY_BACKOFF_MAX", 8))
+LLM_API_ENDPOINT = os.getenv("LLM_API_ENDPOINT") or None
+LLM_TRANSPORT = os.getenv("LLM_TRANSPORT") or ("rest" if LLM_API_ENDPOINT else None)
+
+# Backend LLM giả lập cho benchmark/test offline (xem nodes/llm_fake.py)
+# - LLM_BACKEND: "gemini" (thật), "record" (gọi Gemini và ghi response vào
+#   cassette), "replay" (trả response đã ghi theo prompt hash) hoặc "synthetic"
+#   (response giả theo từng node, không cần cassette)
+# - LLM_CASSETTE: file JSONL chứa response đã ghi
+# - LLM_FAKE_LATENCY: độ trễ giả lập (ms) cho replay/synthetic: "0",
+#   "fixed:200", "uniform:100:800", "normal:400:100", "lognormal:400:0.5"
+#   (median, sigma) hoặc "recorded" (độ trễ thật lúc ghi, chỉ với replay)
+# - LLM_FAKE_SEED: seed cho độ trễ ngẫu nhiên (benchmark lặp lại được)
+# - LLM_REPLAY_MISS: khi replay không có prompt trong cassette: "error"
+#   (raise, node dùng fallback) hoặc "synthetic"
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+LLM_CASSETTE = Path(os.getenv("LLM_CASSETTE", DATA_DIR / "llm_cassette.jsonl"))
+LLM_FAKE_LATENCY = os.getenv("LLM_FAKE_LATENCY", "0")
+LLM_FAKE_SEED = int(os.getenv("LLM_FAKE_SEED", 0))
+LLM_REPLAY_MISS = os.getenv("LLM_REPLAY_MISS", "error").lower()
+
+
+# ==================== LLM CACHE ====================
+
+# Memoize response của Gemini trên đĩa, dùng chung cho mọi worker (xem nodes/llm_cache.py)
+# - LLM_CACHE_ENABLED: bật/tắt cache (cần cài diskcache)
+# - LLM_CACHE_DIR: thư mục chứa cache (SQLite của diskcache)
+# - LLM_CACHE_SIZE_LIMIT: dung lượng tối đa (bytes), vượt quá thì bỏ entry cũ nhất (LRU)
+# - LLM_CACHE_TTL: số giây một response còn hiệu lực (0 = không hết hạn)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", DATA_DIR / "llm_cache"))
+LLM_CACHE_SIZE_LIMIT = int(os.getenv("LLM_CACHE_SIZE_LIMIT", 256 * 1024 * 1024))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 0))
+
 
 # ==================== DATABASE SCHEMA ====================
 
@@ -84,3 +257,13 @@ CREATE TABLE IF NOT EXISTS prices (
     PRIMARY KEY (date, ticker)
 );
 """
+
+# Schema cho bảng data_version (PostgreSQL)
+# Một dòng duy nhất, version tăng mỗi lần db/init_db.py import lại dữ liệu
+DATA_VERSION_TABLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_version (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 from config import POSTGRES_CONFIG
 
@@ -146,3 +147,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
 }
+
+# Agent runtime: warm graph, DB engine, ChromaDB, SQL samples khi khởi động
+# Tắt bằng AGENT_RUNTIME_WARMUP=0 (ví dụ khi chạy script/CI không cần warm)
+AGENT_RUNTIME_WARMUP = os.getenv("AGENT_RUNTIME_WARMUP", "1") == "1"
@@ -0,0 +1,139 @@
+"""
+Benchmark: so sánh query plan trước/sau khi viết lại điều kiện ngày.
+
+Với mỗi SQL sample có điều kiện năm/quý/tháng, script chạy EXPLAIN cho SQL
+gốc (TO_CHAR(date, 'YYYY') = :year ...) và SQL sau nodes.sql_rewriter
+(date >= ... AND date < ...), rồi in loại scan trên bảng prices, cost ước
+lượng và (với --analyze) thời gian thực thi thực tế.
+
+Usage:
+    python db/benchmark_date_predicates.py
+    python db/benchmark_date_predicates.py --analyze --ticker MSFT --year 2023
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+# Add project root to path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from db.engine import create_pooled_engine
+from nodes.sql_rewriter import rewrite_date_predicates
+from nodes.sql_template_matcher import load_sql_samples
+
+
+def _default_params(ticker: str, year: int) -> Dict[str, Any]:
+    """Giá trị cho mọi bind parameter xuất hiện trong SQL samples."""
+    return {
+        "ticker": ticker,
+        "ticker_a": ticker,
+        "ticker_b": "MSFT" if ticker != "MSFT" else "AAPL",
+        "company": ticker,
+        "date": f"{year}-03-15",
+        "year": str(year),
+        "month": "03",
+        "quarter": 2,
+        "start_month": "01",
+        "end_month": "06",
+        "start_date": f"{year}-01-01",
+        "end_date": f"{year}-06-30",
+        "years": 0.5,
+        "window_days": 180,
+    }
+
+
+def _strip_comments(sql: str) -> str:
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return "\n".join(lines).strip().rstrip(";")
+
+
+def _scans(plan: Dict[str, Any]) -> List[str]:
+    """Các node scan trên bảng prices trong plan (ví dụ 'Index Scan(idx_prices_date)')."""
+    found = []
+    if "Scan" in plan.get("Node Type", "") and plan.get("Relation Name") == "prices":
+        index = plan.get("Index Name")
+        found.append(f"{plan['Node Type']}({index})" if index else plan["Node Type"])
+    for child in plan.get("Plans", []):
+        found.extend(_scans(child))
+    return found
+
+
+def _explain(conn, sql: str, params: Dict[str, Any], analyze: bool) -> Dict[str, Any]:
+    options = "ANALYZE, FORMAT JSON" if analyze else "FORMAT JSON"
+    raw = conn.execute(text(f"EXPLAIN ({options}) {sql}"), params).scalar()
+    result = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+    return {
+        "scans": ", ".join(sorted(set(_scans(result["Plan"])))) or "-",
+        "cost": result["Plan"]["Total Cost"],
+        "ms": result.get("Execution Time"),
+    }
+
+
+def run_benchmark(ticker: str, year: int, analyze: bool) -> pd.DataFrame:
+    params = _default_params(ticker, year)
+    engine = create_pooled_engine()
+    rows = []
+    try:
+        with engine.connect() as conn:
+            for index, sample in enumerate(load_sql_samples(), start=1):
+                before_sql = _strip_comments(sample)
+                after_sql, after_params = rewrite_date_predicates(before_sql, params)
+                if after_sql == before_sql:
+                    continue
+                try:
+                    before = _explain(conn, before_sql, params, analyze)
+                    after = _explain(conn, after_sql, after_params, analyze)
+                except Exception as e:
+                    print(f"Lỗi khi EXPLAIN sample #{index}: {e}")
+                    conn.rollback()
+                    continue
+                rows.append({
+                    "sample": index,
+                    "scan_before": before["scans"],
+                    "scan_after": after["scans"],
+                    "cost_before": before["cost"],
+                    "cost_after": after["cost"],
+                    "ms_before": before["ms"],
+                    "ms_after": after["ms"],
+                })
+    finally:
+        engine.dispose()
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ticker", default="AAPL")
+    parser.add_argument("--year", type=int, default=2024)
+    parser.add_argument(
+        "--analyze", action="store_true", help="Chạy EXPLAIN ANALYZE (thực thi query)"
+    )
+    args = parser.parse_args()
+
+    try:
+        df = run_benchmark(args.ticker, args.year, args.analyze)
+    except OperationalError as e:
+        print(f"Lỗi kết nối PostgreSQL: {e}")
+        return
+    if df.empty:
+        print("Không có SQL sample nào được viết lại.")
+        return
+
+    if not args.analyze:
+        df = df.drop(columns=["ms_before", "ms_after"])
+    print(df.to_string(index=False))
+    print(
+        f"\n{len(df)} samples được viết lại; tổng cost ước lượng: "
+        f"{df['cost_before'].sum():.1f} -> {df['cost_after'].sum():.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Data Version - Số phiên bản của dữ liệu trong PostgreSQL.
+
+Bảng data_version (schema trong config.py) chỉ có một dòng. db/init_db.py
+tăng version mỗi lần import lại companies/prices, nên mọi cache dựng trên dữ
+liệu cũ (ví dụ answer cache, xem graphs/answer_cache.py) biết khi nào phải
+bỏ, kể cả khi import chạy ở process khác với server.
+
+Usage:
+    from db.data_version import read_data_version
+    version = read_data_version(get_runtime().engine)
+"""
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+from db.engine import connect
+
+# Dùng trong transaction import của init_db (cursor DBAPI)
+BUMP_DATA_VERSION_SQL = """
+INSERT INTO data_version (id, version) VALUES (1, 1)
+ON CONFLICT (id) DO UPDATE
+SET version = data_version.version + 1, updated_at = now()
+"""
+
+SELECT_DATA_VERSION_SQL = "SELECT version FROM data_version WHERE id = 1"
+
+
+def read_data_version(engine) -> int:
+    """
+    Version hiện tại của dữ liệu.
+
+    Trả về 0 nếu database được tạo trước khi có bảng data_version
+    (chưa chạy lại db/init_db.py).
+    """
+    with connect(engine) as conn:
+        try:
+            version = conn.execute(text(SELECT_DATA_VERSION_SQL)).scalar()
+        except ProgrammingError:
+            return 0
+    return int(version or 0)
@@ -0,0 +1,161 @@
+"""
+Database Engine - Connection pool PostgreSQL dùng chung.
+
+Mọi đường thực thi SQL (sql_executor, chart_generator, /api/execute-sql/,
+db/init_db.py) lấy connection từ pool cấu hình ở đây thay vì tự tạo engine,
+nên mỗi query không phải bắt tay TCP + xác thực lại với PostgreSQL.
+
+Pool được cấu hình từ config.py (DB_POOL_SIZE, DB_MAX_OVERFLOW,
+DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING). SQL mẫu chạy qua prepared
+statement của từng connection (db/prepared.py, DB_PREPARED_STATEMENTS); mỗi lần
+thực thi chạy trong transaction read-only với statement_timeout (db/guard.py).
+
+Thời gian chờ lấy connection được đo qua connect()/aconnect():
+- ghi vào metrics của node đang chạy (pool_wait_ms, xem nodes.instrumentation)
+- cộng dồn vào POOL_STATS cho cả process (báo qua /api/health/ready/)
+
+Usage:
+    from db.engine import connect
+    with connect(get_runtime().engine) as conn:
+        df = pd.read_sql_query(text(sql), conn, params=params)
+"""
+
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict
+
+from sqlalchemy import create_engine, event
+
+from config import (
+    DB_CONNECTION_STRING,
+    ASYNC_DB_CONNECTION_STRING,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+)
+from db.prepared import async_connect_args, configure_async_connection
+from nodes.instrumentation import record_pool_wait
+
+
+def _pool_options() -> Dict[str, Any]:
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+class PoolStats:
+    """Thống kê pool cộng dồn cho cả process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.connections_opened = 0
+
+    def record_wait(self, seconds: float) -> None:
+        wait_ms = seconds * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def record_connection_opened(self) -> None:
+        with self._lock:
+            self.connections_opened += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "connections_opened": self.connections_opened,
+                "avg_wait_ms": round(self.wait_ms / self.checkouts, 2)
+                if self.checkouts
+                else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 2),
+            }
+
+
+POOL_STATS = PoolStats()
+
+
+def _track_new_connections(sync_engine) -> None:
+    # "connect" chỉ bắn khi pool phải mở connection DBAPI mới (không phải mỗi checkout)
+    event.listen(
+        sync_engine,
+        "connect",
+        lambda dbapi_connection, connection_record: POOL_STATS.record_connection_opened(),
+    )
+
+
+def create_pooled_engine(url: str = DB_CONNECTION_STRING):
+    """Tạo SQLAlchemy engine với connection pool theo cấu hình trong config.py."""
+    engine = create_engine(url, **_pool_options())
+    _track_new_connections(engine)
+    return engine
+
+
+def create_pooled_async_engine(url: str = ASYNC_DB_CONNECTION_STRING):
+    """Tạo AsyncEngine (psycopg 3) với cùng cấu hình pool như engine sync."""
+    # Import lazy: sqlalchemy.ext.asyncio cần greenlet, workflow sync không cần
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    # psycopg 3 tự prepare statement chạy lặp lại trên cùng connection (db/prepared.py)
+    engine = create_async_engine(url, connect_args=async_connect_args(), **_pool_options())
+    _track_new_connections(engine.sync_engine)
+    event.listen(
+        engine.sync_engine,
+        "connect",
+        lambda dbapi_connection, connection_record: configure_async_connection(dbapi_connection),
+    )
+    return engine
+
+
+def _record_wait(started: float) -> None:
+    seconds = time.perf_counter() - started
+    POOL_STATS.record_wait(seconds)
+    record_pool_wait(seconds)
+
+
+@contextmanager
+def connect(engine):
+    """Lấy connection từ pool (đo thời gian chờ), trả lại pool khi xong."""
+    started = time.perf_counter()
+    conn = engine.connect()
+    _record_wait(started)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@asynccontextmanager
+async def aconnect(engine):
+    """Phiên bản async của connect() cho AsyncEngine."""
+    started = time.perf_counter()
+    conn = await engine.connect()
+    _record_wait(started)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+def pool_status(engine) -> Dict[str, Any]:
+    """Trạng thái hiện tại của pool (kích thước, đang dùng, overflow) + thống kê chờ."""
+    pool = getattr(engine, "sync_engine", engine).pool
+    status = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checked_in": pool.checkedin(),
+    }
+    status.update(POOL_STATS.snapshot())
+    return status
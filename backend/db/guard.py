@@ -0,0 +1,114 @@
+"""
+Query Guard - Giới hạn tài nguyên cho mỗi lần thực thi SQL.
+
+SQL do LLM sinh và SQL gửi tới /api/execute-sql/ có thể chạy không giới hạn
+trên bảng prices (ví dụ cross join 30 ticker x toàn bộ ngày) và giữ một
+connection của pool dùng chung trong suốt thời gian đó. Module này giới hạn
+mỗi lần thực thi:
+
+1. begin_read_only(): transaction read-only + statement_timeout chỉ áp dụng
+   cho transaction hiện tại (set_config(..., true), một round trip):
+
+       SELECT set_config('transaction_read_only', 'on', true),
+              set_config('statement_timeout', '5000', true)
+
+   Connection trả về pool bị rollback nên các giá trị này không ảnh hưởng
+   request sau; SQL không thể bật lại read-write sau khi đã chạy truy vấn.
+2. check_plan_cost(): EXPLAIN (FORMAT JSON) trước khi chạy, raise ValueError
+   nếu cost ước tính vượt SQL_MAX_PLAN_COST (lỗi được gửi lại LLM để sửa SQL).
+   SQL mẫu không đi qua bước này (đã biết trước, chạy qua prepared statement).
+3. cancel_on_disconnect(): khi task async bị cancel (Django cancel view khi
+   client ngắt kết nối) thì hủy truy vấn đang chạy trên PostgreSQL, không để
+   nó giữ connection tới khi hết statement_timeout. Đường sync (run_sql dưới
+   WSGI) không biết client ngắt kết nối: chỉ có statement_timeout giới hạn.
+
+Usage:
+    with connect(get_runtime().engine) as conn:
+        begin_read_only(conn)
+        check_plan_cost(conn, sql, params)
+        df = pd.read_sql_query(text(sql), conn, params=params)
+"""
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from config import DB_STATEMENT_TIMEOUT_MS, SQL_MAX_PLAN_COST
+
+_BEGIN_SQL = text(
+    "SELECT set_config('transaction_read_only', 'on', true),"
+    " set_config('statement_timeout', :timeout, true)"
+)
+
+
+def begin_read_only(conn, timeout_ms: int = DB_STATEMENT_TIMEOUT_MS) -> None:
+    """
+    Bắt đầu transaction read-only với statement_timeout (ms, 0 = không giới hạn).
+
+    Phải gọi trước truy vấn đầu tiên trên connection; pd.read_sql_query dùng
+    lại transaction này (không tự begin/commit).
+    """
+    conn.execute(_BEGIN_SQL, {"timeout": str(max(int(timeout_ms), 0))})
+
+
+def plan_cost(conn, sql: str, params: Dict[str, Any]) -> Optional[float]:
+    """Total Cost của plan PostgreSQL (EXPLAIN, không thực thi SQL)."""
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON)\n{sql}"), params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    try:
+        return float(plan[0]["Plan"]["Total Cost"])
+    except (TypeError, LookupError, ValueError):
+        return None
+
+
+def check_plan_cost(
+    conn, sql: str, params: Dict[str, Any], max_cost: float = SQL_MAX_PLAN_COST
+) -> None:
+    """
+    Raise ValueError nếu cost ước tính của SQL vượt max_cost (0 = không kiểm tra).
+
+    Raises:
+        ValueError: SQL quá tốn kém (message viết để gửi lại LLM làm feedback)
+    """
+    if max_cost <= 0:
+        return
+    cost = plan_cost(conn, sql, params)
+    if cost is not None and cost > max_cost:
+        raise ValueError(
+            f"Truy vấn quá tốn kém (cost ước tính {cost:,.0f} > {max_cost:,.0f}):"
+            " thêm điều kiện lọc theo ticker/ngày, tránh JOIN không có điều kiện"
+        )
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(conn):
+    """
+    Hủy truy vấn đang chạy trên AsyncConnection nếu task bị cancel.
+
+    Handle của driver phải lấy trước khi chạy truy vấn: sau CancelledError
+    SQLAlchemy đã invalidate connection, get_raw_connection() không dùng được.
+    """
+    driver_connection = (await conn.get_raw_connection()).driver_connection
+    try:
+        yield
+    except asyncio.CancelledError:
+        await _acancel_query(driver_connection)
+        raise
+
+
+async def _acancel_query(driver_connection) -> None:
+    try:
+        # psycopg 3 thường đã tự hủy truy vấn khi nhận CancelledError
+        if driver_connection.info.transaction_status.name != "ACTIVE":
+            return
+        cancel_safe = getattr(driver_connection, "cancel_safe", None)
+        if cancel_safe is not None:
+            await cancel_safe()
+        else:
+            driver_connection.cancel()
+    except Exception as e:
+        print(f"Error cancelling query: {e}")
@@ -1,5 +1,3 @@
-import psycopg2
-from psycopg2.extras import execute_values
 import pandas as pd
 import sys
 from pathlib import Path
@@ -7,7 +5,7 @@ from pathlib import Path
 # Add project root to path
 sys.path.append(str(Path(__file__).parent.parent))
 
-from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 
 from config import (
     POSTGRES_CONFIG,
@@ -15,22 +13,25 @@ from config import (
     DJIA_PRICES_CSV,
     COMPANIES_TABLE_SCHEMA,
     PRICES_TABLE_SCHEMA,
-    DB_CONNECTION_STRING,
+    DATA_VERSION_TABLE_SCHEMA,
 )
+from db.data_version import BUMP_DATA_VERSION_SQL
+from db.engine import create_pooled_engine
 
 def create_database():
     """Tạo database và import dữ liệu từ CSV"""
     
-    # Kết nối PostgreSQL database
+    # Kết nối PostgreSQL database (DDL và to_sql dùng chung một connection pool)
+    engine = create_pooled_engine()
     try:
-        conn = psycopg2.connect(**POSTGRES_CONFIG)
+        conn = engine.raw_connection()
         cursor = conn.cursor()
-    except psycopg2.OperationalError as e:
+    except OperationalError as e:
         print(f"Lỗi kết nối PostgreSQL: {e}")
         print(f"Vui lòng kiểm tra config: {POSTGRES_CONFIG}")
+        engine.dispose()
         return
     
-    engine = None
     try:
         # Tạo bảng companies
         cursor.execute(COMPANIES_TABLE_SCHEMA)
@@ -38,6 +39,9 @@ def create_database():
         # Tạo bảng prices
         cursor.execute(PRICES_TABLE_SCHEMA)
         
+        # Tạo bảng data_version (đánh dấu phiên bản dữ liệu cho answer cache)
+        cursor.execute(DATA_VERSION_TABLE_SCHEMA)
+        
         # Import dữ liệu companies
         print("Đang import dữ liệu companies...")
         companies_df = pd.read_csv(DJIA_COMPANIES_CSV)
@@ -68,8 +72,6 @@ def create_database():
         conn.commit()
         
         # Import dữ liệu vào PostgreSQL
-        if engine is None:
-            engine = create_engine(DB_CONNECTION_STRING)
         companies_df.to_sql('companies', engine, if_exists='append', index=False, method='multi')
         print(f"Đã import {len(companies_df)} records vào bảng companies")
         
@@ -120,8 +122,6 @@ def create_database():
         conn.commit()
         
         # Import dữ liệu vào PostgreSQL
-        if engine is None:
-            engine = create_engine(DB_CONNECTION_STRING)
         prices_df.to_sql('prices', engine, if_exists='append', index=False, method='multi')
         print(f"Đã import {len(prices_df)} records vào bảng prices")
         
@@ -129,6 +129,9 @@ def create_database():
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_ticker ON prices(ticker)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_date ON prices(date)")
         
+        # Tăng data version để server bỏ các câu trả lời đã cache từ dữ liệu cũ
+        cursor.execute(BUMP_DATA_VERSION_SQL)
+        
         conn.commit()
         print("Database đã được tạo thành công!")
         
@@ -151,10 +154,8 @@ def create_database():
         traceback.print_exc()
         conn.rollback()
     finally:
-        if engine is not None:
-            engine.dispose()
-        if conn:
-            conn.close()
+        conn.close()
+        engine.dispose()
 
 if __name__ == "__main__":
     create_database()
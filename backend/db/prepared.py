@@ -0,0 +1,144 @@
+"""
+Prepared Statements - PREPARE SQL mẫu một lần cho mỗi connection.
+
+Phần lớn traffic đi qua SQL mẫu trong sql_samples.sql (lookup một dòng theo
+ticker/ngày), nên thời gian parse + plan của PostgreSQL chiếm phần đáng kể so
+với thời gian thực thi. Module này cho mỗi connection trong pool PREPARE một
+SQL mẫu ở lần dùng đầu tiên; các lần sau chỉ bind parameters và EXECUTE:
+
+    PREPARE djia_tmpl_1 AS SELECT close FROM prices WHERE ticker = $1 AND date = $2
+    EXECUTE djia_tmpl_1 ('AAPL', '2024-01-15')
+
+- Engine sync (psycopg2): PREPARE/EXECUTE tường minh qua read_prepared().
+  Danh sách statement đã prepare nằm trong connection.info của pool, nên tự
+  mất khi pool mở lại connection (recycle, invalidate) - đúng như phía server.
+- Engine async (psycopg 3): dùng prepared-statement cache của driver
+  (async_connect_args()): statement chạy lần thứ hai trên một connection thì
+  được prepare; SQL do LLM sinh chỉ chạy một lần nên không chiếm chỗ.
+
+Chỉ SQL mẫu được prepare (run_sql quyết định qua TemplateRegistry). SQL nào
+PREPARE lỗi (ví dụ PostgreSQL không suy ra được kiểu của parameter) được đánh
+dấu và chạy lại theo đường thường; kết quả truy vấn không thay đổi.
+
+Usage:
+    with connect(get_runtime().engine) as conn:
+        df = read_prepared(conn, sql, params)
+        if df is None:
+            df = pd.read_sql_query(text(sql), conn, params=params)
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from config import DB_PREPARED_STATEMENTS, DB_PREPARED_MAX
+
+# Key trong connection.info: SQL -> (tên statement, tên params theo $1..$n),
+# hoặc None nếu SQL không PREPARE được
+_INFO_KEY = "djia_prepared_statements"
+
+# String literal, quoted identifier, comment (giữ nguyên) hoặc bind parameter :name
+_TOKEN_RE = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|(?<![:\w]):([A-Za-z_]\w*)"
+)
+
+
+def to_positional(sql: str) -> Tuple[str, List[str]]:
+    """
+    Đổi bind parameters :name thành $1..$n cho PREPARE.
+
+    Returns:
+        (SQL với $n, tên params theo thứ tự $1..$n) - cùng một tên dùng chung $n
+    """
+    names: List[str] = []
+
+    def _replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name is None:
+            return match.group(0)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return _TOKEN_RE.sub(_replace, sql), names
+
+
+def read_prepared(conn, sql: str, params: Dict[str, Any]) -> Optional[pd.DataFrame]:
+    """
+    Thực thi SQL qua prepared statement của connection (engine sync, psycopg2).
+
+    Returns:
+        DataFrame kết quả, hoặc None nếu SQL không chạy qua prepared statement
+        được (tắt cấu hình, driver khác, PREPARE lỗi, thiếu parameter, đã đủ
+        DB_PREPARED_MAX statement) - khi đó gọi đường thực thi thường.
+
+    Raises:
+        psycopg2.Error: Nếu EXECUTE lỗi (lỗi của chính truy vấn)
+    """
+    if not DB_PREPARED_STATEMENTS or conn.dialect.driver != "psycopg2":
+        return None
+
+    dbapi_conn = conn.connection
+    statements = dbapi_conn.info.setdefault(_INFO_KEY, {})
+    if sql in statements:
+        entry = statements[sql]
+    elif len(statements) >= DB_PREPARED_MAX:
+        return None
+    else:
+        entry = statements[sql] = _prepare(dbapi_conn, sql, len(statements) + 1)
+    if entry is None:
+        return None
+
+    name, names = entry
+    if any(param not in params for param in names):
+        return None
+    cursor = dbapi_conn.cursor()
+    try:
+        if names:
+            placeholders = ", ".join(["%s"] * len(names))
+            cursor.execute(f"EXECUTE {name} ({placeholders})", [params[n] for n in names])
+        else:
+            cursor.execute(f"EXECUTE {name}")
+        columns = [column[0] for column in cursor.description or ()]
+        # Giống pd.read_sql_query (coerce_float: Decimal -> float)
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=columns, coerce_float=True)
+    finally:
+        cursor.close()
+
+
+def _prepare(dbapi_conn, sql: str, number: int) -> Optional[Tuple[str, List[str]]]:
+    name = f"djia_tmpl_{number}"
+    positional, names = to_positional(sql.strip().rstrip(";"))
+    cursor = dbapi_conn.cursor()
+    try:
+        # Savepoint: PREPARE lỗi không được rollback cả transaction (read-only +
+        # statement_timeout của db/guard.py)
+        cursor.execute("SAVEPOINT djia_prepare")
+        # Không truyền params: psycopg2 không xử lý % trong SQL (LIKE '%...%')
+        cursor.execute(f"PREPARE {name} AS {positional}")
+        cursor.execute("RELEASE SAVEPOINT djia_prepare")
+    except Exception as e:
+        # Transaction đã bị abort, rollback về savepoint để đường thực thi thường chạy tiếp
+        cursor.execute("ROLLBACK TO SAVEPOINT djia_prepare")
+        print(f"Error preparing SQL template: {e}")
+        return None
+    finally:
+        cursor.close()
+    return name, names
+
+
+def async_connect_args() -> Dict[str, Any]:
+    """
+    connect_args cho AsyncEngine (psycopg 3): prepare statement từ lần chạy
+    thứ hai trên mỗi connection, tắt hẳn nếu DB_PREPARED_STATEMENTS=false.
+    """
+    return {"prepare_threshold": 1 if DB_PREPARED_STATEMENTS else None}
+
+
+def configure_async_connection(dbapi_connection) -> None:
+    """Đặt kích thước prepared-statement cache của psycopg 3 (event "connect")."""
+    driver_connection = getattr(dbapi_connection, "driver_connection", None)
+    if driver_connection is not None and hasattr(driver_connection, "prepared_max"):
+        driver_connection.prepared_max = DB_PREPARED_MAX
+
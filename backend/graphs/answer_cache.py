@@ -0,0 +1,176 @@
+"""
+Answer Cache - Cache kết quả của cả workflow DJIA.
+
+Cùng một câu hỏi (ví dụ bộ câu hỏi trong test.txt) không cần chạy lại
+classifier → matcher → SQL → summarizer: kết quả của run_djia_graph được
+giữ lại theo key
+
+    (normalize_text(question), force_chart, data version)
+
+- Data version đọc từ bảng data_version (xem db/data_version.py), được
+  db/init_db.py tăng mỗi lần import lại dữ liệu. Khi version đổi, toàn bộ
+  cache bị xoá.
+- Mỗi câu trả lời hết hạn sau ANSWER_CACHE_TTL giây; khi đầy, câu trả lời ít
+  được dùng gần đây nhất bị bỏ (LRU, tối đa ANSWER_CACHE_MAX_ENTRIES).
+- Chỉ cache kết quả thành công và không phụ thuộc ngày hiện tại
+  (SQL có CURRENT_DATE / NOW() cho kết quả khác nhau theo ngày).
+- Kết quả trả về khi hit có metrics của chính lần tra cache (không LLM/SQL,
+  wall time thực tế) thay vì metrics của lần chạy gốc, và df/chart là bản
+  copy (không dùng chung object giữa các request).
+
+Usage:
+    cache = get_runtime().answer_cache
+    key = cache.key(question, force_chart)
+    result = cache.get(key)
+    if result is None:
+        result = ...  # chạy workflow
+        cache.put(key, result)
+"""
+
+import copy
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+from nodes.instrumentation import summarize_metrics
+from nodes.utils import normalize_text
+
+# SQL có kết quả thay đổi theo thời điểm chạy
+_TIME_DEPENDENT_SQL_RE = re.compile(
+    r"\b(?:current_date|current_timestamp|now\s*\(|localtimestamp)", re.I
+)
+
+CacheKey = Tuple[str, bool, int]
+
+
+def _hit_result(result: Dict[str, Any], wall_ms: float) -> Dict[str, Any]:
+    """Bản copy của kết quả đã cache cho một lần hit."""
+    df = result.get("df")
+    chart = result.get("chart")
+    return {
+        **result,
+        "df": df.copy() if isinstance(df, pd.DataFrame) else df,
+        "chart": copy.deepcopy(chart) if chart is not None else None,
+        # Thời gian từng node là của lần chạy gốc, không phải của request này
+        "workflow": [
+            {k: v for k, v in step.items() if k != "metrics"}
+            for step in result.get("workflow") or []
+        ],
+        "metrics": {**summarize_metrics([]), "wall_ms": round(wall_ms, 2)},
+        "cached": True,
+    }
+
+
+def is_cacheable(result: Dict[str, Any]) -> bool:
+    """Kết quả có thể dùng lại cho lần hỏi sau không."""
+    if not result.get("success") or result.get("error"):
+        return False
+    sql = result.get("actual_sql") or result.get("sql") or ""
+    return not _TIME_DEPENDENT_SQL_RE.search(sql)
+
+
+class AnswerCache:
+    """
+    LRU + TTL cache (thread-safe) cho kết quả của workflow.
+
+    version_reader trả về data version hiện tại; được gọi tối đa một lần mỗi
+    version_check_interval giây để không thêm một query vào mọi request.
+    """
+
+    def __init__(
+        self,
+        version_reader: Callable[[], int],
+        max_entries: int = 512,
+        ttl_seconds: float = 3600,
+        version_check_interval: float = 5,
+    ):
+        self._version_reader = version_reader
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_check_interval = version_check_interval
+        # Tắt tạm thời (ví dụ khi benchmark cần chạy lại toàn bộ workflow)
+        self.enabled = True
+
+        self._lock = threading.Lock()
+        # key -> (thời điểm hết hạn, result)
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._version: Optional[int] = None
+        self._version_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    # ==================== DATA VERSION ====================
+
+    def data_version(self) -> int:
+        """Data version hiện tại (đọc lại từ DB khi quá version_check_interval)."""
+        now = time.monotonic()
+        if (
+            self._version is not None
+            and now - self._version_checked_at < self.version_check_interval
+        ):
+            return self._version
+
+        version = self._version_reader()
+        with self._lock:
+            if version != self._version:
+                # Dữ liệu đã được import lại: mọi câu trả lời cũ không còn đúng
+                self._entries.clear()
+                self._version = version
+            self._version_checked_at = now
+        return version
+
+    # ==================== CACHE ====================
+
+    def key(self, question: str, force_chart: bool = False) -> CacheKey:
+        return (normalize_text(question), bool(force_chart), self.data_version())
+
+    def get(self, key: CacheKey) -> Optional[Dict[str, Any]]:
+        """Kết quả đã cache (bản copy, cached=True, metrics của lần hit) hoặc None."""
+        if not self.enabled:
+            return None
+        started = time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            result = entry[1]
+        return _hit_result(result, (time.perf_counter() - started) * 1000)
+
+    def put(self, key: CacheKey, result: Dict[str, Any]) -> None:
+        if not self.enabled or self.max_entries <= 0 or not is_cacheable(result):
+            return
+        with self._lock:
+            # Key của data version cũ (import lại trong lúc workflow đang chạy)
+            if key[2] != self._version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Xoá toàn bộ cache và đọc lại data version ở lần dùng tiếp theo."""
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "data_version": self._version,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -28,13 +28,17 @@ WORKFLOW (với Classifier và RAG):
     └─────┬────────┘      Có ↙        ↘ Không
           ↓                ↙            ↘
     ┌──────────────┐   ┌──────┐    ┌──────────────────┐
-    │ 4. SQL Gen   │   │ END  │    │ 7. Answer Summary │
-    └─────┬────────┘   │(PDF) │    │ (LLM General)    │
-          ↓            └──────┘    └────────┬─────────┘
-    ┌──────────────┐                        ↓
-    │ 5. SQL Exec  │                ┌───────────────┐
-    └─────┬────────┘                │  END: Answer  │
-          ↓                         └───────────────┘
+    │ 4. SQL Gen   │◄┐ │ END  │    │ 7. Answer Summary │
+    └─────┬────────┘ │ │(PDF) │    │ (LLM General)    │
+          ↓          │ └──────┘    └────────┬─────────┘
+    ┌──────────────┐ │                      ↓
+    │4b. Validate  │─┤ lỗi: sửa     ┌───────────────┐
+    └─────┬────────┘ │ SQL (tối đa  │  END: Answer  │
+          ↓          │ N lần)       └───────────────┘
+    ┌──────────────┐ │
+    │ 5. SQL Exec  │─┘
+    └─────┬────────┘
+          ↓
     Cần biểu đồ?
          ↙    ↘
     Có ↙        ↘ Không
@@ -48,49 +52,77 @@ WORKFLOW (với Classifier và RAG):
                 └───────────────┘
 """
 
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 from langgraph.graph import StateGraph, END
 
 # Import các nodes từ nodes/
-from nodes.question_classifier import classify_question
-from nodes.planner import plan_query
-from nodes.rag_retriever import rag_retrieve
-from nodes.sql_template_matcher import match_sql_template
-from nodes.sql_llm_generator import generate_sql
-from nodes.sql_executor import execute_sql
-from nodes.answer_summarizer import summarize_answer
-from nodes.chart_generator import generate_chart
-
-
-def build_djia_graph():
+from nodes.question_classifier import classify_question, aclassify_question
+from nodes.planner import plan_query, aplan_query
+from nodes.rag_retriever import rag_retrieve, arag_retrieve
+from nodes.sql_template_matcher import match_sql_template, amatch_sql_template
+from nodes.sql_llm_generator import generate_sql, agenerate_sql
+from nodes.sql_validator import validate_sql, avalidate_sql
+from nodes.sql_normalizer import sql_fingerprint
+from nodes.sql_executor import execute_sql, aexecute_sql
+from nodes.answer_summarizer import (
+    summarize_answer,
+    asummarize_answer,
+    ANSWER_TOKEN_EVENT,
+)
+from nodes.chart_generator import generate_chart, agenerate_chart
+from nodes.instrumentation import instrument_node, summarize_metrics
+from config import SQL_REPAIR_MAX_ATTEMPTS
+from runtime import get_runtime
+
+# Tên node -> (hàm sync cho invoke, hàm async cho ainvoke)
+NODES = {
+    "question_classifier": (classify_question, aclassify_question),
+    "plan_query": (plan_query, aplan_query),
+    "rag_retrieve": (rag_retrieve, arag_retrieve),
+    "match_sql_template": (match_sql_template, amatch_sql_template),
+    "generate_sql": (generate_sql, agenerate_sql),
+    "validate_sql": (validate_sql, avalidate_sql),
+    "execute_sql": (execute_sql, aexecute_sql),
+    "generate_chart": (generate_chart, agenerate_chart),
+    "summarize_answer": (summarize_answer, asummarize_answer),
+}
+
+
+def build_djia_graph(use_async: bool = False):
     """
     Xây dựng LangGraph workflow với các nodes và edges.
 
-    Workflow gồm 8 nodes chính:
+    Workflow gồm 9 nodes chính:
     0. question_classifier: Phân loại câu hỏi (SQL-related hay Other)
     1. plan_query: Phân tích câu hỏi SQL, xác định độ phức tạp
     2. rag_retrieve: Xử lý câu hỏi Other từ knowledge base (PDF)
     3. match_sql_template: Tìm SQL mẫu từ 80+ templates
     4. generate_sql: Sinh SQL bằng Gemini AI (nếu không có mẫu)
+    4b. validate_sql: Kiểm tra SQL của LLM tại chỗ (schema, tham số, chỉ SELECT);
+        SQL lỗi (khi validate hoặc thực thi) được gửi lại generate_sql để sửa,
+        tối đa SQL_REPAIR_MAX_ATTEMPTS lần
     5. execute_sql: Thực thi SQL trên PostgreSQL database
     6. generate_chart: Vẽ biểu đồ (nếu cần)
     7. summarize_answer: Tạo câu trả lời tự nhiên (SQL hoặc LLM general)
 
+    Args:
+        use_async: True để dùng các node async (cho ainvoke dưới ASGI),
+            False để dùng các node sync (cho invoke)
+
     Returns:
-        Compiled LangGraph workflow ready để invoke
+        Compiled LangGraph workflow ready để invoke/ainvoke
     """
     # Khởi tạo StateGraph với state type là dictionary
     graph = StateGraph(dict)
 
     # ========== THÊM NODES VÀO GRAPH ==========
-    graph.add_node("question_classifier", classify_question)
-    graph.add_node("plan_query", plan_query)
-    graph.add_node("rag_retrieve", rag_retrieve)
-    graph.add_node("match_sql_template", match_sql_template)
-    graph.add_node("generate_sql", generate_sql)
-    graph.add_node("execute_sql", execute_sql)
-    graph.add_node("generate_chart", generate_chart)
-    graph.add_node("summarize_answer", summarize_answer)
+    # Cùng topology cho cả hai chế độ, chỉ khác implementation của node.
+    # Mỗi node được bọc instrumentation để ghi thời gian, LLM tokens, SQL time
+    for name, (sync_node, async_node) in NODES.items():
+        graph.add_node(
+            name, instrument_node(name, async_node if use_async else sync_node)
+        )
 
     # ========== ĐỊNH NGHĨA WORKFLOW FLOW ==========
 
@@ -140,20 +172,52 @@ def build_djia_graph():
         {"generate_sql": "generate_sql", "execute_sql": "execute_sql"},
     )
 
-    # Step 4→5: Sau generate SQL → execute
-    graph.add_edge("generate_sql", "execute_sql")
+    # Step 4→4b: Sau generate SQL → kiểm tra SQL tại chỗ
+    graph.add_edge("generate_sql", "validate_sql")
+
+    # Step 4b→5/4: Conditional - SQL hợp lệ thì thực thi, lỗi thì sửa lại
+    def after_validate(state: Dict[str, Any]) -> str:
+        """
+        Quyết định sau khi kiểm tra SQL của LLM.
+
+        Returns:
+            "execute_sql" nếu SQL hợp lệ (hoặc hết lượt sửa nhưng lỗi không
+                phải câu lệnh ghi: để PostgreSQL quyết định)
+            "generate_sql" nếu SQL lỗi và còn lượt sửa
+            "summarize_answer" nếu hết lượt sửa và SQL bị chặn (câu lệnh ghi)
+        """
+        validation = state.get("sql_validation") or {}
+        if validation.get("valid", True):
+            return "execute_sql"
+        if can_repair(state):
+            return "generate_sql"
+        return "summarize_answer" if validation.get("blocked") else "execute_sql"
+
+    graph.add_conditional_edges(
+        "validate_sql",
+        after_validate,
+        {
+            "execute_sql": "execute_sql",
+            "generate_sql": "generate_sql",
+            "summarize_answer": "summarize_answer",
+        },
+    )
 
-    # Step 5→6/7: Conditional - Có cần vẽ biểu đồ không?
+    # Step 5→4/6/7: Conditional - SQL của LLM lỗi khi thực thi thì sửa lại,
+    # không thì có cần vẽ biểu đồ không?
     def need_chart(state: Dict[str, Any]) -> str:
         """
-        Quyết định có cần vẽ biểu đồ không.
+        Quyết định bước sau khi thực thi SQL.
 
-        Dựa trên flag "needs_chart" được set bởi planner.
+        Dựa trên lỗi thực thi và flag "needs_chart" được set bởi planner.
 
         Returns:
+            "generate_sql" nếu SQL do LLM sinh chạy lỗi và còn lượt sửa
             "generate_chart" nếu cần vẽ biểu đồ
             "summarize_answer" nếu không cần
         """
+        if state.get("error") and can_repair(state):
+            return "generate_sql"
         return (
             "generate_chart" if state.get("needs_chart", False) else "summarize_answer"
         )
@@ -161,7 +225,11 @@ def build_djia_graph():
     graph.add_conditional_edges(
         "execute_sql",
         need_chart,
-        {"generate_chart": "generate_chart", "summarize_answer": "summarize_answer"},
+        {
+            "generate_sql": "generate_sql",
+            "generate_chart": "generate_chart",
+            "summarize_answer": "summarize_answer",
+        },
     )
 
     # Step 6→7: Sau vẽ biểu đồ → summarize
@@ -174,12 +242,20 @@ def build_djia_graph():
     return graph.compile()
 
 
+def can_repair(state: Dict[str, Any]) -> bool:
+    """SQL do LLM sinh (không phải SQL mẫu) và chưa dùng hết lượt sửa SQL."""
+    return (
+        state.get("sql_source") in ("llm", "shape_cache")
+        and state.get("sql_repairs", 0) < SQL_REPAIR_MAX_ATTEMPTS
+    )
+
+
 def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
     """
     Entry point chính để chạy workflow DJIA.
 
     Hàm này:
-    1. Build workflow graph
+    1. Lấy workflow graph đã compile từ runtime dùng chung
     2. Invoke với câu hỏi từ user
     3. Track workflow steps để debug
     4. Trả về kết quả cuối cùng với metadata
@@ -196,10 +272,17 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
         - df: DataFrame - dữ liệu kết quả
         - chart: Plotly Figure - biểu đồ (nếu có)
         - used_sample: Boolean - có dùng SQL mẫu không
+        - sql_source: "llm" / "shape_cache" - nguồn SQL khi không dùng SQL mẫu
         - error: String - error message (nếu có lỗi)
         - workflow: List - các bước đã thực hiện
         - complexity: Dict - thông tin độ phức tạp
         - is_general_question: Boolean - có phải general question không
+        - classification: Dict - nhãn SQL/OTHER, độ tin cậy và nguồn quyết định
+        - metrics: Dict - thời gian/tokens/SQL thực tế của từng node và tổng
+        - cached: Boolean - chỉ có (True) khi kết quả lấy từ answer cache
+
+    Câu hỏi đã trả lời trước đó (cùng câu hỏi chuẩn hoá, force_chart và data
+    version) được lấy thẳng từ answer cache, không chạy lại workflow.
 
     Examples:
         >>> result = run_djia_graph("What was Apple's closing price on 2024-01-15?")
@@ -213,29 +296,155 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
         >>> result = run_djia_graph("Vẽ biểu đồ giá Apple trong Q1 2024")
         >>> result['chart']  # Plotly figure object
     """
-    # Build và compile workflow
-    app = build_djia_graph()
+    cache, key, cached = _cached_result(question, force_chart)
+    if cached is not None:
+        return cached
 
-    # Track workflow steps để debugging/logging
-    workflow_steps = []
+    # Dùng workflow đã compile sẵn (build một lần cho cả process)
+    app = get_runtime().graph
+    result = _build_result(app.invoke(_initial_state(question, force_chart)))
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+async def arun_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
+    """
+    Phiên bản async của run_djia_graph (dùng dưới ASGI).
+
+    Workflow async gọi Gemini và PostgreSQL không chặn event loop, nên một
+    worker có thể xử lý nhiều câu hỏi đồng thời. Kết quả trả về giống hệt
+    run_djia_graph.
+    """
+    cache, key, cached = await asyncio.to_thread(_cached_result, question, force_chart)
+    if cached is not None:
+        return cached
+
+    app = get_runtime().async_graph
+    result = _build_result(await app.ainvoke(_initial_state(question, force_chart)))
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+async def astream_djia_graph(
+    question: str, force_chart: bool = False
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Chạy workflow async và phát sự kiện tiến trình ngay khi chúng xảy ra.
+
+    Dùng cho SSE endpoint. Mỗi phần tử yield là dict có key "event":
+    - node_start / node_end: {"node": tên node} khi một node bắt đầu/kết thúc
+      (node_end kèm "metrics" của node, xem nodes.instrumentation)
+    - rows: {"df": DataFrame, "sql": SQL đã chạy, "error": ...} ngay sau execute_sql
+    - token: {"text": đoạn câu trả lời} khi Gemini stream câu trả lời
+    - result: {"result": output giống run_djia_graph} khi workflow kết thúc
+
+    Nếu câu hỏi có trong answer cache, chỉ có một event result.
+    """
+    cache, key, cached = await asyncio.to_thread(_cached_result, question, force_chart)
+    if cached is not None:
+        yield {"event": "result", "result": cached}
+        return
+
+    app = get_runtime().async_graph
+
+    async for event in app.astream_events(
+        _initial_state(question, force_chart), version="v2"
+    ):
+        kind = event["event"]
+        name = event.get("name")
+        parent_ids = event.get("parent_ids") or []
+
+        if kind == "on_custom_event" and name == ANSWER_TOKEN_EVENT:
+            yield {"event": "token", "text": event["data"].get("text", "")}
+            continue
+
+        # Event của toàn bộ graph (không có run cha): state cuối cùng
+        if kind == "on_chain_end" and not parent_ids:
+            result = _build_result(event["data"]["output"])
+            if cache is not None:
+                cache.put(key, result)
+            yield {"event": "result", "result": result}
+            continue
+
+        # Chỉ quan tâm run của chính các node (bỏ qua router/runnable con)
+        if name not in NODES or event.get("metadata", {}).get("langgraph_node") != name:
+            continue
+
+        if kind == "on_chain_start":
+            yield {"event": "node_start", "node": name}
+        elif kind == "on_chain_end":
+            output = event["data"].get("output") or {}
+            node_metrics = output.get("node_metrics") or []
+            yield {
+                "event": "node_end",
+                "node": name,
+                "metrics": node_metrics[-1] if node_metrics else None,
+            }
+            if name == "execute_sql":
+                yield {
+                    "event": "rows",
+                    "df": output.get("df"),
+                    "sql": output.get("actual_sql") or output.get("sql") or "",
+                    "error": output.get("error"),
+                }
+
+
+def _cached_result(
+    question: str, force_chart: bool
+) -> Tuple[Any, Optional[tuple], Optional[Dict[str, Any]]]:
+    """
+    Tra answer cache. Trả về (cache, key, kết quả đã cache hoặc None).
 
-    # Invoke workflow với initial state
+    cache là None khi cache bị tắt (ANSWER_CACHE_ENABLED hoặc cache.enabled)
+    hoặc không đọc được data version; khi đó
+    workflow vẫn chạy bình thường, chỉ là không cache.
+    """
+    cache = get_runtime().answer_cache
+    if cache is None or not cache.enabled:
+        return None, None, None
+    try:
+        key = cache.key(question, force_chart)
+    except Exception as e:
+        print(f"Error reading data version for answer cache: {e}")
+        return None, None, None
+    return cache, key, cache.get(key)
+
+
+def _initial_state(question: str, force_chart: bool) -> Dict[str, Any]:
     initial_state = {"question": question}
     if force_chart:
         initial_state["force_chart"] = True
-    result = app.invoke(initial_state)
+    return initial_state
+
+
+def _build_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Chuẩn hóa state cuối cùng của workflow thành output cho API/UI."""
+    # Metrics thực tế của từng node (ghi bởi instrument_node)
+    node_metrics = result.get("node_metrics") or []
+
+    # Track workflow steps để debugging/logging
+    workflow_steps = []
 
     # ========== TRACK WORKFLOW STEPS ==========
 
     # Step 0: Classification
     is_sql_related = result.get("is_sql_related", True)
+    # Độ tin cậy và nguồn quyết định (rules / embedding / llm / default)
+    classification = result.get("classification") or {}
     workflow_steps.append(
         {
             "step": 1,
             "node": "question_classifier",
             "description": "Phân loại câu hỏi",
             "status": "completed",
-            "result": f"Loại: {'SQL-related' if is_sql_related else 'Other'}",
+            "result": (
+                f"Loại: {'SQL-related' if is_sql_related else 'Other'}"
+                f" ({classification.get('source', 'llm')}, "
+                f"độ tin cậy {classification.get('confidence', 1.0):.2f})"
+            ),
+            "classification": classification,
         }
     )
 
@@ -263,6 +472,7 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
             }
         )
         
+        _attach_metrics(workflow_steps, node_metrics)
         return {
             "success": True,
             "sql": None,
@@ -270,11 +480,16 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
             "df": None,
             "answer": result.get("answer", ""),
             "used_sample": False,
+            "sql_source": None,
+            "sql_repairs": 0,
+            "sql_fingerprint": None,
             "error": None,
             "workflow": workflow_steps,
             "chart": None,
             "complexity": {},
             "is_general_question": not is_sql_related,
+            "classification": classification,
+            "metrics": summarize_metrics(node_metrics),
         }
 
     # SQL-related path: Lấy thông tin complexity
@@ -311,24 +526,47 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
                 "node": "generate_sql",
                 "description": "Sinh SQL bằng Gemini AI",
                 "status": "completed",
-                "result": "SQL được sinh tự động bởi LLM",
+                "result": "SQL dùng lại từ câu hỏi cùng dạng (không gọi LLM)"
+                if result.get("sql_source") == "shape_cache"
+                else "SQL được sinh tự động bởi LLM"
+                + (
+                    f" (sửa lại {result['sql_repairs']} lần)"
+                    if result.get("sql_repairs")
+                    else ""
+                ),
             }
         )
 
-    # Step 3: SQL Execution
-    workflow_steps.append(
-        {
-            "step": len(workflow_steps) + 1,
-            "node": "execute_sql",
-            "description": "Thực thi SQL trên PostgreSQL database",
-            "status": "completed" if not result.get("error") else "error",
-            "result": (
-                f"Trả về {len(result.get('df', []))} dòng dữ liệu"
-                if result.get("df") is not None
-                else "Lỗi thực thi"
-            ),
-        }
-    )
+    # Step 2b: Kiểm tra SQL của LLM (kết quả của lần kiểm tra cuối)
+    validation = result.get("sql_validation")
+    if validation:
+        workflow_steps.append(
+            {
+                "step": len(workflow_steps) + 1,
+                "node": "validate_sql",
+                "description": "Kiểm tra SQL (schema, tham số, chỉ SELECT)",
+                "status": "completed" if validation.get("valid") else "error",
+                "result": "SQL hợp lệ"
+                if validation.get("valid")
+                else "; ".join(validation.get("errors") or []),
+            }
+        )
+
+    # Step 3: SQL Execution (không chạy nếu SQL bị validate_sql chặn)
+    if not (validation and validation.get("blocked")):
+        workflow_steps.append(
+            {
+                "step": len(workflow_steps) + 1,
+                "node": "execute_sql",
+                "description": "Thực thi SQL trên PostgreSQL database",
+                "status": "completed" if not result.get("error") else "error",
+                "result": (
+                    f"Trả về {len(result.get('df', []))} dòng dữ liệu"
+                    if result.get("df") is not None
+                    else "Lỗi thực thi"
+                ),
+            }
+        )
 
     # Step 4: Chart Generation (nếu cần)
     if result.get("needs_chart"):
@@ -361,6 +599,8 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
     # Workflow thành công nếu không có lỗi và có kết quả (answer hoặc data)
     success = not has_error and (has_answer or has_data)
 
+    _attach_metrics(workflow_steps, node_metrics)
+
     # ========== CHUẨN HÓA OUTPUT ==========
     return {
         "success": success,  # Workflow thành công?
@@ -369,9 +609,23 @@ def run_djia_graph(question: str, force_chart: bool = False) -> Dict[str, Any]:
         "df": result.get("df"),  # DataFrame kết quả
         "answer": result.get("answer", ""),  # Câu trả lời tự nhiên
         "used_sample": result.get("used_sample", False),  # Có dùng SQL mẫu?
+        "sql_source": result.get("sql_source"),  # "llm" / "shape_cache" (SQL không từ mẫu)
+        "sql_repairs": result.get("sql_repairs", 0),  # Số lần LLM sửa SQL lỗi
+        "sql_fingerprint": sql_fingerprint(result.get("sql")),  # Key thống kê theo truy vấn
         "error": result.get("error"),  # Error message (nếu có)
         "workflow": workflow_steps,  # Steps đã thực hiện
         "chart": result.get("chart"),  # Plotly figure (nếu có)
         "complexity": complexity,  # Thông tin độ phức tạp
         "is_general_question": False,  # Đây là data question
+        "classification": classification,  # Kết quả phân loại SQL/OTHER
+        "metrics": summarize_metrics(node_metrics),  # Thời gian/tokens/SQL thực tế
     }
+
+
+def _attach_metrics(
+    workflow_steps: List[Dict[str, Any]], node_metrics: List[Dict[str, Any]]
+) -> None:
+    """Gắn metrics đo được vào từng workflow step theo tên node."""
+    by_node = {m["node"]: m for m in node_metrics}
+    for step in workflow_steps:
+        step["metrics"] = by_node.get(step["node"])
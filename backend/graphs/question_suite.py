@@ -0,0 +1,184 @@
+"""
+Question Suite - Bộ câu hỏi/đáp án mẫu trong test.txt.
+
+test.txt gồm các nhóm câu hỏi đánh số, ngăn cách bởi dòng header:
+
+    -- TEST SQL TEMPLATE          -> section
+    -- FACTUAL, EASY              -> category
+    1. Question: What was the opening price of Boeing on August 1, 2023?
+    Answer: $237.55
+
+Câu hỏi có thể xuống dòng (ví dụ "... as of April 26,\\n2025"), đáp án có
+thể nhiều dòng (danh sách top 5), nhóm TEST CHART / TEST RAG không có đáp án.
+
+check_answer() so câu trả lời của workflow với đáp án mong đợi: mọi con số
+và ngày trong đáp án phải xuất hiện trong câu trả lời hoặc dữ liệu trả về.
+
+Usage:
+    from graphs.question_suite import load_question_suite, check_answer
+    for item in load_question_suite():
+        result = run_djia_graph(item.question)
+        print(item.label, check_answer(item, result["answer"]))
+"""
+
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Optional, Set
+
+from config import TEST_QUESTIONS_FILE
+
+_ITEM_RE = re.compile(r"^\s*(\d+)\.\s*(?:Question\s*:\s*)?(.*)$", re.I)
+_ANSWER_RE = re.compile(r"^\s*Answer\s*:\s*(.*)$", re.I)
+
+_DATE_RE = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+# Số có thể có dấu phẩy phân cách hàng nghìn: 58,414,500 / 237.55 / -62.13
+_NUMBER_RE = re.compile(r"-?\d{1,3}(?:,\d{3})+(?:\.\d+)?|-?\d+(?:\.\d+)?")
+# Từ ngắn/thông dụng không dùng để so đáp án dạng chữ
+_MIN_WORD_LENGTH = 4
+_WORD_MATCH_RATIO = 0.6
+
+
+@dataclass(frozen=True)
+class SuiteQuestion:
+    """Một câu hỏi trong test.txt cùng đáp án mong đợi (nếu có)."""
+
+    section: Optional[str]
+    category: Optional[str]
+    number: int
+    question: str
+    answer: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        """Tên ngắn để hiển thị, ví dụ "TEST SQL TEMPLATE / FACTUAL, EASY #3"."""
+        group = " / ".join(part for part in (self.section, self.category) if part)
+        return f"{group} #{self.number}" if group else f"#{self.number}"
+
+
+def parse_question_suite(text: str) -> List[SuiteQuestion]:
+    """Parse nội dung test.txt thành danh sách SuiteQuestion."""
+    items: List[SuiteQuestion] = []
+    section = category = None
+    # Mỗi câu hỏi là một khối dòng liền nhau (ngăn cách bởi dòng trống)
+    for block in re.split(r"\n\s*\n", text):
+        lines = [line.rstrip() for line in block.strip().splitlines()]
+        while lines and lines[0].lstrip().startswith("--"):
+            header = lines.pop(0).lstrip("- ").strip()
+            if header.upper().startswith("TEST"):
+                section, category = header, None
+            else:
+                category = header
+        if not lines:
+            continue
+
+        match = _ITEM_RE.match(lines[0])
+        if not match:
+            continue
+        question_lines = [match.group(2)]
+        answer_lines = None
+        for line in lines[1:]:
+            answer_match = _ANSWER_RE.match(line)
+            if answer_lines is None and answer_match:
+                answer_lines = [answer_match.group(1)]
+            elif answer_lines is None:
+                question_lines.append(line.strip())
+            else:
+                answer_lines.append(line)
+
+        items.append(
+            SuiteQuestion(
+                section=section,
+                category=category,
+                number=int(match.group(1)),
+                question=" ".join(part for part in question_lines if part).strip(),
+                answer="\n".join(answer_lines).strip() if answer_lines else None,
+            )
+        )
+    return items
+
+
+def load_question_suite(path: Path = TEST_QUESTIONS_FILE) -> List[SuiteQuestion]:
+    """Đọc và parse file câu hỏi mẫu (mặc định test.txt ở thư mục gốc repo)."""
+    return parse_question_suite(Path(path).read_text(encoding="utf-8"))
+
+
+def _numbers(text: str) -> List[str]:
+    return _NUMBER_RE.findall(_DATE_RE.sub(" ", text))
+
+
+def _to_float(token: str) -> float:
+    return float(token.replace(",", ""))
+
+
+def _tolerance(token: str) -> float:
+    # Đáp án làm tròn tới số chữ số thập phân đang ghi (237.55 -> ±0.005)
+    decimals = len(token.split(".")[1]) if "." in token else 0
+    return 0.5 * 10 ** -decimals + 1e-9
+
+
+def _matches_number(expected: str, actual: Iterable[float]) -> bool:
+    value, tolerance = _to_float(expected), _tolerance(expected)
+    for candidate in actual:
+        # Chấp nhận cả dạng tỷ lệ (0.2421) cho đáp án phần trăm (24.21%)
+        for scaled in (candidate, candidate * 100):
+            if abs(abs(scaled) - abs(value)) <= tolerance:
+                return True
+    return False
+
+
+def _words(text: str) -> Set[str]:
+    return {
+        word
+        for word in re.findall(r"[a-z0-9&]+", text.lower())
+        if len(word) >= _MIN_WORD_LENGTH
+    }
+
+
+def check_answer(
+    item: SuiteQuestion, answer: Optional[str], values: Iterable[object] = ()
+) -> Optional[bool]:
+    """
+    Câu trả lời có khớp đáp án mong đợi không (None nếu câu hỏi không có đáp án).
+
+    - Ngày (YYYY-MM-DD) trong đáp án phải có trong câu trả lời/dữ liệu
+    - Con số trong đáp án (bỏ các số đã có sẵn trong câu hỏi, ví dụ năm) phải
+      khớp một con số trong câu trả lời hoặc giá trị trong dữ liệu trả về,
+      sai số theo số chữ số thập phân của đáp án
+    - Đáp án không có số (ví dụ tên ngành): đủ 60% từ khoá xuất hiện
+
+    Args:
+        item: Câu hỏi cùng đáp án mong đợi
+        answer: Câu trả lời của workflow
+        values: Các giá trị trong dữ liệu trả về (ví dụ df.to_numpy().ravel())
+    """
+    if not item.answer:
+        return None
+    answer = answer or ""
+    values = list(values)
+    haystack = " ".join([answer, *(str(value) for value in values)])
+
+    expected_dates = set(_DATE_RE.findall(item.answer)) - set(_DATE_RE.findall(item.question))
+    if any(date not in haystack for date in expected_dates):
+        return False
+
+    question_numbers = {_to_float(token) for token in _numbers(item.question)}
+    expected_numbers = [
+        token for token in _numbers(item.answer) if _to_float(token) not in question_numbers
+    ]
+    if expected_numbers:
+        actual = [_to_float(token) for token in _numbers(answer)]
+        for value in values:
+            try:
+                actual.append(float(value))
+            except (TypeError, ValueError):
+                actual.extend(_to_float(token) for token in _numbers(str(value)))
+        return all(_matches_number(token, actual) for token in expected_numbers)
+
+    if expected_dates:
+        return True
+    expected_words = _words(item.answer) - _words(item.question)
+    if not expected_words:
+        return True
+    found = expected_words & _words(haystack)
+    return len(found) / len(expected_words) >= _WORD_MATCH_RATIO
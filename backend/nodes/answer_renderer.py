@@ -0,0 +1,353 @@
+"""
+Answer Renderer - Tạo câu trả lời theo quy tắc cho kết quả của SQL mẫu.
+
+Với SQL mẫu, "-- FIELDS:" đã cho biết chính xác ý nghĩa từng cột (ví dụ
+answer=close là giá đóng cửa), nên kết quả nhỏ (một dòng hoặc vài dòng)
+được diễn đạt trực tiếp bằng tiếng Việt/tiếng Anh, không cần gọi Gemini:
+
+    Câu hỏi: What was the closing price of Apple on 2024-01-15?
+    FIELDS:  close
+    df:      [{"close": 185.92}]
+    -> "The closing price of AAPL on 2024-01-15 was 185.92 USD."
+
+render_answer() trả về None khi không chắc diễn đạt đúng (không phải SQL
+mẫu, nhiều dòng, cột chưa biết nghĩa, thiếu cột...) để summarizer dùng LLM.
+"""
+
+import math
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from nodes.template_registry import SqlTemplate
+from nodes.utils import is_vietnamese
+
+# Số dòng tối đa được diễn đạt bằng quy tắc (nhiều hơn thì để LLM tóm tắt)
+MAX_RENDER_ROWS = 5
+
+# field -> (nhãn tiếng Việt, nhãn tiếng Anh, kiểu giá trị)
+# Kiểu giá trị quyết định cách format:
+# price: USD, volume: số cổ phiếu, percent_change/price_change: tăng/giảm,
+# percent: %, money: số tiền lớn (nghìn tỷ/tỷ/triệu), count/number: số, text/date: giữ nguyên
+FIELD_SPECS: Dict[str, Tuple[str, str, str]] = {
+    "close": ("giá đóng cửa", "closing price", "price"),
+    "open": ("giá mở cửa", "opening price", "price"),
+    "high": ("giá cao nhất", "highest price", "price"),
+    "low": ("giá thấp nhất", "lowest price", "price"),
+    "volume": ("khối lượng giao dịch", "trading volume", "volume"),
+    "avg_close": ("giá đóng cửa trung bình", "average closing price", "price"),
+    "avg_open": ("giá mở cửa trung bình", "average opening price", "price"),
+    "median_close": ("giá đóng cửa trung vị", "median closing price", "price"),
+    "median_open": ("giá mở cửa trung vị", "median opening price", "price"),
+    "max_close": ("giá đóng cửa cao nhất", "highest closing price", "price"),
+    "min_close": ("giá đóng cửa thấp nhất", "lowest closing price", "price"),
+    "max_open": ("giá mở cửa cao nhất", "highest opening price", "price"),
+    "min_open": ("giá mở cửa thấp nhất", "lowest opening price", "price"),
+    "moving_avg_close": ("giá đóng cửa trung bình động", "moving average closing price", "price"),
+    "avg_volume": ("khối lượng giao dịch trung bình", "average trading volume", "volume"),
+    "total_volume": ("tổng khối lượng giao dịch", "total trading volume", "volume"),
+    "week_52_high": ("giá cao nhất 52 tuần", "52-week high", "price"),
+    "week_52_low": ("giá thấp nhất 52 tuần", "52-week low", "price"),
+    "52_week_high": ("giá cao nhất 52 tuần", "52-week high", "price"),
+    "52_week_low": ("giá thấp nhất 52 tuần", "52-week low", "price"),
+    "dividends": ("cổ tức", "dividend", "price"),
+    "dividend": ("cổ tức", "dividend", "price"),
+    "dividend_per_share": ("cổ tức mỗi cổ phiếu", "dividend per share", "price"),
+    "dividends_count": ("số lần trả cổ tức", "number of dividend payments", "count"),
+    "pe_ratio": ("chỉ số P/E", "P/E ratio", "number"),
+    "market_cap": ("vốn hóa thị trường", "market capitalization", "money"),
+    "stock_splits": ("tỷ lệ chia tách cổ phiếu", "stock split ratio", "number"),
+    "split_ratio": ("tỷ lệ chia tách cổ phiếu", "stock split ratio", "number"),
+    "percentage_increase": ("mức tăng giá", "price increase", "percent"),
+    "percentage_decrease": ("mức giảm giá", "price decrease", "percent"),
+    "percentage_decline": ("mức giảm giá", "price decline", "percent"),
+    "percentage_change": ("biến động giá", "price change", "percent_change"),
+    "cumulative_return": ("lợi nhuận tích lũy", "cumulative return", "percent_change"),
+    "cagr": ("tốc độ tăng trưởng kép hằng năm (CAGR)", "compound annual growth rate (CAGR)", "percent_change"),
+    "price_change": ("thay đổi giá", "price change", "price_change"),
+    "absolute_change": ("thay đổi giá", "price change", "price_change"),
+    "absolute_decrease": ("mức giảm giá", "price decrease", "price"),
+    "sector": ("lĩnh vực (sector)", "sector", "text"),
+    "industry": ("ngành (industry)", "industry", "text"),
+    "country": ("quốc gia", "country", "text"),
+    "website": ("website", "website", "text"),
+    "description": ("mô tả", "description", "text"),
+    "symbol": ("mã cổ phiếu", "ticker symbol", "text"),
+    "date": ("ngày", "date", "date"),
+    "week_start": ("tuần bắt đầu", "week starting", "date"),
+}
+
+# dividend_yield không có ở đây: đơn vị trong database không thống nhất (tỷ lệ
+# hay %, tuỳ phiên bản yfinance lúc tải) nên để LLM diễn đạt.
+
+# Field xếp hạng mà SQL mẫu dùng cùng alias cho cả hai chiều (max_gain của câu
+# hỏi "lowest single-day percentage gain" là MIN): nhãn lấy chiều từ câu hỏi mẫu.
+# field -> (danh từ tiếng Việt, danh từ tiếng Anh); giá trị có dấu (percent_change)
+RANKED_FIELDS: Dict[str, Tuple[str, str]] = {
+    "max_gain": ("mức tăng phần trăm trong ngày", "single-day percentage gain"),
+    "max_drop": ("mức giảm phần trăm trong ngày", "single-day percentage drop"),
+}
+_LOWEST_WORDS = ("lowest", "smallest", "nhỏ nhất", "thấp nhất")
+_HIGHEST_WORDS = ("highest", "largest", "lớn nhất", "cao nhất")
+
+# Cột xác định đối tượng của từng dòng (không phải giá trị trả lời)
+_SUBJECT_FIELDS = ("company", "ticker", "date", "week_start")
+
+_MONEY_UNITS = {
+    True: ((1e12, "nghìn tỷ"), (1e9, "tỷ"), (1e6, "triệu")),
+    False: ((1e12, "trillion"), (1e9, "billion"), (1e6, "million")),
+}
+
+
+def _is_missing(value: Any) -> bool:
+    if value is None:
+        return True
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def _to_float(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)) or hasattr(value, "item"):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return number if math.isfinite(number) else None
+    return None
+
+
+def _format_date(value: Any) -> str:
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def format_value(value: Any, kind: str, vietnamese: bool) -> Optional[str]:
+    """
+    Format một giá trị theo kiểu của field.
+
+    Examples:
+        >>> format_value(185.9234, "price", False)
+        '185.92 USD'
+        >>> format_value(-12.5, "percent_change", True)
+        'giảm 12.50%'
+        >>> format_value(4113459052544, "money", False)
+        '4.11 trillion USD'
+    """
+    if kind in ("text", "date"):
+        return _format_date(value)
+
+    number = _to_float(value)
+    if number is None:
+        return None
+
+    if kind == "price":
+        return f"{number:,.2f} USD"
+    if kind == "volume":
+        return f"{number:,.0f} {'cổ phiếu' if vietnamese else 'shares'}"
+    if kind == "count":
+        return f"{number:,.0f}"
+    if kind == "percent":
+        return f"{number:,.2f}%"
+    if kind in ("percent_change", "price_change"):
+        magnitude = (
+            f"{abs(number):,.2f}%" if kind == "percent_change" else f"{abs(number):,.2f} USD"
+        )
+        if number > 0:
+            return f"{'tăng' if vietnamese else 'up'} {magnitude}"
+        if number < 0:
+            return f"{'giảm' if vietnamese else 'down'} {magnitude}"
+        return f"{'không đổi' if vietnamese else 'unchanged'} ({magnitude})"
+    if kind == "money":
+        for threshold, unit in _MONEY_UNITS[vietnamese]:
+            if abs(number) >= threshold:
+                return f"{number / threshold:,.2f} {unit} USD"
+        return f"{number:,.2f} USD"
+    return f"{number:,.2f}".rstrip("0").rstrip(".") if number % 1 else f"{number:,.0f}"
+
+
+def _spec(field: str) -> Optional[Tuple[str, str, str]]:
+    return FIELD_SPECS.get(field)
+
+
+def _ranked_spec(field: str, template: SqlTemplate) -> Optional[Tuple[str, str, str]]:
+    """Spec của field xếp hạng, chiều (lớn nhất/nhỏ nhất) lấy từ câu hỏi mẫu."""
+    noun_vi, noun_en = RANKED_FIELDS[field]
+    text = " ".join(template.questions).lower()
+    lowest = any(word in text for word in _LOWEST_WORDS)
+    highest = any(word in text for word in _HIGHEST_WORDS)
+    if lowest == highest:
+        # Không rõ chiều: để LLM diễn đạt
+        return None
+    if lowest:
+        return (f"{noun_vi} nhỏ nhất", f"lowest {noun_en}", "percent_change")
+    return (f"{noun_vi} lớn nhất", f"highest {noun_en}", "percent_change")
+
+
+def _field_spec(field: str, template: SqlTemplate) -> Optional[Tuple[str, str, str]]:
+    if field in RANKED_FIELDS:
+        return _ranked_spec(field, template)
+    return _spec(field)
+
+
+def _context(template: SqlTemplate, params: Dict[str, Any], vietnamese: bool) -> str:
+    """Mốc thời gian của câu hỏi, chỉ lấy từ các parameter mà SQL mẫu thực sự dùng."""
+    used = {name: params.get(name) for name in template.params if params.get(name) is not None}
+    if "date" in used:
+        return f" {'vào' if vietnamese else 'on'} {used['date']}"
+    if "start_date" in used and "end_date" in used:
+        if vietnamese:
+            return f" từ {used['start_date']} đến {used['end_date']}"
+        return f" from {used['start_date']} to {used['end_date']}"
+    if "year" in used:
+        year = used["year"]
+        if "quarter" in used:
+            return f" trong quý {used['quarter']}/{year}" if vietnamese else f" in Q{used['quarter']} {year}"
+        if "month" in used:
+            return f" trong tháng {used['month']}/{year}" if vietnamese else f" in {year}-{used['month']}"
+        if "start_month" in used and "end_month" in used:
+            if vietnamese:
+                return f" từ tháng {used['start_month']} đến tháng {used['end_month']}/{year}"
+            return f" from {year}-{used['start_month']} to {year}-{used['end_month']}"
+        return f" {'trong năm' if vietnamese else 'in'} {year}"
+    return ""
+
+
+def _sentence(label: str, subject: str, context: str, value: str, vietnamese: bool) -> str:
+    if vietnamese:
+        owner = f" của {subject}" if subject else ""
+        return f"{label[0].upper()}{label[1:]}{owner}{context} là {value}."
+    owner = f" of {subject}" if subject else ""
+    # Không có mốc thời gian (sector, market cap...) thì là thông tin hiện tại
+    verb = "was" if context else "is"
+    return f"The {label}{owner}{context} {verb} {value}."
+
+
+def _render_comparison(
+    row: pd.Series,
+    fields: Sequence[str],
+    params: Dict[str, Any],
+    context: str,
+    vietnamese: bool,
+) -> Optional[str]:
+    """FIELDS dạng a_x, b_x: so sánh cùng một chỉ số của hai công ty."""
+    base = fields[0][2:]
+    if len(fields) != 2 or fields[1] != f"b_{base}" or _spec(base) is None:
+        return None
+    label_vi, label_en, kind = _spec(base)
+    values = [row[f] for f in fields]
+    formatted = [format_value(v, kind, vietnamese) for v in values]
+    numbers = [_to_float(v) for v in values]
+    if None in formatted or None in numbers:
+        return None
+
+    ticker_a = params.get("ticker_a") or "A"
+    ticker_b = params.get("ticker_b") or "B"
+    label = label_vi if vietnamese else label_en
+    head = f"{label[0].upper()}{label[1:]}{context}: {ticker_a} {formatted[0]}, {ticker_b} {formatted[1]}"
+    if numbers[0] == numbers[1]:
+        tail = " (bằng nhau)" if vietnamese else " (equal)"
+    else:
+        winner = ticker_a if numbers[0] > numbers[1] else ticker_b
+        tail = f" ({winner} {'cao hơn' if vietnamese else 'higher'})"
+    return head + tail + "."
+
+
+def _row_subject(row: pd.Series, fields: Sequence[str]) -> str:
+    parts = [_format_date(row[f]) for f in _SUBJECT_FIELDS if f in fields and not _is_missing(row[f])]
+    return " - ".join(parts)
+
+
+def _render_rows(
+    df: pd.DataFrame,
+    fields: Sequence[str],
+    template: SqlTemplate,
+    context: str,
+    vietnamese: bool,
+) -> Optional[str]:
+    """Kết quả nhiều dòng dạng (đối tượng, giá trị): liệt kê từng dòng."""
+    subject_fields = [f for f in fields if f in _SUBJECT_FIELDS]
+    value_fields = [f for f in fields if f not in subject_fields]
+    specs = {f: _field_spec(f, template) for f in value_fields}
+    if not subject_fields or any(spec is None for spec in specs.values()):
+        return None
+
+    lines = []
+    for _, row in df.iterrows():
+        values = []
+        for field in value_fields:
+            label_vi, label_en, kind = specs[field]
+            formatted = format_value(row[field], kind, vietnamese)
+            if formatted is None:
+                return None
+            values.append(f"{label_vi if vietnamese else label_en}: {formatted}")
+        lines.append(f"- {_row_subject(row, subject_fields)}" + (f" ({', '.join(values)})" if values else ""))
+
+    header = f"Kết quả{context}:" if vietnamese else f"Results{context}:"
+    return "\n".join([header, *lines])
+
+
+def render_answer(
+    question: str,
+    df: Optional[pd.DataFrame],
+    template: Optional[SqlTemplate],
+    params: Optional[Dict[str, Any]] = None,
+) -> Optional[str]:
+    """
+    Diễn đạt kết quả của SQL mẫu theo quy tắc.
+
+    Args:
+        question: Câu hỏi (để chọn tiếng Việt/tiếng Anh)
+        df: Kết quả truy vấn
+        template: SqlTemplate của SQL đã chạy (None nếu SQL do LLM sinh)
+        params: Bind parameters đã dùng (ticker, date, year...) để nêu đối tượng/mốc thời gian
+
+    Returns:
+        Câu trả lời, hoặc None nếu cần LLM tóm tắt.
+    """
+    if template is None or not template.fields or df is None:
+        return None
+
+    vietnamese = is_vietnamese(question)
+    if df.empty:
+        return "Không tìm thấy dữ liệu phù hợp." if vietnamese else "No matching data found."
+
+    fields = list(template.fields)
+    if len(df) > MAX_RENDER_ROWS or any(f not in df.columns for f in fields):
+        return None
+    if any(_is_missing(v) for v in df[fields].to_numpy().ravel()):
+        return None
+
+    params = params or {}
+    context = _context(template, params, vietnamese)
+
+    if len(df) == 1:
+        row = df.iloc[0]
+        if fields[0].startswith("a_"):
+            return _render_comparison(row, fields, params, context, vietnamese)
+
+        subject_fields = [f for f in fields if f in _SUBJECT_FIELDS]
+        value_fields = [f for f in fields if f not in subject_fields]
+        if len(value_fields) == 1 and not subject_fields:
+            spec = _field_spec(value_fields[0], template)
+            if spec is None:
+                return None
+            label_vi, label_en, kind = spec
+            value = format_value(row[value_fields[0]], kind, vietnamese)
+            if value is None:
+                return None
+            subject = next(
+                (params[p] for p in ("ticker", "company") if p in template.params and params.get(p)),
+                None,
+            )
+            return _sentence(label_vi if vietnamese else label_en, subject, context, value, vietnamese)
+
+    return _render_rows(df, fields, template, context, vietnamese)
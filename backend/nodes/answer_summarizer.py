@@ -1,15 +1,18 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import date, datetime
 import json
-import os
 
 import pandas as pd
-from dotenv import load_dotenv
-from google import generativeai as google_genai
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langchain_core.runnables import RunnableConfig
 
-load_dotenv()
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+from nodes.answer_renderer import render_answer
+from nodes.llm import get_api_key, generate_text, astream_text
+from nodes.utils import is_vietnamese
+from runtime import get_runtime
+
+# Tên custom event chứa từng đoạn câu trả lời (xem graphs.djia_graph.astream_djia_graph)
+ANSWER_TOKEN_EVENT = "answer_token"
 
 
 def _normalize_value(val: Any) -> Any:
@@ -32,9 +35,24 @@ def _format_dataframe(df: pd.DataFrame, max_rows: int = 25) -> List[Dict[str, An
     return trimmed.to_dict(orient="records")
 
 
-def _derive_answer_fallback(df: pd.DataFrame) -> str:
+def _template_fields(sql: Optional[str]) -> Tuple[str, ...]:
+    """Các cột trả lời (-- FIELDS:) nếu sql là SQL mẫu trong registry."""
+    template = get_runtime().template_registry.for_sql(sql)
+    return template.fields if template is not None else ()
+
+
+def _derive_answer_fallback(df: pd.DataFrame, fields: Tuple[str, ...] = ()) -> str:
     if df is None or df.empty:
         return "Không có dữ liệu phù hợp."
+    # SQL mẫu khai báo sẵn cột trả lời: ưu tiên các cột đó
+    answer_fields = [f for f in fields if f in df.columns]
+    if answer_fields:
+        row = df.iloc[0]
+        return ", ".join(
+            f"{f}: {_normalize_value(row[f])}" if len(answer_fields) > 1
+            else str(_normalize_value(row[f]))
+            for f in answer_fields
+        )
     if df.shape[1] == 1:
         val = df.iloc[0, 0]
         if isinstance(val, (int, float)):
@@ -73,12 +91,10 @@ def _derive_answer_fallback(df: pd.DataFrame) -> str:
     return str(row)
 
 
-def _summarize_with_llm(question: str, df: pd.DataFrame, sql: str = None) -> str:
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        return _derive_answer_fallback(df)
-    google_genai.configure(api_key=api_key)
+def _build_summary_prompt(question: str, df: pd.DataFrame, sql: str = None) -> str:
     data_preview = _format_dataframe(df)
+    fields = _template_fields(sql)
+    fields_line = f"Cột trả lời chính: {', '.join(fields)}\n" if fields else ""
     summary_input = json.dumps(data_preview, ensure_ascii=False, indent=2)
 
     system_prompt = (
@@ -91,23 +107,66 @@ def _summarize_with_llm(question: str, df: pd.DataFrame, sql: str = None) -> str
         "Tránh lặp lại dấu âm trong câu trả lời; hãy diễn đạt theo nghĩa tăng/giảm để người đọc dễ hiểu."
     )
 
-    prompt = (
+    return (
         f"{system_prompt}\n\n"
         f"Câu hỏi: {question}\n"
         f"SQL đã chạy: {sql or 'N/A'}\n"
+        f"{fields_line}"
         f"Số dòng kết quả: {len(data_preview)}\n"
         f"Dữ liệu (tối đa 25 dòng):\n{summary_input}\n\n"
         "Trả lời:"
     )
 
-    model = google_genai.GenerativeModel("gemini-2.5-flash")
-    response = model.generate_content(prompt)
-    answer = (response.text or "").strip()
+
+def _summarize_with_llm(question: str, df: pd.DataFrame, sql: str = None) -> str:
+    if not get_api_key():
+        return _derive_answer_fallback(df, _template_fields(sql))
+    answer = generate_text(_build_summary_prompt(question, df, sql))
+    if not answer:
+        return _derive_answer_fallback(df, _template_fields(sql))
+    return answer
+
+
+async def _astream_answer(prompt: str, config: Optional[RunnableConfig]) -> str:
+    """
+    Stream câu trả lời từ Gemini, phát từng đoạn thành custom event
+    ANSWER_TOKEN_EVENT (cho SSE endpoint) và trả về toàn bộ câu trả lời.
+    """
+    parts = []
+    async for chunk in astream_text(prompt):
+        parts.append(chunk)
+        # Chỉ phát event khi chạy trong LangGraph (có run cha)
+        if config is not None:
+            await adispatch_custom_event(
+                ANSWER_TOKEN_EVENT, {"text": chunk}, config=config
+            )
+    return "".join(parts).strip()
+
+
+async def _asummarize_with_llm(
+    question: str,
+    df: pd.DataFrame,
+    sql: str = None,
+    config: Optional[RunnableConfig] = None,
+) -> str:
+    if not get_api_key():
+        return _derive_answer_fallback(df, _template_fields(sql))
+    answer = await _astream_answer(_build_summary_prompt(question, df, sql), config)
     if not answer:
-        return _derive_answer_fallback(df)
+        return _derive_answer_fallback(df, _template_fields(sql))
     return answer
 
 
+def _build_general_prompt(question: str) -> str:
+    system_prompt = (
+        "Bạn là trợ lý AI thông minh và hữu ích. "
+        "Hãy trả lời câu hỏi một cách chính xác, rõ ràng và hữu ích. "
+        f"{'Trả lời bằng tiếng Việt.' if is_vietnamese(question) else 'Answer in English.'}"
+    )
+
+    return f"{system_prompt}\n\nCâu hỏi: {question}\n\nTrả lời:"
+
+
 def _answer_general_question_with_llm(question: str) -> str:
     """
     Trả lời câu hỏi chung không liên quan SQL bằng LLM.
@@ -118,33 +177,11 @@ def _answer_general_question_with_llm(question: str) -> str:
     Returns:
         Câu trả lời từ LLM
     """
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
+    if not get_api_key():
         return "Xin lỗi, tôi không thể trả lời câu hỏi này. Vui lòng kiểm tra API key."
-    
-    google_genai.configure(api_key=api_key)
-    
-    # Detect language
-    vietnamese_chars = ['à', 'á', 'ả', 'ã', 'ạ', 'ă', 'ắ', 'ằ', 'ẳ', 'ẵ', 'ặ', 
-                        'â', 'ấ', 'ầ', 'ẩ', 'ẫ', 'ậ', 'è', 'é', 'ẻ', 'ẽ', 'ẹ',
-                        'ê', 'ế', 'ề', 'ể', 'ễ', 'ệ', 'ì', 'í', 'ỉ', 'ĩ', 'ị',
-                        'ò', 'ó', 'ỏ', 'õ', 'ọ', 'ô', 'ố', 'ồ', 'ổ', 'ỗ', 'ộ',
-                        'ơ', 'ớ', 'ờ', 'ở', 'ỡ', 'ợ', 'ù', 'ú', 'ủ', 'ũ', 'ụ',
-                        'ư', 'ứ', 'ừ', 'ử', 'ữ', 'ự', 'ỳ', 'ý', 'ỷ', 'ỹ', 'ỵ', 'đ']
-    is_vietnamese = any(char in question.lower() for char in vietnamese_chars)
-    
-    system_prompt = (
-        "Bạn là trợ lý AI thông minh và hữu ích. "
-        "Hãy trả lời câu hỏi một cách chính xác, rõ ràng và hữu ích. "
-        f"{'Trả lời bằng tiếng Việt.' if is_vietnamese else 'Answer in English.'}"
-    )
-    
-    prompt = f"{system_prompt}\n\nCâu hỏi: {question}\n\nTrả lời:"
-    
+
     try:
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        answer = (response.text or "").strip()
+        answer = generate_text(_build_general_prompt(question))
         if not answer:
             return "Xin lỗi, tôi không thể tạo câu trả lời cho câu hỏi này."
         return answer
@@ -152,23 +189,22 @@ def _answer_general_question_with_llm(question: str) -> str:
         return f"Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi: {str(e)}"
 
 
-def _answer_with_rag_context(question: str, rag_context: List[Dict[str, Any]]) -> str:
-    """
-    Trả lời câu hỏi sử dụng LLM với context từ RAG.
-    
-    Args:
-        question: Câu hỏi từ người dùng
-        rag_context: List documents retrieved từ PDF
-        
-    Returns:
-        Câu trả lời từ LLM với context từ PDF
-    """
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        return "Không thể kết nối với LLM. Vui lòng kiểm tra API key."
-    
-    google_genai.configure(api_key=api_key)
-    
+async def _aanswer_general_question_with_llm(
+    question: str, config: Optional[RunnableConfig] = None
+) -> str:
+    if not get_api_key():
+        return "Xin lỗi, tôi không thể trả lời câu hỏi này. Vui lòng kiểm tra API key."
+
+    try:
+        answer = await _astream_answer(_build_general_prompt(question), config)
+        if not answer:
+            return "Xin lỗi, tôi không thể tạo câu trả lời cho câu hỏi này."
+        return answer
+    except Exception as e:
+        return f"Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi: {str(e)}"
+
+
+def _build_rag_prompt(question: str, rag_context: List[Dict[str, Any]]) -> str:
     # Build context string với source attribution
     if rag_context:
         context_parts = []
@@ -182,16 +218,7 @@ def _answer_with_rag_context(question: str, rag_context: List[Dict[str, Any]]) -
         context_text = "\n\n---\n\n".join(context_parts)
     else:
         context_text = "Không tìm thấy context phù hợp trong knowledge base."
-    
-    # Detect language
-    vietnamese_chars = ['à', 'á', 'ả', 'ã', 'ạ', 'ă', 'ắ', 'ằ', 'ẳ', 'ẵ', 'ặ', 
-                        'â', 'ấ', 'ầ', 'ẩ', 'ẫ', 'ậ', 'è', 'é', 'ẻ', 'ẽ', 'ẹ',
-                        'ê', 'ế', 'ề', 'ể', 'ễ', 'ệ', 'ì', 'í', 'ỉ', 'ĩ', 'ị',
-                        'ò', 'ó', 'ỏ', 'õ', 'ọ', 'ô', 'ố', 'ồ', 'ổ', 'ỗ', 'ộ',
-                        'ơ', 'ớ', 'ờ', 'ở', 'ỡ', 'ợ', 'ù', 'ú', 'ủ', 'ũ', 'ụ',
-                        'ư', 'ứ', 'ừ', 'ử', 'ữ', 'ự', 'ỳ', 'ý', 'ỷ', 'ỹ', 'ỵ', 'đ']
-    is_vietnamese = any(char in question.lower() for char in vietnamese_chars)
-    
+
     system_prompt = f"""Bạn là trợ lý AI chuyên về thị trường chứng khoán và DJIA (Dow Jones Industrial Average).
 
 RETRIEVED CONTEXT FROM PDF DOCUMENTS:
@@ -200,22 +227,66 @@ RETRIEVED CONTEXT FROM PDF DOCUMENTS:
 YÊU CẦU:
 - Trả lời dựa trên context được cung cấp từ PDF documents
 - Nếu context không đủ thông tin, hãy nói rõ và cung cấp kiến thức chung dựa trên context có sẵn
-- {'Trả lời bằng tiếng Việt' if is_vietnamese else 'Answer in English'}
+- {'Trả lời bằng tiếng Việt' if is_vietnamese(question) else 'Answer in English'}
 - Giữ câu trả lời ngắn gọn, rõ ràng, dễ hiểu
 - Cite source documents khi có thể (ví dụ: "Theo tài liệu X...")
 - Nếu câu hỏi về giá cụ thể của một cổ phiếu tại thời điểm nào đó, hãy hướng dẫn người dùng hỏi lại với format phù hợp"""
 
-    prompt = f"{system_prompt}\n\nCâu hỏi: {question}\n\nTrả lời:"
+    return f"{system_prompt}\n\nCâu hỏi: {question}\n\nTrả lời:"
+
+
+def _answer_with_rag_context(question: str, rag_context: List[Dict[str, Any]]) -> str:
+    """
+    Trả lời câu hỏi sử dụng LLM với context từ RAG.
     
+    Args:
+        question: Câu hỏi từ người dùng
+        rag_context: List documents retrieved từ PDF
+        
+    Returns:
+        Câu trả lời từ LLM với context từ PDF
+    """
+    if not get_api_key():
+        return "Không thể kết nối với LLM. Vui lòng kiểm tra API key."
+
     try:
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        answer = (response.text or "").strip()
+        answer = generate_text(_build_rag_prompt(question, rag_context))
         return answer if answer else "Không thể tạo câu trả lời."
     except Exception as e:
         return f"Lỗi khi gọi LLM: {str(e)}"
 
 
+async def _aanswer_with_rag_context(
+    question: str,
+    rag_context: List[Dict[str, Any]],
+    config: Optional[RunnableConfig] = None,
+) -> str:
+    if not get_api_key():
+        return "Không thể kết nối với LLM. Vui lòng kiểm tra API key."
+
+    try:
+        answer = await _astream_answer(_build_rag_prompt(question, rag_context), config)
+        return answer if answer else "Không thể tạo câu trả lời."
+    except Exception as e:
+        return f"Lỗi khi gọi LLM: {str(e)}"
+
+
+def _render_template_answer(state: Dict[str, Any]) -> Optional[str]:
+    """Câu trả lời theo quy tắc cho kết quả nhỏ của SQL mẫu (None nếu cần LLM)."""
+    template = get_runtime().template_registry.for_sql(state.get("sql"))
+    return render_answer(
+        state.get("question", ""), state.get("df"), template, state.get("sql_params")
+    )
+
+
+def _sql_answer_fallback(state: Dict[str, Any], df: pd.DataFrame, e: Exception) -> str:
+    fallback = _derive_answer_fallback(df, _template_fields(state.get("sql")))
+    # Nếu đã có biểu đồ vẽ thành công, không hiển thị thông báo lỗi LLM
+    if state.get("chart") is not None:
+        return fallback
+    return f"{fallback} (LLM fallback: {e})"
+
+
 def summarize_answer(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     LangGraph Node: Answer Summarizer - Tạo câu trả lời tự nhiên.
@@ -266,15 +337,72 @@ def summarize_answer(state: Dict[str, Any]) -> Dict[str, Any]:
         answer = f"Không thể thực thi truy vấn do lỗi: {error}"
         return {**state, "answer": answer}
 
+    # Kết quả nhỏ của SQL mẫu: diễn đạt theo FIELDS, không cần gọi LLM
+    rendered = _render_template_answer(state)
+    if rendered is not None:
+        return {**state, "answer": rendered}
+
     try:
         answer = _summarize_with_llm(question, df, sql)
     except Exception as e:
-        fallback = _derive_answer_fallback(df)
-        # Nếu đã có biểu đồ vẽ thành công, không hiển thị thông báo lỗi LLM
-        chart = state.get("chart")
-        if chart is not None:
-            answer = fallback
+        answer = _sql_answer_fallback(state, df, e)
+
+    return {**state, "answer": answer}
+
+
+async def asummarize_answer(
+    state: Dict[str, Any], config: Optional[RunnableConfig] = None
+) -> Dict[str, Any]:
+    """
+    Phiên bản async của summarize_answer (cùng 3 trường hợp).
+
+    Câu trả lời được stream từ Gemini; LangGraph truyền config để từng đoạn
+    được phát thành custom event "answer_token" trong astream_events.
+    """
+    df = state.get("df")
+    error = state.get("error")
+    question = state.get("question", "")
+    sql = state.get("sql")
+
+    if not state.get("is_sql_related", True):
+        rag_context = state.get("rag_context", [])
+
+        if state.get("has_rag_context", False) and rag_context:
+            try:
+                answer = await _aanswer_with_rag_context(question, rag_context, config)
+                return {**state, "answer": answer}
+            except Exception as e:
+                print(f"Error answering with RAG context: {e}. Falling back to LLM general.")
+                try:
+                    answer = await _aanswer_general_question_with_llm(question, config)
+                    return {**state, "answer": answer}
+                except Exception as e2:
+                    answer = f"Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi. Lỗi: {str(e2)}"
+                    return {**state, "answer": answer}
         else:
-            answer = f"{fallback} (LLM fallback: {e})"
+            try:
+                answer = await _aanswer_general_question_with_llm(question, config)
+                return {**state, "answer": answer}
+            except Exception as e:
+                answer = f"Xin lỗi, tôi không thể trả lời câu hỏi này. Lỗi: {str(e)}"
+                return {**state, "answer": answer}
+
+    if error:
+        answer = f"Không thể thực thi truy vấn do lỗi: {error}"
+        return {**state, "answer": answer}
+
+    rendered = _render_template_answer(state)
+    if rendered is not None:
+        # Phát cả câu trả lời thành một token để client stream vẫn nhận được
+        if config is not None:
+            await adispatch_custom_event(
+                ANSWER_TOKEN_EVENT, {"text": rendered}, config=config
+            )
+        return {**state, "answer": rendered}
+
+    try:
+        answer = await _asummarize_with_llm(question, df, sql, config)
+    except Exception as e:
+        answer = _sql_answer_fallback(state, df, e)
 
     return {**state, "answer": answer}
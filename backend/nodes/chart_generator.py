@@ -1,6 +1,7 @@
 from typing import Dict, Any, Optional, List
 import json
-import os
+import re
+import time
 
 import pandas as pd
 import numpy as np
@@ -8,21 +9,16 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import plotly.express as px
 import psycopg2
-from sqlalchemy import create_engine, text
-from dotenv import load_dotenv
-from google import generativeai as google_genai
+from sqlalchemy import text
 
-from config import DB_CONNECTION_STRING
-from nodes.utils import (
-    extract_ticker,
-    extract_date_range,
-    extract_date_parts,
-    normalize_text,
-)
-
-load_dotenv()
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+from nodes.llm import get_api_key, generate_text, agenerate_text
+from nodes.instrumentation import record_sql
+from nodes.sql_rewriter import date_range
+from nodes.entities import QueryEntities, entities_from_state, extract_entities
+from nodes.utils import normalize_text
+from runtime import get_runtime
+from db.engine import connect, aconnect
+from db.guard import begin_read_only, cancel_on_disconnect
 
 
 def _required_columns_for_chart(chart_type: Optional[str]) -> List[str]:
@@ -66,21 +62,12 @@ def _prepare_data_preview(df: pd.DataFrame, max_rows: int = 60) -> List[Dict[str
     return records
 
 
-def build_chart_sql(
+def _build_chart_sql_prompt(
     question: str,
     chart_type: Optional[str],
     chart_request: Optional[Dict[str, Any]],
     ticker: Optional[str],
-) -> Optional[str]:
-    """
-    Sinh SQL bằng LLM để lấy dữ liệu vẽ biểu đồ.
-    Trả về None nếu không thể sinh được.
-    """
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        return None
-
-    google_genai.configure(api_key=api_key)
+) -> str:
     required_cols = ", ".join(_required_columns_for_chart(chart_type))
     chart_request_json = json.dumps(chart_request or {}, ensure_ascii=False)
     ticker_hint = ticker or "unknown"
@@ -190,170 +177,197 @@ def build_chart_sql(
         f"Cần tối thiểu các cột: {required_cols}\n\n"
         f"SQL:"
     )
-
-    try:
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        resp = model.generate_content(prompt)
-        sql = (resp.text or "").strip()
-
-        if sql.startswith("```"):
-            lines = sql.split("\n")
-            if lines[0].startswith("```"):
-                lines = lines[1:]
-            if lines and lines[-1].strip() == "```":
-                lines = lines[:-1]
-            sql = "\n".join(lines).strip()
-
-        # Bỏ mọi phần text/Reasoning đứng trước câu lệnh SQL
-        first_sql_match = re.search(
-            r"\b(WITH|SELECT|INSERT|UPDATE|DELETE)\b", sql, re.IGNORECASE
-        )
-        if first_sql_match:
-            sql = sql[first_sql_match.start() :].strip()
-
-        if sql and not sql.endswith(";"):
-            sql += ";"
-
-        # Post-processing: Convert SQLite syntax sang PostgreSQL syntax
-        # Chuyển strftime() thành EXTRACT() hoặc TO_CHAR()
-        # Xử lý tất cả các pattern: strftime('%Y', date), strftime('%%Y', date), strftime('%%%Y', date), etc.
-        # strftime('%Y', date) hoặc strftime('%%Y', date) -> EXTRACT(YEAR FROM date)
-        sql = re.sub(
-            r"strftime\s*\(\s*'%+Y'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-            r"EXTRACT(YEAR FROM \1)",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # strftime('%m', date) hoặc strftime('%%m', date) -> EXTRACT(MONTH FROM date)
-        sql = re.sub(
-            r"strftime\s*\(\s*'%+m'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-            r"EXTRACT(MONTH FROM \1)",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # strftime('%d', date) hoặc strftime('%%d', date) -> EXTRACT(DAY FROM date)
-        sql = re.sub(
-            r"strftime\s*\(\s*'%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-            r"EXTRACT(DAY FROM \1)",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # strftime('%Y-%m-%d', date) -> TO_CHAR(date, 'YYYY-MM-DD')
-        sql = re.sub(
-            r"strftime\s*\(\s*'%+Y-%+m-%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-            r"TO_CHAR(\1, 'YYYY-MM-DD')",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # strftime('%W', date) -> EXTRACT(WEEK FROM date)
-        sql = re.sub(
-            r"strftime\s*\(\s*'%+W'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-            r"EXTRACT(WEEK FROM \1)",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # Xử lý trường hợp so sánh: strftime('%%Y', date) = '2024' -> EXTRACT(YEAR FROM date) = 2024
-        # Loại bỏ dấu nháy đơn quanh số năm nếu có
-        sql = re.sub(
-            r"EXTRACT\(YEAR FROM ([a-zA-Z_][a-zA-Z0-9_.]*)\)\s*=\s*'(\d{4})'",
-            r"EXTRACT(YEAR FROM \1) = \2",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        
-        # Post-processing: Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
-        # Áp dụng cho TẤT CẢ các trường hợp
-        # Lý do: Tên công ty trong database là "Apple Inc." chứ không phải "Apple", nên name = 'Apple' sẽ không match
-        
-        # Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
-        sql = re.sub(
-            r"WHERE\s+companies\.name\s*=\s*'([^']+)'",
-            r"WHERE companies.name ILIKE '%' || '\1' || '%'",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # Sửa WHERE c.name = 'literal' thành WHERE c.name ILIKE '%literal%' (khi có alias c)
+    return prompt
+
+
+def _clean_chart_sql(sql: str) -> Optional[str]:
+    """Làm sạch SQL do LLM sinh ra cho biểu đồ và chuyển về cú pháp PostgreSQL."""
+    if sql.startswith("```"):
+        lines = sql.split("\n")
+        if lines[0].startswith("```"):
+            lines = lines[1:]
+        if lines and lines[-1].strip() == "```":
+            lines = lines[:-1]
+        sql = "\n".join(lines).strip()
+
+    # Bỏ mọi phần text/Reasoning đứng trước câu lệnh SQL
+    first_sql_match = re.search(
+        r"\b(WITH|SELECT|INSERT|UPDATE|DELETE)\b", sql, re.IGNORECASE
+    )
+    if first_sql_match:
+        sql = sql[first_sql_match.start() :].strip()
+
+    if sql and not sql.endswith(";"):
+        sql += ";"
+
+    # Post-processing: Convert SQLite syntax sang PostgreSQL syntax
+    # Chuyển strftime() thành EXTRACT() hoặc TO_CHAR()
+    # Xử lý tất cả các pattern: strftime('%Y', date), strftime('%%Y', date), strftime('%%%Y', date), etc.
+    # strftime('%Y', date) hoặc strftime('%%Y', date) -> EXTRACT(YEAR FROM date)
+    sql = re.sub(
+        r"strftime\s*\(\s*'%+Y'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
+        r"EXTRACT(YEAR FROM \1)",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # strftime('%m', date) hoặc strftime('%%m', date) -> EXTRACT(MONTH FROM date)
+    sql = re.sub(
+        r"strftime\s*\(\s*'%+m'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
+        r"EXTRACT(MONTH FROM \1)",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # strftime('%d', date) hoặc strftime('%%d', date) -> EXTRACT(DAY FROM date)
+    sql = re.sub(
+        r"strftime\s*\(\s*'%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
+        r"EXTRACT(DAY FROM \1)",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # strftime('%Y-%m-%d', date) -> TO_CHAR(date, 'YYYY-MM-DD')
+    sql = re.sub(
+        r"strftime\s*\(\s*'%+Y-%+m-%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
+        r"TO_CHAR(\1, 'YYYY-MM-DD')",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # strftime('%W', date) -> EXTRACT(WEEK FROM date)
+    sql = re.sub(
+        r"strftime\s*\(\s*'%+W'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
+        r"EXTRACT(WEEK FROM \1)",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # Xử lý trường hợp so sánh: strftime('%%Y', date) = '2024' -> EXTRACT(YEAR FROM date) = 2024
+    # Loại bỏ dấu nháy đơn quanh số năm nếu có
+    sql = re.sub(
+        r"EXTRACT\(YEAR FROM ([a-zA-Z_][a-zA-Z0-9_.]*)\)\s*=\s*'(\d{4})'",
+        r"EXTRACT(YEAR FROM \1) = \2",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    
+    # Post-processing: Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
+    # Áp dụng cho TẤT CẢ các trường hợp
+    # Lý do: Tên công ty trong database là "Apple Inc." chứ không phải "Apple", nên name = 'Apple' sẽ không match
+    
+    # Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
+    sql = re.sub(
+        r"WHERE\s+companies\.name\s*=\s*'([^']+)'",
+        r"WHERE companies.name ILIKE '%' || '\1' || '%'",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # Sửa WHERE c.name = 'literal' thành WHERE c.name ILIKE '%literal%' (khi có alias c)
+    sql = re.sub(
+        r"WHERE\s+([a-zA-Z_][a-zA-Z0-9_]*)\.name\s*=\s*'([^']+)'",
+        lambda m: f"WHERE {m.group(1)}.name ILIKE '%' || '{m.group(2)}' || '%'" if m.group(1).lower() in ['c', 'companies', 'company'] else m.group(0),
+        sql,
+        flags=re.IGNORECASE,
+    )
+    # Sửa WHERE name = 'literal' khi đang query từ companies (SELECT ... FROM companies WHERE name = ...)
+    if re.search(r"FROM\s+companies", sql, re.IGNORECASE) and not re.search(r"WHERE\s+companies\.name|WHERE\s+[a-zA-Z_]\.name", sql, re.IGNORECASE):
         sql = re.sub(
-            r"WHERE\s+([a-zA-Z_][a-zA-Z0-9_]*)\.name\s*=\s*'([^']+)'",
-            lambda m: f"WHERE {m.group(1)}.name ILIKE '%' || '{m.group(2)}' || '%'" if m.group(1).lower() in ['c', 'companies', 'company'] else m.group(0),
+            r"WHERE\s+name\s*=\s*'([^']+)'",
+            r"WHERE name ILIKE '%' || '\1' || '%'",
             sql,
             flags=re.IGNORECASE,
         )
-        # Sửa WHERE name = 'literal' khi đang query từ companies (SELECT ... FROM companies WHERE name = ...)
-        if re.search(r"FROM\s+companies", sql, re.IGNORECASE) and not re.search(r"WHERE\s+companies\.name|WHERE\s+[a-zA-Z_]\.name", sql, re.IGNORECASE):
+    
+    # Post-processing: Sửa :company_name thành :company (tên parameter sai)
+    sql = re.sub(
+        r":company_name\b",
+        r":company",
+        sql,
+        flags=re.IGNORECASE,
+    )
+    
+    # Post-processing: Loại bỏ CTE tìm ticker nếu SQL đã có :ticker
+    # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE ...) ... JOIN company_ticker
+    # Nếu SQL có :ticker thì thay thế bằng WHERE ticker = :ticker trực tiếp
+    if re.search(r":ticker\b", sql, re.IGNORECASE):
+        # Tìm và loại bỏ CTE tìm ticker
+        # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE '%' || :company || '%'), ... JOIN company_ticker ct ON ...
+        cte_pattern = r"WITH\s+company_ticker\s+AS\s*\(\s*SELECT\s+symbol\s+FROM\s+companies\s+WHERE\s+name\s+ILIKE\s+'%%'\s*\|\|\s*:company\s*\|\|\s*'%%'\s*\)\s*,?\s*"
+        if re.search(cte_pattern, sql, re.IGNORECASE):
+            # Loại bỏ CTE
+            sql = re.sub(cte_pattern, "", sql, flags=re.IGNORECASE)
+            # Thay thế JOIN company_ticker ct ON p.ticker = ct.symbol thành WHERE p.ticker = :ticker
             sql = re.sub(
-                r"WHERE\s+name\s*=\s*'([^']+)'",
-                r"WHERE name ILIKE '%' || '\1' || '%'",
+                r"JOIN\s+company_ticker\s+[a-zA-Z_]*\s+ON\s+[a-zA-Z_]*\.ticker\s*=\s*[a-zA-Z_]*\.symbol",
+                "",
                 sql,
                 flags=re.IGNORECASE,
             )
-        
-        # Post-processing: Sửa :company_name thành :company (tên parameter sai)
-        sql = re.sub(
-            r":company_name\b",
-            r":company",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        
-        # Post-processing: Loại bỏ CTE tìm ticker nếu SQL đã có :ticker
-        # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE ...) ... JOIN company_ticker
-        # Nếu SQL có :ticker thì thay thế bằng WHERE ticker = :ticker trực tiếp
-        if re.search(r":ticker\b", sql, re.IGNORECASE):
-            # Tìm và loại bỏ CTE tìm ticker
-            # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE '%' || :company || '%'), ... JOIN company_ticker ct ON ...
-            cte_pattern = r"WITH\s+company_ticker\s+AS\s*\(\s*SELECT\s+symbol\s+FROM\s+companies\s+WHERE\s+name\s+ILIKE\s+'%%'\s*\|\|\s*:company\s*\|\|\s*'%%'\s*\)\s*,?\s*"
-            if re.search(cte_pattern, sql, re.IGNORECASE):
-                # Loại bỏ CTE
-                sql = re.sub(cte_pattern, "", sql, flags=re.IGNORECASE)
-                # Thay thế JOIN company_ticker ct ON p.ticker = ct.symbol thành WHERE p.ticker = :ticker
-                sql = re.sub(
-                    r"JOIN\s+company_ticker\s+[a-zA-Z_]*\s+ON\s+[a-zA-Z_]*\.ticker\s*=\s*[a-zA-Z_]*\.symbol",
-                    "",
-                    sql,
-                    flags=re.IGNORECASE,
-                )
-                # Thêm WHERE ticker = :ticker nếu chưa có WHERE
-                if not re.search(r"WHERE\s+.*ticker\s*=", sql, re.IGNORECASE):
-                    # Tìm vị trí sau FROM prices hoặc sau JOIN companies
-                    if re.search(r"FROM\s+prices", sql, re.IGNORECASE):
-                        sql = re.sub(
-                            r"(FROM\s+prices(?:\s+[a-zA-Z_]+)?)",
-                            r"\1 WHERE ticker = :ticker",
-                            sql,
-                            flags=re.IGNORECASE,
-                            count=1,
-                        )
-                    elif re.search(r"JOIN\s+companies", sql, re.IGNORECASE):
-                        # Nếu có JOIN companies, thêm WHERE sau JOIN
-                        sql = re.sub(
-                            r"(JOIN\s+companies(?:\s+[a-zA-Z_]+)?\s+ON\s+[^W]+)",
-                            r"\1 WHERE prices.ticker = :ticker",
-                            sql,
-                            flags=re.IGNORECASE,
-                            count=1,
-                        )
-
-        return sql or None
+            # Thêm WHERE ticker = :ticker nếu chưa có WHERE
+            if not re.search(r"WHERE\s+.*ticker\s*=", sql, re.IGNORECASE):
+                # Tìm vị trí sau FROM prices hoặc sau JOIN companies
+                if re.search(r"FROM\s+prices", sql, re.IGNORECASE):
+                    sql = re.sub(
+                        r"(FROM\s+prices(?:\s+[a-zA-Z_]+)?)",
+                        r"\1 WHERE ticker = :ticker",
+                        sql,
+                        flags=re.IGNORECASE,
+                        count=1,
+                    )
+                elif re.search(r"JOIN\s+companies", sql, re.IGNORECASE):
+                    # Nếu có JOIN companies, thêm WHERE sau JOIN
+                    sql = re.sub(
+                        r"(JOIN\s+companies(?:\s+[a-zA-Z_]+)?\s+ON\s+[^W]+)",
+                        r"\1 WHERE prices.ticker = :ticker",
+                        sql,
+                        flags=re.IGNORECASE,
+                        count=1,
+                    )
+
+    return sql or None
+
+
+def build_chart_sql(
+    question: str,
+    chart_type: Optional[str],
+    chart_request: Optional[Dict[str, Any]],
+    ticker: Optional[str],
+) -> Optional[str]:
+    """
+    Sinh SQL bằng LLM để lấy dữ liệu vẽ biểu đồ.
+    Trả về None nếu không thể sinh được.
+    """
+    if not get_api_key():
+        return None
+
+    prompt = _build_chart_sql_prompt(question, chart_type, chart_request, ticker)
+    try:
+        return _clean_chart_sql(generate_text(prompt))
     except Exception as e:
         print(f"Error generating chart SQL with LLM: {e}")
         return None
 
 
-def build_chart_code(
+async def abuild_chart_sql(
     question: str,
-    chart_type_hint: Optional[str],
+    chart_type: Optional[str],
     chart_request: Optional[Dict[str, Any]],
-    df: pd.DataFrame,
+    ticker: Optional[str],
 ) -> Optional[str]:
-    """
-    Yêu cầu LLM sinh code Plotly để dựng biểu đồ trực tiếp từ DataFrame df.
-    """
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key or df is None or df.empty:
+    """Phiên bản async của build_chart_sql."""
+    if not get_api_key():
         return None
 
-    google_genai.configure(api_key=api_key)
+    prompt = _build_chart_sql_prompt(question, chart_type, chart_request, ticker)
+    try:
+        return _clean_chart_sql(await agenerate_text(prompt))
+    except Exception as e:
+        print(f"Error generating chart SQL with LLM: {e}")
+        return None
+
+
+def _build_chart_code_prompt(
+    question: str,
+    chart_type_hint: Optional[str],
+    chart_request: Optional[Dict[str, Any]],
+    df: pd.DataFrame,
+) -> str:
     preview = _prepare_data_preview(df)
     columns = ", ".join(df.columns.tolist())
     chart_request_json = json.dumps(chart_request or {}, ensure_ascii=False)
@@ -535,15 +549,49 @@ def build_chart_code(
         f"Dữ liệu mẫu (JSON, {len(preview)} dòng đầu):\n{data_json}\n\n"
         f"Hãy sinh code Python để tạo biểu đồ Plotly phù hợp với câu hỏi và dữ liệu trên."
     )
+    return prompt
+
+
+def _clean_chart_code(code: str) -> str:
+    if code.startswith("```"):
+        parts = code.split("```")
+        code = parts[1] if len(parts) > 1 else code
+    return code.strip()
+
 
+def build_chart_code(
+    question: str,
+    chart_type_hint: Optional[str],
+    chart_request: Optional[Dict[str, Any]],
+    df: pd.DataFrame,
+) -> Optional[str]:
+    """
+    Yêu cầu LLM sinh code Plotly để dựng biểu đồ trực tiếp từ DataFrame df.
+    """
+    if not get_api_key() or df is None or df.empty:
+        return None
+
+    prompt = _build_chart_code_prompt(question, chart_type_hint, chart_request, df)
+    try:
+        return _clean_chart_code(generate_text(prompt))
+    except Exception as e:
+        print(f"Error generating chart code with LLM: {e}")
+        return None
+
+
+async def abuild_chart_code(
+    question: str,
+    chart_type_hint: Optional[str],
+    chart_request: Optional[Dict[str, Any]],
+    df: pd.DataFrame,
+) -> Optional[str]:
+    """Phiên bản async của build_chart_code."""
+    if not get_api_key() or df is None or df.empty:
+        return None
+
+    prompt = _build_chart_code_prompt(question, chart_type_hint, chart_request, df)
     try:
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        resp = model.generate_content(prompt)
-        code = (resp.text or "").strip()
-        if code.startswith("```"):
-            parts = code.split("```")
-            code = parts[1] if len(parts) > 1 else code
-        return code.strip()
+        return _clean_chart_code(await agenerate_text(prompt))
     except Exception as e:
         print(f"Error generating chart code with LLM: {e}")
         return None
@@ -805,81 +853,141 @@ def create_volume_chart(df: pd.DataFrame, ticker: str, title: str = None) -> go.
     return fig
 
 
-def fetch_chart_data(question: str, ticker: str, chart_type: str) -> pd.DataFrame:
+def _build_chart_data_sql(
+    question: str,
+    ticker: str,
+    chart_type: str,
+    entities: Optional[QueryEntities] = None,
+) -> str:
+    """Xây dựng SQL (PostgreSQL) lấy dữ liệu vẽ biểu đồ khi chưa có df."""
+    # Xác định khoảng thời gian
+    entities = entities or extract_entities(question)
+    start_date, end_date = entities.start_date, entities.end_date
+    date_parts = entities.date_parts
+
+    if chart_type == "comparison":
+        # So sánh nhiều công ty - cần tìm tất cả tickers trong câu hỏi
+        # Fallback: lấy tất cả công ty trong 1 tháng gần nhất
+        return """
+            SELECT date, ticker, open, high, low, close, volume
+            FROM prices
+            WHERE date >= CURRENT_DATE - INTERVAL '1 month'
+            ORDER BY date ASC, ticker ASC
+        """
+
+    # Single ticker
+    where_clauses = [f"ticker = '{ticker}'"]
+
+    if start_date and end_date:
+        where_clauses.append(
+            f"date BETWEEN '{start_date}'::date AND '{end_date}'::date"
+        )
+    elif "year" in date_parts:
+        # Khoảng nửa mở trên cột date (dùng được idx_prices_date), không bọc date trong hàm
+        year = int(date_parts["year"])
+        if "month" in date_parts:
+            month = int(date_parts["month"])
+            range_start, range_end = date_range(year, month, month)
+        else:
+            range_start, range_end = date_range(year)
+        where_clauses.append(
+            f"date >= '{range_start}'::date AND date < '{range_end}'::date"
+        )
+    else:
+        # Default: last 3 months
+        where_clauses.append("date >= CURRENT_DATE - INTERVAL '3 months'")
+
+    where_clause = " AND ".join(where_clauses)
+
+    return f"""
+        SELECT date, open, high, low, close, volume
+        FROM prices
+        WHERE {where_clause}
+        ORDER BY date ASC
+    """
+
+
+def _chart_data_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # Convert date to datetime (PostgreSQL trả về date object)
+    if not df.empty and "date" in df.columns:
+        df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+def _read_chart_data(conn, sql: str) -> pd.DataFrame:
+    # Transaction read-only + statement_timeout như mọi đường thực thi SQL (db/guard.py)
+    begin_read_only(conn)
+    return pd.read_sql_query(text(sql), conn)
+
+
+def fetch_chart_data(
+    question: str,
+    ticker: str,
+    chart_type: str,
+    entities: Optional[QueryEntities] = None,
+) -> pd.DataFrame:
     """Lấy dữ liệu từ database để vẽ biểu đồ."""
-    engine = create_engine(DB_CONNECTION_STRING)
+    engine = get_runtime().engine
 
     try:
-        # Xác định khoảng thời gian
-        start_date, end_date = extract_date_range(question)
-        date_parts = extract_date_parts(question)
-
-        # Xây dựng SQL query (PostgreSQL syntax)
-        if chart_type == "comparison":
-            # So sánh nhiều công ty - cần tìm tất cả tickers trong câu hỏi
-            # Fallback: lấy tất cả công ty trong 1 tháng gần nhất
-            sql = """
-                SELECT date, ticker, open, high, low, close, volume
-                FROM prices
-                WHERE date >= CURRENT_DATE - INTERVAL '1 month'
-                ORDER BY date ASC, ticker ASC
-            """
-        else:
-            # Single ticker
-            where_clauses = [f"ticker = '{ticker}'"]
+        sql = _build_chart_data_sql(question, ticker, chart_type, entities)
 
-            if start_date and end_date:
-                where_clauses.append(
-                    f"date BETWEEN '{start_date}'::date AND '{end_date}'::date"
-                )
-            elif "year" in date_parts:
-                where_clauses.append(f"EXTRACT(YEAR FROM date) = {date_parts['year']}")
-            elif "month" in date_parts and "year" in date_parts:
-                where_clauses.append(
-                    f"EXTRACT(YEAR FROM date) = {date_parts['year']} AND EXTRACT(MONTH FROM date) = {date_parts['month']}"
-                )
-            else:
-                # Default: last 3 months
-                where_clauses.append("date >= CURRENT_DATE - INTERVAL '3 months'")
+        with connect(engine) as conn:
+            started = time.perf_counter()
+            df = _read_chart_data(conn, sql)
+            record_sql(time.perf_counter() - started, len(df))
 
-            where_clause = " AND ".join(where_clauses)
+        return _chart_data_frame(df)
+    except Exception as e:
+        print(f"Error fetching chart data: {e}")
+        import traceback
 
-            sql = f"""
-                SELECT date, open, high, low, close, volume
-                FROM prices
-                WHERE {where_clause}
-                ORDER BY date ASC
-            """
+        traceback.print_exc()
+        return pd.DataFrame()
 
-        with engine.connect() as conn:
-            df = pd.read_sql_query(text(sql), conn)
 
-        # Convert date to datetime (PostgreSQL trả về date object)
-        if not df.empty and "date" in df.columns:
-            df["date"] = pd.to_datetime(df["date"])
+async def afetch_chart_data(
+    question: str,
+    ticker: str,
+    chart_type: str,
+    entities: Optional[QueryEntities] = None,
+) -> pd.DataFrame:
+    """Phiên bản async của fetch_chart_data (dùng AsyncEngine)."""
+    engine = get_runtime().async_engine
+
+    try:
+        sql = _build_chart_data_sql(question, ticker, chart_type, entities)
 
-        return df
+        async with aconnect(engine) as conn:
+            started = time.perf_counter()
+            async with cancel_on_disconnect(conn):
+                df = await conn.run_sync(lambda sync_conn: _read_chart_data(sync_conn, sql))
+            record_sql(time.perf_counter() - started, len(df))
+
+        return _chart_data_frame(df)
     except Exception as e:
         print(f"Error fetching chart data: {e}")
         import traceback
 
         traceback.print_exc()
         return pd.DataFrame()
-    finally:
-        engine.dispose()
 
 
-def generate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
-    """Node tạo biểu đồ dựa trên yêu cầu."""
+def _resolve_chart_target(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Phần chuẩn bị chung của generate_chart / agenerate_chart.
+
+    Trả về {"result": state} nếu không vẽ được (hoặc không cần vẽ), ngược lại
+    trả về ticker và cờ needs_fetch (cần lấy lại dữ liệu từ database).
+    """
     question = state.get("question", "")
     ticker = state.get("ticker")
     needs_chart = state.get("needs_chart", False)
     chart_type = state.get("chart_type", "line")
-    chart_request = state.get("chart_request")
     df = state.get("df")
 
     if not needs_chart:
-        return {**state, "chart": None}
+        return {"result": {**state, "chart": None}}
 
     # Kiểm tra nếu câu hỏi về tất cả DJIA companies, top N companies, hoặc sector/industry
     q = normalize_text(question)
@@ -910,7 +1018,7 @@ def generate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
 
     # Nếu không có ticker, thử trích xuất (trừ khi là all companies hoặc sector query)
     if not ticker and not is_all_companies and not is_sector_query:
-        ticker = extract_ticker(question)
+        ticker = entities_from_state(state).ticker
 
     # Nếu vẫn không có ticker và không phải all companies/sector, không vẽ được
     if (
@@ -920,32 +1028,39 @@ def generate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
         and not is_sector_query
     ):
         return {
-            **state,
-            "chart": None,
-            "chart_error": "Không xác định được mã cổ phiếu",
+            "result": {
+                **state,
+                "chart": None,
+                "chart_error": "Không xác định được mã cổ phiếu",
+            }
         }
 
     # Nếu đã có df từ SQL execution, dùng luôn (không fetch lại)
     # Với all companies hoặc sector query, SQL đã trả về đúng dữ liệu
     # Giữ nguyên df kể cả khi không có cột date (ví dụ correlation matrix, aggregate)
-    if not is_all_companies and not is_sector_query:
-        if df is None or df.empty:
-            df = fetch_chart_data(question, ticker, chart_type)
+    needs_fetch = (
+        not is_all_companies and not is_sector_query and (df is None or df.empty)
+    )
+    return {"result": None, "ticker": ticker, "needs_fetch": needs_fetch}
 
-    if df is None or df.empty:
-        return {**state, "chart": None, "chart_error": "Không có dữ liệu để vẽ biểu đồ"}
 
+def _normalize_chart_df(df: pd.DataFrame) -> pd.DataFrame:
     # Normalize column names to lowercase để tránh vấn đề case sensitivity
     df.columns = [col.lower() for col in df.columns]
 
     # Ensure date column is datetime (nếu có)
     if "date" in df.columns and not pd.api.types.is_datetime64_any_dtype(df["date"]):
         df["date"] = pd.to_datetime(df["date"])
+    return df
+
 
+def _chart_result(
+    state: Dict[str, Any], code: Optional[str], df: pd.DataFrame
+) -> Dict[str, Any]:
+    """Render code Plotly do LLM sinh ra và trả về state mới."""
     chart = None
     error_msg = None
     try:
-        code = build_chart_code(question, chart_type, chart_request, df)
         if not code:
             error_msg = "LLM không thể sinh code Python để vẽ biểu đồ."
         else:
@@ -965,3 +1080,57 @@ def generate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
         }
 
     return {**state, "chart": chart, "chart_error": None}
+
+
+def generate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Node tạo biểu đồ dựa trên yêu cầu."""
+    target = _resolve_chart_target(state)
+    if target["result"] is not None:
+        return target["result"]
+
+    question = state.get("question", "")
+    chart_type = state.get("chart_type", "line")
+    df = state.get("df")
+    if target["needs_fetch"]:
+        df = fetch_chart_data(
+            question, target["ticker"], chart_type, entities_from_state(state)
+        )
+
+    if df is None or df.empty:
+        return {**state, "chart": None, "chart_error": "Không có dữ liệu để vẽ biểu đồ"}
+
+    df = _normalize_chart_df(df)
+    try:
+        code = build_chart_code(question, chart_type, state.get("chart_request"), df)
+    except Exception as e:
+        print(f"Error generating chart code via LLM: {e}")
+        code = None
+    return _chart_result(state, code, df)
+
+
+async def agenerate_chart(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của generate_chart."""
+    target = _resolve_chart_target(state)
+    if target["result"] is not None:
+        return target["result"]
+
+    question = state.get("question", "")
+    chart_type = state.get("chart_type", "line")
+    df = state.get("df")
+    if target["needs_fetch"]:
+        df = await afetch_chart_data(
+            question, target["ticker"], chart_type, entities_from_state(state)
+        )
+
+    if df is None or df.empty:
+        return {**state, "chart": None, "chart_error": "Không có dữ liệu để vẽ biểu đồ"}
+
+    df = _normalize_chart_df(df)
+    try:
+        code = await abuild_chart_code(
+            question, chart_type, state.get("chart_request"), df
+        )
+    except Exception as e:
+        print(f"Error generating chart code via LLM: {e}")
+        code = None
+    return _chart_result(state, code, df)
@@ -0,0 +1,304 @@
+"""
+Company Matcher - Nhận diện tên công ty trong câu hỏi bằng automaton Aho-Corasick.
+
+Trước đây extract_ticker thử lần lượt từng alias trong COMPANY_ALIASES (mỗi
+alias một regex), nên chi phí tăng theo số alias và chỉ trả về công ty đầu
+tiên theo thứ tự dict. CompanyMatcher compile mọi alias (symbol, tên đã
+canonicalize từ CSV, alias thủ công) thành một automaton duy nhất khi import
+nodes.utils; một lần quét câu hỏi tìm được mọi công ty được nhắc tới:
+
+- Chỉ nhận match đúng ranh giới từ (giống (?<!\\w)alias(?!\\w)), nên "v"
+  (Visa) không khớp trong "revenue".
+- Match trùng nhau thì chọn match bắt đầu sớm nhất, rồi dài nhất
+  ("johnson & johnson" thay vì "johnson"; "unitedhealth group" thay vì
+  "unitedhealth").
+
+Tên viết sai chính tả ("microsft", "walgren") không khớp automaton;
+FuzzyCompanyIndex tìm chúng tại chỗ bằng trigram index + edit distance thay
+vì để câu hỏi rơi xuống nhánh sinh SQL bằng LLM (ILIKE theo :company).
+
+Usage:
+    matcher = CompanyMatcher({"apple": "AAPL", "microsoft": "MSFT"})
+    matcher.tickers("which had a higher closing price: apple or microsoft?")
+    # ["AAPL", "MSFT"]
+
+    fuzzy = FuzzyCompanyIndex({"microsoft": "MSFT", "walgreens": "WBA"})
+    fuzzy.find_all("closing price of microsft on 2024-01-15", threshold=0.75)
+    # [CompanyMatch(start=17, end=25, alias="microsoft", ticker="MSFT")]
+"""
+
+import re
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class CompanyMatch(NamedTuple):
+    start: int
+    end: int
+    alias: str
+    ticker: str
+
+
+def _normalize_alias(alias: str) -> str:
+    # Câu hỏi đã được normalize_text (lowercase, straight quote U+0027), nên
+    # alias cũng được đưa về cùng dạng
+    return (
+        " ".join(alias.lower().split())
+        .replace("’", "'")
+        .replace("‘", "'")
+        .replace("‛", "'")
+    )
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class CompanyMatcher:
+    """
+    Automaton Aho-Corasick trên ký tự của các alias.
+
+    Mỗi state là một node của trie: _goto[state] map ký tự -> state con,
+    _fail[state] là state của hậu tố dài nhất cũng là tiền tố trong trie,
+    _output[state] là các alias (độ dài, ticker) kết thúc tại state đó (gồm cả
+    alias của chuỗi fail). Thời gian quét tuyến tính theo độ dài câu hỏi, không
+    phụ thuộc số alias.
+    """
+
+    def __init__(self, aliases: Dict[str, str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[tuple]] = [[]]
+        for alias, ticker in aliases.items():
+            alias = _normalize_alias(alias)
+            if alias:
+                self._add(alias, ticker)
+        self._build_failure_links()
+
+    def __len__(self) -> int:
+        return sum(len(output) for output in self._output)
+
+    def _add(self, alias: str, ticker: str) -> None:
+        state = 0
+        for char in alias:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        # Alias trùng nhau: giữ ticker đầu tiên
+        if not self._output[state]:
+            self._output[state].append((len(alias), alias, ticker))
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find_all(self, text: str) -> List[CompanyMatch]:
+        """
+        Mọi alias xuất hiện trong text (đã normalize_text), không chồng lấn
+        nhau, theo thứ tự xuất hiện.
+        """
+        candidates: List[CompanyMatch] = []
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for length, alias, ticker in self._output[state]:
+                start = end - length
+                if start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if end < len(text) and _is_word_char(text[end]):
+                    continue
+                candidates.append(CompanyMatch(start, end, alias, ticker))
+
+        # Leftmost-longest: ưu tiên match bắt đầu sớm hơn, rồi dài hơn
+        candidates.sort(key=lambda match: (match.start, -match.end))
+        matches: List[CompanyMatch] = []
+        for match in candidates:
+            if not matches or match.start >= matches[-1].end:
+                matches.append(match)
+        return matches
+
+    def tickers(self, text: str) -> List[str]:
+        """Các ticker khác nhau được nhắc tới trong text, theo thứ tự xuất hiện."""
+        return list(dict.fromkeys(match.ticker for match in self.find_all(text)))
+
+
+# ==================== FUZZY ====================
+
+_WORD_RE = re.compile(r"[^\W_]+")
+# Từ tiếng Anh thường gặp gần giống một alias ("apply" ~ "apple")
+_FUZZY_IGNORE_WORDS = {"apply", "applied", "applies", "merch", "honey", "visit"}
+_LOOKUP_CACHE_SIZE = 50_000
+
+
+def _fuzzy_key(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein distance, chỉ tính dải |i - j| <= max_distance của bảng DP và
+    dừng sớm (trả về max_distance + 1) khi chắc chắn vượt max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    too_far = max_distance + 1
+    previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        low, high = max(1, i - max_distance), min(len(b), i + max_distance)
+        current = [too_far] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        char_a = a[i - 1]
+        row_min = current[0]
+        for j in range(low, high + 1):
+            value = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != b[j - 1]),
+            )
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return too_far
+        previous = current
+    return min(previous[-1], too_far)
+
+
+class FuzzyCompanyIndex:
+    """
+    Trigram index trên alias (đã bỏ dấu câu) để tìm tên công ty viết sai.
+
+    Với mỗi cụm 1..max_words từ của câu hỏi, các alias có chung trigram được
+    lấy từ inverted index rồi chấm bằng similarity = 1 - edit distance / độ
+    dài; chỉ nhận alias có similarity >= threshold và cụm từ phải phủ cả
+    alias (không nhận một mảnh của alias). Alias ngắn hơn min_length ký tự
+    ("v", "ko", "nike") không được index vì quá dễ khớp nhầm.
+    """
+
+    def __init__(self, aliases: Dict[str, str], min_length: int = 5):
+        self.min_length = min_length
+        self._names: List[Tuple[str, str]] = []
+        self._gram_counts: List[int] = []
+        self._postings: Dict[str, List[int]] = {}
+        seen = set()
+        for alias, ticker in aliases.items():
+            key = _fuzzy_key(_normalize_alias(alias))
+            if len(key) < min_length or key in seen:
+                continue
+            seen.add(key)
+            grams = _trigrams(key)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(len(self._names))
+            self._names.append((key, ticker))
+            self._gram_counts.append(len(grams))
+        self.max_words = max((len(key.split()) for key, _ in self._names), default=0)
+        self._max_length = max((len(key) for key, _ in self._names), default=0)
+        # Kết quả lookup theo (cụm từ, threshold): từ thường gặp trong câu hỏi
+        # ("closing", "price", ...) lặp lại giữa các câu hỏi
+        self._cache: Dict[Tuple[str, float], Optional[Tuple[str, str, float]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def lookup(self, text: str, threshold: float) -> Optional[Tuple[str, str, float]]:
+        """Alias giống text nhất: (alias, ticker, similarity) hoặc None."""
+        key = _fuzzy_key(text)
+        if len(key) < self.min_length or key in _FUZZY_IGNORE_WORDS:
+            return None
+        cache_key = (key, threshold)
+        if cache_key in self._cache:
+            return self._cache[cache_key]
+        result = self._lookup(key, threshold)
+        if len(self._cache) >= _LOOKUP_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[cache_key] = result
+        return result
+
+    def _lookup(self, key: str, threshold: float) -> Optional[Tuple[str, str, float]]:
+        grams = _trigrams(key)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for position in self._postings.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+
+        best: Optional[Tuple[str, str, float]] = None
+        for position, count in shared.items():
+            name, ticker = self._names[position]
+            # Cụm từ chỉ là một mảnh của alias ("morgan" trong "jpmorgan", dễ
+            # là công ty khác như Morgan Stanley): không phải lỗi chính tả.
+            # Vẫn nhận alias thiếu một ký tự cuối/đầu ("salesforc")
+            if len(name) - len(key) > 1 and key in name:
+                continue
+            longest = max(len(key), len(name))
+            max_distance = int(longest * (1.0 - threshold))
+            if abs(len(key) - len(name)) > max_distance:
+                continue
+            # Lọc nhanh: mỗi phép sửa làm mất tối đa 3 trigram, nên quá ít
+            # trigram chung thì edit distance chắc chắn vượt max_distance
+            if max(len(grams), self._gram_counts[position]) - count > 3 * max_distance:
+                continue
+            distance = edit_distance(key, name, max_distance)
+            if distance > max_distance:
+                continue
+            score = 1.0 - distance / longest
+            if best is None or score > best[2]:
+                best = (name, ticker, score)
+        return best
+
+    def find_all(
+        self,
+        text: str,
+        threshold: float,
+        exclude: Sequence[Tuple[int, int]] = (),
+    ) -> List[CompanyMatch]:
+        """
+        Tên công ty viết sai trong text, không chồng lấn nhau và không chồng
+        lấn các khoảng exclude (thường là match chính xác của CompanyMatcher).
+        """
+        words = list(_WORD_RE.finditer(text))
+        # Cụm dài hơn mức này không thể đủ giống alias dài nhất
+        max_span_length = self._max_length / max(threshold, 0.01)
+        candidates = []
+        for i in range(len(words)):
+            if words[i].group().isdigit():
+                continue
+            for j in range(i, min(i + self.max_words, len(words))):
+                start, end = words[i].start(), words[j].end()
+                if end - start > max_span_length:
+                    break
+                if any(start < e and s < end for s, e in exclude):
+                    break
+                found = self.lookup(text[start:end], threshold)
+                if found is not None:
+                    name, ticker, score = found
+                    candidates.append((score, end - start, CompanyMatch(start, end, name, ticker)))
+
+        # Giống nhất trước, rồi cụm dài hơn
+        candidates.sort(key=lambda candidate: (-candidate[0], -candidate[1]))
+        chosen: List[CompanyMatch] = []
+        for _, _, match in candidates:
+            if all(match.end <= other.start or match.start >= other.end for other in chosen):
+                chosen.append(match)
+        return sorted(chosen)
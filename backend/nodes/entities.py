@@ -0,0 +1,203 @@
+"""
+Query Entities - Trích xuất entity của câu hỏi một lần cho cả workflow.
+
+Trước đây planner, matcher, executor và chart node đều gọi lại
+extract_ticker / extract_date_parts / extract_date_range / extract_quarter /
+extract_month_range trên cùng câu hỏi (mỗi hàm normalize và quét lại câu hỏi),
+build_params còn compile thêm pattern mỗi lần chạy. Giờ question_classifier
+gọi extract_entities() một lần (câu hỏi chỉ normalize một lần, mọi pattern
+compile sẵn) và lưu QueryEntities vào state["entities"]; các node sau đọc
+từ state qua entities_from_state().
+
+Usage:
+    entities = extract_entities("Which had a higher closing price on 2024-01-15: Apple or Microsoft?")
+    entities.ticker_a, entities.ticker_b   # ("AAPL", "MSFT")
+    entities.date                          # "2024-01-15"
+"""
+
+import re
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple
+
+from nodes.utils import (
+    _month_range_in,
+    _quarter_in,
+    _ticker_in,
+    _tickers_in,
+    extract_date_parts,
+    extract_date_range,
+    normalize_text,
+)
+
+
+@dataclass(frozen=True)
+class QueryEntities:
+    """Các entity trích xuất từ câu hỏi (None nếu không có)."""
+
+    ticker: Optional[str] = None
+    date: Optional[str] = None
+    year: Optional[str] = None
+    month: Optional[str] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    quarter: Optional[int] = None
+    start_month: Optional[str] = None
+    end_month: Optional[str] = None
+    # Tên công ty cho câu hỏi ticker symbol / metadata ("market cap of Boeing")
+    company: Optional[str] = None
+    # Hai công ty đầu tiên của câu hỏi so sánh ("Apple or Microsoft", "A vs B")
+    ticker_a: Optional[str] = None
+    ticker_b: Optional[str] = None
+    # Mọi công ty được nhắc tới, theo thứ tự xuất hiện
+    tickers: Tuple[str, ...] = ()
+
+    @property
+    def date_parts(self) -> Dict[str, str]:
+        """Giống extract_date_parts(): các key date/year/month có giá trị."""
+        return {
+            key: value
+            for key, value in (("date", self.date), ("year", self.year), ("month", self.month))
+            if value
+        }
+
+
+# ==================== TÊN CÔNG TY ====================
+
+# Câu hỏi tìm ticker symbol: "ticker symbol for {company}", "symbol of {company}"...
+_TICKER_SYMBOL_RES = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"ticker\s+symbol\s+for\s+([^?]+)",
+        r"symbol\s+for\s+([^?]+)",
+        r"ticker\s+of\s+([^?]+)",
+        r"symbol\s+of\s+([^?]+)",
+        r"ticket\s+of\s+([^?]+)",
+    )
+]
+_TICKER_SYMBOL_PHRASES = [
+    "ticker symbol",
+    "symbol of",
+    "ticket of",
+    "ticker of",
+    "mã cổ phiếu",
+    "mã ticker",
+]
+_TICKER_SYMBOL_FALLBACK_RES = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"(?:what|which|tell me).*?(?:ticker|symbol|ticket).*?(?:of|for)\s+([^?]+)",
+        r"(?:ticker|symbol|ticket).*?(?:of|for)\s+([^?]+)",
+    )
+]
+# Câu hỏi metadata: "{field} of {company}", ví dụ "dividend yield of apple"
+_METADATA_RE = re.compile(r"(\w+(?:\s+\w+)*)\s+of\s+([^?]+)", re.IGNORECASE)
+_METADATA_FIELDS = [
+    "dividend yield",
+    "52 week high",
+    "52 week low",
+    "week 52 high",
+    "week 52 low",
+    "market cap",
+    "pe ratio",
+    "p/e ratio",
+    "description",
+    "country",
+    "industry",
+    "sector",
+    "website",
+    "market capitalization",
+]
+
+
+def _clean_company(name: str) -> str:
+    return name.strip().rstrip("?.,!")
+
+
+def _company_name(question: str, q: str, ticker: Optional[str]) -> Optional[str]:
+    for pattern in _TICKER_SYMBOL_RES:
+        match = pattern.search(question)
+        if match:
+            # Luôn lấy tên công ty cho câu hỏi tìm ticker symbol
+            if _clean_company(match.group(1)):
+                return _clean_company(match.group(1))
+            break
+
+    # Câu hỏi về ticker symbol nhưng viết khác pattern trên (fallback)
+    if ticker and any(phrase in q for phrase in _TICKER_SYMBOL_PHRASES):
+        for pattern in _TICKER_SYMBOL_FALLBACK_RES:
+            match = pattern.search(question)
+            if match and _clean_company(match.group(1)):
+                return _clean_company(match.group(1))
+
+    match = _METADATA_RE.search(question)
+    if match:
+        field = match.group(1).strip().lower()
+        if any(metadata_field in field for metadata_field in _METADATA_FIELDS):
+            return _clean_company(match.group(2)) or None
+    return None
+
+
+# ==================== API ====================
+
+
+def extract_entities(question: str) -> QueryEntities:
+    """Trích xuất mọi entity của câu hỏi trong một lần (normalize một lần)."""
+    q = normalize_text(question)
+    # Một lần quét automaton cho mọi công ty (nodes/company_matcher.py)
+    tickers = _tickers_in(q)
+    ticker = _ticker_in(question, q, tickers)
+    parts = extract_date_parts(question)
+    start_date, end_date = extract_date_range(question)
+    start_month, end_month = _month_range_in(q)
+    return QueryEntities(
+        ticker=ticker,
+        date=parts.get("date"),
+        year=parts.get("year"),
+        month=parts.get("month"),
+        start_date=start_date,
+        end_date=end_date,
+        quarter=_quarter_in(q),
+        start_month=start_month,
+        end_month=end_month,
+        company=_company_name(question, q, ticker),
+        ticker_a=tickers[0] if len(tickers) >= 2 else None,
+        ticker_b=tickers[1] if len(tickers) >= 2 else None,
+        tickers=tuple(tickers),
+    )
+
+
+def entities_from_state(state: Dict[str, Any]) -> QueryEntities:
+    """QueryEntities đã lưu trong state; trích xuất lại nếu node được gọi riêng lẻ."""
+    entities = state.get("entities")
+    if isinstance(entities, QueryEntities):
+        return entities
+    return extract_entities(state.get("question", ""))
+
+
+def merge_llm_entities(entities: QueryEntities, llm_entities: Dict[str, Any]) -> QueryEntities:
+    """
+    Bổ sung entity mà regex không thấy bằng entities của understanding call
+    (nodes/understanding.py). Giá trị regex đã có luôn được giữ.
+    """
+    if not llm_entities:
+        return entities
+    tickers = llm_entities.get("tickers") or []
+    dates = llm_entities.get("dates") or []
+    updates: Dict[str, Any] = {}
+    if entities.ticker is None and tickers:
+        updates["ticker"] = tickers[0]
+    if not entities.tickers and tickers:
+        updates["tickers"] = tuple(tickers)
+    if entities.ticker_a is None and len(tickers) >= 2:
+        updates["ticker_a"], updates["ticker_b"] = tickers[0], tickers[1]
+    if entities.date is None and len(dates) == 1:
+        updates["date"] = dates[0]
+        updates["year"] = entities.year or dates[0][:4]
+        updates["month"] = entities.month or dates[0][5:7]
+    if entities.start_date is None and len(dates) >= 2:
+        updates["start_date"], updates["end_date"] = dates[0], dates[1]
+    if entities.year is None and "year" not in updates and llm_entities.get("year"):
+        updates["year"] = llm_entities["year"]
+    if entities.quarter is None and llm_entities.get("quarter"):
+        updates["quarter"] = llm_entities["quarter"]
+    return replace(entities, **updates) if updates else entities
@@ -0,0 +1,290 @@
+"""
+Fast Classifier - Phân loại SQL/OTHER tại chỗ trước khi hỏi Gemini.
+
+Phần lớn câu hỏi có tín hiệu rõ ràng (tên công ty + ngày + "closing price",
+hoặc "What is ...?" không nhắc tới công ty nào), không cần một round trip
+Gemini để biết là SQL hay OTHER. Classifier gồm hai tầng:
+
+1. Rules: cộng điểm log-odds theo entity (QueryEntities, nodes/entities.py)
+   và từ khoá (giá, volume, biểu đồ, ... vs "what is", "giải thích", ...).
+2. Embedding model: k-nearest neighbours trên các câu hỏi đã gán nhãn -
+   câu hỏi mẫu của SQL templates (nhãn SQL) và GENERAL_EXAMPLES (nhãn OTHER),
+   embed bằng cùng embedding function với RAG/template index.
+
+Xác suất SQL nằm ngoài khoảng [CLASSIFIER_OTHER_THRESHOLD,
+CLASSIFIER_SQL_THRESHOLD] thì quyết định ngay; nằm trong khoảng (không chắc
+chắn) thì node question_classifier mới gọi Gemini.
+
+Kết quả được ghi vào state["classification"] (hiện trong workflow trace):
+    {"label": "SQL", "sql_probability": 0.98, "confidence": 0.98, "source": "rules"}
+source là "rules", "embedding", "llm" hoặc "default" (không gọi được LLM).
+CLASSIFIER_STATS đếm số lần theo source để tính tỷ lệ fallback sang LLM.
+
+Usage:
+    decision = classify_locally("What was the closing price of Apple on 2024-01-15?")
+    if decision is not None:
+        print(decision["label"], decision["confidence"])
+"""
+
+import math
+import re
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import (
+    CLASSIFIER_FAST_PATH,
+    CLASSIFIER_SQL_THRESHOLD,
+    CLASSIFIER_OTHER_THRESHOLD,
+    CLASSIFIER_KNN_K,
+)
+from nodes.entities import QueryEntities, extract_entities
+from nodes.template_index import mask_question, normalize_rows
+from nodes.utils import extract_ticker, normalize_text
+
+# ==================== RULES ====================
+
+# Từ khoá của câu hỏi cần số liệu trong database
+_DATA_TERMS_RE = re.compile(
+    r"\b(?:price|prices|close|closing|open|opening|high|highest|low|lowest|volume"
+    r"|dividends?|split|market cap|p/e|yield|52 week|return|returns|volatility"
+    r"|average|avg|total|sum|max|min|percent|percentage|change|performance"
+    r"|ticker|sector|industry|country|website|rank|top \d+|compare|comparison)\b"
+    r"|giá|khối lượng|cổ tức|trung bình|tổng|so sánh|lợi nhuận|biến động|ngành"
+)
+# Từ khoá yêu cầu vẽ biểu đồ (luôn cần dữ liệu)
+_CHART_TERMS_RE = re.compile(
+    r"\b(?:plot|chart|graph|visuali[sz]e|histogram|heatmap|scatter|candlestick)\b"
+    r"|biểu đồ|vẽ"
+)
+# Câu hỏi khái niệm / giải thích / tài liệu
+_GENERAL_TERMS_RE = re.compile(
+    r"^(?:what is|what are|what does|who is|why|how does|how do|explain|define"
+    r"|tell me about)\b"
+    r"|\b(?:mean|meaning|definition|concept|explain|calculated|according to"
+    r"|annual report|report|history|strategy|highlights|events|risk factors)\b"
+    r"|là gì|giải thích|khái niệm|định nghĩa|tại sao|như thế nào"
+)
+
+# Tên chỉ số DJIA: "Dow Jones" không phải công ty Dow Inc. (ticker DOW)
+_INDEX_NAME_RE = re.compile(r"\bdow jones(?: industrial average)?\b|\bdjia\b", re.I)
+
+# Trọng số log-odds của từng tín hiệu
+_WEIGHTS = {
+    "company": 2.0,
+    "date": 1.5,
+    "year": 0.5,
+    "data_terms": 2.0,
+    "chart_terms": 3.0,
+    "general_terms": -3.0,
+}
+
+
+def rule_features(
+    question: str, entities: Optional[QueryEntities] = None
+) -> Dict[str, bool]:
+    """Các tín hiệu entity/từ khoá của câu hỏi."""
+    q = normalize_text(question)
+    entities = entities or extract_entities(question)
+    has_company = entities.ticker is not None
+    if has_company and _INDEX_NAME_RE.search(question):
+        has_company = extract_ticker(_INDEX_NAME_RE.sub(" ", question)) is not None
+    return {
+        "company": has_company,
+        "date": entities.date is not None,
+        "year": entities.year is not None and entities.date is None,
+        "data_terms": bool(_DATA_TERMS_RE.search(q)),
+        "chart_terms": bool(_CHART_TERMS_RE.search(q)),
+        "general_terms": bool(_GENERAL_TERMS_RE.search(q)),
+    }
+
+
+def rule_score(question: str, entities: Optional[QueryEntities] = None) -> float:
+    """Điểm log-odds câu hỏi là SQL theo rules (0 = không có tín hiệu)."""
+    features = rule_features(question, entities)
+    return sum(weight for name, weight in _WEIGHTS.items() if features[name])
+
+
+# ==================== EMBEDDING MODEL ====================
+
+# Câu hỏi không cần SQL (nhãn OTHER) - câu hỏi mẫu của SQL templates là nhãn SQL
+GENERAL_EXAMPLES = [
+    "What is DJIA?",
+    "What is the Dow Jones Industrial Average?",
+    "How does the stock market work?",
+    "What is a dividend?",
+    "What does P/E ratio mean and how is it calculated?",
+    "What is dividend yield and how is it different from dividend per share?",
+    "What is a stock split?",
+    "What is market capitalization?",
+    "Explain the difference between stocks and bonds",
+    "How is the DJIA calculated?",
+    "Why do stock prices change?",
+    "What are blue chip stocks?",
+    "What sectors are represented in the Dow Jones Industrial Average?",
+    "What were the key highlights in the company's annual report?",
+    "What risks does the company describe in its annual report?",
+    "What is the company's business strategy?",
+    "Tell me about investing for beginners",
+    "Hello, what can you do?",
+    "Giải thích về thị trường chứng khoán",
+    "Tôi muốn biết về đầu tư",
+    "Chỉ số DJIA là gì?",
+    "Cổ tức là gì?",
+    "Tại sao giá cổ phiếu biến động?",
+    "Chỉ số P/E được tính như thế nào?",
+]
+
+# Xác suất của embedding model bị kẹp để không át hẳn điểm của rules
+_MIN_PROBABILITY = 0.02
+
+
+class QuestionTypeModel:
+    """
+    k-nearest neighbours trên embedding của câu hỏi đã gán nhãn.
+
+    Câu hỏi được mask (tên công ty, ngày, năm -> placeholder) giống template
+    index, nên câu hỏi về công ty/ngày bất kỳ vẫn gần câu hỏi mẫu tương ứng.
+    """
+
+    def __init__(
+        self,
+        sql_examples: Sequence[str],
+        other_examples: Sequence[str],
+        embedding_function,
+        k: int = 5,
+    ):
+        self._embedding_function = embedding_function
+        self.k = k
+        texts = [mask_question(text) for text in [*sql_examples, *other_examples]]
+        self._labels = np.asarray(
+            [1.0] * len(sql_examples) + [0.0] * len(other_examples), dtype=np.float32
+        )
+        self._vectors = self._embed(texts)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return normalize_rows(
+            np.asarray(self._embedding_function(texts), dtype=np.float32)
+        )
+
+    def predict(self, question: str) -> float:
+        """Xác suất câu hỏi là SQL (trung bình nhãn của k láng giềng, trọng số similarity)."""
+        query = self._embed([mask_question(question)])[0]
+        scores = self._vectors @ query
+        nearest = np.argsort(-scores)[: self.k]
+        weights = np.clip(scores[nearest], 1e-6, None)
+        return float(np.dot(weights, self._labels[nearest]) / weights.sum())
+
+
+def build_question_type_model(templates, embedding_function) -> Optional[QuestionTypeModel]:
+    """Build QuestionTypeModel từ câu hỏi mẫu của templates, None nếu chưa có embedding."""
+    if embedding_function is None:
+        return None
+    sql_examples = [question for template in templates for question in template.questions]
+    if not sql_examples:
+        return None
+    try:
+        return QuestionTypeModel(
+            sql_examples, GENERAL_EXAMPLES, embedding_function, k=CLASSIFIER_KNN_K
+        )
+    except Exception as e:
+        print(f"Error building question type model: {e}")
+        return None
+
+
+# ==================== CLASSIFIER ====================
+
+
+def _sigmoid(x: float) -> float:
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+def _logit(p: float) -> float:
+    p = min(max(p, _MIN_PROBABILITY), 1.0 - _MIN_PROBABILITY)
+    return math.log(p / (1.0 - p))
+
+
+def make_decision(sql_probability: float, source: str) -> Dict[str, Any]:
+    """Dict classification ghi vào state (label, xác suất SQL, độ tin cậy, nguồn)."""
+    is_sql = sql_probability >= 0.5
+    return {
+        "label": "SQL" if is_sql else "OTHER",
+        "sql_probability": round(sql_probability, 4),
+        "confidence": round(sql_probability if is_sql else 1.0 - sql_probability, 4),
+        "source": source,
+    }
+
+
+def _is_confident(sql_probability: float) -> bool:
+    return (
+        sql_probability >= CLASSIFIER_SQL_THRESHOLD
+        or sql_probability <= CLASSIFIER_OTHER_THRESHOLD
+    )
+
+
+def score_question(
+    question: str,
+    model: Optional[QuestionTypeModel] = None,
+    entities: Optional[QueryEntities] = None,
+) -> Dict[str, Any]:
+    """
+    Xác suất SQL của câu hỏi theo rules, rồi kết hợp embedding model nếu rules
+    chưa đủ chắc chắn.
+
+    Returns:
+        make_decision(...) với source "rules" hoặc "embedding"
+    """
+    score = rule_score(question, entities)
+    probability = _sigmoid(score)
+    if _is_confident(probability) or model is None:
+        return make_decision(probability, "rules")
+    # Cộng log-odds của hai tầng (coi như hai bằng chứng độc lập)
+    probability = _sigmoid(score + _logit(model.predict(question)))
+    return make_decision(probability, "embedding")
+
+
+def classify_locally(
+    question: str, entities: Optional[QueryEntities] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Phân loại câu hỏi không cần LLM.
+
+    Returns:
+        Dict classification nếu đủ tin cậy; None nếu nằm trong vùng không
+        chắc chắn (hoặc fast path bị tắt) và cần hỏi Gemini.
+    """
+    if not CLASSIFIER_FAST_PATH or not question or not question.strip():
+        return None
+    from runtime import get_runtime
+
+    decision = score_question(question, get_runtime().question_type_model, entities)
+    return decision if _is_confident(decision["sql_probability"]) else None
+
+
+# ==================== THỐNG KÊ ====================
+
+
+class ClassifierStats:
+    """Số câu hỏi đã phân loại theo source, cộng dồn cho cả process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+
+    def record(self, source: str) -> None:
+        with self._lock:
+            self._counts[source] = self._counts.get(source, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._counts)
+        total = sum(counts.values())
+        return {
+            "total": total,
+            "by_source": counts,
+            "llm_fallback_rate": round(counts.get("llm", 0) / total, 4) if total else 0.0,
+        }
+
+
+CLASSIFIER_STATS = ClassifierStats()
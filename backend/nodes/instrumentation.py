@@ -0,0 +1,177 @@
+"""
+Instrumentation - Đo thời gian và tài nguyên thực tế của từng node.
+
+Mỗi node đăng ký trong build_djia_graph được bọc bởi instrument_node().
+Trong lúc node chạy, một dict metrics được đặt vào contextvar để các lớp
+bên dưới ghi số liệu mà không cần truyền tham số qua state:
+- nodes.llm ghi model, prompt/response tokens và thời gian gọi Gemini
+  (hoặc một lần cache hit nếu response lấy từ LLM cache)
+- nodes.sql_executor / chart_generator ghi thời gian SQL và số dòng
+- db.engine ghi thời gian chờ lấy connection từ pool
+
+Khi node kết thúc, metrics được append vào state["node_metrics"]:
+    {
+        "node": "execute_sql",
+        "wall_ms": 812.4,      # thời gian thực
+        "cpu_ms": 35.1,        # CPU time của thread chạy node
+        "llm_calls": 0, "llm_ms": 0.0,
+        "llm_cache_hits": 0,   # lời gọi LLM lấy từ cache (không gọi Gemini)
+        "prompt_tokens": 0, "response_tokens": 0, "models": [],
+        "sql_queries": 1, "sql_ms": 790.2, "rows": 1,
+        "pool_wait_ms": 0.4,   # thời gian chờ connection pool
+    }
+
+Với node async, cpu_ms là CPU time của thread event loop trong khoảng thời
+gian node chạy nên có thể gồm cả coroutine khác khi tải đồng thời cao.
+"""
+
+import contextvars
+import functools
+import inspect
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+_current: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    "node_metrics", default=None
+)
+
+
+def _new_metrics(name: str) -> Dict[str, Any]:
+    return {
+        "node": name,
+        "wall_ms": 0.0,
+        "cpu_ms": 0.0,
+        "llm_calls": 0,
+        "llm_ms": 0.0,
+        "llm_cache_hits": 0,
+        "prompt_tokens": 0,
+        "response_tokens": 0,
+        "models": [],
+        "sql_queries": 0,
+        "sql_ms": 0.0,
+        "rows": 0,
+        "pool_wait_ms": 0.0,
+    }
+
+
+def current_node() -> Optional[str]:
+    """Tên node đang chạy (None nếu gọi ngoài workflow)."""
+    metrics = _current.get()
+    return metrics["node"] if metrics is not None else None
+
+
+def record_llm_call(
+    model_name: str, usage_metadata: Any = None, seconds: float = 0.0
+) -> None:
+    """Ghi một lần gọi LLM vào metrics của node đang chạy (no-op nếu không có)."""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics["llm_calls"] += 1
+    metrics["llm_ms"] = round(metrics["llm_ms"] + seconds * 1000, 2)
+    if model_name not in metrics["models"]:
+        metrics["models"].append(model_name)
+    if usage_metadata is not None:
+        metrics["prompt_tokens"] += getattr(usage_metadata, "prompt_token_count", 0) or 0
+        metrics["response_tokens"] += (
+            getattr(usage_metadata, "candidates_token_count", 0) or 0
+        )
+
+
+def record_llm_cache_hit(model_name: str) -> None:
+    """Ghi một lời gọi LLM được trả về từ cache (no-op nếu không có node đang chạy)."""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics["llm_cache_hits"] += 1
+    if model_name not in metrics["models"]:
+        metrics["models"].append(model_name)
+
+
+def record_sql(seconds: float, rows: int) -> None:
+    """Ghi một lần thực thi SQL vào metrics của node đang chạy (no-op nếu không có)."""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics["sql_queries"] += 1
+    metrics["sql_ms"] = round(metrics["sql_ms"] + seconds * 1000, 2)
+    metrics["rows"] += rows
+
+
+def record_pool_wait(seconds: float) -> None:
+    """Ghi thời gian chờ lấy connection từ pool (no-op nếu không có node đang chạy)."""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics["pool_wait_ms"] = round(metrics["pool_wait_ms"] + seconds * 1000, 2)
+
+
+def _finish(
+    result: Dict[str, Any],
+    metrics: Dict[str, Any],
+    wall_started: float,
+    cpu_started: float,
+) -> Dict[str, Any]:
+    metrics["wall_ms"] = round((time.perf_counter() - wall_started) * 1000, 2)
+    metrics["cpu_ms"] = round((time.thread_time() - cpu_started) * 1000, 2)
+    previous = result.get("node_metrics") or []
+    return {**result, "node_metrics": [*previous, metrics]}
+
+
+def instrument_node(name: str, fn: Callable) -> Callable:
+    """
+    Bọc một node (sync hoặc async) để đo wall/CPU time, LLM tokens và SQL time.
+
+    Wrapper luôn nhận config và chỉ chuyển tiếp cho node nếu node có tham số
+    config (ví dụ asummarize_answer dùng config để phát answer tokens).
+    """
+    accepts_config = "config" in inspect.signature(fn).parameters
+
+    def _call_args(config):
+        return {"config": config} if accepts_config else {}
+
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(state: Dict[str, Any], config=None) -> Dict[str, Any]:
+            metrics = _new_metrics(name)
+            token = _current.set(metrics)
+            wall_started, cpu_started = time.perf_counter(), time.thread_time()
+            try:
+                result = await fn(state, **_call_args(config))
+            finally:
+                _current.reset(token)
+            return _finish(result, metrics, wall_started, cpu_started)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(state: Dict[str, Any], config=None) -> Dict[str, Any]:
+        metrics = _new_metrics(name)
+        token = _current.set(metrics)
+        wall_started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            result = fn(state, **_call_args(config))
+        finally:
+            _current.reset(token)
+        return _finish(result, metrics, wall_started, cpu_started)
+
+    return wrapper
+
+
+def summarize_metrics(node_metrics: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Tổng hợp metrics của cả request (tổng thời gian, tokens, SQL)."""
+    return {
+        "wall_ms": round(sum(m["wall_ms"] for m in node_metrics), 2),
+        "cpu_ms": round(sum(m["cpu_ms"] for m in node_metrics), 2),
+        "llm_calls": sum(m["llm_calls"] for m in node_metrics),
+        "llm_ms": round(sum(m["llm_ms"] for m in node_metrics), 2),
+        "llm_cache_hits": sum(m.get("llm_cache_hits", 0) for m in node_metrics),
+        "prompt_tokens": sum(m["prompt_tokens"] for m in node_metrics),
+        "response_tokens": sum(m["response_tokens"] for m in node_metrics),
+        "sql_queries": sum(m["sql_queries"] for m in node_metrics),
+        "sql_ms": round(sum(m["sql_ms"] for m in node_metrics), 2),
+        "rows": sum(m["rows"] for m in node_metrics),
+        "pool_wait_ms": round(sum(m.get("pool_wait_ms", 0.0) for m in node_metrics), 2),
+        "nodes": node_metrics,
+    }
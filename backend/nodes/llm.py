@@ -0,0 +1,480 @@
+"""
+LLM Helper - Client Gemini dùng chung cho các nodes (sync + async).
+
+Các nodes chỉ cần build prompt rồi gọi generate_text() (LangGraph invoke),
+agenerate_text() (LangGraph ainvoke) hoặc astream_text() (stream từng đoạn
+text), không cần tự configure API key và tạo GenerativeModel ở mỗi lần gọi.
+
+Mọi lời gọi đi qua cùng một lớp (cấu hình trong config.py, mục LLM CLIENT):
+- Model chọn theo node đang chạy (LLM_NODE_MODELS), mặc định LLM_MODEL
+- Tối đa LLM_MAX_CONCURRENCY lời gọi đồng thời mỗi process; request chờ slot
+  quá LLM_TIMEOUT giây sẽ timeout thay vì giữ worker vô thời hạn
+- Mỗi lần gọi có deadline LLM_TIMEOUT giây
+- Lỗi 429/5xx và timeout được thử lại tối đa LLM_MAX_RETRIES lần với
+  exponential backoff + jitter
+- Latency từng model được gom thành histogram (LLM_STATS, báo qua
+  /api/health/ready/)
+- LLM_API_ENDPOINT trỏ client sang server giả lập local để test offline
+- LLM_BACKEND chọn backend ghi/phát lại cassette hoặc response giả lập để
+  benchmark không cần mạng (xem nodes/llm_fake.py)
+
+Response được memoize theo (model, generation config, prompt) trong LLM cache
+trên đĩa dùng chung giữa các worker (xem nodes/llm_cache.py): prompt đã gửi
+trước đó không phải gọi lại Gemini.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+import google.generativeai as google_genai
+from google.api_core import exceptions as api_exceptions
+
+from config import (
+    LLM_MODEL,
+    LLM_NODE_MODELS,
+    LLM_MAX_CONCURRENCY,
+    LLM_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BACKOFF,
+    LLM_RETRY_BACKOFF_MAX,
+    LLM_API_ENDPOINT,
+    LLM_TRANSPORT,
+    LLM_BACKEND,
+)
+from nodes.instrumentation import current_node, record_llm_call, record_llm_cache_hit
+from nodes.llm_cache import cache_key
+from nodes.llm_fake import BACKENDS, FAKE_BACKENDS, create_model
+from runtime import get_runtime
+
+load_dotenv()
+if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
+    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+
+# Model mặc định cho tất cả nodes
+DEFAULT_MODEL = LLM_MODEL
+
+# Client async của SDK chỉ hỗ trợ gRPC; với REST (ví dụ server giả lập local)
+# lời gọi async chạy bản sync trong thread riêng
+_ASYNC_TRANSPORT = LLM_TRANSPORT != "rest"
+
+# Lỗi upstream đáng thử lại: 429 (quota/rate limit), 5xx và timeout
+_RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServerError,
+    TimeoutError,
+    asyncio.TimeoutError,
+)
+_TIMEOUT_ERRORS = (api_exceptions.DeadlineExceeded, TimeoutError, asyncio.TimeoutError)
+
+_models: Dict[str, google_genai.GenerativeModel] = {}
+_configured_key: Optional[str] = None
+_lock = threading.Lock()
+_backend = LLM_BACKEND
+
+# Slot gọi đồng thời: semaphore cho thread (invoke) và cho từng event loop (ainvoke)
+_sync_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_async_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# Cận trên (ms) của các bucket trong histogram latency
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class LLMStats:
+    """Thống kê lời gọi LLM theo model, cộng dồn cho cả process (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def _model(self, model_name: str) -> Dict[str, Any]:
+        stats = self._models.get(model_name)
+        if stats is None:
+            stats = {
+                "calls": 0,
+                "errors": 0,
+                "timeouts": 0,
+                "retries": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+            self._models[model_name] = stats
+        return stats
+
+    def record(self, model_name: str, seconds: float, error: Optional[Exception] = None) -> None:
+        elapsed_ms = seconds * 1000
+        bucket = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound),
+            len(LATENCY_BUCKETS_MS),
+        )
+        with self._lock:
+            stats = self._model(model_name)
+            stats["calls"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["buckets"][bucket] += 1
+            if isinstance(error, _TIMEOUT_ERRORS):
+                stats["timeouts"] += 1
+            elif error is not None:
+                stats["errors"] += 1
+
+    def record_retry(self, model_name: str) -> None:
+        with self._lock:
+            self._model(model_name)["retries"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + [
+            f">{LATENCY_BUCKETS_MS[-1]}"
+        ]
+        with self._lock:
+            return {
+                model_name: {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "timeouts": stats["timeouts"],
+                    "retries": stats["retries"],
+                    "avg_ms": round(stats["total_ms"] / stats["calls"], 2)
+                    if stats["calls"]
+                    else 0.0,
+                    "max_ms": round(stats["max_ms"], 2),
+                    "histogram_ms": dict(zip(labels, stats["buckets"])),
+                }
+                for model_name, stats in self._models.items()
+            }
+
+
+LLM_STATS = LLMStats()
+
+
+def get_api_key() -> Optional[str]:
+    """
+    Lấy Gemini API key từ môi trường (GEMINI_API_KEY hoặc GOOGLE_API_KEY).
+
+    Khi dùng LLM_API_ENDPOINT (server giả lập local) hoặc backend giả lập
+    (replay/synthetic) không cần key thật.
+    """
+    return (
+        os.environ.get("GEMINI_API_KEY")
+        or os.environ.get("GOOGLE_API_KEY")
+        or ("local" if LLM_API_ENDPOINT or _backend in FAKE_BACKENDS else None)
+    )
+
+
+def get_backend() -> str:
+    return _backend
+
+
+def set_backend(backend: str) -> None:
+    """Đổi backend LLM cho cả process ("gemini", "record", "replay", "synthetic")."""
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"LLM backend không hợp lệ: {backend} (chọn một trong {BACKENDS})")
+    with _lock:
+        _backend = backend
+        _models.clear()
+
+
+def model_for_node(node: Optional[str] = None) -> str:
+    """Model dùng cho node (mặc định là node đang chạy trong workflow)."""
+    return LLM_NODE_MODELS.get(node or current_node(), DEFAULT_MODEL)
+
+
+def get_model(model_name: Optional[str] = None) -> google_genai.GenerativeModel:
+    """
+    Trả về GenerativeModel dùng chung cho model_name.
+
+    Chỉ configure lại SDK khi API key thay đổi.
+    Với LLM_BACKEND khác "gemini", trả về model ghi cassette hoặc model giả
+    lập có cùng interface (xem nodes/llm_fake.py).
+    """
+    global _configured_key
+    model_name = model_name or model_for_node()
+    api_key = get_api_key()
+    with _lock:
+        if api_key != _configured_key:
+            options = {}
+            if LLM_API_ENDPOINT:
+                options["client_options"] = {"api_endpoint": LLM_API_ENDPOINT}
+            if LLM_TRANSPORT:
+                options["transport"] = LLM_TRANSPORT
+            google_genai.configure(api_key=api_key, **options)
+            _configured_key = api_key
+            _models.clear()
+        model = _models.get(model_name)
+        if model is None:
+            model = create_model(
+                _backend, model_name, lambda: google_genai.GenerativeModel(model_name)
+            )
+            _models[model_name] = model
+        return model
+
+
+def _async_supported() -> bool:
+    return _ASYNC_TRANSPORT or _backend in FAKE_BACKENDS
+
+
+# ==================== CONCURRENCY / RETRY ====================
+
+
+def _loop_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    slots = _async_slots.get(loop)
+    if slots is None:
+        with _lock:
+            slots = _async_slots.get(loop)
+            if slots is None:
+                slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+                _async_slots[loop] = slots
+    return slots
+
+
+def _backoff_seconds(attempt: int) -> float:
+    # Full jitter: tránh các worker cùng thử lại một lúc sau khi bị 429
+    return random.uniform(0, min(LLM_RETRY_BACKOFF_MAX, LLM_RETRY_BACKOFF * 2**attempt))
+
+
+def _should_retry(error: Exception, attempt: int, model_name: str) -> bool:
+    if attempt >= LLM_MAX_RETRIES or not isinstance(error, _RETRYABLE_ERRORS):
+        return False
+    LLM_STATS.record_retry(model_name)
+    print(f"Retrying LLM call ({model_name}) after {type(error).__name__}: {error}")
+    return True
+
+
+def _call(model_name: str, request: Callable[[float], Any]) -> Any:
+    """
+    Chạy request(timeout) trong một slot, thử lại khi lỗi tạm thời.
+
+    timeout truyền cho request là thời gian còn lại của deadline sau khi chờ slot.
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            if not _sync_slots.acquire(timeout=LLM_TIMEOUT):
+                raise TimeoutError(
+                    f"Quá {LLM_TIMEOUT}s chờ slot gọi LLM "
+                    f"(LLM_MAX_CONCURRENCY={LLM_MAX_CONCURRENCY})"
+                )
+            try:
+                remaining = LLM_TIMEOUT - (time.perf_counter() - started)
+                response = request(max(remaining, 1.0))
+            finally:
+                _sync_slots.release()
+        except Exception as e:
+            LLM_STATS.record(model_name, time.perf_counter() - started, e)
+            if not _should_retry(e, attempt, model_name):
+                raise
+            time.sleep(_backoff_seconds(attempt))
+            continue
+
+        seconds = time.perf_counter() - started
+        LLM_STATS.record(model_name, seconds)
+        record_llm_call(model_name, response.usage_metadata, seconds)
+        return response
+
+
+async def _acall(model_name: str, request: Callable[[float], Any]) -> Any:
+    """Phiên bản async của _call (request(timeout) trả về awaitable)."""
+
+    async def _in_slot() -> Any:
+        async with _loop_slots():
+            return await request(LLM_TIMEOUT)
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            # Deadline gồm cả thời gian chờ slot; hết hạn thì huỷ và trả slot
+            response = await asyncio.wait_for(_in_slot(), timeout=LLM_TIMEOUT)
+        except Exception as e:
+            LLM_STATS.record(model_name, time.perf_counter() - started, e)
+            if not _should_retry(e, attempt, model_name):
+                raise
+            await asyncio.sleep(_backoff_seconds(attempt))
+            continue
+
+        seconds = time.perf_counter() - started
+        LLM_STATS.record(model_name, seconds)
+        record_llm_call(model_name, response.usage_metadata, seconds)
+        return response
+
+
+# ==================== CACHE ====================
+
+
+def _active_cache():
+    # Backend record/replay/synthetic phải thấy mọi lời gọi nên bỏ qua cache
+    return get_runtime().llm_cache if _backend == "gemini" else None
+
+
+def _lookup(
+    prompt: str, model_name: str, generation_config: Optional[Dict[str, Any]]
+) -> Tuple[Any, Optional[str], Optional[str]]:
+    """Tra LLM cache. Trả về (cache, key, text đã cache hoặc None)."""
+    cache = _active_cache()
+    if cache is None:
+        return None, None, None
+    key = cache_key(model_name, prompt, generation_config)
+    text = cache.get(key)
+    if text is not None:
+        record_llm_cache_hit(model_name)
+    return cache, key, text
+
+
+def text_cache_key(
+    prompt: str,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> Optional[str]:
+    """
+    Key LLM cache của lời gọi generate_text với cùng tham số (None nếu không
+    dùng cache). Phải gọi trong cùng node với lời gọi LLM (model theo node).
+    """
+    if _active_cache() is None:
+        return None
+    return cache_key(model_name or model_for_node(), prompt, generation_config)
+
+
+def forget_text(key: Optional[str]) -> None:
+    """Xoá response đã cache (ví dụ SQL do LLM sinh bị validate/thực thi lỗi)."""
+    cache = _active_cache() if key else None
+    if cache is not None:
+        cache.delete(key)
+
+
+# ==================== API CHO NODES ====================
+
+
+def generate_text(
+    prompt: str,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Gọi Gemini (blocking) và trả về text đã strip. Lỗi SDK được raise nguyên vẹn."""
+    model_name = model_name or model_for_node()
+    cache, key, cached = _lookup(prompt, model_name, generation_config)
+    if cached is not None:
+        return cached
+
+    model = get_model(model_name)
+    response = _call(
+        model_name,
+        lambda timeout: model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            request_options={"timeout": timeout},
+        ),
+    )
+    text = (response.text or "").strip()
+    if cache is not None:
+        cache.set(key, text)
+    return text
+
+
+async def agenerate_text(
+    prompt: str,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Phiên bản async của generate_text (không chặn event loop)."""
+    model_name = model_name or model_for_node()
+    # diskcache là SQLite (I/O đĩa) nên tra cache trong thread riêng
+    cache, key, cached = await asyncio.to_thread(
+        _lookup, prompt, model_name, generation_config
+    )
+    if cached is not None:
+        return cached
+
+    model = get_model(model_name)
+    if _async_supported():
+        request = lambda timeout: model.generate_content_async(
+            prompt,
+            generation_config=generation_config,
+            request_options={"timeout": timeout},
+        )
+    else:
+        request = lambda timeout: asyncio.to_thread(
+            model.generate_content,
+            prompt,
+            generation_config=generation_config,
+            request_options={"timeout": timeout},
+        )
+    response = await _acall(model_name, request)
+    text = (response.text or "").strip()
+    if cache is not None:
+        await asyncio.to_thread(cache.set, key, text)
+    return text
+
+
+async def astream_text(
+    prompt: str,
+    model_name: Optional[str] = None,
+    generation_config: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """
+    Stream response của Gemini theo từng đoạn text ngay khi nhận được.
+
+    Nếu prompt đã có trong LLM cache (hoặc transport REST không hỗ trợ stream
+    async), toàn bộ câu trả lời được yield một lần. Chỉ lần mở stream được
+    thử lại; lỗi giữa chừng được raise vì client đã nhận một phần câu trả lời.
+    """
+    model_name = model_name or model_for_node()
+    if not _async_supported():
+        yield await agenerate_text(prompt, model_name, generation_config)
+        return
+
+    cache, key, cached = await asyncio.to_thread(
+        _lookup, prompt, model_name, generation_config
+    )
+    if cached is not None:
+        yield cached
+        return
+
+    model = get_model(model_name)
+    started = time.perf_counter()
+    # Giữ slot trong suốt stream: lời gọi upstream vẫn đang mở
+    async with _loop_slots():
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                response = await asyncio.wait_for(
+                    model.generate_content_async(
+                        prompt,
+                        generation_config=generation_config,
+                        stream=True,
+                        request_options={"timeout": LLM_TIMEOUT},
+                    ),
+                    timeout=LLM_TIMEOUT,
+                )
+                break
+            except Exception as e:
+                LLM_STATS.record(model_name, time.perf_counter() - started, e)
+                if not _should_retry(e, attempt, model_name):
+                    raise
+                await asyncio.sleep(_backoff_seconds(attempt))
+                started = time.perf_counter()
+
+        chunks = []
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk không có text part (ví dụ chunk cuối chỉ chứa finish_reason)
+                continue
+            if text:
+                chunks.append(text)
+                yield text
+
+    # usage_metadata chỉ đầy đủ sau khi đã nhận hết các chunk
+    seconds = time.perf_counter() - started
+    LLM_STATS.record(model_name, seconds)
+    record_llm_call(model_name, response.usage_metadata, seconds)
+    if cache is not None:
+        await asyncio.to_thread(cache.set, key, "".join(chunks).strip())
@@ -0,0 +1,109 @@
+"""
+LLM Cache - Memoize response của Gemini trên đĩa, dùng chung giữa các worker.
+
+Mọi lần gọi qua nodes.llm (generate_text, agenerate_text, astream_text) được
+tra cache theo key = sha256(model, generation config, prompt). Cùng một prompt
+(ví dụ prompt classifier/matcher của câu hỏi vừa được worker khác hỏi) trả về
+ngay từ cache thay vì gọi lại Gemini.
+
+Cache dùng diskcache (SQLite trong LLM_CACHE_DIR) nên mọi process Django/ASGI
+trên cùng máy đọc/ghi chung một store:
+- Giới hạn dung lượng LLM_CACHE_SIZE_LIMIT, vượt quá thì bỏ entry ít được
+  dùng gần đây nhất (least-recently-used)
+- Mỗi entry hết hạn sau LLM_CACHE_TTL giây (0 = không hết hạn)
+- Số hit/miss được diskcache đếm chung cho mọi process (xem stats())
+
+Nếu chưa cài diskcache hoặc LLM_CACHE_ENABLED tắt, runtime không tạo cache và
+mọi lời gọi đi thẳng tới Gemini.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+def cache_key(
+    model_name: str, prompt: str, generation_config: Optional[Dict[str, Any]] = None
+) -> str:
+    """Key của một lời gọi LLM: sha256(model, generation config, prompt)."""
+    payload = json.dumps(
+        [model_name, generation_config or {}, prompt],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Bọc diskcache.Cache: get/set text response theo cache_key()."""
+
+    def __init__(self, directory: Path, size_limit: int, ttl_seconds: float = 0):
+        import diskcache
+
+        self.directory = Path(directory)
+        self.ttl_seconds = ttl_seconds
+        self._cache = diskcache.Cache(
+            str(self.directory),
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+        # Bật bộ đếm hit/miss (lưu trong SQLite nên cộng dồn cho mọi worker)
+        self._cache.stats(enable=True)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self._cache.get(key)
+        except Exception as e:
+            print(f"Error reading LLM cache: {e}")
+            return None
+
+    def set(self, key: str, text: str) -> None:
+        # Không cache response rỗng (thường là lỗi/bị chặn bởi safety filter)
+        if not text:
+            return
+        try:
+            self._cache.set(key, text, expire=self.ttl_seconds or None)
+        except Exception as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def delete(self, key: str) -> None:
+        try:
+            self._cache.delete(key)
+        except Exception as e:
+            print(f"Error deleting LLM cache entry: {e}")
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        hits, misses = self._cache.stats()
+        return {
+            "directory": str(self.directory),
+            "entries": len(self._cache),
+            "size_bytes": self._cache.volume(),
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+def create_llm_cache() -> Optional[LLMCache]:
+    """Tạo LLMCache theo config.py (None nếu tắt hoặc chưa cài diskcache)."""
+    from config import (
+        LLM_CACHE_ENABLED,
+        LLM_CACHE_DIR,
+        LLM_CACHE_SIZE_LIMIT,
+        LLM_CACHE_TTL,
+    )
+
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        return LLMCache(LLM_CACHE_DIR, LLM_CACHE_SIZE_LIMIT, LLM_CACHE_TTL)
+    except ImportError:
+        print("Warning: diskcache not installed. LLM responses will not be cached.")
+        return None
+    except Exception as e:
+        print(f"Error opening LLM cache: {e}")
+        return None
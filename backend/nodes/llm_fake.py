@@ -0,0 +1,448 @@
+"""
+LLM Fake - Backend Gemini giả lập để benchmark pipeline không cần mạng.
+
+nodes.llm chọn backend theo LLM_BACKEND (hoặc set_backend()):
+- "gemini":    gọi Gemini thật
+- "record":    gọi Gemini thật và ghi mỗi response vào cassette (JSONL)
+- "replay":    trả response đã ghi theo prompt hash, không gọi mạng
+- "synthetic": trả response giả theo loại prompt (SQL, plan JSON, code
+               Plotly, câu trả lời...), không cần cassette; chỉ đúng định
+               dạng nên chỉ dùng để đo độ trễ, không đo độ chính xác
+
+Model giả có cùng interface với GenerativeModel mà nodes.llm dùng
+(generate_content / generate_content_async, kể cả stream=True), nên mọi node
+chạy được mà không sửa gì. Replay/synthetic có thể thêm độ trễ giả lập theo
+phân phối cấu hình ở LLM_FAKE_LATENCY.
+
+Ghi cassette từ các câu hỏi trong test.txt:
+    python scripts/record_llm_cassette.py
+
+Chạy lại offline:
+    LLM_BACKEND=replay LLM_FAKE_LATENCY=recorded python manage.py runserver
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from google.api_core import exceptions as api_exceptions
+
+from config import LLM_CASSETTE, LLM_FAKE_LATENCY, LLM_FAKE_SEED, LLM_REPLAY_MISS
+from nodes.instrumentation import current_node
+from nodes.llm_cache import cache_key
+
+FAKE_BACKENDS = ("replay", "synthetic")
+BACKENDS = ("gemini", "record", *FAKE_BACKENDS)
+
+
+# ==================== ĐỘ TRỄ GIẢ LẬP ====================
+
+
+class LatencyModel:
+    """
+    Độ trễ (ms) theo spec của LLM_FAKE_LATENCY.
+
+    Examples:
+        >>> LatencyModel("uniform:100:800").sample_ms()
+        431.7
+    """
+
+    def __init__(self, spec: str = "0", seed: int = 0):
+        kind, _, args = (spec or "0").strip().lower().partition(":")
+        self.kind = kind
+        self.args = [float(value) for value in args.split(":") if value]
+        if kind not in ("fixed", "uniform", "normal", "lognormal", "recorded"):
+            # "200" là viết tắt của "fixed:200"
+            self.kind, self.args = "fixed", [float(kind)]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_ms(self, recorded_ms: Optional[float] = None) -> float:
+        with self._lock:
+            if self.kind == "recorded":
+                return recorded_ms or 0.0
+            if self.kind == "uniform":
+                return self._random.uniform(self.args[0], self.args[1])
+            if self.kind == "normal":
+                return max(0.0, self._random.gauss(self.args[0], self.args[1]))
+            if self.kind == "lognormal":
+                # args: median (ms), sigma của log
+                median, sigma = self.args[0], self.args[1]
+                return median * self._random.lognormvariate(0.0, sigma)
+            return self.args[0] if self.args else 0.0
+
+
+def _delay_seconds(latency: LatencyModel, timeout: Optional[float], recorded_ms=None):
+    """(số giây phải chờ, có vượt deadline không)."""
+    seconds = latency.sample_ms(recorded_ms) / 1000
+    if timeout is not None and seconds > timeout:
+        return timeout, True
+    return seconds, False
+
+
+def _deadline_error(model_name: str, timeout: float) -> Exception:
+    return api_exceptions.DeadlineExceeded(
+        f"Fake {model_name} vượt deadline {timeout}s"
+    )
+
+
+# ==================== CASSETTE ====================
+
+
+class Cassette:
+    """File JSONL chứa response đã ghi, tra theo prompt hash (thread-safe)."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            entries = {}
+            if self.path.exists():
+                with self.path.open(encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            # Ghi nhiều lần cùng prompt: lấy bản mới nhất
+                            entries[entry["key"]] = entry
+            self._entries = entries
+        return self._entries
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._load().get(key)
+
+    def record(
+        self,
+        key: str,
+        model_name: str,
+        prompt: str,
+        text: str,
+        latency_ms: float,
+        usage_metadata: Any = None,
+    ) -> None:
+        entry = {
+            "key": key,
+            "model": model_name,
+            "node": current_node(),
+            "prompt_chars": len(prompt),
+            "latency_ms": round(latency_ms, 2),
+            "prompt_tokens": getattr(usage_metadata, "prompt_token_count", None),
+            "response_tokens": getattr(usage_metadata, "candidates_token_count", None),
+            "text": text,
+        }
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Append một dòng: nhiều worker cùng ghi không làm hỏng file
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._load()[key] = entry
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load())
+
+
+# ==================== RESPONSE GIẢ ====================
+
+
+def _usage(prompt_tokens: Optional[int], response_tokens: Optional[int]):
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens or 0,
+        candidates_token_count=response_tokens or 0,
+    )
+
+
+def _estimate_tokens(text: str) -> int:
+    # Ước lượng thô ~4 ký tự/token, đủ để metrics có số liệu hợp lý
+    return max(1, len(text) // 4)
+
+
+class FakeResponse:
+    """Giống GenerateContentResponse ở các thuộc tính nodes.llm dùng."""
+
+    def __init__(self, text: str, usage_metadata: Any):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeStream:
+    """Response stream=True: async iterable các chunk (mỗi chunk có .text)."""
+
+    def __init__(self, text: str, usage_metadata: Any, chunk_size: int = 48):
+        self._chunks = [
+            text[i : i + chunk_size] for i in range(0, len(text), chunk_size)
+        ] or [""]
+        self.usage_metadata = usage_metadata
+
+    async def _iterate(self) -> AsyncIterator[SimpleNamespace]:
+        for chunk in self._chunks:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(text=chunk)
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+# Response của chế độ synthetic: chọn theo loại prompt (định dạng mà parser của
+# prompt đó chờ), không theo node đang chạy - một node có thể gọi LLM với nhiều
+# loại prompt (match_sql_template sinh cả SQL biểu đồ). Response chỉ đúng định
+# dạng, không đúng nội dung: không bao giờ chọn SQL mẫu, SQL luôn là giá AAPL,
+# nên synthetic chỉ dùng để đo độ trễ/overhead của pipeline, không đo độ chính xác.
+_SYNTHETIC_SQL = (
+    "SELECT date, close FROM prices WHERE ticker = 'AAPL' "
+    "ORDER BY date DESC LIMIT 30"
+)
+_SYNTHETIC_CHART_SQL = (
+    "SELECT date, open, high, low, close, volume FROM prices WHERE ticker = 'AAPL' "
+    "ORDER BY date DESC LIMIT 30"
+)
+_SYNTHETIC_CHART_CODE = (
+    "figure = px.line(df, x=df.columns[0], y=df.columns[-1])\n"
+    "figure.update_layout(title='Synthetic chart')"
+)
+_SYNTHETIC_STEPS = [
+    {
+        "step_number": 1,
+        "description": "Truy vấn dữ liệu từ database",
+        "sql_needed": True,
+        "chart_needed": False,
+    }
+]
+_SYNTHETIC_ANSWER = "Đây là câu trả lời giả lập (LLM_BACKEND=synthetic)."
+
+
+def _synthetic_understanding(prompt: str) -> str:
+    # Không có entity/template: entity và SQL mẫu lấy từ phần phân tích tại chỗ
+    return json.dumps(
+        {
+            "route": "SQL",
+            "complexity": {},
+            "chart_type": None,
+            "entities": {"tickers": [], "dates": [], "year": None, "quarter": None},
+            "steps": _SYNTHETIC_STEPS if "- is_multi_step: True" in prompt else [],
+            "template": None,
+        }
+    )
+
+
+# (dấu hiệu trong prompt, response) - kiểm tra theo thứ tự
+_SYNTHETIC_BY_PROMPT = (
+    # understanding.py (prompt có cả "steps" nên phải đứng trước planner)
+    ('"template": số hoặc null', _synthetic_understanding),
+    # sql_template_matcher.py
+    ("FOUND: n hoặc NO_MATCH", lambda prompt: "NO_MATCH"),
+    # rag_retriever.py (câu hỏi có cần tài liệu PDF không)
+    ("TRUE hoặc FALSE", lambda prompt: "FALSE"),
+    # chart_generator.py: code Plotly, SQL lấy dữ liệu biểu đồ
+    ("Plotly Figure", lambda prompt: _SYNTHETIC_CHART_CODE),
+    ("chuẩn bị dữ liệu vẽ biểu đồ", lambda prompt: _SYNTHETIC_CHART_SQL),
+    # sql_llm_generator.py
+    ("trợ lý tạo SQL cho PostgreSQL", lambda prompt: _SYNTHETIC_SQL),
+    # planner.py
+    ('{"steps": [', lambda prompt: json.dumps({"steps": _SYNTHETIC_STEPS})),
+)
+
+
+def synthetic_text(prompt: str) -> str:
+    """Response giả đúng định dạng của prompt (câu trả lời text nếu không nhận ra)."""
+    for marker, respond in _SYNTHETIC_BY_PROMPT:
+        if marker in prompt:
+            return respond(prompt)
+    return _SYNTHETIC_ANSWER
+
+
+# ==================== MODEL GIẢ ====================
+
+
+def _timeout(request_options: Optional[Dict[str, Any]]) -> Optional[float]:
+    return (request_options or {}).get("timeout")
+
+
+class FakeModel:
+    """Model replay/synthetic: trả response ngay (cộng độ trễ giả lập)."""
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str,
+        cassette: Optional[Cassette] = None,
+        latency: Optional[LatencyModel] = None,
+    ):
+        self.model_name = model_name
+        self.backend = backend
+        self.cassette = cassette
+        self.latency = latency or LatencyModel("0")
+
+    def _respond(self, prompt: str, generation_config: Any):
+        """(text, usage_metadata, độ trễ đã ghi nếu có)."""
+        if self.backend == "replay":
+            key = cache_key(self.model_name, prompt, generation_config)
+            entry = self.cassette.get(key) if self.cassette is not None else None
+            if entry is not None:
+                usage = _usage(entry.get("prompt_tokens"), entry.get("response_tokens"))
+                return entry["text"], usage, entry.get("latency_ms")
+            if LLM_REPLAY_MISS != "synthetic":
+                raise LookupError(
+                    f"Cassette không có response cho prompt {key[:12]} "
+                    f"(model {self.model_name}, node {current_node()})"
+                )
+        text = synthetic_text(prompt)
+        return text, _usage(_estimate_tokens(prompt), _estimate_tokens(text)), None
+
+    def generate_content(
+        self,
+        prompt: str,
+        generation_config: Any = None,
+        request_options: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+    ) -> FakeResponse:
+        text, usage, recorded_ms = self._respond(prompt, generation_config)
+        timeout = _timeout(request_options)
+        seconds, expired = _delay_seconds(self.latency, timeout, recorded_ms)
+        time.sleep(seconds)
+        if expired:
+            raise _deadline_error(self.model_name, timeout)
+        return FakeResponse(text, usage)
+
+    async def generate_content_async(
+        self,
+        prompt: str,
+        generation_config: Any = None,
+        request_options: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
+    ):
+        text, usage, recorded_ms = self._respond(prompt, generation_config)
+        timeout = _timeout(request_options)
+        seconds, expired = _delay_seconds(self.latency, timeout, recorded_ms)
+        await asyncio.sleep(seconds)
+        if expired:
+            raise _deadline_error(self.model_name, timeout)
+        return FakeStream(text, usage) if stream else FakeResponse(text, usage)
+
+
+class _RecordingStream:
+    """Bọc response stream thật: chuyển tiếp chunk và ghi cassette khi hết."""
+
+    def __init__(self, response, on_complete):
+        self._response = response
+        self._on_complete = on_complete
+
+    @property
+    def usage_metadata(self):
+        return self._response.usage_metadata
+
+    async def _iterate(self):
+        parts: List[str] = []
+        async for chunk in self._response:
+            try:
+                if chunk.text:
+                    parts.append(chunk.text)
+            except ValueError:
+                pass
+            yield chunk
+        self._on_complete("".join(parts).strip(), self._response.usage_metadata)
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class RecordingModel:
+    """Gọi GenerativeModel thật và ghi mỗi response vào cassette."""
+
+    def __init__(self, model_name: str, model, cassette: Cassette):
+        self.model_name = model_name
+        self._model = model
+        self.cassette = cassette
+
+    def _record(self, prompt, generation_config, started, text, usage_metadata):
+        self.cassette.record(
+            cache_key(self.model_name, prompt, generation_config),
+            self.model_name,
+            prompt,
+            text,
+            (time.perf_counter() - started) * 1000,
+            usage_metadata,
+        )
+
+    def generate_content(self, prompt: str, generation_config: Any = None, **kwargs):
+        started = time.perf_counter()
+        response = self._model.generate_content(
+            prompt, generation_config=generation_config, **kwargs
+        )
+        self._record(
+            prompt,
+            generation_config,
+            started,
+            (response.text or "").strip(),
+            response.usage_metadata,
+        )
+        return response
+
+    async def generate_content_async(
+        self, prompt: str, generation_config: Any = None, stream: bool = False, **kwargs
+    ):
+        started = time.perf_counter()
+        response = await self._model.generate_content_async(
+            prompt, generation_config=generation_config, stream=stream, **kwargs
+        )
+        if stream:
+            return _RecordingStream(
+                response,
+                lambda text, usage: self._record(
+                    prompt, generation_config, started, text, usage
+                ),
+            )
+        self._record(
+            prompt,
+            generation_config,
+            started,
+            (response.text or "").strip(),
+            response.usage_metadata,
+        )
+        return response
+
+
+# ==================== FACTORY ====================
+
+_cassette: Optional[Cassette] = None
+_latency: Optional[LatencyModel] = None
+_factory_lock = threading.Lock()
+
+
+def get_cassette() -> Cassette:
+    """Cassette dùng chung cho process (file LLM_CASSETTE)."""
+    global _cassette
+    with _factory_lock:
+        if _cassette is None:
+            _cassette = Cassette(LLM_CASSETTE)
+        return _cassette
+
+
+def _get_latency() -> LatencyModel:
+    global _latency
+    with _factory_lock:
+        if _latency is None:
+            _latency = LatencyModel(LLM_FAKE_LATENCY, LLM_FAKE_SEED)
+        return _latency
+
+
+def create_model(backend: str, model_name: str, real_model_factory):
+    """
+    Model cho backend.
+
+    real_model_factory() tạo GenerativeModel thật (chỉ gọi với gemini/record).
+    """
+    if backend in FAKE_BACKENDS:
+        return FakeModel(model_name, backend, get_cassette(), _get_latency())
+    model = real_model_factory()
+    if backend == "record":
+        return RecordingModel(model_name, model, get_cassette())
+    return model
@@ -9,17 +9,10 @@ Module này là bước đầu tiên trong workflow, phân tích câu hỏi ngư
 """
 
 from typing import Dict, Any, Optional, List
-import os
 import re
 import json
-import google.generativeai as google_genai
-from dotenv import load_dotenv
 from nodes.utils import normalize_text, extract_ticker
-
-# Load environment variables
-load_dotenv()
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+from nodes.llm import generate_text, agenerate_text
 
 
 def detect_query_complexity(question: str, force_chart: bool = False) -> Dict[str, Any]:
@@ -222,32 +215,8 @@ def detect_query_complexity(question: str, force_chart: bool = False) -> Dict[st
     return complexity
 
 
-def create_execution_plan(
-    question: str, complexity: Dict[str, Any]
-) -> List[Dict[str, Any]]:
-    """
-    Tạo kế hoạch thực thi chi tiết cho các câu hỏi phức tạp.
-
-    Sử dụng Gemini AI để phân tích câu hỏi và tạo các bước thực thi.
-
-    Args:
-        question: Câu hỏi từ người dùng
-        complexity: Dictionary chứa thông tin độ phức tạp từ detect_query_complexity()
-
-    Returns:
-        List các bước thực thi, mỗi bước có:
-        - step_number: Số thứ tự bước
-        - description: Mô tả bước
-        - sql_needed: Có cần truy vấn SQL không
-        - chart_needed: Có cần vẽ biểu đồ không
-
-    Note:
-        Nếu LLM gặp lỗi, trả về execution plan đơn giản (fallback)
-    """
-    # Cấu hình Gemini API
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    google_genai.configure(api_key=api_key)
-
+def _build_plan_prompt(question: str, complexity: Dict[str, Any]) -> str:
+    """Prompt để LLM tạo execution plan dạng JSON."""
     # System prompt cho LLM
     system = (
         "Bạn là một chuyên gia phân tích dữ liệu tài chính. "
@@ -261,7 +230,7 @@ def create_execution_plan(
     )
 
     # Tạo prompt với thông tin complexity
-    prompt = (
+    return (
         f"{system}\n"
         f"Câu hỏi: {question}\n\n"
         f"Độ phức tạp phát hiện:\n"
@@ -273,36 +242,76 @@ def create_execution_plan(
         f"Hãy tạo kế hoạch thực thi:"
     )
 
-    try:
-        # Gọi Gemini AI
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        resp = model.generate_content(prompt)
 
-        # Parse JSON response
-        plan_text = resp.text.strip()
+def _parse_plan(plan_text: str) -> List[Dict[str, Any]]:
+    """Parse JSON execution plan từ response của LLM."""
+    # Xử lý markdown code blocks nếu LLM trả về
+    if "```json" in plan_text:
+        plan_text = plan_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in plan_text:
+        plan_text = plan_text.split("```")[1].split("```")[0].strip()
+
+    # Parse JSON
+    plan = json.loads(plan_text)
+    return plan.get("steps", [])
+
+
+def _fallback_plan(complexity: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Plan đơn giản khi LLM gặp lỗi."""
+    return [
+        {
+            "step_number": 1,
+            "description": "Truy vấn dữ liệu từ database",
+            "sql_needed": True,
+            "chart_needed": complexity["needs_chart"],
+        }
+    ]
+
+
+def create_execution_plan(
+    question: str, complexity: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Tạo kế hoạch thực thi chi tiết cho các câu hỏi phức tạp.
+
+    Sử dụng Gemini AI để phân tích câu hỏi và tạo các bước thực thi.
+
+    Args:
+        question: Câu hỏi từ người dùng
+        complexity: Dictionary chứa thông tin độ phức tạp từ detect_query_complexity()
 
-        # Xử lý markdown code blocks nếu LLM trả về
-        if "```json" in plan_text:
-            plan_text = plan_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in plan_text:
-            plan_text = plan_text.split("```")[1].split("```")[0].strip()
+    Returns:
+        List các bước thực thi, mỗi bước có:
+        - step_number: Số thứ tự bước
+        - description: Mô tả bước
+        - sql_needed: Có cần truy vấn SQL không
+        - chart_needed: Có cần vẽ biểu đồ không
 
-        # Parse JSON
-        plan = json.loads(plan_text)
-        return plan.get("steps", [])
+    Note:
+        Nếu LLM gặp lỗi, trả về execution plan đơn giản (fallback)
+    """
+    try:
+        # Gọi Gemini AI
+        plan_text = generate_text(_build_plan_prompt(question, complexity))
+        return _parse_plan(plan_text)
 
     except Exception as e:
         print(f"Error creating execution plan: {e}")
 
         # Fallback: Tạo plan đơn giản nếu LLM gặp lỗi
-        return [
-            {
-                "step_number": 1,
-                "description": "Truy vấn dữ liệu từ database",
-                "sql_needed": True,
-                "chart_needed": complexity["needs_chart"],
-            }
-        ]
+        return _fallback_plan(complexity)
+
+
+async def acreate_execution_plan(
+    question: str, complexity: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Phiên bản async của create_execution_plan."""
+    try:
+        plan_text = await agenerate_text(_build_plan_prompt(question, complexity))
+        return _parse_plan(plan_text)
+    except Exception as e:
+        print(f"Error creating execution plan: {e}")
+        return _fallback_plan(complexity)
 
 
 def plan_query(state: Dict[str, Any]) -> Dict[str, Any]:
@@ -323,10 +332,17 @@ def plan_query(state: Dict[str, Any]) -> Dict[str, Any]:
         - execution_plan: List các bước thực thi (nếu multi-step)
         - needs_chart: Boolean - có cần vẽ biểu đồ
         - chart_type: String - loại biểu đồ (nếu cần)
+
+    Nếu state đã có "understanding" (xem nodes/understanding.py), độ phức
+    tạp và execution plan lấy từ đó thay vì gọi LLM.
     """
     question = state.get("question", "")
     force_chart = state.get("force_chart", False)
 
+    # Đã phân tích ở question_classifier (understanding call): không gọi LLM lại
+    if state.get("understanding"):
+        return _understood_state(state)
+
     # Bước 1: Phát hiện độ phức tạp
     complexity = detect_query_complexity(question, force_chart=force_chart)
 
@@ -336,6 +352,31 @@ def plan_query(state: Dict[str, Any]) -> Dict[str, Any]:
     else:
         execution_plan = []
 
+    return _planned_state(state, complexity, execution_plan)
+
+
+async def aplan_query(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của plan_query (dùng cho LangGraph ainvoke)."""
+    question = state.get("question", "")
+    force_chart = state.get("force_chart", False)
+
+    if state.get("understanding"):
+        return _understood_state(state)
+
+    complexity = detect_query_complexity(question, force_chart=force_chart)
+    if complexity["is_multi_step"]:
+        execution_plan = await acreate_execution_plan(question, complexity)
+    else:
+        execution_plan = []
+
+    return _planned_state(state, complexity, execution_plan)
+
+
+def _planned_state(
+    state: Dict[str, Any],
+    complexity: Dict[str, Any],
+    execution_plan: List[Dict[str, Any]],
+) -> Dict[str, Any]:
     # Trả về state mới với thông tin đã phân tích
     return {
         **state,
@@ -344,3 +385,13 @@ def plan_query(state: Dict[str, Any]) -> Dict[str, Any]:
         "needs_chart": complexity["needs_chart"],
         "chart_type": complexity.get("chart_type"),
     }
+
+
+def _understood_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """State sau planning từ kết quả understanding call của question_classifier."""
+    understanding = state["understanding"]
+    complexity = understanding["complexity"]
+    execution_plan = []
+    if complexity["is_multi_step"]:
+        execution_plan = understanding.get("steps") or _fallback_plan(complexity)
+    return _planned_state(state, complexity, execution_plan)
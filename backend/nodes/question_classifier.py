@@ -5,17 +5,98 @@ Node này phân tích câu hỏi và quyết định:
 - SQL-related: Câu hỏi cần truy vấn database (giá, volume, số liệu)
 - Other: Câu hỏi không liên quan SQL (kiến thức tổng quát, câu hỏi chung)
 
-Sử dụng LLM để phân loại chính xác hơn so với pattern matching.
+Câu hỏi có tín hiệu rõ ràng được phân loại tại chỗ (rules + embedding, xem
+nodes/fast_classifier.py). Với câu hỏi còn lại, và câu hỏi dữ liệu cần
+execution plan hoặc cần LLM chọn SQL mẫu, node gửi MỘT understanding call
+(nodes/understanding.py) trả về route, độ phức tạp, entities và template;
+planner và matcher dùng lại kết quả này thay vì tự gọi LLM.
 """
 
-import os
-from typing import Dict, Any
-from dotenv import load_dotenv
-import google.generativeai as google_genai
+import asyncio
+from typing import Dict, Any, Optional, Tuple
+from nodes.entities import extract_entities, merge_llm_entities
+from nodes.fast_classifier import CLASSIFIER_STATS, classify_locally, make_decision
+from nodes.llm import get_api_key
+from nodes.understanding import (
+    aunderstand_question,
+    local_understanding,
+    needs_llm,
+    prepare_understanding,
+    understand_question,
+)
 
-load_dotenv()
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+
+def _needs_llm(state: Dict[str, Any]) -> bool:
+    """Kiểm tra có thể gọi LLM không; nếu không thì mặc định SQL-related."""
+    question = state.get("question", "")
+    if not question or not question.strip():
+        # Mặc định là SQL-related nếu không có câu hỏi
+        return False
+    if not get_api_key():
+        # Fallback: mặc định là SQL-related
+        print("Warning: No Gemini API key found. Defaulting to SQL-related.")
+        return False
+    return True
+
+
+def _analyze_locally(
+    state: Dict[str, Any],
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Phần không cần LLM: (classification tại chỗ, prepared understanding).
+
+    prepared là None khi câu hỏi chắc chắn là OTHER (không cần phân tích SQL).
+    """
+    question = state.get("question", "")
+    if not question or not question.strip():
+        return None, None
+    local = classify_locally(question, state["entities"])
+    if local is not None and local["label"] == "OTHER":
+        return local, None
+    return local, prepare_understanding(question, state.get("force_chart", False))
+
+
+def _should_call_llm(
+    state: Dict[str, Any],
+    local: Optional[Dict[str, Any]],
+    prepared: Optional[Dict[str, Any]],
+) -> bool:
+    if prepared is None or (local is not None and not needs_llm(prepared)):
+        return False
+    return _needs_llm(state)
+
+
+def _classified_state(
+    state: Dict[str, Any],
+    local: Optional[Dict[str, Any]],
+    prepared: Optional[Dict[str, Any]],
+    understanding: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    if understanding is not None:
+        # Classification tại chỗ đã đủ tin cậy thì giữ, route của LLM chỉ dùng
+        # khi classifier local không chắc chắn
+        classification = local or make_decision(
+            1.0 if understanding["route"] == "SQL" else 0.0, "llm"
+        )
+    else:
+        # Fallback: mặc định là SQL-related
+        classification = local or make_decision(1.0, "default")
+        if local is not None and prepared is not None and not needs_llm(prepared):
+            understanding = local_understanding(local["label"], prepared)
+
+    CLASSIFIER_STATS.record(classification["source"])
+    new_state = {
+        **state,
+        "is_sql_related": classification["label"] == "SQL",
+        "classification": classification,
+    }
+    if understanding is not None:
+        new_state["understanding"] = understanding
+        # Bổ sung entity regex không thấy bằng entity LLM nhận ra
+        new_state["entities"] = merge_llm_entities(
+            state["entities"], understanding.get("entities")
+        )
+    return new_state
 
 
 def classify_question(state: Dict[str, Any]) -> Dict[str, Any]:
@@ -25,6 +106,10 @@ def classify_question(state: Dict[str, Any]) -> Dict[str, Any]:
     Node này phân tích câu hỏi và quyết định:
     - is_sql_related: True nếu cần truy vấn SQL database
     - is_sql_related: False nếu là câu hỏi khác (kiến thức tổng quát, câu hỏi chung)
+
+    Rules + embedding model (nodes.fast_classifier) quyết định trước; chỉ
+    gọi Gemini (một understanding call) khi độ tin cậy nằm trong vùng không
+    chắc chắn hoặc câu hỏi dữ liệu cần plan / chọn SQL mẫu.
     
     Args:
         state: Dictionary chứa workflow state, cần có key "question"
@@ -32,62 +117,25 @@ def classify_question(state: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         State mới với các key:
         - is_sql_related: Boolean - có liên quan SQL không
+        - classification: Dict - label, sql_probability, confidence, source
+        - understanding: Dict - độ phức tạp, entities, plan, SQL mẫu (câu hỏi SQL)
+        - entities: QueryEntities - ticker, ngày, quý... (nodes/entities.py),
+          trích xuất một lần cho cả workflow
     """
-    question = state.get("question", "")
-    
-    if not question or not question.strip():
-        # Mặc định là SQL-related nếu không có câu hỏi
-        return {**state, "is_sql_related": True}
-    
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        # Fallback: mặc định là SQL-related
-        print("Warning: No Gemini API key found. Defaulting to SQL-related.")
-        return {**state, "is_sql_related": True}
-    
-    try:
-        google_genai.configure(api_key=api_key)
-        
-        # Prompt để LLM phân loại câu hỏi
-        prompt = f"""Bạn là một chuyên gia phân loại câu hỏi cho hệ thống tài chính.
+    state = {**state, "entities": extract_entities(state.get("question", ""))}
+    local, prepared = _analyze_locally(state)
+    understanding = None
+    if _should_call_llm(state, local, prepared):
+        understanding = understand_question(state["question"], prepared)
+    return _classified_state(state, local, prepared, understanding)
 
-Hệ thống có 2 loại câu hỏi:
-1. SQL-RELATED: Câu hỏi yêu cầu dữ liệu cụ thể từ database (giá cổ phiếu, volume, số liệu, so sánh, biểu đồ)
-   Ví dụ: "What was the price of Apple on 2024-01-15?", "Plot the volume", "Compare prices of AAPL and MSFT", 
-          "Average closing price in 2024", "Giá đóng cửa của Apple ngày 15/1/2024"
-   
-2. OTHER: Câu hỏi không cần SQL (kiến thức tổng quát, giải thích, định nghĩa, câu hỏi chung)
-   Ví dụ: "What is DJIA?", "How does stock market work?", "Giải thích về thị trường chứng khoán",
-          "What is a dividend?", "Tôi muốn biết về đầu tư"
-
-CÂU HỎI: {question}
-
-NHIỆM VỤ: Xác định xem câu hỏi này có liên quan đến SQL database không.
-
-QUY TẮC:
-- Trả về SQL nếu câu hỏi yêu cầu: giá cả, volume, số liệu cụ thể, so sánh số liệu, biểu đồ dữ liệu, 
-  truy vấn theo ngày tháng, ticker cụ thể
-  
-- Trả về OTHER nếu câu hỏi hỏi về: khái niệm, định nghĩa, giải thích, kiến thức tổng quát, 
-  cách thức hoạt động, câu hỏi chung không cần dữ liệu cụ thể
-
-CHỈ TRẢ LỜI: SQL hoặc OTHER (không có dấu chấm, không có giải thích thêm)"""
-
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        
-        result = (response.text or "").strip().upper()
-        
-        # Parse kết quả
-        is_sql_related = "SQL" in result
-        
-        return {
-            **state,
-            "is_sql_related": is_sql_related,
-        }
-            
-    except Exception as e:
-        print(f"Error in classify_question with LLM: {e}")
-        # Fallback: mặc định là SQL-related
-        return {**state, "is_sql_related": True}
 
+async def aclassify_question(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của classify_question (dùng cho LangGraph ainvoke)."""
+    state = {**state, "entities": extract_entities(state.get("question", ""))}
+    # Embed câu hỏi tốn CPU nên chạy ngoài event loop
+    local, prepared = await asyncio.to_thread(_analyze_locally, state)
+    understanding = None
+    if _should_call_llm(state, local, prepared):
+        understanding = await aunderstand_question(state["question"], prepared)
+    return _classified_state(state, local, prepared, understanding)
@@ -15,12 +15,15 @@ Dependencies:
 
 import os
 import re
+import asyncio
 import hashlib
 from typing import Dict, Any, List, Optional
 from pathlib import Path
 
 from dotenv import load_dotenv
-import google.generativeai as google_genai
+
+from nodes.llm import generate_text
+from runtime import get_runtime
 
 # Load environment
 load_dotenv()
@@ -157,11 +160,12 @@ def index_documents(force_reindex: bool = False) -> bool:
     Returns:
         True nếu có documents được index
     """
-    client = get_chroma_client()
+    runtime = get_runtime()
+    client = runtime.chroma_client
     if not client:
         return False
     
-    embedding_fn = get_embedding_function()
+    embedding_fn = runtime.embedding_function
     if not embedding_fn:
         return False
     
@@ -263,11 +267,12 @@ def retrieve_from_db(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
     Returns:
         List các documents với metadata
     """
-    client = get_chroma_client()
+    runtime = get_runtime()
+    client = runtime.chroma_client
     if not client:
         return []
     
-    embedding_fn = get_embedding_function()
+    embedding_fn = runtime.embedding_function
     if not embedding_fn:
         return []
     
@@ -332,8 +337,6 @@ def detect_general_question(question: str) -> bool:
         return False
     
     try:
-        google_genai.configure(api_key=api_key)
-        
         # Prompt để LLM phân tích câu hỏi
         prompt = f"""Bạn là một chuyên gia phân tích câu hỏi cho hệ thống tài chính.
 
@@ -354,10 +357,7 @@ QUY TẮC:
 
 CHỈ TRẢ LỜI: TRUE hoặc FALSE (không có dấu chấm, không có giải thích thêm)"""
 
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        
-        result = (response.text or "").strip().upper()
+        result = generate_text(prompt).upper()
         
         # Parse kết quả
         if "TRUE" in result:
@@ -383,8 +383,6 @@ def answer_with_context(question: str, context_docs: List[Dict[str, Any]]) -> st
     if not api_key:
         return "Không thể kết nối với LLM. Vui lòng kiểm tra API key."
     
-    google_genai.configure(api_key=api_key)
-    
     # Build context string với source attribution
     if context_docs:
         context_parts = []
@@ -422,9 +420,7 @@ YÊU CẦU:
     prompt = f"{system_prompt}\n\nCâu hỏi: {question}\n\nTrả lời:"
     
     try:
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        answer = (response.text or "").strip()
+        answer = generate_text(prompt)
         return answer if answer else "Không thể tạo câu trả lời."
     except Exception as e:
         return f"Lỗi khi gọi LLM: {str(e)}"
@@ -449,8 +445,8 @@ def rag_retrieve(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     question = state.get("question", "")
     
-    # Đảm bảo documents đã được index
-    index_documents(force_reindex=False)
+    # Đảm bảo documents đã được index (chỉ chạy lần đầu, runtime ghi nhớ kết quả)
+    get_runtime().ensure_documents_indexed()
     
     # Retrieve context từ ChromaDB
     context_docs = retrieve_from_db(question, top_k=5)
@@ -484,6 +480,16 @@ def rag_retrieve(state: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+async def arag_retrieve(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Phiên bản async của rag_retrieve.
+
+    ChromaDB và sentence-transformers chỉ có API đồng bộ (và tốn CPU), nên
+    chạy trong thread pool để không chặn event loop.
+    """
+    return await asyncio.to_thread(rag_retrieve, state)
+
+
 # ========== UTILITY FUNCTIONS ==========
 
 def reindex_all():
@@ -506,12 +512,13 @@ def get_collection_info() -> Dict[str, Any]:
     Returns:
         Dictionary chứa thông tin collection
     """
-    client = get_chroma_client()
+    runtime = get_runtime()
+    client = runtime.chroma_client
     if not client:
         return {"error": "ChromaDB not available"}
     
     try:
-        embedding_fn = get_embedding_function()
+        embedding_fn = runtime.embedding_function
         collection = client.get_collection(
             name=COLLECTION_NAME,
             embedding_function=embedding_fn
@@ -10,19 +10,21 @@ Module này thực hiện:
 from typing import Dict, Any, Optional, Tuple
 from datetime import datetime
 import re
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import pandas as pd
-from sqlalchemy import create_engine, text
-from config import DB_CONNECTION_STRING, POSTGRES_CONFIG
-from nodes.utils import (
-    normalize_text,
-    extract_date_parts,
-    extract_date_range,
-    extract_quarter,
-    extract_month_range,
-    extract_ticker,
-)
+from sqlalchemy import text
+from config import POSTGRES_CONFIG
+from runtime import get_runtime
+from db.engine import connect, aconnect
+from db.guard import begin_read_only, cancel_on_disconnect, check_plan_cost
+from db.prepared import read_prepared
+from nodes.instrumentation import record_sql
+from nodes.sql_rewriter import rewrite_date_predicates
+from nodes.entities import QueryEntities, extract_entities
+from nodes.sql_shape_cache import forget_sql, remember_sql
+from nodes.template_promotion import record_candidate
 
 
 def build_params(
@@ -31,7 +33,8 @@ def build_params(
     """
     Xây dựng dictionary parameters từ câu hỏi để bind vào SQL.
 
-    Hàm này trích xuất các thông tin từ câu hỏi như:
+    Các entity đọc từ state["entities"] (trích xuất một lần ở đầu workflow),
+    chỉ trích xuất lại khi state chưa có. Các thông tin gồm:
     - Ticker/symbol công ty
     - Ngày cụ thể, khoảng ngày
     - Năm, tháng, quý
@@ -60,11 +63,10 @@ def build_params(
         >>> build_params("Average price in Q1 2024?", "AAPL")
         {'ticker': 'AAPL', 'year': '2024', 'quarter': 1}
     """
-    # Trích xuất các thành phần ngày tháng từ câu hỏi
-    parts = extract_date_parts(question)
-    start_date, end_date = extract_date_range(question)
-    quarter = extract_quarter(question)
-    start_month, end_month = extract_month_range(question)
+    # Entity đã trích xuất một lần ở question_classifier (nodes/entities.py)
+    entities = (state or {}).get("entities")
+    if not isinstance(entities, QueryEntities):
+        entities = extract_entities(question)
 
     # Khởi tạo params dictionary
     params: Dict[str, Any] = {}
@@ -74,98 +76,15 @@ def build_params(
         params["ticker"] = ticker
         params["ticker_a"] = ticker  # Cho comparative queries
 
-    # ========== XỬ LÝ CÂU HỎI TÌM TICKER SYMBOL ==========
-    # Ví dụ: "What is the ticker symbol for Walt Disney?" hoặc "symbol of apple"
-    # Pattern: "ticker symbol for {company}", "symbol for {company}", "symbol of {company}", "ticket of {company}"
-    ticker_symbol_patterns = [
-        r"ticker\s+symbol\s+for\s+([^?]+)",
-        r"symbol\s+for\s+([^?]+)",
-        r"ticker\s+of\s+([^?]+)",
-        r"symbol\s+of\s+([^?]+)",
-        r"ticket\s+of\s+([^?]+)",
-    ]
-    for pattern in ticker_symbol_patterns:
-        match = re.search(pattern, question, re.IGNORECASE)
-        if match:
-            company_name = match.group(1).strip().rstrip("?.,!")
-            # Luôn extract company name cho câu hỏi tìm ticker symbol
-            if company_name:
-                params["company"] = company_name
-            break
-
-    # Nếu chưa có company nhưng câu hỏi về ticker symbol và có ticker,
-    # thử extract tên công ty từ câu hỏi (fallback)
-    if "company" not in params and ticker:
-        q_lower = normalize_text(question)
-        # Kiểm tra xem có phải câu hỏi về ticker symbol không
-        is_ticker_symbol_query = any(
-            phrase in q_lower
-            for phrase in [
-                "ticker symbol",
-                "symbol of",
-                "ticket of",
-                "ticker of",
-                "mã cổ phiếu",
-                "mã ticker",
-            ]
-        )
-        if is_ticker_symbol_query:
-            # Thử extract tên công ty từ các pattern khác
-            # Pattern: "what is the ticker symbol for {company}?"
-            # Hoặc: "symbol of {company}"
-            fallback_patterns = [
-                r"(?:what|which|tell me).*?(?:ticker|symbol|ticket).*?(?:of|for)\s+([^?]+)",
-                r"(?:ticker|symbol|ticket).*?(?:of|for)\s+([^?]+)",
-            ]
-            for pattern in fallback_patterns:
-                match = re.search(pattern, question, re.IGNORECASE)
-                if match:
-                    company_name = match.group(1).strip().rstrip("?.,!")
-                    if company_name and len(company_name) > 0:
-                        params["company"] = company_name
-                        break
-
-    # Extract company name từ pattern "X of {company}" cho các câu hỏi metadata
-    # Ví dụ: "dividend yield of apple", "52 week high of apple"
-    if "company" not in params:
-        # Pattern: "{field} of {company}"
-        metadata_patterns = [
-            r"(\w+(?:\s+\w+)*)\s+of\s+([^?]+)",
-        ]
-        for pattern in metadata_patterns:
-            match = re.search(pattern, question, re.IGNORECASE)
-            if match:
-                field = match.group(1).strip()
-                company_name = match.group(2).strip().rstrip("?.,!")
-                # Kiểm tra xem field có phải là metadata field không
-                metadata_fields = [
-                    "dividend yield",
-                    "52 week high",
-                    "52 week low",
-                    "week 52 high",
-                    "week 52 low",
-                    "market cap",
-                    "pe ratio",
-                    "p/e ratio",
-                    "description",
-                    "country",
-                    "industry",
-                    "sector",
-                    "website",
-                    "market capitalization",
-                ]
-                if any(mf in field.lower() for mf in metadata_fields):
-                    if company_name and len(company_name) > 0:
-                        params["company"] = company_name
-                        break
+    # Tên công ty cho câu hỏi tìm ticker symbol ("What is the ticker symbol for
+    # Walt Disney?") hoặc metadata ("dividend yield of apple", "52 week high of apple")
+    if entities.company:
+        params["company"] = entities.company
 
     # Thêm date/time parameters
-    if "date" in parts:
-        params["date"] = parts["date"]
-    if "year" in parts:
-        params["year"] = parts["year"]
-    if "month" in parts:
-        params["month"] = parts["month"]
+    for key, value in entities.date_parts.items():
+        params[key] = value
+    start_date, end_date = entities.start_date, entities.end_date
     if start_date:
         params["start_date"] = start_date
     if end_date:
@@ -182,47 +101,18 @@ def build_params(
             params["years"] = round(years_value, 6)
         except ValueError:
             pass
-    if quarter:
-        params["quarter"] = quarter
-    if start_month:
-        params["start_month"] = start_month
-    if end_month:
-        params["end_month"] = end_month
+    if entities.quarter:
+        params["quarter"] = entities.quarter
+    if entities.start_month:
+        params["start_month"] = entities.start_month
+    if entities.end_month:
+        params["end_month"] = entities.end_month
 
     # ========== XỬ LÝ CÂU HỎI SO SÁNH 2 CÔNG TY ==========
     # Ví dụ: "Which had a higher closing price: Apple or Microsoft?"
-
-    q = normalize_text(question)
-
-    # Pattern 1: "which had a higher closing price: A or B?"
-    colon_or_match = re.search(r":\s*([^:]+?)\s+or\s+([^?]+)", q, re.IGNORECASE)
-    if colon_or_match:
-        company1 = colon_or_match.group(1).strip()
-        company2 = colon_or_match.group(2).strip()
-        t1 = extract_ticker(company1)
-        t2 = extract_ticker(company2)
-        if t1 and t2:
-            params["ticker_a"] = t1
-            params["ticker_b"] = t2
-
-    # Pattern 2-4: "A or B", "A vs B", "A versus B"
-    patterns = [
-        r"([^,]+?)\s+or\s+([^,]+?)(?:\s+had|$)",
-        r"([^,]+?)\s+vs\s+([^,]+?)(?:\s+had|$)",
-        r"([^,]+?)\s+versus\s+([^,]+?)(?:\s+had|$)",
-    ]
-
-    for pattern in patterns:
-        match = re.search(pattern, q, re.IGNORECASE)
-        if match:
-            company1 = match.group(1).strip().rstrip("?.,!")
-            company2 = match.group(2).strip().rstrip("?.,!")
-            t1 = extract_ticker(company1)
-            t2 = extract_ticker(company2)
-            if t1 and t2:
-                params["ticker_a"] = t1
-                params["ticker_b"] = t2
-                break  # Tìm thấy rồi thì dừng
+    if entities.ticker_a and entities.ticker_b:
+        params["ticker_a"] = entities.ticker_a
+        params["ticker_b"] = entities.ticker_b
 
     # ========== XỬ LÝ CHART PARAMETERS ==========
     # Nếu cần vẽ biểu đồ, có thể có thêm parameters về date range
@@ -242,7 +132,7 @@ def build_params(
     # dùng giá trị mặc định 180 ngày
     # (Xảy ra khi LLM sinh SQL không đúng format)
     if "window_days" not in params:
-        sql_text = (state or {}).get("sql", "")
+        sql_text = (state or {}).get("sql") or ""
         if ":window_days" in sql_text:
             params["window_days"] = 180  # ~6 tháng
 
@@ -254,10 +144,14 @@ def run_sql(sql: str, params: Dict[str, Any]) -> Tuple[pd.DataFrame, str]:
     Thực thi SQL trên PostgreSQL database với bind parameters.
 
     Hàm này:
-    1. Kết nối đến PostgreSQL database
-    2. Thực thi SQL với parameters (để tránh SQL injection)
-    3. Tạo SQL hiển thị (thay %(params)s bằng giá trị thực) để show cho user
-    4. Trả về DataFrame kết quả và SQL đã format
+    1. Lấy connection từ engine dùng chung (connection pool của runtime)
+    2. Viết lại điều kiện năm/quý/tháng thành khoảng date (nodes.sql_rewriter)
+    3. Mở transaction read-only với statement_timeout; SQL không phải SQL mẫu
+       phải qua kiểm tra cost EXPLAIN (db/guard.py)
+    4. Thực thi SQL với parameters (để tránh SQL injection); SQL mẫu chạy qua
+       prepared statement của connection (db/prepared.py), không parse/plan lại
+    5. Tạo SQL hiển thị (thay %(params)s bằng giá trị thực) để show cho user
+    6. Trả về DataFrame kết quả và SQL đã format
 
     Args:
         sql: Câu lệnh SQL với bind parameters (:ticker, :date, ...)
@@ -276,61 +170,108 @@ def run_sql(sql: str, params: Dict[str, Any]) -> Tuple[pd.DataFrame, str]:
         SELECT * FROM prices WHERE ticker = 'AAPL' AND date = '2024-01-15'
 
     Raises:
-        psycopg2.Error: Nếu SQL không hợp lệ hoặc lỗi database
+        psycopg2.Error: Nếu SQL không hợp lệ, lỗi database hoặc quá statement_timeout
+        ValueError: Nếu cost ước tính vượt SQL_MAX_PLAN_COST
     """
-    # SQL samples/LLM output đã ở dạng PostgreSQL nên chỉ cần dùng trực tiếp
-    pg_sql = sql
+    # SQL mẫu (kiểm tra trước khi viết lại điều kiện ngày) được prepare một lần
+    # mỗi connection
+    is_template = get_runtime().template_registry.for_sql(sql) is not None
+
+    # SQL samples/LLM output đã ở dạng PostgreSQL; chỉ viết lại điều kiện
+    # năm/quý/tháng thành khoảng date để dùng được index
+    pg_sql, params = rewrite_date_predicates(sql, params)
+
+    # Engine dùng chung cho cả process (không tạo/dispose engine mỗi lần gọi)
+    engine = get_runtime().engine
+
+    display_sql = format_display_sql(pg_sql, params)
+
+    # ========== THỰC THI SQL ==========
+    # Dùng SQL đã convert với bind parameters (an toàn, tránh SQL injection)
+    with connect(engine) as conn:
+        started = time.perf_counter()
+        begin_read_only(conn)
+        df = read_prepared(conn, pg_sql, params) if is_template else None
+        if df is None:
+            if not is_template:
+                check_plan_cost(conn, pg_sql, params)
+            df = pd.read_sql_query(text(pg_sql), conn, params=params)
+        record_sql(time.perf_counter() - started, len(df))
 
-    # Kết nối đến PostgreSQL database
-    engine = create_engine(DB_CONNECTION_STRING)
+    return df, display_sql
 
-    try:
-        # ========== TẠO SQL HIỂN THỊ ==========
-        # Thay :param và %(param)s bằng giá trị thực để show cho user
-        # KHÔNG dùng SQL này để execute (dùng SQL gốc với params để tránh SQL injection)
-        display_sql = pg_sql
-
-        # Sắp xếp params theo độ dài để tránh thay thế sai (thay thế param dài trước)
-        sorted_params = sorted(params.items(), key=lambda x: len(x[0]), reverse=True)
-
-        for param_name, param_value in sorted_params:
-            # Format giá trị để hiển thị
-            if isinstance(param_value, str):
-                # String parameters cần có dấu nháy
-                formatted_value = f"'{param_value}'"
-            elif param_value is None:
-                formatted_value = "NULL"
-            else:
-                # Số không cần dấu nháy
-                formatted_value = str(param_value)
-
-            # Thay thế cả :param và %(param)s
-            # Dùng regex để tránh thay thế nhầm (ví dụ :ticker trong :ticker_a)
-            # Pattern: :param_name không phải là phần của từ khác
-            pattern1 = r":\b" + re.escape(param_name) + r"\b"
-            display_sql = re.sub(pattern1, formatted_value, display_sql)
-            # Pattern: %(param_name)s
-            pattern2 = r"%\(" + re.escape(param_name) + r"\)s"
-            display_sql = re.sub(pattern2, formatted_value, display_sql)
-
-        # Loại bỏ comment lines để SQL hiển thị gọn gàng
-        display_sql = "\n".join(
-            [
-                line
-                for line in display_sql.splitlines()
-                if not line.strip().startswith("--")
-            ]
-        ).strip()
-
-        # ========== THỰC THI SQL ==========
-        # Dùng SQL đã convert với bind parameters (an toàn, tránh SQL injection)
-        with engine.connect() as conn:
-            df = pd.read_sql_query(text(pg_sql), conn, params=params)
 
-        return df, display_sql
+async def arun_sql(sql: str, params: Dict[str, Any]) -> Tuple[pd.DataFrame, str]:
+    """
+    Phiên bản async của run_sql.
+
+    Dùng AsyncEngine (psycopg 3) của event loop hiện tại nên chờ database
+    không chặn event loop. pandas chỉ đọc được từ connection sync nên phần
+    read_sql_query chạy qua AsyncConnection.run_sync. SQL lặp lại (SQL mẫu)
+    được prepare bởi prepared-statement cache của psycopg 3. Request bị cancel
+    (client ngắt kết nối) thì truy vấn trên PostgreSQL cũng bị hủy.
+    """
+    engine = get_runtime().async_engine
+    is_template = get_runtime().template_registry.for_sql(sql) is not None
+    sql, params = rewrite_date_predicates(sql, params)
+    display_sql = format_display_sql(sql, params)
+
+    def _read(sync_conn) -> pd.DataFrame:
+        begin_read_only(sync_conn)
+        if not is_template:
+            check_plan_cost(sync_conn, sql, params)
+        return pd.read_sql_query(text(sql), sync_conn, params=params)
+
+    async with aconnect(engine) as conn:
+        started = time.perf_counter()
+        async with cancel_on_disconnect(conn):
+            df = await conn.run_sync(_read)
+        record_sql(time.perf_counter() - started, len(df))
 
-    finally:
-        engine.dispose()
+    return df, display_sql
+
+
+def format_display_sql(pg_sql: str, params: Dict[str, Any]) -> str:
+    """
+    Tạo SQL hiển thị: thay :param và %(param)s bằng giá trị thực để show cho user.
+
+    KHÔNG dùng SQL này để execute (dùng SQL gốc với params để tránh SQL injection).
+    """
+    display_sql = pg_sql
+
+    # Sắp xếp params theo độ dài để tránh thay thế sai (thay thế param dài trước)
+    sorted_params = sorted(params.items(), key=lambda x: len(x[0]), reverse=True)
+
+    for param_name, param_value in sorted_params:
+        # Format giá trị để hiển thị
+        if isinstance(param_value, str):
+            # String parameters cần có dấu nháy
+            formatted_value = f"'{param_value}'"
+        elif param_value is None:
+            formatted_value = "NULL"
+        else:
+            # Số không cần dấu nháy
+            formatted_value = str(param_value)
+
+        # Thay thế cả :param và %(param)s
+        # Dùng regex để tránh thay thế nhầm (ví dụ :ticker trong :ticker_a)
+        # Pattern: :param_name không phải là phần của từ khác
+        pattern1 = r":\b" + re.escape(param_name) + r"\b"
+        display_sql = re.sub(pattern1, formatted_value, display_sql)
+        # Pattern: %(param_name)s
+        pattern2 = r"%\(" + re.escape(param_name) + r"\)s"
+        display_sql = re.sub(pattern2, formatted_value, display_sql)
+
+    # Loại bỏ comment lines để SQL hiển thị gọn gàng
+    display_sql = "\n".join(
+        [
+            line
+            for line in display_sql.splitlines()
+            if not line.strip().startswith("--")
+        ]
+    ).strip()
+
+    return display_sql
 
 
 def execute_sql(state: Dict[str, Any]) -> Dict[str, Any]:
@@ -352,6 +293,7 @@ def execute_sql(state: Dict[str, Any]) -> Dict[str, Any]:
         State mới với các key bổ sung:
         - df: DataFrame kết quả (hoặc empty nếu lỗi)
         - actual_sql: SQL đã thay thế parameters để hiển thị
+        - sql_params: Parameters đã bind vào SQL
         - error: Error message (None nếu thành công)
         - feedback: Feedback để retry (nếu có lỗi)
 
@@ -368,25 +310,69 @@ def execute_sql(state: Dict[str, Any]) -> Dict[str, Any]:
     params = build_params(question, ticker, state)
 
     try:
+        # SQL mẫu: kiểm tra đủ bind parameters trước khi gửi tới database
+        _check_template_params(sql, params)
         # Thực thi SQL
         df, actual_sql = run_sql(sql, params)
+    except Exception as e:
+        return _execution_failed(state, sql, e)
 
-        # Trả về kết quả thành công
-        return {
-            **state,
-            "df": df,
-            "actual_sql": actual_sql,
-            "error": None,
-            "feedback": None,
-        }
+    # Trả về kết quả thành công
+    return _execution_succeeded(state, df, actual_sql, params)
 
+
+async def aexecute_sql(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của execute_sql (dùng AsyncEngine)."""
+    sql = state.get("sql") or ""
+    params = build_params(state.get("question", ""), state.get("ticker"), state)
+
+    try:
+        _check_template_params(sql, params)
+        df, actual_sql = await arun_sql(sql, params)
     except Exception as e:
-        # Xử lý lỗi: trả về empty DataFrame và error message
-        # Feedback được dùng để retry với LLM (nếu workflow có bước retry)
-        return {
-            **state,
-            "df": pd.DataFrame(),
-            "actual_sql": sql,
-            "error": str(e),
-            "feedback": f"{e}. SQL: {sql}",
-        }
+        return _execution_failed(state, sql, e)
+
+    return _execution_succeeded(state, df, actual_sql, params)
+
+
+def _check_template_params(sql: str, params: Dict[str, Any]) -> None:
+    """Raise ValueError nếu SQL là SQL mẫu và thiếu bind parameter bắt buộc."""
+    template = get_runtime().template_registry.for_sql(sql)
+    if template is None:
+        return
+    missing = [name for name in template.params if params.get(name) is None]
+    if missing:
+        raise ValueError(
+            f"Thiếu tham số cho SQL mẫu: {', '.join(':' + name for name in missing)}"
+        )
+
+
+def _execution_succeeded(
+    state: Dict[str, Any], df: pd.DataFrame, actual_sql: str, params: Dict[str, Any]
+) -> Dict[str, Any]:
+    # SQL do LLM sinh chạy được: dùng lại cho câu hỏi cùng dạng và ghi lại
+    # để promote thành SQL mẫu (manage.py promote_templates)
+    remember_sql(state, df)
+    record_candidate(state, df)
+    return {
+        **state,
+        "df": df,
+        "actual_sql": actual_sql,
+        # Parameters đã bind (answer_renderer dùng để nêu công ty/mốc thời gian)
+        "sql_params": params,
+        "error": None,
+        "feedback": None,
+    }
+
+
+def _execution_failed(state: Dict[str, Any], sql: str, e: Exception) -> Dict[str, Any]:
+    # Xử lý lỗi: trả về empty DataFrame và error message
+    # Feedback được dùng để retry với LLM (nếu workflow có bước retry)
+    forget_sql(state)
+    return {
+        **state,
+        "df": pd.DataFrame(),
+        "actual_sql": sql,
+        "error": str(e),
+        "feedback": f"{e}. SQL: {sql}",
+    }
@@ -1,12 +1,9 @@
-from typing import Dict, Any, Optional
-import os
+from typing import Dict, Any, Optional, Tuple
 import re
-from google import generativeai as google_genai
-from dotenv import load_dotenv
-
-load_dotenv()
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+from nodes.llm import generate_text, agenerate_text, text_cache_key
+from nodes.sql_executor import build_params
+from nodes.sql_normalizer import normalize_llm_sql
+from nodes.sql_shape_cache import lookup_sql
 
 HINT_GUIDANCE = {
     "std_dev": "Tính độ lệch chuẩn bằng cách dùng STDDEV_POP(close) hoặc STDDEV_SAMP(close) trong PostgreSQL.",
@@ -35,12 +32,9 @@ def _build_hint_text(analysis_hint: Optional[str]) -> str:
     return f"\nYÊU CẦU NÂNG CAO: Hãy dùng CTE và các phép tính cần thiết để xử lý loại câu hỏi '{analysis_hint}'."
 
 
-def generate_sql_with_llm(
+def _build_sql_prompt(
     question: str, feedback: Optional[str] = None, analysis_hint: Optional[str] = None
 ) -> str:
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-    google_genai.configure(api_key=api_key)
-
     # Dataset Schema
     schema = (
         "=== DATASET SCHEMA ===\n"
@@ -166,10 +160,11 @@ def generate_sql_with_llm(
     else:
         prompt_text = f"{system}{hint_text}\n\nCâu hỏi: {question}"
 
-    model = google_genai.GenerativeModel("gemini-2.5-flash")
-    resp = model.generate_content(prompt_text)
-    response_text = (resp.text or "").strip()
+    return prompt_text
 
+
+def _extract_sql(response_text: str) -> str:
+    """Trích SQL từ response của LLM và chuẩn hoá về cú pháp PostgreSQL (sql_normalizer)."""
     # Extract SQL từ response (có thể có reasoning trước)
     sql = response_text
     # Nếu LLM trả về code block ở giữa text -> ưu tiên trích code block
@@ -201,196 +196,85 @@ def generate_sql_with_llm(
     if first_sql_match:
         sql = sql[first_sql_match.start() :].strip()
 
-    # Thêm dấu ; nếu chưa có
-    if sql and not sql.endswith(";"):
-        sql += ";"
-
-    # Post-processing: Convert SQLite syntax sang PostgreSQL syntax
-    # Chuyển strftime() thành EXTRACT() hoặc TO_CHAR()
-    # Xử lý tất cả các pattern: strftime('%Y', date), strftime('%%Y', date), strftime('%%%Y', date), etc.
-    # strftime('%Y', date) hoặc strftime('%%Y', date) -> EXTRACT(YEAR FROM date)
-    sql = re.sub(
-        r"strftime\s*\(\s*'%+Y'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-        r"EXTRACT(YEAR FROM \1)",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # strftime('%m', date) hoặc strftime('%%m', date) -> EXTRACT(MONTH FROM date)
-    sql = re.sub(
-        r"strftime\s*\(\s*'%+m'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-        r"EXTRACT(MONTH FROM \1)",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # strftime('%d', date) hoặc strftime('%%d', date) -> EXTRACT(DAY FROM date)
-    sql = re.sub(
-        r"strftime\s*\(\s*'%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-        r"EXTRACT(DAY FROM \1)",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # strftime('%W', date) hoặc strftime('%%W', date) -> EXTRACT(WEEK FROM date)
-    sql = re.sub(
-        r"strftime\s*\(\s*'%+W'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-        r"EXTRACT(WEEK FROM \1)",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # strftime('%Y-%m-%d', date) hoặc strftime('%%Y-%%m-%%d', date) -> TO_CHAR(date, 'YYYY-MM-DD')
-    sql = re.sub(
-        r"strftime\s*\(\s*'%+Y-%+m-%+d'\s*,\s*([a-zA-Z_][a-zA-Z0-9_.]*)\s*\)",
-        r"TO_CHAR(\1, 'YYYY-MM-DD')",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # Xử lý trường hợp so sánh: strftime('%%Y', date) = '2024' -> EXTRACT(YEAR FROM date) = 2024
-    # Loại bỏ dấu nháy đơn quanh số năm nếu có
-    sql = re.sub(
-        r"EXTRACT\(YEAR FROM ([a-zA-Z_][a-zA-Z0-9_.]*)\)\s*=\s*'(\d{4})'",
-        r"EXTRACT(YEAR FROM \1) = \2",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # date('now', '-X month') -> CURRENT_DATE - INTERVAL 'X month'
-    sql = re.sub(
-        r"date\s*\(\s*'now'\s*,\s*'-(\d+)\s+month'\s*\)",
-        r"CURRENT_DATE - INTERVAL '\1 month'",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # date('now', '-X day') -> CURRENT_DATE - INTERVAL 'X day'
-    sql = re.sub(
-        r"date\s*\(\s*'now'\s*,\s*'-(\d+)\s+day'\s*\)",
-        r"CURRENT_DATE - INTERVAL '\1 day'",
-        sql,
-        flags=re.IGNORECASE,
-    )
+    # Sửa cú pháp SQLite/tên tham số trên cây cú pháp và format lại SQL chuẩn
+    return normalize_llm_sql(sql)
 
-    # Post-processing: Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
-    # Áp dụng cho TẤT CẢ các trường hợp (không chỉ SELECT symbol)
-    # Pattern: WHERE companies.name = '...' hoặc WHERE c.name = '...' hoặc WHERE name = '...' (trong context của companies)
-    # Lý do: Tên công ty trong database là "Apple Inc." chứ không phải "Apple", nên name = 'Apple' sẽ không match
-    
-    # Sửa WHERE companies.name = 'literal' thành WHERE companies.name ILIKE '%literal%'
-    sql = re.sub(
-        r"WHERE\s+companies\.name\s*=\s*'([^']+)'",
-        r"WHERE companies.name ILIKE '%' || '\1' || '%'",
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # Sửa WHERE c.name = 'literal' thành WHERE c.name ILIKE '%literal%' (khi có alias c)
-    sql = re.sub(
-        r"WHERE\s+([a-zA-Z_][a-zA-Z0-9_]*)\.name\s*=\s*'([^']+)'",
-        lambda m: f"WHERE {m.group(1)}.name ILIKE '%' || '{m.group(2)}' || '%'" if m.group(1).lower() in ['c', 'companies', 'company'] else m.group(0),
-        sql,
-        flags=re.IGNORECASE,
-    )
-    # Sửa WHERE name = 'literal' khi đang query từ companies (SELECT ... FROM companies WHERE name = ...)
-    if re.search(r"FROM\s+companies", sql, re.IGNORECASE) and not re.search(r"WHERE\s+companies\.name|WHERE\s+[a-zA-Z_]\.name", sql, re.IGNORECASE):
-        sql = re.sub(
-            r"WHERE\s+name\s*=\s*'([^']+)'",
-            r"WHERE name ILIKE '%' || '\1' || '%'",
-            sql,
-            flags=re.IGNORECASE,
-        )
-    
-    # Post-processing: Sửa WHERE name = '...' thành WHERE name ILIKE '%...%' khi tìm ticker symbol
-    # Pattern: SELECT symbol FROM companies WHERE name = '...'
-    # Hoặc: SELECT symbol FROM companies WHERE name = :company
-    # Chỉ sửa khi đang SELECT symbol (ticker symbol query) - giữ lại logic cũ cho trường hợp đặc biệt
-    if re.search(r"SELECT\s+symbol\s+FROM\s+companies", sql, re.IGNORECASE):
-        # Sửa WHERE name = :company thành WHERE name ILIKE '%' || :company || '%'
-        sql = re.sub(
-            r"WHERE\s+name\s*=\s*:company\b",
-            r"WHERE name ILIKE '%' || :company || '%'",
-            sql,
-            flags=re.IGNORECASE,
-        )
 
-    # Post-processing: Sửa WHERE name ILIKE '%' || :company || '%' thành WHERE symbol = :ticker
-    # Khi đang query metadata từ companies (không phải ticker symbol query)
-    # Chỉ sửa khi đang SELECT metadata fields (sector, country, industry, description, website, market_cap, pe_ratio, dividend_yield, week_52_high, week_52_low, etc.)
-    metadata_fields_pattern = r"SELECT\s+(?:sector|country|industry|description|website|market_cap|pe_ratio|dividend_yield|week_52_high|week_52_low|52_week_high|52_week_low)\s+FROM\s+companies"
-    if re.search(metadata_fields_pattern, sql, re.IGNORECASE) and not re.search(
-        r"SELECT\s+symbol\s+FROM\s+companies", sql, re.IGNORECASE
-    ):
-        # Sửa WHERE name ILIKE '%' || :company || '%' thành WHERE symbol = :ticker
-        sql = re.sub(
-            r"WHERE\s+name\s+ILIKE\s+'%%'\s*\|\|\s*:company\s*\|\|\s*'%%'",
-            r"WHERE symbol = :ticker",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # Sửa WHERE name = :company thành WHERE symbol = :ticker
-        sql = re.sub(
-            r"WHERE\s+name\s*=\s*:company\b",
-            r"WHERE symbol = :ticker",
-            sql,
-            flags=re.IGNORECASE,
-        )
-        # Sửa WHERE name = 'literal' thành WHERE symbol = :ticker
-        sql = re.sub(
-            r"WHERE\s+name\s*=\s*'([^']+)'",
-            r"WHERE symbol = :ticker",
-            sql,
-            flags=re.IGNORECASE,
-        )
+def generate_sql_with_llm(
+    question: str, feedback: Optional[str] = None, analysis_hint: Optional[str] = None
+) -> str:
+    prompt_text = _build_sql_prompt(question, feedback, analysis_hint)
+    return _extract_sql(generate_text(prompt_text))
+
+
+async def agenerate_sql_with_llm(
+    question: str, feedback: Optional[str] = None, analysis_hint: Optional[str] = None
+) -> str:
+    """Phiên bản async của generate_sql_with_llm."""
+    prompt_text = _build_sql_prompt(question, feedback, analysis_hint)
+    return _extract_sql(await agenerate_text(prompt_text))
+
 
-    # Post-processing: Sửa :company_name thành :company (tên parameter sai)
-    sql = re.sub(
-        r":company_name\b",
-        r":company",
-        sql,
-        flags=re.IGNORECASE,
+def _cached_sql_state(state: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Tra SQL shape cache (nodes/sql_shape_cache.py) trước khi gọi LLM.
+
+    Returns:
+        (state có sql_shape, SQL đã cache hoặc None). Không tra cache khi
+        đang sửa SQL theo feedback của lần chạy lỗi trước.
+    """
+    if state.get("feedback"):
+        return state, None
+    shape, sql = lookup_sql(
+        state,
+        lambda sql: build_params(
+            state.get("question", ""), state.get("ticker"), {**state, "sql": sql}
+        ),
     )
-    
-    # Post-processing: Loại bỏ CTE tìm ticker nếu SQL đã có :ticker
-    # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE ...) ... JOIN company_ticker
-    # Nếu SQL có :ticker thì thay thế bằng WHERE ticker = :ticker trực tiếp
-    if re.search(r":ticker\b", sql, re.IGNORECASE):
-        # Tìm và loại bỏ CTE tìm ticker
-        # Pattern: WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE '%' || :company || '%'), ... JOIN company_ticker ct ON ...
-        cte_pattern = r"WITH\s+company_ticker\s+AS\s*\(\s*SELECT\s+symbol\s+FROM\s+companies\s+WHERE\s+name\s+ILIKE\s+'%%'\s*\|\|\s*:company\s*\|\|\s*'%%'\s*\)\s*,?\s*"
-        if re.search(cte_pattern, sql, re.IGNORECASE):
-            # Loại bỏ CTE
-            sql = re.sub(cte_pattern, "", sql, flags=re.IGNORECASE)
-            # Thay thế JOIN company_ticker ct ON p.ticker = ct.symbol thành WHERE p.ticker = :ticker
-            sql = re.sub(
-                r"JOIN\s+company_ticker\s+[a-zA-Z_]*\s+ON\s+[a-zA-Z_]*\.ticker\s*=\s*[a-zA-Z_]*\.symbol",
-                "",
-                sql,
-                flags=re.IGNORECASE,
-            )
-            # Thêm WHERE ticker = :ticker nếu chưa có WHERE
-            if not re.search(r"WHERE\s+.*ticker\s*=", sql, re.IGNORECASE):
-                # Tìm vị trí sau FROM prices hoặc sau JOIN companies
-                if re.search(r"FROM\s+prices", sql, re.IGNORECASE):
-                    sql = re.sub(
-                        r"(FROM\s+prices(?:\s+[a-zA-Z_]+)?)",
-                        r"\1 WHERE ticker = :ticker",
-                        sql,
-                        flags=re.IGNORECASE,
-                        count=1,
-                    )
-                elif re.search(r"JOIN\s+companies", sql, re.IGNORECASE):
-                    # Nếu có JOIN companies, thêm WHERE sau JOIN
-                    sql = re.sub(
-                        r"(JOIN\s+companies(?:\s+[a-zA-Z_]+)?\s+ON\s+[^W]+)",
-                        r"\1 WHERE prices.ticker = :ticker",
-                        sql,
-                        flags=re.IGNORECASE,
-                        count=1,
-                    )
-
-    return sql
+    return {**state, "sql_shape": shape}, sql
 
 
 def generate_sql(state: Dict[str, Any]) -> Dict[str, Any]:
-    question = state.get("question", "")
+    state, cached_sql = _cached_sql_state(state)
+    if cached_sql is not None:
+        return {**state, "sql": cached_sql, "used_sample": False, "sql_source": "shape_cache"}
+
     # Có thể dùng feedback từ vòng trước
-    feedback = state.get("feedback")
-    analysis_hint = state.get("analysis_hint")
-    sql = generate_sql_with_llm(
-        question, feedback=feedback, analysis_hint=analysis_hint
+    prompt_text = _state_prompt(state)
+    sql = _extract_sql(generate_text(prompt_text))
+    return _generated_state(state, sql, prompt_text)
+
+
+async def agenerate_sql(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của generate_sql."""
+    state, cached_sql = _cached_sql_state(state)
+    if cached_sql is not None:
+        return {**state, "sql": cached_sql, "used_sample": False, "sql_source": "shape_cache"}
+
+    prompt_text = _state_prompt(state)
+    sql = _extract_sql(await agenerate_text(prompt_text))
+    return _generated_state(state, sql, prompt_text)
+
+
+def _state_prompt(state: Dict[str, Any]) -> str:
+    return _build_sql_prompt(
+        state.get("question", ""),
+        feedback=state.get("feedback"),
+        analysis_hint=state.get("analysis_hint"),
     )
-    return {**state, "sql": sql, "used_sample": False}
+
+
+def _generated_state(state: Dict[str, Any], sql: str, prompt_text: str) -> Dict[str, Any]:
+    # Sinh lại theo feedback (lỗi validate_sql/execute_sql) tính là một lần sửa
+    # SQL; graph dừng vòng sửa khi đạt SQL_REPAIR_MAX_ATTEMPTS
+    repairs = state.get("sql_repairs", 0) + (1 if state.get("feedback") else 0)
+    return {
+        **state,
+        "sql": sql,
+        "used_sample": False,
+        "sql_source": "llm",
+        "sql_repairs": repairs,
+        # Key LLM cache của response: forget_sql() xoá nếu SQL lỗi để worker
+        # khác không replay SQL hỏng (và lại trả giá một vòng sửa)
+        "sql_llm_cache_key": text_cache_key(prompt_text),
+    }
@@ -0,0 +1,298 @@
+"""
+SQL Normalizer - Chuẩn hoá SQL do LLM sinh trên cây cú pháp (sqlglot).
+
+Trước đây _extract_sql sửa SQL của LLM bằng một chuỗi re.sub nối tiếp nhau
+(strftime của SQLite, WHERE name = '...', :company_name, CTE company_ticker...):
+mỗi regex chỉ khớp đúng một cách viết, và SQL đầu ra giữ nguyên cách viết của
+LLM nên cùng một truy vấn có nhiều dạng text khác nhau. Module này parse SQL
+một lần (dialect postgres), sửa trên cây cú pháp rồi sinh lại SQL theo format
+chuẩn:
+
+1. Hàm SQLite -> PostgreSQL: strftime('%Y', date) -> EXTRACT(YEAR FROM date),
+   strftime('%Y-%m-%d', date) -> TO_CHAR(date, 'YYYY-MM-DD'),
+   date('now', '-6 month') -> CURRENT_DATE - INTERVAL '6 month'
+2. EXTRACT(YEAR FROM date) = '2024' -> EXTRACT(YEAR FROM date) = 2024
+3. companies.name = 'Apple' -> name ILIKE '%' || 'Apple' || '%' (tên trong
+   database là "Apple Inc."); name = :company -> ILIKE khi tìm symbol, hoặc
+   symbol = :ticker khi lấy metadata của công ty
+4. Tên bind parameter chuẩn: :company_name -> :company, :ticker_symbol /
+   :symbol -> :ticker
+5. Bỏ CTE tìm ticker theo tên công ty khi SQL đã có :ticker:
+   WITH company_ticker AS (SELECT symbol FROM companies WHERE name ILIKE ...)
+   ... JOIN company_ticker ct ON p.ticker = ct.symbol
+   -> ... WHERE p.ticker = :ticker
+
+canonical_sql() cho text chuẩn của một SQL bất kỳ (một dòng, không comment,
+identifier lowercase): hai SQL chỉ khác khoảng trắng, chữ hoa/thường, alias
+AS hay cách ép kiểu (::date / CAST) có cùng canonical_sql, nên dùng làm key
+cho cache và thống kê (sql_fingerprint) thay vì text gốc.
+
+Usage:
+    normalize_llm_sql("select close from prices where ticker = :ticker_symbol")
+    # "SELECT\\n  close\\nFROM prices\\nWHERE\\n  ticker = :ticker;"
+    sql_fingerprint("SELECT close FROM prices WHERE ticker = :ticker;")
+    # "3f1c0a9d2b7e4c55"
+"""
+
+import hashlib
+import re
+from typing import Callable, Dict, List, Optional
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.dialects.postgres import Postgres
+from sqlglot.errors import ParseError
+
+
+class _DjiaPostgres(Postgres):
+    """PostgreSQL, nhưng giữ bind parameter dạng :name (SQLAlchemy text())."""
+
+    class Generator(Postgres.Generator):
+        def placeholder_sql(self, expression: exp.Placeholder) -> str:
+            return f":{expression.name}" if expression.name else "?"
+
+
+_READ = "postgres"
+
+# Tên parameter LLM hay dùng sai -> tên build_params tạo ra
+_PARAM_ALIASES = {
+    "company_name": "company",
+    "ticker_symbol": "ticker",
+    "symbol": "ticker",
+}
+
+# Cột metadata của companies (câu hỏi về một công ty đã biết ticker)
+_METADATA_COLUMNS = {
+    "sector",
+    "country",
+    "industry",
+    "description",
+    "website",
+    "market_cap",
+    "pe_ratio",
+    "dividend_yield",
+    "week_52_high",
+    "week_52_low",
+}
+
+# strftime của SQLite -> phần EXTRACT hoặc format TO_CHAR tương ứng
+_STRFTIME_PARTS = {"%Y": "YEAR", "%m": "MONTH", "%d": "DAY", "%W": "WEEK"}
+_STRFTIME_FORMATS = {"%Y-%m-%d": "YYYY-MM-DD"}
+
+# date('now', '-6 month') của SQLite
+_SQLITE_MODIFIER_RE = re.compile(r"^\s*([+-])\s*(\d+)\s+(day|month|year)s?\s*$", re.I)
+
+
+# ==================== REWRITES ====================
+
+
+def _sqlite_functions(tree: exp.Expression) -> exp.Expression:
+    def _transform(node: exp.Expression) -> exp.Expression:
+        if isinstance(node, exp.Anonymous) and node.name.lower() == "strftime":
+            args = node.expressions
+            if len(args) == 2 and isinstance(args[0], exp.Literal) and args[0].is_string:
+                fmt = re.sub(r"%+", "%", args[0].this)
+                if fmt in _STRFTIME_PARTS:
+                    return exp.Extract(
+                        this=exp.var(_STRFTIME_PARTS[fmt]), expression=args[1].copy()
+                    )
+                if fmt in _STRFTIME_FORMATS:
+                    return exp.Anonymous(
+                        this="TO_CHAR",
+                        expressions=[args[1].copy(), exp.Literal.string(_STRFTIME_FORMATS[fmt])],
+                    )
+        if isinstance(node, exp.Date) and isinstance(node.this, exp.Literal):
+            modifier = node.args.get("zone")
+            if node.this.this.lower() == "now" and isinstance(modifier, exp.Literal):
+                match = _SQLITE_MODIFIER_RE.match(modifier.this)
+                if match:
+                    sign, amount, unit = match.groups()
+                    interval = exp.Interval(
+                        this=exp.Literal.string(amount), unit=exp.var(unit.upper())
+                    )
+                    operator = exp.Sub if sign == "-" else exp.Add
+                    return operator(this=exp.CurrentDate(), expression=interval)
+        return node
+
+    return tree.transform(_transform, copy=False)
+
+
+def _numeric_date_parts(tree: exp.Expression) -> exp.Expression:
+    """EXTRACT(...) = '2024' -> EXTRACT(...) = 2024 (so sánh số với số)."""
+    for eq in tree.find_all(exp.EQ):
+        for part, value in ((eq.this, eq.expression), (eq.expression, eq.this)):
+            if (
+                isinstance(part, exp.Extract)
+                and isinstance(value, exp.Literal)
+                and value.is_string
+                and value.this.isdigit()
+            ):
+                value.replace(exp.Literal.number(int(value.this)))
+    return tree
+
+
+def _canonical_params(tree: exp.Expression) -> exp.Expression:
+    for placeholder in tree.find_all(exp.Placeholder):
+        name = placeholder.name.lower()
+        if name:
+            placeholder.set("this", _PARAM_ALIASES.get(name, name))
+    return tree
+
+
+def _table_aliases(tree: exp.Expression) -> Dict[str, str]:
+    """alias (hoặc tên bảng) -> tên bảng, cho mọi bảng trong SQL."""
+    return {table.alias_or_name: table.name for table in tree.find_all(exp.Table) if table.name}
+
+
+def _is_company_name(column: exp.Expression, aliases: Dict[str, str]) -> bool:
+    if not isinstance(column, exp.Column) or column.name.lower() != "name":
+        return False
+    if column.table:
+        return aliases.get(column.table) == "companies"
+    # Chỉ companies có cột name
+    return "companies" in aliases.values()
+
+
+def _projected_columns(select: Optional[exp.Select]) -> set:
+    if select is None:
+        return set()
+    return {column.name.lower() for projection in select.expressions for column in projection.find_all(exp.Column)}
+
+
+def _contains(pattern: exp.Expression) -> exp.Expression:
+    """'%' || pattern || '%'"""
+    return exp.DPipe(
+        this=exp.DPipe(this=exp.Literal.string("%"), expression=pattern, safe=True),
+        expression=exp.Literal.string("%"),
+        safe=True,
+    )
+
+
+def _company_name_filters(tree: exp.Expression) -> exp.Expression:
+    aliases = _table_aliases(tree)
+    if "companies" not in aliases.values():
+        return tree
+    for eq in list(tree.find_all(exp.EQ)):
+        column, value = eq.this, eq.expression
+        if not _is_company_name(column, aliases):
+            column, value = value, column
+            if not _is_company_name(column, aliases):
+                continue
+        if isinstance(value, exp.Literal) and value.is_string:
+            # Tên trong database là "Apple Inc." nên name = 'Apple' không bao giờ khớp
+            eq.replace(exp.ILike(this=column.copy(), expression=_contains(value.copy())))
+        elif isinstance(value, exp.Placeholder) and value.name == "company":
+            projected = _projected_columns(eq.find_ancestor(exp.Select))
+            if "symbol" in projected:
+                eq.replace(exp.ILike(this=column.copy(), expression=_contains(value.copy())))
+            elif projected & _METADATA_COLUMNS:
+                # Metadata của công ty: lọc theo ticker đã trích xuất từ câu hỏi
+                symbol = exp.column("symbol", table=column.table or None)
+                eq.replace(exp.EQ(this=symbol, expression=exp.Placeholder(this="ticker")))
+    return tree
+
+
+def _is_ticker_lookup(query: exp.Expression) -> bool:
+    """SELECT symbol FROM companies WHERE ... (CTE tìm ticker theo tên công ty)."""
+    return (
+        isinstance(query, exp.Select)
+        and _projected_columns(query) == {"symbol"}
+        and len(query.expressions) == 1
+        and not query.args.get("joins")
+        and [table.name for table in query.find_all(exp.Table)] == ["companies"]
+    )
+
+
+def _ticker_lookup_ctes(tree: exp.Expression) -> exp.Expression:
+    """Bỏ CTE tìm ticker theo tên công ty khi SQL đã có :ticker."""
+    if not any(p.name == "ticker" for p in tree.find_all(exp.Placeholder)):
+        return tree
+    for cte in list(tree.find_all(exp.CTE)):
+        if not _is_ticker_lookup(cte.this):
+            continue
+        uses = [table for table in tree.find_all(exp.Table) if table.name == cte.alias]
+        if len(uses) != 1 or not isinstance(uses[0].parent, exp.Join):
+            continue
+        join = uses[0].parent
+        condition = join.args.get("on")
+        if not isinstance(condition, exp.EQ):
+            continue
+        alias = uses[0].alias_or_name
+        sides = [condition.this, condition.expression]
+        cte_side = [c for c in sides if isinstance(c, exp.Column) and c.table == alias]
+        ticker_side = [
+            c for c in sides if isinstance(c, exp.Column) and c.table != alias and c.name == "ticker"
+        ]
+        select = join.find_ancestor(exp.Select)
+        if len(cte_side) != 1 or cte_side[0].name != "symbol" or len(ticker_side) != 1 or select is None:
+            continue
+        join.pop()
+        cte.pop()
+        condition = exp.EQ(this=ticker_side[0].copy(), expression=exp.Placeholder(this="ticker"))
+        where = select.args.get("where")
+        if where is None or not any(eq == condition for eq in where.find_all(exp.EQ)):
+            select.where(condition, copy=False)
+    with_ = tree.args.get("with")
+    if with_ is not None and not with_.expressions:
+        tree.set("with", None)
+    return tree
+
+
+_REWRITES: List[Callable[[exp.Expression], exp.Expression]] = [
+    _sqlite_functions,
+    _numeric_date_parts,
+    _canonical_params,
+    _company_name_filters,
+    _ticker_lookup_ctes,
+]
+
+
+# ==================== API ====================
+
+
+def _parse_single(sql: str) -> Optional[exp.Expression]:
+    """Cây cú pháp nếu sql là đúng một câu lệnh parse được, ngược lại None."""
+    try:
+        statements = [
+            s
+            for s in sqlglot.parse(sql, read=_READ)
+            if s is not None and not isinstance(s, exp.Semicolon)
+        ]
+    except ParseError:
+        return None
+    return statements[0] if len(statements) == 1 else None
+
+
+def normalize_llm_sql(sql: str) -> str:
+    """
+    Sửa lỗi thường gặp của SQL do LLM sinh và format lại theo chuẩn.
+
+    SQL không parse được (hoặc nhiều câu lệnh) được giữ nguyên để
+    validate_sql báo lỗi cú pháp cho LLM sửa.
+    """
+    sql = sql.strip()
+    tree = _parse_single(sql)
+    if tree is None:
+        return sql if not sql or sql.endswith(";") else sql + ";"
+    for rewrite in _REWRITES:
+        tree = rewrite(tree)
+    return tree.sql(dialect=_DjiaPostgres, pretty=True) + ";"
+
+
+def canonical_sql(sql: str) -> str:
+    """
+    Text chuẩn của SQL (một dòng, không comment, identifier lowercase) để làm
+    key cache/thống kê. SQL không parse được: gộp khoảng trắng, bỏ comment.
+    """
+    tree = _parse_single(sql)
+    if tree is None:
+        lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+        return " ".join(" ".join(lines).split()).rstrip(";").strip()
+    return tree.sql(dialect=_DjiaPostgres, normalize=True, comments=False)
+
+
+def sql_fingerprint(sql: Optional[str]) -> Optional[str]:
+    """Hash ngắn của canonical_sql (None nếu không có SQL)."""
+    if not sql or not sql.strip():
+        return None
+    return hashlib.sha1(canonical_sql(sql).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,248 @@
+"""
+SQL Rewriter - Viết lại điều kiện lọc ngày thành dạng sargable.
+
+SQL samples và SQL do LLM sinh lọc theo năm/quý/tháng bằng cách bọc cột date
+trong hàm (TO_CHAR(date, 'YYYY') = :year, EXTRACT(YEAR FROM date) = 2024...).
+PostgreSQL không dùng được idx_prices_date hay primary key (date, ticker) cho
+các điều kiện này nên phải quét toàn bộ bảng prices.
+
+rewrite_date_predicates() chạy ngay trước khi thực thi SQL (run_sql/arun_sql)
+và đổi các điều kiện đó thành khoảng nửa mở trên chính cột date:
+
+    TO_CHAR(date, 'YYYY') = :year
+    -> (date >= CAST(:date_from_1 AS DATE) AND date < CAST(:date_to_1 AS DATE))
+
+Các dạng được hỗ trợ (cột date có thể có alias, ví dụ p.date):
+- Năm: TO_CHAR(date, 'YYYY') / EXTRACT(YEAR FROM date) / DATE_PART('year', date)
+- Năm + tháng: ... AND TO_CHAR(date, 'MM') = :month
+- Năm + khoảng tháng: ... AND TO_CHAR(date, 'MM') BETWEEN :start_month AND :end_month
+- Năm + danh sách tháng liên tiếp: ... AND TO_CHAR(date, 'MM') IN ('01', '02', '03')
+- Năm + quý: ... AND CASE WHEN :quarter = 1 THEN TO_CHAR(date, 'MM') IN (...) ... END
+
+Giá trị lấy từ bind parameters hoặc literal trong SQL. Điều kiện nào không
+xác định được giá trị (thiếu param, tháng không liên tiếp...) được giữ nguyên,
+nên kết quả truy vấn không thay đổi.
+"""
+
+import re
+from datetime import date
+from typing import Any, Dict, Optional, Tuple
+
+# Cột date, có thể kèm alias bảng (p.date)
+_COL = r"(?:[A-Za-z_]\w*\.)?date\b"
+
+# Giá trị so sánh không được nối tiếp bởi toán tử/ép kiểu (ví dụ :year - 1)
+_VALUE_END = r"(?![\w.:'])(?!\s*(?:[-+*/|%]|::))"
+
+
+def _year_expr(tag: str) -> str:
+    return (
+        rf"(?:TO_CHAR\(\s*(?P<{tag}_a>{_COL})\s*,\s*'YYYY'\s*\)"
+        rf"|EXTRACT\(\s*YEAR\s+FROM\s+(?P<{tag}_b>{_COL})\s*\)"
+        rf"|DATE_PART\(\s*'year'\s*,\s*(?P<{tag}_c>{_COL})\s*\))"
+    )
+
+
+def _month_expr(tag: str) -> str:
+    return (
+        rf"(?:TO_CHAR\(\s*(?P<{tag}_a>{_COL})\s*,\s*'MM'\s*\)"
+        rf"|EXTRACT\(\s*MONTH\s+FROM\s+(?P<{tag}_b>{_COL})\s*\)"
+        rf"|DATE_PART\(\s*'month'\s*,\s*(?P<{tag}_c>{_COL})\s*\))"
+    )
+
+
+def _value(tag: str) -> str:
+    return (
+        rf"(?::(?P<{tag}_param>[A-Za-z_]\w*)|'(?P<{tag}_str>\d{{1,4}})'"
+        rf"|(?P<{tag}_num>\d{{1,4}}))"
+        + _VALUE_END
+    )
+
+
+_YEAR = rf"{_year_expr('ycol')}\s*=\s*{_value('year')}"
+_AND = r"\s+AND\s+"
+
+_YEAR_MONTH_RE = re.compile(
+    rf"{_YEAR}{_AND}{_month_expr('mcol')}\s*=\s*{_value('month')}", re.I
+)
+_YEAR_MONTH_BETWEEN_RE = re.compile(
+    rf"{_YEAR}{_AND}{_month_expr('mcol')}\s+BETWEEN\s+{_value('mstart')}"
+    rf"\s+AND\s+{_value('mend')}",
+    re.I,
+)
+_YEAR_MONTH_IN_RE = re.compile(
+    rf"{_YEAR}{_AND}{_month_expr('mcol')}\s+IN\s*\((?P<months>[^()]*)\)", re.I
+)
+_YEAR_QUARTER_RE = re.compile(
+    rf"{_YEAR}{_AND}CASE\s+(?P<body>(?:WHEN\s+:\w+\s*=\s*\d\s+THEN\s+"
+    rf"{_month_expr('qcol')}\s+IN\s*\([^()]*\)\s*)+)END",
+    re.I,
+)
+_YEAR_RE = re.compile(_YEAR, re.I)
+
+_QUARTER_WHEN_RE = re.compile(
+    rf"WHEN\s+:(?P<param>\w+)\s*=\s*(?P<quarter>\d)\s+THEN\s+{_month_expr('col')}"
+    rf"\s+IN\s*\((?P<months>[^()]*)\)",
+    re.I,
+)
+
+
+def date_range(year: int, start_month: int = 1, end_month: int = 12) -> Tuple[str, str]:
+    """
+    Khoảng nửa mở [from, to) của các tháng start_month..end_month trong năm.
+
+    Examples:
+        >>> date_range(2024)
+        ('2024-01-01', '2025-01-01')
+        >>> date_range(2024, 12, 12)
+        ('2024-12-01', '2025-01-01')
+    """
+    start = date(year, start_month, 1)
+    end = date(year + 1, 1, 1) if end_month == 12 else date(year, end_month + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def _column(match: re.Match, tag: str) -> str:
+    return match.group(f"{tag}_a") or match.group(f"{tag}_b") or match.group(f"{tag}_c")
+
+
+def _resolve(match: re.Match, tag: str, params: Dict[str, Any]) -> Optional[int]:
+    """Giá trị số của một vế so sánh (bind parameter hoặc literal)."""
+    param = match.group(f"{tag}_param")
+    raw = params.get(param) if param else (
+        match.group(f"{tag}_str") or match.group(f"{tag}_num")
+    )
+    try:
+        return int(str(raw).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _months_in(text: str) -> Optional[Tuple[int, int]]:
+    """('01', '02', '03') -> (1, 3) nếu danh sách là các tháng liên tiếp."""
+    months = []
+    for item in text.split(","):
+        item = item.strip().strip("'")
+        if not item.isdigit():
+            return None
+        months.append(int(item))
+    months.sort()
+    if not months or months != list(range(months[0], months[-1] + 1)):
+        return None
+    return months[0], months[-1]
+
+
+def _quarter_months(body: str, params: Dict[str, Any]) -> Optional[Tuple[int, int, str]]:
+    """
+    Tháng đầu/cuối của quý được chọn trong khối CASE WHEN :quarter = n.
+
+    Chỉ nhận khối CASE theo đúng ánh xạ quý -> tháng chuẩn, trả về
+    (start_month, end_month, cột) hoặc None.
+    """
+    whens = list(_QUARTER_WHEN_RE.finditer(body))
+    if not whens:
+        return None
+    param = whens[0].group("param")
+    column = _column(whens[0], "col")
+    for when in whens:
+        quarter = int(when.group("quarter"))
+        expected = (quarter * 3 - 2, quarter * 3)
+        if (
+            when.group("param") != param
+            or _column(when, "col") != column
+            or _months_in(when.group("months")) != expected
+        ):
+            return None
+    try:
+        quarter = int(str(params.get(param)).strip())
+    except (TypeError, ValueError):
+        return None
+    if not 1 <= quarter <= 4:
+        return None
+    return quarter * 3 - 2, quarter * 3, column
+
+
+def rewrite_date_predicates(
+    sql: str, params: Dict[str, Any]
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Đổi điều kiện năm/quý/tháng bọc trong hàm thành khoảng date nửa mở.
+
+    Args:
+        sql: SQL PostgreSQL với bind parameters (:year, :month, ...)
+        params: Parameters sẽ bind khi thực thi
+
+    Returns:
+        Tuple (SQL đã viết lại, params gồm thêm date_from_n/date_to_n).
+        Nếu không có điều kiện nào viết lại được, trả về nguyên SQL và params.
+
+    Examples:
+        >>> rewrite_date_predicates(
+        ...     "SELECT * FROM prices WHERE TO_CHAR(date, 'YYYY') = :year", {"year": "2024"}
+        ... )[0]
+        "SELECT * FROM prices WHERE (date >= CAST(:date_from_1 AS DATE) AND date < CAST(:date_to_1 AS DATE))"
+    """
+    new_params = dict(params)
+    counter = [0]
+
+    def _range(column: str, year: Optional[int], start_month: int, end_month: int) -> Optional[str]:
+        if year is None or not (1 <= start_month <= end_month <= 12) or not 1 <= year <= 9999:
+            return None
+        counter[0] += 1
+        from_name, to_name = f"date_from_{counter[0]}", f"date_to_{counter[0]}"
+        new_params[from_name], new_params[to_name] = date_range(year, start_month, end_month)
+        return (
+            f"({column} >= CAST(:{from_name} AS DATE)"
+            f" AND {column} < CAST(:{to_name} AS DATE))"
+        )
+
+    def _same_column(match: re.Match, tag: str) -> bool:
+        return _column(match, tag).lower() == _column(match, "ycol").lower()
+
+    def _year_month(match: re.Match) -> str:
+        month = _resolve(match, "month", new_params)
+        if month is None or not _same_column(match, "mcol"):
+            return match.group(0)
+        year = _resolve(match, "year", new_params)
+        return _range(_column(match, "ycol"), year, month, month) or match.group(0)
+
+    def _year_month_between(match: re.Match) -> str:
+        start = _resolve(match, "mstart", new_params)
+        end = _resolve(match, "mend", new_params)
+        if start is None or end is None or not _same_column(match, "mcol"):
+            return match.group(0)
+        year = _resolve(match, "year", new_params)
+        return _range(_column(match, "ycol"), year, start, end) or match.group(0)
+
+    def _year_month_in(match: re.Match) -> str:
+        months = _months_in(match.group("months"))
+        if months is None or not _same_column(match, "mcol"):
+            return match.group(0)
+        year = _resolve(match, "year", new_params)
+        return _range(_column(match, "ycol"), year, *months) or match.group(0)
+
+    def _year_quarter(match: re.Match) -> str:
+        quarter = _quarter_months(match.group("body"), new_params)
+        if quarter is None or quarter[2].lower() != _column(match, "ycol").lower():
+            return match.group(0)
+        year = _resolve(match, "year", new_params)
+        return _range(_column(match, "ycol"), year, quarter[0], quarter[1]) or match.group(0)
+
+    def _year_only(match: re.Match) -> str:
+        year = _resolve(match, "year", new_params)
+        return _range(_column(match, "ycol"), year, 1, 12) or match.group(0)
+
+    # Dạng kết hợp năm + tháng/quý phải chạy trước dạng chỉ có năm
+    rewritten = sql
+    for pattern, replace in (
+        (_YEAR_QUARTER_RE, _year_quarter),
+        (_YEAR_MONTH_BETWEEN_RE, _year_month_between),
+        (_YEAR_MONTH_IN_RE, _year_month_in),
+        (_YEAR_MONTH_RE, _year_month),
+        (_YEAR_RE, _year_only),
+    ):
+        rewritten = pattern.sub(replace, rewritten)
+
+    if counter[0] == 0:
+        return sql, params
+    return rewritten, new_params
@@ -0,0 +1,186 @@
+"""
+SQL Shape Cache - Dùng lại SQL do LLM sinh cho các câu hỏi cùng dạng.
+
+Khi không có SQL mẫu, generate_sql phải chờ một round trip Gemini. Câu hỏi
+tiếp theo thường cùng dạng, chỉ khác công ty hoặc ngày:
+
+    "What was the 30-day volatility of Apple in 2023?"
+    "What was the 30-day volatility of Boeing in 2024?"
+
+Cả hai có chung dạng (mask_question của nodes/template_index.py):
+
+    "what was the 30-day volatility of {company} in {year}?"
+
+Cache giữ SQL có bind parameters (:ticker, :year, ...) đã chạy thành công
+theo dạng câu hỏi; câu hỏi cùng dạng bỏ qua LLM và đi thẳng tới execute_sql
+với parameters mới (build_params). Chỉ SQL không chứa giá trị cụ thể của câu
+hỏi gốc (ticker 'AAPL', ngày, năm, tên công ty) mới được cache - SQL viết
+cứng giá trị sẽ trả lời sai cho câu hỏi khác.
+
+Luồng trong workflow:
+- generate_sql: lookup_sql() trước khi gọi LLM; state["sql_source"] là
+  "shape_cache" (dùng lại) hoặc "llm" (sinh mới), state["sql_shape"] là dạng
+- execute_sql: remember_sql() khi SQL của LLM chạy thành công, forget_sql()
+  khi SQL lấy từ cache bị lỗi (lần sau sẽ sinh lại bằng LLM) hoặc khi SQL của
+  LLM bị lỗi (xoá response khỏi LLM cache, xem nodes/llm_cache.py)
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Optional, Tuple
+
+import pandas as pd
+
+from nodes.entities import entities_from_state
+from nodes.llm import forget_text
+from nodes.template_index import mask_question
+from nodes.utils import find_companies, normalize_text
+
+# Bind parameter dạng :name (bỏ qua cast kiểu ::date)
+_PARAM_RE = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+def question_shape(question: str) -> str:
+    """Dạng câu hỏi: công ty, ngày, năm, quý được thay bằng placeholder."""
+    return mask_question(question)
+
+
+def sql_params(sql: str) -> FrozenSet[str]:
+    """Tên các bind parameter trong SQL."""
+    return frozenset(_PARAM_RE.findall(sql))
+
+
+def is_reusable(sql: str, state: Dict[str, Any]) -> bool:
+    """
+    SQL có dùng lại được cho câu hỏi cùng dạng không: mọi giá trị bị mask
+    trong dạng câu hỏi phải đi vào SQL qua bind parameter, không viết cứng.
+    """
+    entities = entities_from_state(state)
+    sql_lower = sql.lower()
+
+    tickers = {*entities.tickers, entities.ticker, entities.ticker_a, entities.ticker_b}
+    if any(f"'{ticker.lower()}'" in sql_lower for ticker in tickers if ticker):
+        return False
+    q = normalize_text(state.get("question", ""))
+    if any(q[match.start : match.end] in sql_lower for match in find_companies(q)):
+        return False
+    for date in (entities.date, entities.start_date, entities.end_date):
+        if date and date in sql:
+            return False
+    if entities.year and re.search(rf"\b{entities.year}\b", sql):
+        return False
+    # Quý chỉ an toàn khi SQL dùng :quarter (không viết cứng tháng của quý)
+    if entities.quarter and "quarter" not in sql_params(sql):
+        return False
+    return True
+
+
+class SqlShapeCache:
+    """LRU cache (thread-safe): dạng câu hỏi -> (SQL, bind parameters của SQL)."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, FrozenSet[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self, shape: str, params_for: Callable[[str], Dict[str, Any]]
+    ) -> Optional[str]:
+        """
+        SQL đã cache cho dạng câu hỏi, nếu câu hỏi mới có đủ giá trị cho mọi
+        bind parameter của SQL đó (params_for(sql) trả về params sẽ bind).
+        """
+        with self._lock:
+            entry = self._entries.get(shape)
+        if entry is not None:
+            params = params_for(entry[0])
+            if any(params.get(name) is None for name in entry[1]):
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if shape in self._entries:
+                self._entries.move_to_end(shape)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, shape: str, sql: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[shape] = (sql, sql_params(sql))
+            self._entries.move_to_end(shape)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, shape: str, sql: str) -> None:
+        """Bỏ entry của dạng câu hỏi (chỉ khi vẫn là SQL này)."""
+        with self._lock:
+            entry = self._entries.get(shape)
+            if entry is not None and entry[0] == sql:
+                del self._entries[shape]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _cache() -> Optional[SqlShapeCache]:
+    from runtime import get_runtime
+
+    return get_runtime().sql_shape_cache
+
+
+def lookup_sql(
+    state: Dict[str, Any], params_for: Callable[[str], Dict[str, Any]]
+) -> Tuple[str, Optional[str]]:
+    """
+    Tra cache cho câu hỏi trong state; params_for(sql) trả về bind parameters
+    của câu hỏi cho SQL đó (sql_executor.build_params).
+
+    Returns:
+        (dạng câu hỏi, SQL đã cache hoặc None)
+    """
+    shape = question_shape(state.get("question", ""))
+    cache = _cache()
+    if cache is None:
+        return shape, None
+    return shape, cache.get(shape, params_for)
+
+
+def remember_sql(state: Dict[str, Any], df: pd.DataFrame) -> None:
+    """Cache SQL do LLM sinh sau khi chạy thành công và có dữ liệu."""
+    if state.get("sql_source") != "llm" or not state.get("sql_shape") or df.empty:
+        return
+    cache = _cache()
+    sql = state.get("sql") or ""
+    if cache is not None and sql and is_reusable(sql, state):
+        cache.put(state["sql_shape"], sql)
+
+
+def forget_sql(state: Dict[str, Any]) -> None:
+    """
+    Bỏ SQL bị validate_sql/execute_sql báo lỗi khỏi cache: SQL lấy từ shape
+    cache (lỗi với câu hỏi mới) hoặc response của LLM trong LLM cache.
+    """
+    if state.get("sql_source") == "llm":
+        forget_text(state.get("sql_llm_cache_key"))
+        return
+    if state.get("sql_source") != "shape_cache" or not state.get("sql_shape"):
+        return
+    cache = _cache()
+    if cache is not None:
+        cache.discard(state["sql_shape"], state.get("sql") or "")
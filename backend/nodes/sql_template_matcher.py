@@ -1,41 +1,26 @@
-from typing import Dict, Any, Optional, List
-import re
-import os
-from dotenv import load_dotenv
-from google import generativeai as google_genai
-from config import SQL_SAMPLES_FILE
-from nodes.utils import normalize_text, extract_ticker
-from nodes.chart_generator import build_chart_sql
-
-# Load environment variables
-load_dotenv()
-
-# Setup Gemini API key
-if os.getenv("GOOGLE_API_KEY") in (None, "") and os.getenv("GEMINI_API_KEY"):
-    os.environ["GOOGLE_API_KEY"] = os.getenv("GEMINI_API_KEY")
+from typing import Dict, Any, Optional, List, Tuple
+import asyncio
+from config import (
+    TEMPLATE_MATCH_THRESHOLD,
+    TEMPLATE_MATCH_MARGIN,
+    TEMPLATE_MATCH_TOP_K,
+)
+from nodes.entities import entities_from_state
+from nodes.utils import normalize_text
+from nodes.chart_generator import build_chart_sql, abuild_chart_sql
+from nodes.llm import get_api_key, generate_text, agenerate_text
+from runtime import get_runtime
 
 
 def load_sql_samples() -> List[str]:
-    """Load SQL samples từ file."""
-    if not SQL_SAMPLES_FILE.exists():
-        return []
-
-    text = SQL_SAMPLES_FILE.read_text(encoding="utf-8")
-    statements = [s.strip() + ";" for s in re.split(r";\s*\n", text) if s.strip()]
-
-    return statements
+    """SQL samples từ template registry (parse một lần, reload khi file đổi)."""
+    return get_runtime().sql_samples
 
 
-def validate_and_find_sql_with_llm(
-    question: str, sql_samples: List[str]
-) -> Optional[str]:
-    """Dùng LLM duy nhất để tìm SQL sample phù hợp. Nếu không có, trả về None."""
-    if not sql_samples:
-        return None
-
+def _build_match_prompt(question: str, sql_samples: List[str]) -> str:
     samples_text = "\n".join([f"{i+1}. {sql}" for i, sql in enumerate(sql_samples)])
 
-    prompt = f"""
+    return f"""
 Bạn là chuyên gia SQL của hệ thống Agentic Financial Information. Nhiệm vụ: từ danh sách SQL mẫu dưới đây, chọn CHÍNH XÁC một câu lệnh phù hợp nhất với câu hỏi.
 
 CÂU HỎI: {question}
@@ -55,48 +40,121 @@ CÁCH TRẢ LỜI:
 
 Chỉ trả lời: FOUND: n hoặc NO_MATCH."""
 
-    try:
-        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            print("Warning: No Gemini API key found. Skipping SQL template matching.")
-            return None
-        
-        google_genai.configure(api_key=api_key)
-        model = google_genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt)
-        result = (response.text or "").strip()
-        if result.startswith("FOUND:"):
-            try:
-                idx_str = result.split(":")[1].strip()
-                idx = int(idx_str) - 1
-                if 0 <= idx < len(sql_samples):
-                    return sql_samples[idx]
-            except (ValueError, IndexError):
-                return None
-        elif result == "NO_MATCH":
+
+def _parse_match_result(result: str, sql_samples: List[str]) -> Optional[str]:
+    """Parse "FOUND: n" / "NO_MATCH" thành SQL sample tương ứng."""
+    if result.startswith("FOUND:"):
+        try:
+            idx_str = result.split(":")[1].strip()
+            idx = int(idx_str) - 1
+            if 0 <= idx < len(sql_samples):
+                return sql_samples[idx]
+        except (ValueError, IndexError):
             return None
+    return None
+
+
+def _can_match(sql_samples: List[str]) -> bool:
+    if not sql_samples:
+        return False
+    if not get_api_key():
+        print("Warning: No Gemini API key found. Skipping SQL template matching.")
+        return False
+    return True
+
+
+def validate_and_find_sql_with_llm(
+    question: str, sql_samples: List[str]
+) -> Optional[str]:
+    """Dùng LLM duy nhất để tìm SQL sample phù hợp. Nếu không có, trả về None."""
+    if not _can_match(sql_samples):
         return None
+
+    try:
+        result = generate_text(_build_match_prompt(question, sql_samples))
+        return _parse_match_result(result, sql_samples)
     except Exception as e:
         print(f"LLM validation error: {e}")
         return None
 
 
-def match_sample(question: str) -> Optional[str]:
-    """Chỉ dựa vào LLM để tìm SQL sample phù hợp."""
-    sql_samples = load_sql_samples()
-    return validate_and_find_sql_with_llm(question, sql_samples)
+async def avalidate_and_find_sql_with_llm(
+    question: str, sql_samples: List[str]
+) -> Optional[str]:
+    """Phiên bản async của validate_and_find_sql_with_llm."""
+    if not _can_match(sql_samples):
+        return None
+
+    try:
+        result = await agenerate_text(_build_match_prompt(question, sql_samples))
+        return _parse_match_result(result, sql_samples)
+    except Exception as e:
+        print(f"LLM validation error: {e}")
+        return None
 
 
-def match_sql_template(state: Dict[str, Any]) -> Dict[str, Any]:
-    """Trích xuất ticker và tìm SQL template phù hợp với câu hỏi."""
+def search_templates(question: str) -> Tuple[Optional[str], List[str]]:
+    """
+    Tìm SQL sample bằng vector index (nearest neighbour, không gọi LLM).
+
+    Returns:
+        (sql, []) nếu template gần nhất đủ tin cậy (similarity >= ngưỡng và
+        cách template thứ 2 đủ xa); ngược lại (None, candidates) với
+        candidates là top-k samples để LLM chọn. Khi chưa có index (chưa cài
+        sentence-transformers), candidates là toàn bộ samples.
+    """
+    runtime = get_runtime()
+    # Template registry được parse một lần và giữ trong runtime dùng chung
+    index = runtime.template_index
+    if index is None:
+        return None, runtime.sql_samples
+
+    hits = index.search(question, TEMPLATE_MATCH_TOP_K)
+    if not hits:
+        return None, runtime.sql_samples
+
+    best, best_score = hits[0]
+    runner_up = hits[1][1] if len(hits) > 1 else 0.0
+    if best_score >= TEMPLATE_MATCH_THRESHOLD and best_score - runner_up >= TEMPLATE_MATCH_MARGIN:
+        return best.sql, []
+    return None, [template.sql for template, _ in hits]
+
+
+def match_sample(question: str) -> Optional[str]:
+    """
+    Tìm SQL sample phù hợp: vector index trước, LLM chỉ chọn trong top-k
+    ứng viên khi độ tin cậy thấp.
+    """
+    sql, candidates = search_templates(question)
+    if sql is not None:
+        return sql
+    return validate_and_find_sql_with_llm(question, candidates)
+
+
+async def amatch_sample(question: str) -> Optional[str]:
+    """Phiên bản async của match_sample."""
+    # Embed câu hỏi tốn CPU nên chạy ngoài event loop
+    sql, candidates = await asyncio.to_thread(search_templates, question)
+    if sql is not None:
+        return sql
+    return await avalidate_and_find_sql_with_llm(question, candidates)
+
+
+def _route_template(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Phần xử lý không cần LLM của match_sql_template.
+
+    Trả về {"ticker": ..., "result": state mới} nếu đã quyết định được
+    (force LLM / all companies), hoặc {"ticker": ..., "result": None,
+    "chart": bool} nếu cần gọi LLM (build chart SQL hoặc tìm sample).
+    """
     question = state.get("question", "")
     needs_chart = state.get("needs_chart", False)
-    chart_request = state.get("chart_request")
-    chart_type = state.get("chart_type")
     complexity = state.get("complexity", {})
 
-    # Trích xuất ticker (gộp logic từ alias_resolver)
-    ticker = extract_ticker(question)
+    # Ticker đã trích xuất ở question_classifier (gồm cả ticker understanding
+    # call nhận ra khi regex không thấy)
+    ticker = entities_from_state(state).ticker
 
     # Kiểm tra nếu câu hỏi về tất cả DJIA companies
     q = normalize_text(question)
@@ -115,24 +173,75 @@ def match_sql_template(state: Dict[str, Any]) -> Dict[str, Any]:
     )
 
     if needs_chart:
-        sql = build_chart_sql(question, chart_type, chart_request, ticker)
-        return {**state, "ticker": ticker, "sql": sql, "used_sample": False}
+        return {"ticker": ticker, "result": None, "chart": True}
 
     # Nếu câu hỏi về tất cả companies, force dùng LLM thay vì template
     if is_all_companies:
         return {
-            **state,
             "ticker": None,
-            "sql": None,
-            "used_sample": False,
-            "force_llm": True,
+            "result": {
+                **state,
+                "ticker": None,
+                "sql": None,
+                "used_sample": False,
+                "force_llm": True,
+            },
         }
 
     if state.get("force_llm"):
-        return {**state, "ticker": ticker, "sql": None, "used_sample": False}
+        return {
+            "ticker": ticker,
+            "result": {**state, "ticker": ticker, "sql": None, "used_sample": False},
+        }
+
+    return {"ticker": ticker, "result": None, "chart": False}
+
+
+def match_sql_template(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Trích xuất ticker và tìm SQL template phù hợp với câu hỏi."""
+    route = _route_template(state)
+    if route["result"] is not None:
+        return route["result"]
+
+    question = state.get("question", "")
+    ticker = route["ticker"]
+    if route["chart"]:
+        sql = build_chart_sql(
+            question, state.get("chart_type"), state.get("chart_request"), ticker
+        )
+        return {**state, "ticker": ticker, "sql": sql, "used_sample": False}
+
+    # Tìm SQL template (chỉ khi không phải all companies); understanding đã
+    # chọn template thì không tìm/gọi LLM lại
+    understanding = state.get("understanding") or {}
+    if understanding.get("template_checked"):
+        sql = understanding.get("template_sql")
+    else:
+        sql = match_sample(question)
+    used_sample = sql is not None
+
+    return {**state, "ticker": ticker, "sql": sql, "used_sample": used_sample}
+
+
+async def amatch_sql_template(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của match_sql_template."""
+    route = _route_template(state)
+    if route["result"] is not None:
+        return route["result"]
+
+    question = state.get("question", "")
+    ticker = route["ticker"]
+    if route["chart"]:
+        sql = await abuild_chart_sql(
+            question, state.get("chart_type"), state.get("chart_request"), ticker
+        )
+        return {**state, "ticker": ticker, "sql": sql, "used_sample": False}
 
-    # Tìm SQL template (chỉ khi không phải all companies)
-    sql = match_sample(question)
+    understanding = state.get("understanding") or {}
+    if understanding.get("template_checked"):
+        sql = understanding.get("template_sql")
+    else:
+        sql = await amatch_sample(question)
     used_sample = sql is not None
 
     return {**state, "ticker": ticker, "sql": sql, "used_sample": used_sample}
@@ -0,0 +1,236 @@
+"""
+SQL Validator Node - Kiểm tra SQL do LLM sinh tại chỗ trước khi thực thi.
+
+SQL sai của LLM (sai cú pháp, bảng/cột không tồn tại, thiếu bind parameter)
+trước đây chỉ lộ ra trong PostgreSQL, sau khi đã lấy connection và mất một
+round trip. Node validate_sql nằm giữa generate_sql và execute_sql, parse SQL
+bằng sqlglot (dialect postgres) và:
+
+1. Chỉ cho phép một câu lệnh đọc dữ liệu (SELECT/WITH/UNION); câu lệnh ghi
+   (INSERT/UPDATE/DELETE/DDL, SELECT INTO) bị chặn hẳn
+2. Kiểm tra bảng và cột theo COMPANIES_TABLE_SCHEMA / PRICES_TABLE_SCHEMA
+   (CTE, subquery, alias được resolve bởi sqlglot.optimizer.qualify)
+3. Kiểm tra mọi bind parameter (:ticker, :date, ...) có giá trị trong params
+   của build_params
+4. Thêm LIMIT SQL_MAX_ROWS nếu câu lệnh ngoài cùng chưa giới hạn số dòng
+   (bỏ qua câu lệnh chỉ trả về một dòng aggregate)
+
+Kết quả ghi vào state["sql_validation"]:
+    {"valid": False, "errors": ["Bảng không tồn tại: stocks ..."], "blocked": False}
+SQL không hợp lệ được gửi lại generate_sql kèm feedback (vòng sửa SQL giới
+hạn bởi SQL_REPAIR_MAX_ATTEMPTS, xem graphs/djia_graph.py); SQL mẫu trong
+sql_samples.sql không đi qua node này.
+
+Usage:
+    result = check_sql("SELECT close FROM prices WHERE ticker = :ticker;", {"ticker": "AAPL"})
+    result.valid, result.sql
+    # (True, "SELECT close FROM prices WHERE ticker = :ticker\\nLIMIT 10000;")
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import OptimizeError, ParseError
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.tokens import TokenType
+
+from config import (
+    COMPANIES_TABLE_SCHEMA,
+    PRICES_TABLE_SCHEMA,
+    SQL_MAX_ROWS,
+    SQL_VALIDATION_ENABLED,
+)
+from nodes.sql_executor import build_params
+from nodes.sql_shape_cache import forget_sql
+
+_DIALECT = "postgres"
+
+# Node ghi dữ liệu (kể cả trong CTE: WITH d AS (DELETE ... RETURNING *) SELECT ...)
+_WRITE_NODES = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Into)
+
+
+def _parse_schema(*ddls: str) -> Dict[str, Dict[str, str]]:
+    """{bảng: {cột: kiểu}} từ các câu CREATE TABLE trong config.py."""
+    schema: Dict[str, Dict[str, str]] = {}
+    for ddl in ddls:
+        table = sqlglot.parse_one(ddl, read=_DIALECT).this
+        schema[table.this.name] = {
+            column.name: column.args["kind"].sql(_DIALECT)
+            for column in table.expressions
+            if isinstance(column, exp.ColumnDef)
+        }
+    return schema
+
+
+TABLE_SCHEMA = _parse_schema(COMPANIES_TABLE_SCHEMA, PRICES_TABLE_SCHEMA)
+
+
+@dataclass
+class SqlValidation:
+    """Kết quả kiểm tra: SQL (đã thêm LIMIT nếu hợp lệ) và các lỗi."""
+
+    sql: str
+    errors: List[str] = field(default_factory=list)
+    # Không được gửi tới PostgreSQL kể cả khi đã hết lượt sửa (câu lệnh ghi)
+    blocked: bool = False
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+
+def check_sql(sql: str, params: Dict[str, Any], max_rows: int = SQL_MAX_ROWS) -> SqlValidation:
+    """
+    Kiểm tra SQL với schema và bind parameters.
+
+    Args:
+        sql: SQL do LLM sinh (bind parameters dạng :name)
+        params: Parameters sẽ bind (build_params)
+        max_rows: LIMIT thêm vào nếu SQL chưa giới hạn số dòng (0 = không thêm)
+
+    Returns:
+        SqlValidation; errors viết để gửi lại cho LLM làm feedback
+    """
+    try:
+        statements = [
+            s
+            for s in sqlglot.parse(sql, read=_DIALECT)
+            # Comment sau dấu ; cuối cùng được parse thành Semicolon rỗng
+            if s is not None and not isinstance(s, exp.Semicolon)
+        ]
+    except ParseError as e:
+        return SqlValidation(sql, [f"Lỗi cú pháp SQL: {str(e).splitlines()[0]}"])
+    if len(statements) != 1:
+        return SqlValidation(sql, ["Chỉ được có đúng một câu lệnh SQL"], blocked=True)
+
+    tree = statements[0]
+    if not isinstance(tree, exp.Query) or tree.find(*_WRITE_NODES):
+        return SqlValidation(
+            sql, ["Chỉ được dùng câu lệnh SELECT (không ghi/sửa dữ liệu)"], blocked=True
+        )
+
+    errors = _check_tables(tree)
+    if not errors:
+        errors = _check_columns(tree)
+    errors += _check_params(tree, params)
+    if errors:
+        return SqlValidation(sql, errors)
+    return SqlValidation(_with_limit(sql, tree, max_rows))
+
+
+def _schema_hint() -> str:
+    return "; ".join(f"{table}({', '.join(columns)})" for table, columns in TABLE_SCHEMA.items())
+
+
+def _check_tables(tree: exp.Expression) -> List[str]:
+    cte_names = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+    unknown = []
+    for table in tree.find_all(exp.Table):
+        # Table function (generate_series(...)) không có tên bảng
+        if table.name and table.name not in TABLE_SCHEMA and table.name not in cte_names:
+            unknown.append(table.name)
+    if not unknown:
+        return []
+    return [
+        f"Bảng không tồn tại: {', '.join(dict.fromkeys(unknown))}"
+        f" (chỉ có bảng {', '.join(TABLE_SCHEMA)})"
+    ]
+
+
+def _check_columns(tree: exp.Expression) -> List[str]:
+    try:
+        qualify(
+            tree.copy(),
+            schema=TABLE_SCHEMA,
+            dialect=_DIALECT,
+            validate_qualify_columns=True,
+            quote_identifiers=False,
+        )
+    except OptimizeError as e:
+        return [f"Cột không hợp lệ: {str(e).splitlines()[0]}. Schema: {_schema_hint()}"]
+    except Exception as e:
+        # Cú pháp sqlglot chưa hỗ trợ resolve: để PostgreSQL quyết định
+        print(f"Error qualifying SQL columns: {e}")
+    return []
+
+
+def _check_params(tree: exp.Expression, params: Dict[str, Any]) -> List[str]:
+    names = dict.fromkeys(p.name for p in tree.find_all(exp.Placeholder) if p.name)
+    missing = [name for name in names if params.get(name) is None]
+    if not missing:
+        return []
+    available = [f":{name}" for name, value in params.items() if value is not None]
+    return [
+        f"Không có giá trị cho tham số: {', '.join(':' + name for name in missing)}"
+        f" (câu hỏi chỉ có: {', '.join(available) or 'không có tham số nào'})"
+    ]
+
+
+def _returns_single_row(tree: exp.Expression) -> bool:
+    """SELECT aggregate không GROUP BY (luôn trả về đúng một dòng)."""
+    return (
+        isinstance(tree, exp.Select)
+        and not tree.args.get("group")
+        and bool(tree.expressions)
+        and all(
+            projection.find(exp.AggFunc) is not None and projection.find(exp.Window) is None
+            for projection in tree.expressions
+        )
+    )
+
+
+def _with_limit(sql: str, tree: exp.Expression, max_rows: int) -> str:
+    """Thêm LIMIT vào cuối SQL (giữ nguyên SQL gốc, chỉ bỏ dấu ; và comment cuối)."""
+    if max_rows <= 0 or tree.args.get("limit") or tree.args.get("fetch"):
+        return sql
+    if _returns_single_row(tree):
+        return sql
+    tokens = [
+        token
+        for token in sqlglot.tokenize(sql, read=_DIALECT)
+        if token.token_type != TokenType.SEMICOLON
+    ]
+    if not tokens:
+        return sql
+    return f"{sql[: tokens[-1].end + 1].rstrip()}\nLIMIT {max_rows};"
+
+
+def validate_sql(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    LangGraph Node: Kiểm tra SQL do LLM sinh trước khi execute_sql.
+
+    Returns:
+        State mới với:
+        - sql_validation: {"valid", "errors", "blocked"}
+        - sql: SQL đã thêm LIMIT (nếu hợp lệ)
+        - error / feedback: lỗi để generate_sql sửa lại (nếu không hợp lệ)
+    """
+    sql = state.get("sql") or ""
+    if not SQL_VALIDATION_ENABLED or not sql:
+        return state
+
+    params = build_params(state.get("question", ""), state.get("ticker"), state)
+    result = check_sql(sql, params)
+    validation = {"valid": result.valid, "errors": result.errors, "blocked": result.blocked}
+    if result.valid:
+        return {**state, "sql": result.sql, "sql_validation": validation}
+
+    # SQL lấy từ shape cache không còn đúng: lần sau sinh lại bằng LLM
+    forget_sql(state)
+    error = "; ".join(result.errors)
+    return {
+        **state,
+        "sql_validation": validation,
+        "df": pd.DataFrame(),
+        "actual_sql": sql,
+        "error": error,
+        "feedback": f"{error}. SQL: {sql}",
+    }
+
+
+async def avalidate_sql(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Phiên bản async của validate_sql (chỉ parse tại chỗ, không I/O)."""
+    return validate_sql(state)
@@ -0,0 +1,145 @@
+"""
+Template Index - Vector index local của các câu hỏi mẫu trong sql_samples.sql.
+
+Mỗi SqlTemplate (nodes.template_registry) có câu hỏi mẫu bằng hai ngôn ngữ:
+    -- MẪU CÂU HỎI: Giá đóng cửa của {company} vào {date}
+    -- EN: What was the closing price of {company} on {date}?
+
+Các câu hỏi này được embed một lần (cùng embedding model với RAG) thành ma
+trận vector đã chuẩn hoá. Khi có câu hỏi, giá trị cụ thể (tên công ty, ngày,
+năm, quý) được thay bằng placeholder giống trong header rồi tìm nearest
+neighbour bằng cosine similarity, không cần gọi LLM.
+
+Usage:
+    index = get_runtime().template_index
+    candidates = index.search("What was Apple's closing price on 2024-01-15?", top_k=5)
+    # [(SqlTemplate, score), ...] giảm dần theo score
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from nodes.template_registry import SqlTemplate
+from nodes.utils import find_companies, normalize_text
+
+_MONTHS = (
+    r"(?:january|february|march|april|may|june|july|august|september|october"
+    r"|november|december)"
+)
+
+# Thứ tự quan trọng: ngày đầy đủ phải được thay trước năm
+_MASKS = [
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}\b"), "{date}"),
+    (re.compile(rf"\b{_MONTHS}\s+\d{{1,2}},?\s*\d{{4}}\b"), "{date}"),
+    (re.compile(r"\b\d{1,2}/\d{1,2}/\d{4}\b"), "{date}"),
+    (re.compile(r"\bq([1-4])\b"), "q{quarter}"),
+    (re.compile(r"\bquý\s*([1-4])\b"), "quý {quarter}"),
+    (re.compile(r"\b(?:19|20)\d{2}\b"), "{year}"),
+]
+
+# Alias ngắn (ví dụ "v", "ko", "ba") dễ trùng từ thường nên không mask
+_MIN_ALIAS_LENGTH = 3
+
+
+def _mask_companies(text: str) -> str:
+    # Automaton alias + fuzzy index (nodes/company_matcher.py)
+    parts: List[str] = []
+    position = 0
+    for match in find_companies(text):
+        if len(match.alias) < _MIN_ALIAS_LENGTH:
+            continue
+        parts.append(text[position : match.start])
+        parts.append("{company}")
+        position = match.end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def mask_question(question: str) -> str:
+    """
+    Thay giá trị cụ thể trong câu hỏi bằng placeholder của header template.
+
+    Examples:
+        >>> mask_question("What was Apple's closing price on 2024-01-15?")
+        "what was {company}'s closing price on {date}?"
+    """
+    masked = normalize_text(question)
+    for pattern, placeholder in _MASKS:
+        masked = pattern.sub(placeholder, masked)
+    return _mask_companies(masked)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Chuẩn hoá mỗi dòng về độ dài 1 (dòng toàn 0 giữ nguyên)."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TemplateIndex:
+    """
+    Ma trận embedding của các câu hỏi mẫu, mỗi dòng trỏ về một SqlTemplate.
+
+    Một template có nhiều dòng (mỗi ngôn ngữ một dòng); điểm của template là
+    điểm cao nhất trong các dòng của nó. Index giữ chính tuple templates đã
+    dùng để build, nên kết quả search luôn khớp với index kể cả khi registry
+    vừa reload.
+    """
+
+    def __init__(self, templates: Sequence[SqlTemplate], embedding_function):
+        self._embedding_function = embedding_function
+        self.templates = templates
+        texts: List[str] = []
+        owners: List[int] = []
+        for position, template in enumerate(templates):
+            for question in template.questions:
+                texts.append(question.lower())
+                owners.append(position)
+
+        self._owners = np.asarray(owners, dtype=np.int64)
+        self._vectors = (
+            self._embed(texts) if texts else np.zeros((0, 0), dtype=np.float32)
+        )
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return normalize_rows(
+            np.asarray(self._embedding_function(texts), dtype=np.float32)
+        )
+
+    def search(self, question: str, top_k: int = 5) -> List[Tuple[SqlTemplate, float]]:
+        """
+        Tìm các SQL template gần nhất với câu hỏi.
+
+        Returns:
+            List (SqlTemplate, cosine similarity) của tối đa top_k template
+            khác nhau, giảm dần theo similarity.
+        """
+        if not len(self._owners):
+            return []
+
+        query = self._embed([mask_question(question)])[0]
+        scores = self._vectors @ query
+
+        best: Dict[int, float] = {}
+        for row in np.argsort(-scores):
+            owner = int(self._owners[row])
+            if owner not in best:
+                best[owner] = float(scores[row])
+                if len(best) >= top_k:
+                    break
+        return [(self.templates[owner], score) for owner, score in best.items()]
+
+
+def build_template_index(
+    templates: Sequence[SqlTemplate], embedding_function
+) -> Optional[TemplateIndex]:
+    """Build TemplateIndex, trả về None nếu chưa có embedding function."""
+    if embedding_function is None or not templates:
+        return None
+    try:
+        return TemplateIndex(templates, embedding_function)
+    except Exception as e:
+        print(f"Error building template index: {e}")
+        return None
@@ -0,0 +1,256 @@
+"""
+Template Promotion - Đưa SQL do LLM sinh đã chạy tốt vào sql_samples.sql.
+
+SQL mẫu trong sql_samples.sql trả lời nhanh (không cần LLM sinh SQL), nhưng
+bộ mẫu viết tay cố định. Module này cho bộ mẫu lớn dần theo traffic thật:
+
+1. Thu thập: mỗi lần SQL do LLM sinh (hoặc lấy từ SQL shape cache) chạy
+   thành công và có dữ liệu, execute_sql gọi record_candidate() để ghi một
+   dòng JSONL vào TEMPLATE_CANDIDATES_FILE:
+       {"question": ..., "shape": ..., "sql": ..., "fields": [...], "created_at": ...}
+   Chỉ ghi SQL không viết cứng giá trị của câu hỏi (sql_shape_cache.is_reusable).
+2. Gom nhóm: cluster_candidates() gom các dòng theo SQL đã chuẩn hoá (bỏ
+   comment, khoảng trắng, chữ hoa/thường); mỗi cluster đếm số câu hỏi khác
+   nhau và các dạng câu hỏi (mask_question) đã dùng SQL đó.
+3. Promote: `python manage.py promote_templates` thêm các cluster có ít nhất
+   TEMPLATE_PROMOTION_MIN_QUESTIONS câu hỏi (và chưa có trong sql_samples.sql)
+   vào cuối file, dưới dòng phân loại "-- PROMOTED, AUTO":
+
+       -- EN: What was the 30-day volatility of {company} in {year}?
+       -- FIELDS: volatility
+       SELECT ... WHERE ticker = :ticker AND ...;
+
+   TemplateRegistry tự parse lại file khi mtime đổi, nên match_sql_template
+   dùng template mới ngay ở request tiếp theo, không cần restart.
+
+Mọi worker cùng append vào file JSONL trong khi promote_templates viết lại
+file: cả hai giữ flock trên file "<candidates>.lock" (lock của file dữ liệu
+không đủ vì prune_candidates thay file bằng os.replace, inode đổi).
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import pandas as pd
+
+from config import TEMPLATE_CANDIDATES_ENABLED, TEMPLATE_CANDIDATES_FILE
+from nodes.sql_normalizer import canonical_sql
+from nodes.sql_shape_cache import is_reusable, question_shape
+from nodes.template_registry import SqlTemplate
+from nodes.utils import is_vietnamese, normalize_text
+
+PROMOTED_CATEGORY = "PROMOTED, AUTO"
+
+_write_lock = threading.Lock()
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ lock trong process
+    fcntl = None
+
+
+@contextmanager
+def _locked(path: Path):
+    """Lock ghi file candidates cho cả thread trong process lẫn các worker khác."""
+    with _write_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.with_name(path.name + ".lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# ==================== THU THẬP ====================
+
+
+def record_candidate(
+    state: Dict[str, Any], df: pd.DataFrame, path: Optional[Path] = None
+) -> None:
+    """Ghi lại SQL do LLM sinh vừa chạy thành công (bỏ qua nếu không đủ điều kiện)."""
+    if not TEMPLATE_CANDIDATES_ENABLED:
+        return
+    if state.get("sql_source") not in ("llm", "shape_cache") or df is None or df.empty:
+        return
+    sql = state.get("sql") or ""
+    if not sql or not is_reusable(sql, state):
+        return
+
+    question = state.get("question", "")
+    line = json.dumps(
+        {
+            "question": question,
+            "shape": state.get("sql_shape") or question_shape(question),
+            "sql": sql,
+            "fields": [str(column) for column in df.columns],
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+        ensure_ascii=False,
+    )
+    path = Path(path or TEMPLATE_CANDIDATES_FILE)
+    try:
+        with _locked(path):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        print(f"Error recording SQL template candidate: {e}")
+
+
+def load_candidates(path: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """Đọc các dòng đã ghi (bỏ qua dòng hỏng)."""
+    path = Path(path or TEMPLATE_CANDIDATES_FILE)
+    if not path.exists():
+        return []
+    candidates = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        try:
+            candidate = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(candidate, dict) and candidate.get("sql"):
+            candidates.append(candidate)
+    return candidates
+
+
+# ==================== GOM NHÓM ====================
+
+
+def normalize_sql(sql: str) -> str:
+    """Key để gom nhóm: canonical_sql (cùng truy vấn, khác cách viết -> cùng key)."""
+    return canonical_sql(sql)
+
+
+@dataclass
+class CandidateCluster:
+    """Các lần chạy thành công của cùng một SQL (đã chuẩn hoá)."""
+
+    key: str
+    sql: str
+    questions: set = field(default_factory=set)
+    shapes: Counter = field(default_factory=Counter)
+    fields: tuple = ()
+
+    @property
+    def count(self) -> int:
+        return len(self.questions)
+
+    def question_for(self, vietnamese: bool) -> Optional[str]:
+        """Dạng câu hỏi phổ biến nhất của một ngôn ngữ (viết hoa chữ cái đầu)."""
+        for shape, _ in self.shapes.most_common():
+            if is_vietnamese(shape) == vietnamese:
+                return shape[:1].upper() + shape[1:]
+        return None
+
+
+def cluster_candidates(candidates: Iterable[Dict[str, Any]]) -> List[CandidateCluster]:
+    """Gom candidate theo SQL đã chuẩn hoá, cluster nhiều câu hỏi nhất trước."""
+    clusters: Dict[str, CandidateCluster] = {}
+    for candidate in candidates:
+        key = normalize_sql(candidate["sql"])
+        cluster = clusters.get(key)
+        if cluster is None:
+            cluster = clusters[key] = CandidateCluster(key=key, sql=candidate["sql"].strip())
+        cluster.questions.add(normalize_text(candidate.get("question", "")))
+        if candidate.get("shape"):
+            cluster.shapes[candidate["shape"]] += 1
+        if candidate.get("fields"):
+            cluster.fields = tuple(candidate["fields"])
+    return sorted(clusters.values(), key=lambda cluster: -cluster.count)
+
+
+def select_promotions(
+    clusters: Sequence[CandidateCluster],
+    templates: Sequence[SqlTemplate],
+    min_questions: int,
+) -> List[CandidateCluster]:
+    """
+    Cluster đủ điều kiện thành SQL mẫu: đủ số câu hỏi, có dạng câu hỏi làm
+    header, là một câu lệnh duy nhất và chưa có trong sql_samples.sql.
+    """
+    existing = {normalize_sql(template.sql) for template in templates}
+    selected = []
+    for cluster in clusters:
+        if cluster.count < min_questions or cluster.key in existing:
+            continue
+        if not cluster.shapes:
+            continue
+        # sql_samples.sql tách statement theo dấu ; cuối dòng
+        if ";" in cluster.sql.rstrip().rstrip(";"):
+            continue
+        selected.append(cluster)
+    return selected
+
+
+# ==================== PROMOTE ====================
+
+
+def format_template(cluster: CandidateCluster) -> str:
+    """Một entry của sql_samples.sql (header comment + SQL)."""
+    lines = []
+    question_vi = cluster.question_for(vietnamese=True)
+    question_en = cluster.question_for(vietnamese=False)
+    if question_vi:
+        lines.append(f"-- MẪU CÂU HỎI: {question_vi}")
+    if question_en:
+        lines.append(f"-- EN: {question_en}")
+    if cluster.fields:
+        lines.append(f"-- FIELDS: {', '.join(cluster.fields)}")
+    sql_lines = [
+        line.rstrip()
+        for line in cluster.sql.splitlines()
+        if line.strip() and not line.strip().startswith("--")
+    ]
+    lines.append("\n".join(sql_lines).rstrip().rstrip(";") + ";")
+    return "\n".join(lines)
+
+
+def append_templates(path: Path, clusters: Sequence[CandidateCluster]) -> int:
+    """Thêm các cluster vào cuối sql_samples.sql. Trả về số template đã thêm."""
+    if not clusters:
+        return 0
+    path = Path(path)
+    text = path.read_text(encoding="utf-8") if path.exists() else ""
+    parts = []
+    if not re.search(rf"^--\s*{re.escape(PROMOTED_CATEGORY)}\s*$", text, re.M):
+        parts.append(f"-- {PROMOTED_CATEGORY}")
+    parts.extend(format_template(cluster) for cluster in clusters)
+    # Một dòng trống giữa entry cuối hiện có và phần thêm vào
+    separator = "" if not text else ("\n" if text.endswith("\n") else "\n\n")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(separator + "\n\n".join(parts) + "\n")
+    return len(clusters)
+
+
+def prune_candidates(path: Path, promoted_keys: Iterable[str]) -> None:
+    """Bỏ các candidate đã thành SQL mẫu khỏi file JSONL."""
+    promoted = set(promoted_keys)
+    if not promoted:
+        return
+    path = Path(path)
+    with _locked(path):
+        remaining = [
+            json.dumps(candidate, ensure_ascii=False)
+            for candidate in load_candidates(path)
+            if normalize_sql(candidate["sql"]) not in promoted
+        ]
+        # Ghi file tạm rồi os.replace: người đọc không thấy file ghi dở
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("".join(line + "\n" for line in remaining))
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
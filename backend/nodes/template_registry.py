@@ -0,0 +1,167 @@
+"""
+Template Registry - SQL samples đã parse thành đối tượng có cấu trúc.
+
+sql_samples.sql được đọc và parse một lần thành các SqlTemplate, giữ lại
+metadata trong comment của từng template:
+
+    -- FACTUAL, EASY                                  -> category
+    -- MẪU CÂU HỎI: Giá đóng cửa của {company} vào {date}   -> question_vi
+    -- EN: What was the closing price of {company} on {date}? -> question_en
+    -- FIELDS: answer=close                           -> fields ("close",)
+    SELECT close FROM prices WHERE ticker = :ticker ... -> params ("ticker", "date")
+
+Registry chỉ parse lại khi mtime của file thay đổi (sửa template không cần
+restart server). Matcher, executor và summarizer tra metadata theo SQL bằng
+for_sql() (dict lookup).
+
+Usage:
+    registry = get_runtime().template_registry
+    template = registry.for_sql(state["sql"])
+    if template is not None:
+        print(template.params, template.fields)
+"""
+
+import os
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Tách statement theo dấu ; cuối dòng (giống cách load SQL samples trước đây)
+_STATEMENT_SPLIT_RE = re.compile(r";\s*\n")
+_QUESTION_VI_RE = re.compile(r"^--\s*MẪU CÂU HỎI\s*:\s*(.+)$", re.M)
+_QUESTION_EN_RE = re.compile(r"^--\s*EN\s*:\s*(.+)$", re.M)
+_FIELDS_RE = re.compile(r"^--\s*FIELDS\s*:\s*(.+)$", re.M)
+# Dòng phân loại, ví dụ "-- FACTUAL, EASY" hoặc "-- COMPARATIVE, HARD"
+_CATEGORY_RE = re.compile(r"^--\s*([A-Z]+,\s*[A-Z]+)\s*$", re.M)
+# Bind parameter :name (bỏ qua ép kiểu ::date)
+_PARAM_RE = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+@dataclass(frozen=True)
+class SqlTemplate:
+    """Một SQL sample cùng metadata parse từ comment header."""
+
+    id: int
+    sql: str
+    params: Tuple[str, ...]
+    fields: Tuple[str, ...]
+    question_vi: Optional[str] = None
+    question_en: Optional[str] = None
+    category: Optional[str] = None
+
+    @property
+    def questions(self) -> List[str]:
+        """Các câu hỏi mẫu (VI, EN) có trong header."""
+        return [q for q in (self.question_vi, self.question_en) if q]
+
+
+def _strip_comments(sql: str) -> str:
+    return "\n".join(
+        line for line in sql.splitlines() if not line.strip().startswith("--")
+    )
+
+
+def _parse_fields(raw: str) -> Tuple[str, ...]:
+    # "answer=close" -> "close"; "company, ticker, avg_close" -> 3 fields
+    fields = []
+    for item in raw.split(","):
+        name = item.split("=")[-1].strip()
+        if name:
+            fields.append(name)
+    return tuple(fields)
+
+
+def _first(pattern: re.Pattern, text: str) -> Optional[str]:
+    match = pattern.search(text)
+    return match.group(1).strip() if match else None
+
+
+def parse_templates(text: str) -> List[SqlTemplate]:
+    """Parse nội dung sql_samples.sql thành danh sách SqlTemplate."""
+    templates: List[SqlTemplate] = []
+    category = None
+    for chunk in _STATEMENT_SPLIT_RE.split(text):
+        if not chunk.strip():
+            continue
+        sql = chunk.strip() + ";"
+
+        # Dòng phân loại áp dụng cho các template phía sau cho tới dòng phân loại kế tiếp
+        categories = _CATEGORY_RE.findall(chunk)
+        if categories:
+            category = categories[-1]
+
+        params = dict.fromkeys(_PARAM_RE.findall(_strip_comments(sql)))
+        fields = _first(_FIELDS_RE, sql)
+        templates.append(
+            SqlTemplate(
+                id=len(templates),
+                sql=sql,
+                params=tuple(params),
+                fields=_parse_fields(fields) if fields else (),
+                question_vi=_first(_QUESTION_VI_RE, sql),
+                question_en=_first(_QUESTION_EN_RE, sql),
+                category=category,
+            )
+        )
+    return templates
+
+
+class TemplateRegistry:
+    """
+    Danh sách SqlTemplate của một file, tự parse lại khi mtime thay đổi.
+
+    templates trả về tuple bất biến: một lần reload tạo tuple mới, nên các
+    cache dựng từ tuple cũ (ví dụ TemplateIndex) biết khi nào cần build lại.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._templates: Tuple[SqlTemplate, ...] = ()
+        self._by_sql: Dict[str, SqlTemplate] = {}
+
+    def _current_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _refresh(self) -> None:
+        mtime = self._current_mtime()
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            if mtime is None:
+                templates = ()
+            else:
+                templates = tuple(parse_templates(self.path.read_text(encoding="utf-8")))
+            self._by_sql = {t.sql.strip(): t for t in templates}
+            self._templates = templates
+            self._mtime = mtime
+
+    @property
+    def templates(self) -> Tuple[SqlTemplate, ...]:
+        self._refresh()
+        return self._templates
+
+    @property
+    def sql_samples(self) -> List[str]:
+        return [t.sql for t in self.templates]
+
+    def get(self, template_id: int) -> Optional[SqlTemplate]:
+        templates = self.templates
+        if 0 <= template_id < len(templates):
+            return templates[template_id]
+        return None
+
+    def for_sql(self, sql: Optional[str]) -> Optional[SqlTemplate]:
+        """SqlTemplate có SQL trùng với sql (None nếu sql không phải SQL mẫu)."""
+        if not sql:
+            return None
+        self._refresh()
+        return self._by_sql.get(sql.strip())
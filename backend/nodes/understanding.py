@@ -0,0 +1,238 @@
+"""
+Understanding - Một lời gọi LLM thay cho classify + plan + chọn SQL mẫu.
+
+Trước đây một câu hỏi dữ liệu có thể cần tới ba lời gọi Gemini ở giai đoạn
+phân tích, mỗi lời gọi gửi lại câu hỏi và ngữ cảnh:
+- question_classifier: SQL hay OTHER
+- planner.create_execution_plan: execution plan cho câu hỏi multi-step
+- sql_template_matcher.validate_and_find_sql_with_llm: chọn SQL mẫu
+
+Node question_classifier giờ chuẩn bị trước phần không cần LLM (độ phức tạp
+bằng regex, tìm template bằng vector index) rồi, chỉ khi còn điều cần LLM
+quyết định, gửi MỘT prompt trả về JSON:
+
+    {
+        "route": "SQL",
+        "complexity": {"is_multi_step": false, "is_comparison": false, ...},
+        "chart_type": null,
+        "entities": {"tickers": ["AAPL"], "dates": ["2024-01-15"], "year": "2024", "quarter": null},
+        "steps": [],
+        "template": 3
+    }
+
+Kết quả được lưu ở state["understanding"]; planner và matcher đọc từ đó thay
+vì tự gọi LLM:
+    {
+        "source": "llm" | "local",
+        "route": "SQL" | "OTHER",
+        "complexity": {...},      # cờ độ phức tạp (regex, cộng thêm cờ của LLM)
+        "chart_type": ...,
+        "entities": {...},
+        "steps": [...],           # execution plan (câu hỏi multi-step)
+        "template_checked": bool, # đã tìm SQL mẫu chưa
+        "template_sql": ...,      # SQL mẫu đã chọn (None nếu không có)
+    }
+"""
+
+import json
+import re
+from typing import Any, Dict, Optional
+
+from nodes.llm import generate_text, agenerate_text
+from nodes.planner import detect_query_complexity
+from nodes.sql_template_matcher import search_templates
+
+COMPLEXITY_FLAGS = (
+    "is_multi_step",
+    "is_comparison",
+    "is_aggregation",
+    "is_statistical",
+    "time_series",
+    "involves_multiple_companies",
+)
+CHART_TYPES = ("line", "candlestick", "bar", "pie", "scatter", "heatmap", "volume", "comparison")
+
+_TICKER_RE = re.compile(r"^[A-Z]{1,5}$")
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def prepare_understanding(question: str, force_chart: bool = False) -> Dict[str, Any]:
+    """
+    Phần phân tích không cần LLM: độ phức tạp (regex) và SQL mẫu (vector index).
+
+    Câu hỏi cần biểu đồ hoặc liên quan nhiều công ty không dùng SQL mẫu
+    (matcher build chart SQL / sinh SQL bằng LLM), nên không tìm template.
+    """
+    complexity = detect_query_complexity(question, force_chart=force_chart)
+    needs_template = not (
+        complexity["needs_chart"] or complexity["involves_multiple_companies"]
+    )
+    template_sql, candidates = (
+        search_templates(question) if needs_template else (None, [])
+    )
+    return {
+        "complexity": complexity,
+        "needs_template": needs_template,
+        "template_sql": template_sql,
+        "candidates": candidates,
+    }
+
+
+def needs_llm(prepared: Dict[str, Any]) -> bool:
+    """Còn cần LLM không: execution plan hoặc chọn SQL mẫu trong các ứng viên."""
+    if prepared["complexity"]["is_multi_step"]:
+        return True
+    return (
+        prepared["needs_template"]
+        and prepared["template_sql"] is None
+        and bool(prepared["candidates"])
+    )
+
+
+def local_understanding(route: str, prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """Understanding chỉ từ phần đã chuẩn bị (không gọi LLM)."""
+    return {
+        "source": "local",
+        "route": route,
+        "complexity": prepared["complexity"],
+        "chart_type": prepared["complexity"].get("chart_type"),
+        "entities": {},
+        "steps": [],
+        "template_checked": prepared["needs_template"],
+        "template_sql": prepared["template_sql"],
+    }
+
+
+def _build_understanding_prompt(question: str, prepared: Dict[str, Any]) -> str:
+    complexity = prepared["complexity"]
+    detected = "\n".join(f"- {flag}: {complexity[flag]}" for flag in COMPLEXITY_FLAGS)
+
+    template_section = ""
+    template_rule = '- "template": luôn là null'
+    if prepared["template_sql"] is None and prepared["candidates"]:
+        samples_text = "\n".join(
+            f"{i + 1}. {sql}" for i, sql in enumerate(prepared["candidates"])
+        )
+        template_section = f"\nDANH SÁCH SQL MẪU:\n{samples_text}\n"
+        template_rule = (
+            '- "template": index (bắt đầu từ 1) của SQL mẫu chỉ khi cấu trúc, field SELECT, '
+            "điều kiện WHERE và parameters (:ticker, :date, ...) hoàn toàn khớp với câu hỏi; "
+            "không chọn SQL chỉ \"gần giống\", khi đó trả về null"
+        )
+
+    return f"""Bạn là bộ phân tích câu hỏi của hệ thống thông tin tài chính DJIA
+(PostgreSQL chứa giá cổ phiếu, cổ tức, stock split và thông tin 30 công ty DJIA;
+tài liệu PDF cho câu hỏi kiến thức).
+
+CÂU HỎI: {question}
+
+Độ phức tạp phát hiện bằng từ khoá (có thể chưa đầy đủ):
+{detected}
+{template_section}
+Trả về DUY NHẤT một JSON object (không markdown, không giải thích):
+{{
+  "route": "SQL" hoặc "OTHER",
+  "complexity": {{"is_multi_step": bool, "is_comparison": bool, "is_aggregation": bool,
+                 "is_statistical": bool, "time_series": bool, "involves_multiple_companies": bool}},
+  "chart_type": null hoặc một trong {list(CHART_TYPES)},
+  "entities": {{"tickers": ["AAPL"], "dates": ["YYYY-MM-DD"], "year": "YYYY" hoặc null, "quarter": 1-4 hoặc null}},
+  "steps": [{{"step_number": 1, "description": "...", "sql_needed": true, "chart_needed": false}}],
+  "template": số hoặc null
+}}
+
+QUY TẮC:
+- "route": SQL nếu câu hỏi cần dữ liệu cụ thể (giá, volume, số liệu, so sánh, biểu đồ,
+  theo ngày tháng, ticker cụ thể); OTHER nếu hỏi khái niệm, định nghĩa, giải thích,
+  kiến thức tổng quát hoặc nội dung báo cáo
+- "chart_type": chỉ khi câu hỏi yêu cầu vẽ biểu đồ
+- "entities": ticker của các công ty được nhắc tới, ngày dạng YYYY-MM-DD
+- "steps": các bước thực thi nếu câu hỏi cần nhiều bước (thống kê, nhiều công ty,
+  vừa so sánh vừa tổng hợp), ngược lại []
+{template_rule}"""
+
+
+def _strip_code_fence(text: str) -> str:
+    # Xử lý markdown code blocks nếu LLM trả về
+    if "```json" in text:
+        return text.split("```json")[1].split("```")[0].strip()
+    if "```" in text:
+        return text.split("```")[1].split("```")[0].strip()
+    return text.strip()
+
+
+def _parse_entities(raw: Any) -> Dict[str, Any]:
+    raw = raw if isinstance(raw, dict) else {}
+    tickers = [
+        str(ticker).upper()
+        for ticker in raw.get("tickers") or []
+        if _TICKER_RE.match(str(ticker).upper())
+    ]
+    dates = [str(date) for date in raw.get("dates") or [] if _DATE_RE.match(str(date))]
+    year = str(raw["year"]) if re.fullmatch(r"\d{4}", str(raw.get("year"))) else None
+    quarter = raw.get("quarter")
+    quarter = int(quarter) if str(quarter) in ("1", "2", "3", "4") else None
+    return {"tickers": tickers, "dates": dates, "year": year, "quarter": quarter}
+
+
+def parse_understanding(text: str, prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse JSON của LLM thành understanding (xem docstring module).
+
+    Cờ độ phức tạp của LLM được cộng thêm vào cờ regex; needs_chart giữ theo
+    regex (chỉ vẽ khi câu hỏi có "plot"/"vẽ" hoặc force_chart).
+
+    Raises:
+        ValueError: response không phải JSON object
+    """
+    data = json.loads(_strip_code_fence(text))
+    if not isinstance(data, dict):
+        raise ValueError("Understanding response is not a JSON object")
+
+    complexity = dict(prepared["complexity"])
+    llm_flags = data.get("complexity") if isinstance(data.get("complexity"), dict) else {}
+    for flag in COMPLEXITY_FLAGS:
+        complexity[flag] = bool(complexity[flag] or llm_flags.get(flag))
+    if complexity["needs_chart"] and data.get("chart_type") in CHART_TYPES:
+        complexity["chart_type"] = data["chart_type"]
+
+    template_sql = prepared["template_sql"]
+    if template_sql is None and prepared["candidates"]:
+        index = data.get("template")
+        if isinstance(index, int) and 1 <= index <= len(prepared["candidates"]):
+            template_sql = prepared["candidates"][index - 1]
+
+    steps = data.get("steps")
+    return {
+        "source": "llm",
+        "route": "OTHER" if str(data.get("route", "SQL")).upper().startswith("OTHER") else "SQL",
+        "complexity": complexity,
+        "chart_type": complexity.get("chart_type"),
+        "entities": _parse_entities(data.get("entities")),
+        "steps": [step for step in steps if isinstance(step, dict)]
+        if isinstance(steps, list)
+        else [],
+        "template_checked": prepared["needs_template"],
+        "template_sql": template_sql,
+    }
+
+
+def understand_question(question: str, prepared: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Gọi LLM một lần để phân tích câu hỏi. None nếu LLM lỗi hoặc response không hợp lệ."""
+    try:
+        text = generate_text(_build_understanding_prompt(question, prepared))
+        return parse_understanding(text, prepared)
+    except Exception as e:
+        print(f"Error in understand_question: {e}")
+        return None
+
+
+async def aunderstand_question(
+    question: str, prepared: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Phiên bản async của understand_question."""
+    try:
+        text = await agenerate_text(_build_understanding_prompt(question, prepared))
+        return parse_understanding(text, prepared)
+    except Exception as e:
+        print(f"Error in aunderstand_question: {e}")
+        return None
@@ -1,7 +1,13 @@
+import csv
 import re
 from typing import Dict, Any, Optional, Tuple, List
-import pandas as pd
-from config import SQL_SAMPLES_FILE, DJIA_COMPANIES_CSV
+from config import (
+    SQL_SAMPLES_FILE,
+    DJIA_COMPANIES_CSV,
+    COMPANY_FUZZY_MATCHING,
+    COMPANY_FUZZY_THRESHOLD,
+)
+from nodes.company_matcher import CompanyMatch, CompanyMatcher, FuzzyCompanyIndex
 
 COMPANY_ALIASES: Dict[str, str] = {}
 
@@ -19,8 +25,10 @@ def load_company_aliases() -> Dict[str, str]:
     aliases: Dict[str, str] = {}
     try:
         if DJIA_COMPANIES_CSV.exists():
-            df = pd.read_csv(DJIA_COMPANIES_CSV)
-            for _, row in df.iterrows():
+            # csv.DictReader: chỉ cần hai cột, không cần pandas lúc import
+            with open(DJIA_COMPANIES_CSV, newline="", encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            for row in rows:
                 symbol = str(row.get("symbol") or row.get("Symbol") or "").strip()
                 name = str(row.get("name") or row.get("Name") or "").strip()
                 if not symbol:
@@ -93,323 +101,302 @@ def normalize_text(text: str) -> str:
     return normalized
 
 
-def extract_ticker(question: str) -> Optional[str]:
-    q = normalize_text(question)
-
-    # Bỏ qua các từ không phải ticker
-    ignore_words = {
-        "djia",
-        "plot",
-        "pie",
-        "bar",
-        "scatter",
-        "heatmap",
-        "chart",
-        "graph",
-    }
-    if any(word in q for word in ignore_words):
-        # Nếu có từ "all companies", "each company", "all DJIA" thì không extract ticker
-        if any(
-            phrase in q
-            for phrase in [
-                "all companies",
-                "each company",
-                "all djia",
-                "each djia company",
-                "tất cả công ty",
-                "mỗi công ty",
-            ]
-        ):
-            return None
-
-    # Tìm ticker từ alias trước (ưu tiên hơn)
-    for name, ticker in COMPANY_ALIASES.items():
-        # Normalize dấu nháy đơn trong alias để match với câu hỏi đã normalize
-        # (câu hỏi đã được normalize với straight quote U+0027)
-        # Thay thế tất cả các loại dấu nháy đơn (curly U+2019, straight U+0027) bằng straight quote
-        normalized_alias = name
-        # Unicode normalize: thay curly quotes bằng straight quote
-        normalized_alias = normalized_alias.replace(
-            "\u2019", "'"
-        )  # Right single quotation mark
-        normalized_alias = normalized_alias.replace(
-            "\u2018", "'"
-        )  # Left single quotation mark
-        normalized_alias = normalized_alias.replace(
-            "\u201B", "'"
-        )  # Single high-reversed-9 quotation mark
-        # Escape tên
-        escaped_name = re.escape(normalized_alias)
-        # Pattern: word boundary trước (hoặc không có ký tự word), tên, word boundary sau (hoặc không có ký tự word)
-        # Sử dụng negative lookbehind/lookahead để tránh match partial words
-        pattern = r"(?<!\w)" + escaped_name + r"(?!\w)"
-        if re.search(pattern, q, re.IGNORECASE):
-            return ticker
-
-    # Tìm ticker từ pattern (chỉ khi không có từ ignore)
-    m = re.search(r"\b([A-Z]{2,5})\b", question)
+# Ký tự đặc trưng tiếng Việt (dùng để chọn ngôn ngữ trả lời)
+VIETNAMESE_CHARS = ['à', 'á', 'ả', 'ã', 'ạ', 'ă', 'ắ', 'ằ', 'ẳ', 'ẵ', 'ặ',
+                    'â', 'ấ', 'ầ', 'ẩ', 'ẫ', 'ậ', 'è', 'é', 'ẻ', 'ẽ', 'ẹ',
+                    'ê', 'ế', 'ề', 'ể', 'ễ', 'ệ', 'ì', 'í', 'ỉ', 'ĩ', 'ị',
+                    'ò', 'ó', 'ỏ', 'õ', 'ọ', 'ô', 'ố', 'ồ', 'ổ', 'ỗ', 'ộ',
+                    'ơ', 'ớ', 'ờ', 'ở', 'ỡ', 'ợ', 'ù', 'ú', 'ủ', 'ũ', 'ụ',
+                    'ư', 'ứ', 'ừ', 'ử', 'ữ', 'ự', 'ỳ', 'ý', 'ỷ', 'ỹ', 'ỵ', 'đ']
+
+
+def is_vietnamese(question: str) -> bool:
+    return any(char in question.lower() for char in VIETNAMESE_CHARS)
+
+
+# ==================== TRÍCH XUẤT ENTITY ====================
+# Các pattern được compile một lần khi import. Mỗi hàm extract_* có một bản
+# _*_in() nhận câu hỏi đã normalize_text, để nodes.entities.extract_entities
+# chỉ normalize câu hỏi một lần cho mọi entity.
+
+# Từ không phải ticker
+_TICKER_IGNORE_WORDS = {
+    "djia",
+    "plot",
+    "pie",
+    "bar",
+    "scatter",
+    "heatmap",
+    "chart",
+    "graph",
+}
+_ALL_COMPANIES_PHRASES = [
+    "all companies",
+    "each company",
+    "all djia",
+    "each djia company",
+    "tất cả công ty",
+    "mỗi công ty",
+]
+_UPPER_TICKER_RE = re.compile(r"\b([A-Z]{2,5})\b")
+
+
+# Automaton của mọi alias và fuzzy index cho tên viết sai
+# (nodes/company_matcher.py), build một lần khi import
+COMPANY_MATCHER = CompanyMatcher(COMPANY_ALIASES)
+COMPANY_FUZZY_INDEX = FuzzyCompanyIndex(COMPANY_ALIASES)
+
+
+def find_companies(q: str) -> List[CompanyMatch]:
+    """
+    Các công ty được nhắc tới trong câu hỏi đã normalize_text, theo thứ tự
+    xuất hiện: match chính xác của automaton, cộng tên viết sai tìm được bằng
+    fuzzy index ở phần còn lại của câu hỏi.
+    """
+    matches = COMPANY_MATCHER.find_all(q)
+    if COMPANY_FUZZY_MATCHING:
+        matches += COMPANY_FUZZY_INDEX.find_all(
+            q,
+            COMPANY_FUZZY_THRESHOLD,
+            exclude=[(match.start, match.end) for match in matches],
+        )
+        matches.sort()
+    return matches
+
+
+def _is_all_companies(q: str) -> bool:
+    # Câu hỏi về tất cả công ty ("all companies", "each DJIA company"...)
+    return any(word in q for word in _TICKER_IGNORE_WORDS) and any(
+        phrase in q for phrase in _ALL_COMPANIES_PHRASES
+    )
+
+
+def _tickers_in(q: str) -> List[str]:
+    """Mọi ticker được nhắc tới (theo alias) trong câu hỏi đã normalize_text."""
+    if _is_all_companies(q):
+        return []
+    return list(dict.fromkeys(match.ticker for match in find_companies(q)))
+
+
+def _ticker_in(question: str, q: str, tickers: Optional[List[str]] = None) -> Optional[str]:
+    if _is_all_companies(q):
+        return None
+
+    # Tìm ticker từ alias trước (ưu tiên hơn): công ty được nhắc tới đầu tiên
+    tickers = _tickers_in(q) if tickers is None else tickers
+    if tickers:
+        return tickers[0]
+
+    # Tìm ticker từ pattern chữ in hoa trong câu hỏi gốc
+    m = _UPPER_TICKER_RE.search(question)
     if m:
         ticker_candidate = m.group(1)
         # Bỏ qua nếu là từ ignore
-        if ticker_candidate.lower() not in ignore_words:
+        if ticker_candidate.lower() not in _TICKER_IGNORE_WORDS:
             return ticker_candidate
 
     return None
 
 
+def extract_ticker(question: str) -> Optional[str]:
+    return _ticker_in(question, normalize_text(question))
+
+
+_MONTHS = {
+    "january": "01",
+    "february": "02",
+    "march": "03",
+    "april": "04",
+    "may": "05",
+    "june": "06",
+    "july": "07",
+    "august": "08",
+    "september": "09",
+    "october": "10",
+    "november": "11",
+    "december": "12",
+}
+_MONTH_NAMES = "|".join(_MONTHS)
+_MONTH_DAY_YEAR_RE = re.compile(rf"({_MONTH_NAMES})\s+(\d{{1,2}}),\s*(\d{{4}})", re.I)
+_MONTH_YEAR_RE = re.compile(rf"({_MONTH_NAMES})\s+(\d{{4}})", re.I)
+_ISO_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+_DMY_DATE_RE = re.compile(r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})")
+_YEAR_RE = re.compile(r"(20\d{2})")
+
+
 def extract_date_parts(question: str) -> Dict[str, str]:
     q = question
-    months = {
-        "january": "01",
-        "february": "02",
-        "march": "03",
-        "april": "04",
-        "may": "05",
-        "june": "06",
-        "july": "07",
-        "august": "08",
-        "september": "09",
-        "october": "10",
-        "november": "11",
-        "december": "12",
-    }
-    m = re.search(
-        r"(january|february|march|april|may|june|july|august|september|october|november|december)\s+(\d{1,2}),\s*(\d{4})",
-        q,
-        re.I,
-    )
+    m = _MONTH_DAY_YEAR_RE.search(q)
     if m:
-        month = months[m.group(1).lower()]
+        month = _MONTHS[m.group(1).lower()]
         day = f"{int(m.group(2)):02d}"
         year = m.group(3)
         return {"date": f"{year}-{month}-{day}", "year": year, "month": month}
     # Thêm pattern cho "March 2025" (tháng + năm)
-    m = re.search(
-        r"(january|february|march|april|may|june|july|august|september|october|november|december)\s+(\d{4})",
-        q,
-        re.I,
-    )
+    m = _MONTH_YEAR_RE.search(q)
     if m:
-        month = months[m.group(1).lower()]
+        month = _MONTHS[m.group(1).lower()]
         year = m.group(2)
         return {"year": year, "month": month}
-    m = re.search(r"(\d{4})-(\d{2})-(\d{2})", q)
+    m = _ISO_DATE_RE.search(q)
     if m:
         return {
             "date": f"{m.group(1)}-{m.group(2)}-{m.group(3)}",
             "year": m.group(1),
             "month": m.group(2),
         }
-    m = re.search(r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})", q)
+    m = _DMY_DATE_RE.search(q)
     if m:
         day = f"{int(m.group(1)):02d}"
         month = f"{int(m.group(2)):02d}"
         year = m.group(3)
         return {"date": f"{year}-{month}-{day}", "year": year, "month": month}
-    m = re.search(r"(20\d{2})", q)
+    m = _YEAR_RE.search(q)
     if m:
         return {"year": m.group(1)}
     return {}
 
 
+# Tên tháng viết tắt (3 ký tự đầu) -> số tháng
+_MONTH_ABBREVIATIONS = {name[:3]: number for name, number in _MONTHS.items()}
+_MONTH_REGEX = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
+# Pattern: "Month Day to Month Day, Year"
+_MONTH_DAY_SPAN_RE = re.compile(
+    rf"{_MONTH_REGEX}\s+(\d{{1,2}})\s+(?:to|-)\s+{_MONTH_REGEX}\s+(\d{{1,2}}),\s*(\d{{4}})",
+    re.IGNORECASE,
+)
+_RANGE_DATE_RES = [
+    re.compile(r"(\d{4})-(\d{2})-(\d{2})", re.IGNORECASE),
+    re.compile(r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})", re.IGNORECASE),
+    re.compile(rf"{_MONTH_REGEX}\s+(\d{{1,2}}),\s*(\d{{4}})", re.IGNORECASE),
+]
+
+
 def extract_date_range(question: str) -> Tuple[Optional[str], Optional[str]]:
     q = question
-    month_map = {
-        "jan": "01",
-        "january": "01",
-        "feb": "02",
-        "february": "02",
-        "mar": "03",
-        "march": "03",
-        "apr": "04",
-        "april": "04",
-        "may": "05",
-        "jun": "06",
-        "june": "06",
-        "jul": "07",
-        "july": "07",
-        "aug": "08",
-        "august": "08",
-        "sep": "09",
-        "sept": "09",
-        "september": "09",
-        "oct": "10",
-        "october": "10",
-        "nov": "11",
-        "november": "11",
-        "dec": "12",
-        "december": "12",
-    }
-    month_regex = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
-    # Pattern: "Month Day to Month Day, Year"
-    m = re.search(
-        rf"{month_regex}\s+(\d{{1,2}})\s+(?:to|-)\s+{month_regex}\s+(\d{{1,2}}),\s*(\d{{4}})",
-        q,
-        re.IGNORECASE,
-    )
+    m = _MONTH_DAY_SPAN_RE.search(q)
     if m:
-        start_month = month_map[m.group(1).lower()[:3]]
+        start_month = _MONTH_ABBREVIATIONS[m.group(1).lower()[:3]]
         start_day = f"{int(m.group(2)):02d}"
-        end_month = month_map[m.group(3).lower()[:3]]
+        end_month = _MONTH_ABBREVIATIONS[m.group(3).lower()[:3]]
         end_day = f"{int(m.group(4)):02d}"
         year = m.group(5)
         return (
             f"{year}-{start_month}-{start_day}",
             f"{year}-{end_month}-{end_day}",
         )
-    patterns = [
-        r"(\d{4})-(\d{2})-(\d{2})",
-        r"(\d{1,2})[/-](\d{1,2})[/-](\d{4})",
-        rf"{month_regex}\s+(\d{{1,2}}),\s*(\d{{4}})",
-    ]
+    iso_re, dmy_re, month_day_re = _RANGE_DATE_RES
     found: List[str] = []
-    for pat in patterns:
-        for m in re.finditer(pat, q, re.IGNORECASE):
-            if pat == patterns[0]:
-                found.append(f"{m.group(1)}-{m.group(2)}-{m.group(3)}")
-            elif pat == patterns[1]:
-                day = f"{int(m.group(1)):02d}"
-                month = f"{int(m.group(2)):02d}"
-                year = m.group(3)
-                found.append(f"{year}-{month}-{day}")
-            else:
-                month = month_map.get(m.group(1).lower()[:3])
-                day = f"{int(m.group(2)):02d}"
-                year = m.group(3)
-                if month:
-                    found.append(f"{year}-{month}-{day}")
+    for m in iso_re.finditer(q):
+        found.append(f"{m.group(1)}-{m.group(2)}-{m.group(3)}")
+    for m in dmy_re.finditer(q):
+        day = f"{int(m.group(1)):02d}"
+        month = f"{int(m.group(2)):02d}"
+        year = m.group(3)
+        found.append(f"{year}-{month}-{day}")
+    for m in month_day_re.finditer(q):
+        month = _MONTH_ABBREVIATIONS.get(m.group(1).lower()[:3])
+        day = f"{int(m.group(2)):02d}"
+        year = m.group(3)
+        if month:
+            found.append(f"{year}-{month}-{day}")
     if len(found) >= 2:
         return found[0], found[1]
     return None, None
 
 
-def extract_quarter(question: str) -> Optional[int]:
-    q = normalize_text(question)
-    m = re.search(r"\bq([1-4])\b", q)
+_QUARTER_WORDS = {
+    "first": 1,
+    "1st": 1,
+    "one": 1,
+    "second": 2,
+    "2nd": 2,
+    "two": 2,
+    "third": 3,
+    "3rd": 3,
+    "three": 3,
+    "fourth": 4,
+    "4th": 4,
+    "four": 4,
+}
+_QUARTER_Q_RE = re.compile(r"\bq([1-4])\b")
+_QUARTER_NUMBER_RE = re.compile(r"\b(quarter|qu(?:ý|y))\s*([1-4])\b")
+_QUARTER_WORD_AFTER_RE = re.compile(
+    r"\bquarter\s+(first|second|third|fourth|1st|2nd|3rd|4th|one|two|three|four)\b"
+)
+_QUARTER_WORD_BEFORE_RE = re.compile(
+    r"\b(first|second|third|fourth|1st|2nd|3rd|4th|one|two|three|four)\s+quarter\b"
+)
+_QUARTER_ROMAN_RE = re.compile(r"\bqu(?:ý|y)\s*(i{1,3}|iv)\b")
+_ROMAN_QUARTERS = {"i": 1, "ii": 2, "iii": 3, "iv": 4}
+_NON_LETTERS_RE = re.compile(r"[^a-z]+")
+# Tháng thuộc từng quý (câu hỏi nhắc tên tháng thì suy ra quý)
+_QUARTER_MONTHS = [
+    (1, {"jan", "january", "feb", "february", "mar", "march"}),
+    (2, {"apr", "april", "may", "jun", "june"}),
+    (3, {"jul", "july", "aug", "august", "sep", "september"}),
+    (4, {"oct", "october", "nov", "november", "dec", "december"}),
+]
+
+
+def _quarter_in(q: str) -> Optional[int]:
+    m = _QUARTER_Q_RE.search(q)
     if m:
         return int(m.group(1))
-    m = re.search(r"\b(quarter|qu(?:ý|y))\s*([1-4])\b", q)
+    m = _QUARTER_NUMBER_RE.search(q)
     if m:
         return int(m.group(2))
-    word_to_num = {
-        "first": 1,
-        "1st": 1,
-        "one": 1,
-        "second": 2,
-        "2nd": 2,
-        "two": 2,
-        "third": 3,
-        "3rd": 3,
-        "three": 3,
-        "fourth": 4,
-        "4th": 4,
-        "four": 4,
-        "thu nhat": 1,
-        "thứ nhất": 1,
-        "dau tien": 1,
-        "đầu tiên": 1,
-        "thu hai": 2,
-        "thứ hai": 2,
-        "thu ba": 3,
-        "thứ ba": 3,
-        "thu tu": 4,
-        "thứ tư": 4,
-    }
-    m = re.search(
-        r"\bquarter\s+(first|second|third|fourth|1st|2nd|3rd|4th|one|two|three|four)\b",
-        q,
-    )
+    m = _QUARTER_WORD_AFTER_RE.search(q)
     if m:
-        return word_to_num.get(m.group(1), None)
-    m = re.search(
-        r"\b(first|second|third|fourth|1st|2nd|3rd|4th|one|two|three|four)\s+quarter\b",
-        q,
-    )
+        return _QUARTER_WORDS.get(m.group(1), None)
+    m = _QUARTER_WORD_BEFORE_RE.search(q)
     if m:
-        return word_to_num.get(m.group(1), None)
-    m = re.search(r"\bqu(?:ý|y)\s*(i{1,3}|iv)\b", q)
+        return _QUARTER_WORDS.get(m.group(1), None)
+    m = _QUARTER_ROMAN_RE.search(q)
     if m:
-        roman = m.group(1)
-        roman_map = {"i": 1, "ii": 2, "iii": 3, "iv": 4}
-        return roman_map.get(roman, None)
-    q_simple = q.replace("–", "-")
-    tokens = re.split(r"[^a-z]+", q_simple)
-    tokens = [t for t in tokens if t]
-    has = set(tokens)
-    q1 = {"jan", "january", "feb", "february", "mar", "march"}
-    q2 = {"apr", "april", "may", "jun", "june"}
-    q3 = {"jul", "july", "aug", "august", "sep", "september"}
-    q4 = {"oct", "october", "nov", "november", "dec", "december"}
-    if has & q1:
-        return 1
-    if has & q2:
-        return 2
-    if has & q3:
-        return 3
-    if has & q4:
-        return 4
+        return _ROMAN_QUARTERS.get(m.group(1), None)
+    tokens = _NON_LETTERS_RE.split(q.replace("–", "-"))
+    has = {t for t in tokens if t}
+    for quarter, months in _QUARTER_MONTHS:
+        if has & months:
+            return quarter
     return None
 
 
-def extract_month_range(question: str) -> Tuple[Optional[str], Optional[str]]:
-    q = normalize_text(question)
-    month_map = {
-        "jan": "01",
-        "january": "01",
-        "thang 1": "01",
-        "feb": "02",
-        "february": "02",
-        "thang 2": "02",
-        "mar": "03",
-        "march": "03",
-        "thang 3": "03",
-        "apr": "04",
-        "april": "04",
-        "thang 4": "04",
-        "may": "05",
-        "thang 5": "05",
-        "jun": "06",
-        "june": "06",
-        "thang 6": "06",
-        "jul": "07",
-        "july": "07",
-        "thang 7": "07",
-        "aug": "08",
-        "august": "08",
-        "thang 8": "08",
-        "sep": "09",
-        "september": "09",
-        "thang 9": "09",
-        "oct": "10",
-        "october": "10",
-        "thang 10": "10",
-        "nov": "11",
-        "november": "11",
-        "thang 11": "11",
-        "dec": "12",
-        "december": "12",
-        "thang 12": "12",
-    }
+def extract_quarter(question: str) -> Optional[int]:
+    return _quarter_in(normalize_text(question))
+
+
+_MONTH_RANGE_NAMES = {
+    **_MONTH_ABBREVIATIONS,
+    **_MONTHS,
+    **{f"thang {number}": f"{number:02d}" for number in range(1, 13)},
+}
+_MONTH_RANGE_RES = [
+    re.compile(r"from\s+([a-z]+)\s+(?:to|through)\s+([a-z]+)(?:\s+\d{4})?"),
+    re.compile(r"\b([a-z]+)\s*-\s*([a-z]+)\b"),
+    re.compile(r"thang\s+([0-9]{1,2})\s+(?:den|đến)\s+thang\s+([0-9]{1,2})"),
+]
+
+
+def _month_number(token: str) -> Optional[str]:
+    if token.isalpha():
+        return _MONTH_RANGE_NAMES.get(token, _MONTH_RANGE_NAMES.get(token[:3], None))
+    return f"{int(token):02d}" if token.isdigit() else None
+
+
+def _month_range_in(q: str) -> Tuple[Optional[str], Optional[str]]:
     q2 = q.replace("–", "-").replace("—", "-")
-    patterns = [
-        r"from\s+([a-z]+)\s+(?:to|through)\s+([a-z]+)(?:\s+\d{4})?",
-        r"\b([a-z]+)\s*-\s*([a-z]+)\b",
-        r"thang\s+([0-9]{1,2})\s+(?:den|đến)\s+thang\s+([0-9]{1,2})",
-    ]
-    for pat in patterns:
-        m = re.search(pat, q2)
+    for pattern in _MONTH_RANGE_RES:
+        m = pattern.search(q2)
         if not m:
             continue
-        a = m.group(1)
-        b = m.group(2)
-        if a.isalpha():
-            a_norm = month_map.get(a, month_map.get(a[:3], None))
-        else:
-            a_norm = f"{int(a):02d}" if a.isdigit() else None
-        if b.isalpha():
-            b_norm = month_map.get(b, month_map.get(b[:3], None))
-        else:
-            b_norm = f"{int(b):02d}" if b.isdigit() else None
+        a_norm = _month_number(m.group(1))
+        b_norm = _month_number(m.group(2))
         if a_norm and b_norm:
             return a_norm, b_norm
     return None, None
+
+
+def extract_month_range(question: str) -> Tuple[Optional[str], Optional[str]]:
+    return _month_range_in(normalize_text(question))
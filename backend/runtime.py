@@ -0,0 +1,404 @@
+"""
+Agent Runtime - Tài nguyên dùng chung cho toàn bộ process.
+
+Module này giữ các đối tượng "nặng" của hệ thống multi-agent để mọi request
+dùng lại thay vì khởi tạo lại ở mỗi lần gọi:
+- LangGraph workflow đã compile (bản sync cho invoke, bản async cho ainvoke)
+- SQLAlchemy engine kết nối PostgreSQL (sync + AsyncEngine theo event loop),
+  cùng cấu hình connection pool trong db/engine.py
+- ChromaDB client + embedding function (RAG)
+- Template registry (SQL samples đã parse, tự reload khi file đổi) + vector
+  index câu hỏi mẫu (tìm template không cần LLM)
+- Question type model: phân loại SQL/OTHER không cần LLM (fast classifier)
+- Answer cache: kết quả workflow theo câu hỏi + data version
+- SQL shape cache: SQL do LLM sinh theo dạng câu hỏi (bỏ qua LLM cho câu hỏi
+  cùng dạng, khác công ty/ngày)
+- LLM cache: response Gemini memoize trên đĩa, dùng chung giữa các worker
+
+Runtime được warm khi Django khởi động (xem api.apps.ApiConfig.ready) và
+trạng thái được báo qua endpoint /api/health/ready/. Bước warm-up lỗi (DB,
+embedding model chưa sẵn sàng) được thử lại trong background với backoff;
+tài nguyên chỉ phục vụ RAG (ChromaDB, index tài liệu) không chặn readiness.
+
+Usage:
+    from runtime import get_runtime
+    app = get_runtime().graph
+    engine = get_runtime().engine
+"""
+
+import asyncio
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+
+from config import RUNTIME_WARMUP_RETRY_SECONDS, RUNTIME_WARMUP_RETRY_MAX_SECONDS
+from db.engine import create_pooled_engine, create_pooled_async_engine, pool_status
+
+# Sentinel để phân biệt "chưa khởi tạo" với "khởi tạo trả về None"
+# (ví dụ ChromaDB chưa được cài thì factory trả về None, không nên thử lại mỗi request)
+_UNSET = object()
+
+# Bước warm-up chỉ phục vụ RAG: lỗi không làm runtime not ready (đường SQL vẫn chạy)
+_OPTIONAL_WARM_STEPS = ("chroma_client", "documents")
+
+
+class AgentRuntime:
+    """
+    Giữ các tài nguyên dùng chung, khởi tạo lazy và thread-safe.
+
+    Mỗi tài nguyên chỉ được build một lần cho cả process. Gọi warm() để build
+    toàn bộ trước khi nhận request đầu tiên.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._graph = _UNSET
+        self._async_graph = _UNSET
+        self._engine = _UNSET
+        # AsyncEngine gắn với event loop tạo ra connection, nên giữ một engine
+        # cho mỗi loop (tự bị bỏ khi loop bị thu hồi)
+        self._async_engines = weakref.WeakKeyDictionary()
+        self._chroma_client = _UNSET
+        self._embedding_function = _UNSET
+        self._template_registry = _UNSET
+        # (tuple templates đã dùng để build, TemplateIndex) - build lại khi registry reload
+        self._template_index = _UNSET
+        self._question_type_model = _UNSET
+        self._answer_cache = _UNSET
+        self._sql_shape_cache = _UNSET
+        self._llm_cache = _UNSET
+        self._documents_indexed = False
+
+        # Trạng thái warm-up (cho readiness endpoint)
+        self._ready = False
+        self._warming = False
+        self._warm_error: Optional[str] = None
+        self._warmed_at: Optional[float] = None
+        self._warmup_timings: Dict[str, float] = {}
+        # Bước đã warm xong (không chạy lại) / bước lỗi ở lần warm gần nhất
+        self._warmed_steps: set = set()
+        self._failed_steps: Dict[str, str] = {}
+        self._warm_lock = threading.Lock()
+        self._warm_thread: Optional[threading.Thread] = None
+
+    # ==================== TÀI NGUYÊN ====================
+
+    def _get_or_build(self, attr: str, factory):
+        value = getattr(self, attr)
+        if value is not _UNSET:
+            return value
+        with self._lock:
+            value = getattr(self, attr)
+            if value is _UNSET:
+                value = factory()
+                setattr(self, attr, value)
+            return value
+
+    @property
+    def graph(self):
+        """LangGraph workflow đã compile (dùng cho invoke)."""
+
+        def _build():
+            from graphs.djia_graph import build_djia_graph
+
+            return build_djia_graph()
+
+        return self._get_or_build("_graph", _build)
+
+    @property
+    def async_graph(self):
+        """LangGraph workflow đã compile với các node async (dùng cho ainvoke)."""
+
+        def _build():
+            from graphs.djia_graph import build_djia_graph
+
+            return build_djia_graph(use_async=True)
+
+        return self._get_or_build("_async_graph", _build)
+
+    @property
+    def engine(self):
+        """SQLAlchemy engine dùng chung (giữ connection pool giữa các request)."""
+        return self._get_or_build("_engine", create_pooled_engine)
+
+    @property
+    def async_engine(self):
+        """
+        SQLAlchemy AsyncEngine (psycopg 3) cho event loop đang chạy.
+
+        Phải gọi từ trong coroutine. Connection pool của AsyncEngine không
+        dùng chung được giữa các event loop nên mỗi loop có engine riêng.
+        """
+        loop = asyncio.get_running_loop()
+        engine = self._async_engines.get(loop)
+        if engine is None:
+            with self._lock:
+                engine = self._async_engines.get(loop)
+                if engine is None:
+                    engine = create_pooled_async_engine()
+                    self._async_engines[loop] = engine
+        return engine
+
+    @property
+    def chroma_client(self):
+        """ChromaDB PersistentClient (None nếu chưa cài chromadb)."""
+
+        def _build():
+            from nodes.rag_retriever import get_chroma_client
+
+            return get_chroma_client()
+
+        return self._get_or_build("_chroma_client", _build)
+
+    @property
+    def embedding_function(self):
+        """Embedding function sentence-transformers (None nếu chưa cài)."""
+
+        def _build():
+            from nodes.rag_retriever import get_embedding_function
+
+            return get_embedding_function()
+
+        return self._get_or_build("_embedding_function", _build)
+
+    @property
+    def template_registry(self):
+        """TemplateRegistry của SQL_SAMPLES_FILE (parse lại khi mtime thay đổi)."""
+
+        def _build():
+            from config import SQL_SAMPLES_FILE
+            from nodes.template_registry import TemplateRegistry
+
+            return TemplateRegistry(SQL_SAMPLES_FILE)
+
+        return self._get_or_build("_template_registry", _build)
+
+    @property
+    def sql_samples(self) -> List[str]:
+        """Danh sách SQL samples (SQL của từng template trong registry)."""
+        return self.template_registry.sql_samples
+
+    @property
+    def template_index(self):
+        """
+        Vector index các câu hỏi mẫu (None nếu chưa có embedding).
+
+        Build lại khi registry reload (file SQL samples thay đổi).
+        """
+        templates = self.template_registry.templates
+        cached = self._template_index
+        if cached is not _UNSET and cached[0] is templates:
+            return cached[1]
+        with self._lock:
+            cached = self._template_index
+            if cached is _UNSET or cached[0] is not templates:
+                from nodes.template_index import build_template_index
+
+                cached = (
+                    templates,
+                    build_template_index(templates, self.embedding_function),
+                )
+                self._template_index = cached
+            return cached[1]
+
+    @property
+    def question_type_model(self):
+        """Embedding model phân loại SQL/OTHER (None nếu chưa có embedding)."""
+
+        def _build():
+            from nodes.fast_classifier import build_question_type_model
+
+            return build_question_type_model(
+                self.template_registry.templates, self.embedding_function
+            )
+
+        return self._get_or_build("_question_type_model", _build)
+
+    @property
+    def answer_cache(self):
+        """AnswerCache của workflow (None nếu ANSWER_CACHE_ENABLED tắt)."""
+
+        def _build():
+            from config import (
+                ANSWER_CACHE_ENABLED,
+                ANSWER_CACHE_MAX_ENTRIES,
+                ANSWER_CACHE_TTL,
+                DATA_VERSION_CHECK_INTERVAL,
+            )
+            from db.data_version import read_data_version
+            from graphs.answer_cache import AnswerCache
+
+            if not ANSWER_CACHE_ENABLED:
+                return None
+            return AnswerCache(
+                lambda: read_data_version(self.engine),
+                max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                ttl_seconds=ANSWER_CACHE_TTL,
+                version_check_interval=DATA_VERSION_CHECK_INTERVAL,
+            )
+
+        return self._get_or_build("_answer_cache", _build)
+
+    @property
+    def sql_shape_cache(self):
+        """SqlShapeCache của SQL do LLM sinh (None nếu SQL_SHAPE_CACHE_ENABLED tắt)."""
+
+        def _build():
+            from config import SQL_SHAPE_CACHE_ENABLED, SQL_SHAPE_CACHE_MAX_ENTRIES
+            from nodes.sql_shape_cache import SqlShapeCache
+
+            if not SQL_SHAPE_CACHE_ENABLED:
+                return None
+            return SqlShapeCache(max_entries=SQL_SHAPE_CACHE_MAX_ENTRIES)
+
+        return self._get_or_build("_sql_shape_cache", _build)
+
+    @property
+    def llm_cache(self):
+        """LLMCache trên đĩa (None nếu tắt hoặc chưa cài diskcache)."""
+
+        def _build():
+            from nodes.llm_cache import create_llm_cache
+
+            return create_llm_cache()
+
+        return self._get_or_build("_llm_cache", _build)
+
+    def ensure_documents_indexed(self) -> None:
+        """Index PDF documents vào ChromaDB (chỉ một lần cho cả process)."""
+        if self._documents_indexed:
+            return
+        with self._lock:
+            if self._documents_indexed:
+                return
+            from nodes.rag_retriever import index_documents
+
+            index_documents(force_reindex=False)
+            self._documents_indexed = True
+
+    # ==================== WARM-UP ====================
+
+    def _warm_steps(self):
+        return [
+            ("graph", lambda: self.graph),
+            ("async_graph", lambda: self.async_graph),
+            ("engine", lambda: self.engine),
+            ("llm_cache", lambda: self.llm_cache),
+            ("template_registry", lambda: self.template_registry.templates),
+            ("chroma_client", lambda: self.chroma_client),
+            ("embedding_function", lambda: self.embedding_function),
+            ("template_index", lambda: self.template_index),
+            ("question_type_model", lambda: self.question_type_model),
+            ("documents", self.ensure_documents_indexed),
+        ]
+
+    def warm(self) -> bool:
+        """
+        Build các tài nguyên chưa build được. Trả về True nếu runtime đã sẵn sàng.
+
+        Lỗi của từng tài nguyên được ghi lại vào status() thay vì raise,
+        để server vẫn khởi động được (readiness sẽ báo not ready). Bước đã
+        thành công không chạy lại; bước lỗi được thử lại ở lần gọi sau.
+        Runtime sẵn sàng khi mọi bước không thuộc _OPTIONAL_WARM_STEPS thành công.
+        """
+        with self._warm_lock:
+            with self._lock:
+                self._warming = True
+
+            failed = {}
+            for name, step in self._warm_steps():
+                if name in self._warmed_steps:
+                    continue
+                started = time.perf_counter()
+                try:
+                    step()
+                    self._warmed_steps.add(name)
+                except Exception as e:
+                    failed[name] = str(e)
+                    print(f"Error warming runtime resource '{name}': {e}")
+                self._warmup_timings[name] = round(time.perf_counter() - started, 4)
+
+            with self._lock:
+                self._warming = False
+                self._failed_steps = failed
+                self._warm_error = (
+                    "; ".join(f"{name}: {error}" for name, error in failed.items()) or None
+                )
+                if not self._ready and not set(failed) - set(_OPTIONAL_WARM_STEPS):
+                    self._ready = True
+                    self._warmed_at = time.time()
+                return self._ready
+
+    def _warm_with_retry(self) -> None:
+        delay = RUNTIME_WARMUP_RETRY_SECONDS
+        while True:
+            self.warm()
+            if not self._failed_steps or delay <= 0:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, RUNTIME_WARMUP_RETRY_MAX_SECONDS)
+
+    def warm_in_background(self) -> threading.Thread:
+        """
+        Chạy warm() trong daemon thread để không chặn quá trình khởi động.
+
+        Bước lỗi được thử lại với backoff (RUNTIME_WARMUP_RETRY_SECONDS, nhân đôi
+        tới RUNTIME_WARMUP_RETRY_MAX_SECONDS) tới khi mọi bước thành công. Gọi
+        lại khi thread đang chạy thì trả về thread đó.
+        """
+        with self._lock:
+            if self._warm_thread is not None and self._warm_thread.is_alive():
+                return self._warm_thread
+            thread = threading.Thread(
+                target=self._warm_with_retry, name="agent-runtime-warmup", daemon=True
+            )
+            self._warm_thread = thread
+        thread.start()
+        return thread
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready
+
+    def status(self) -> Dict[str, Any]:
+        """Trạng thái runtime cho readiness endpoint."""
+        from nodes.fast_classifier import CLASSIFIER_STATS
+        from nodes.llm import LLM_STATS
+
+        return {
+            "ready": self._ready,
+            "warming": self._warming,
+            "error": self._warm_error,
+            # Bước đang chờ thử lại (kể cả bước RAG không chặn readiness)
+            "failed_steps": sorted(self._failed_steps),
+            "retrying": self._warm_thread is not None and self._warm_thread.is_alive(),
+            "warmed_at": self._warmed_at,
+            "warmup_seconds": dict(self._warmup_timings),
+            "db_pool": pool_status(self._engine) if self._engine is not _UNSET else None,
+            "answer_cache": self._answer_cache.stats()
+            if self._answer_cache not in (_UNSET, None)
+            else None,
+            "sql_shape_cache": self._sql_shape_cache.stats()
+            if self._sql_shape_cache not in (_UNSET, None)
+            else None,
+            "llm": LLM_STATS.snapshot(),
+            "classifier": CLASSIFIER_STATS.snapshot(),
+            "llm_cache": self._llm_cache.stats()
+            if self._llm_cache not in (_UNSET, None)
+            else None,
+        }
+
+
+_runtime: Optional[AgentRuntime] = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> AgentRuntime:
+    """Trả về AgentRuntime dùng chung cho toàn bộ process."""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = AgentRuntime()
+    return _runtime
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Script ghi LLM cassette từ các câu hỏi trong test.txt.
+
+Chạy từng câu hỏi qua run_djia_graph với backend "record": mọi lời gọi
+Gemini được thực hiện thật và response được ghi vào cassette (JSONL, theo
+prompt hash). Sau đó có thể benchmark offline với LLM_BACKEND=replay.
+
+Cần GEMINI_API_KEY và PostgreSQL đã import dữ liệu (python db/init_db.py).
+
+Usage:
+    cd backend
+    python scripts/record_llm_cassette.py
+    python scripts/record_llm_cassette.py --cassette data/llm_cassette.jsonl --limit 10
+    python scripts/record_llm_cassette.py --section "TEST CHART"
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path để import nodes
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ghi response Gemini của các câu hỏi test.txt vào LLM cassette"
+    )
+    parser.add_argument("--questions", help="File câu hỏi (mặc định test.txt)")
+    parser.add_argument("--cassette", help="File cassette (mặc định LLM_CASSETTE)")
+    parser.add_argument(
+        "--section", help="Chỉ chạy section này, ví dụ \"TEST SQL TEMPLATE\""
+    )
+    parser.add_argument("--limit", type=int, help="Số câu hỏi tối đa")
+    args = parser.parse_args()
+
+    # Cấu hình phải được đặt trước khi import config:
+    # answer cache phải tắt để mọi câu hỏi thực sự gọi Gemini
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    if args.cassette:
+        os.environ["LLM_CASSETTE"] = str(Path(args.cassette).resolve())
+
+    from config import LLM_CASSETTE, TEST_QUESTIONS_FILE
+    from graphs.djia_graph import run_djia_graph
+    from graphs.question_suite import load_question_suite
+    from nodes.llm import set_backend
+    from nodes.llm_fake import get_cassette
+
+    items = load_question_suite(args.questions or TEST_QUESTIONS_FILE)
+    if args.section:
+        items = [item for item in items if item.section == args.section]
+    if args.limit:
+        items = items[: args.limit]
+
+    set_backend("record")
+    cassette = get_cassette()
+    before = len(cassette)
+    print(f"Ghi {len(items)} câu hỏi vào {LLM_CASSETTE}")
+
+    for item in items:
+        started = time.perf_counter()
+        try:
+            result = run_djia_graph(item.question)
+            status = "OK" if result.get("success") else f"FAIL: {result.get('error')}"
+        except Exception as e:
+            status = f"ERROR: {e}"
+        print(f"[{time.perf_counter() - started:6.2f}s] {item.label}: {status}")
+
+    print(f"Cassette có {len(cassette)} responses (+{len(cassette) - before})")
+
+
+if __name__ == "__main__":
+    main()